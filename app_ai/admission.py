@@ -0,0 +1,193 @@
+# 准入控制与降级：限制同时进行的模型推理和搜索数量，过载时降低搜索精度或直接拒绝请求
+#
+# 每个推理请求 (搜索、单张插入) 先领取一个并发名额：
+#   - 有空闲名额时立即执行；
+#   - 没有空闲名额时排队等待，队列已满、等待超过 HERITAGE_QUEUE_TIMEOUT 或请求截止时间已过时
+#     返回 503 和 Retry-After，而不是让所有请求一起变慢。
+# 领取名额时根据排队情况确定负载等级，搜索按等级降低 nprobe 和 top_k 上限 (见 DEGRADATION)。
+# 每个请求有截止时间 (默认 HERITAGE_REQUEST_DEADLINE 秒，客户端可用 X-Request-Timeout 头缩短)，
+# 各处理阶段之间检查截止时间，超时后不再继续推理和搜索，Milvus 搜索的超时也不超过剩余时间。
+#
+# 配置：HERITAGE_MAX_INFLIGHT 并发名额；HERITAGE_MAX_QUEUE 排队上限；
+#       HERITAGE_QUEUE_TIMEOUT 最长排队时间 (秒)；HERITAGE_REQUEST_DEADLINE 默认截止时间 (秒)。
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+from metrics import LOAD_LEVEL, INFLIGHT, SHED, DEGRADED
+
+# --- 准入控制配置 ---
+MAX_INFLIGHT = int(os.environ.get('HERITAGE_MAX_INFLIGHT', str(max(2, os.cpu_count() or 2))))
+MAX_QUEUE = int(os.environ.get('HERITAGE_MAX_QUEUE', str(MAX_INFLIGHT * 4)))
+QUEUE_TIMEOUT = float(os.environ.get('HERITAGE_QUEUE_TIMEOUT', '2.0'))
+REQUEST_DEADLINE = float(os.environ.get('HERITAGE_REQUEST_DEADLINE', '10.0'))
+
+# --- 负载等级与降级策略 ---
+LEVEL_NORMAL = 0  # 有空闲名额
+LEVEL_BUSY = 1  # 名额已满，有请求排队
+LEVEL_OVERLOADED = 2  # 排队数量超过队列上限的一半
+LEVEL_NAMES = {LEVEL_NORMAL: 'normal', LEVEL_BUSY: 'busy', LEVEL_OVERLOADED: 'overloaded'}
+# 各等级的搜索参数：nprobe 和 top_k 上限
+DEGRADATION = {
+    LEVEL_NORMAL: {'nprobe': 10, 'max_top_k': 50},
+    LEVEL_BUSY: {'nprobe': 6, 'max_top_k': 20},
+    LEVEL_OVERLOADED: {'nprobe': 3, 'max_top_k': 10},
+}
+
+
+class Overloaded(Exception):
+    """请求被拒绝，retry_after 为建议的重试间隔 (秒)"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """请求在截止时间前未能完成"""
+
+
+class Deadline:
+    """请求截止时间"""
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    @property
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def check(self, stage):
+        """截止时间已过时抛出 DeadlineExceeded，在各处理阶段之间调用"""
+        if self.remaining <= 0:
+            raise DeadlineExceeded(f"请求在 {stage} 阶段前已超过截止时间")
+
+
+class Ticket:
+    """一个已领取的并发名额，level 为领取时的负载等级"""
+
+    def __init__(self, level, deadline):
+        self.level = level
+        self.deadline = deadline
+
+    @property
+    def degraded(self):
+        return self.level != LEVEL_NORMAL
+
+    def search_params(self, top_k):
+        """按负载等级返回 (nprobe, top_k)"""
+        policy = DEGRADATION[self.level]
+        return policy['nprobe'], min(top_k, policy['max_top_k'])
+
+
+class AdmissionController:
+    """有界并发 + 有界排队的准入控制器"""
+
+    def __init__(self, max_inflight=MAX_INFLIGHT, max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._service_time = 0.2  # 请求处理时间的指数移动平均 (秒)，用于估算 Retry-After
+        LOAD_LEVEL.set_function(lambda: self.level)
+        INFLIGHT.set_function(lambda: self._active)
+
+    @property
+    def level(self):
+        if self._waiting * 2 > self.max_queue:
+            return LEVEL_OVERLOADED
+        if self._waiting > 0 or self._active >= self.max_inflight:
+            return LEVEL_BUSY
+        return LEVEL_NORMAL
+
+    def retry_after(self):
+        """按当前排队长度和平均处理时间估算的重试间隔 (秒)"""
+        backlog = (self._waiting + 1) / self.max_inflight
+        return max(1, math.ceil(backlog * self._service_time))
+
+    def status(self):
+        with self._cond:
+            return {
+                'level': LEVEL_NAMES[self.level],
+                'active': self._active,
+                'waiting': self._waiting,
+                'max_inflight': self.max_inflight,
+                'max_queue': self.max_queue,
+                'avg_service_seconds': round(self._service_time, 4),
+                'shed': _counter_values(SHED),
+                'degraded': _counter_values(DEGRADED)
+            }
+
+    @contextmanager
+    def admit(self, endpoint, deadline):
+        """
+        领取一个并发名额，退出时归还。
+
+        参数:
+            endpoint (str): 接口名，用于统计。
+            deadline (Deadline): 请求截止时间，排队不会超过截止时间。
+
+        返回:
+            Ticket: 包含负载等级的名额。
+
+        异常:
+            Overloaded: 队列已满或排队超时。
+        """
+        with self._cond:
+            if self._active >= self.max_inflight:
+                if self._waiting >= self.max_queue:
+                    SHED.labels(endpoint, 'queue_full').inc()
+                    raise Overloaded('queue_full', self.retry_after())
+                self._waiting += 1
+                try:
+                    wait_until = time.monotonic() + min(self.queue_timeout, max(deadline.remaining, 0))
+                    while self._active >= self.max_inflight:
+                        remaining = wait_until - time.monotonic()
+                        if remaining <= 0:
+                            SHED.labels(endpoint, 'queue_timeout').inc()
+                            raise Overloaded('queue_timeout', self.retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            # 名额按领取时的排队情况定级 (自己已离开队列)
+            level = self.level if self._waiting > 0 else LEVEL_NORMAL
+            self._active += 1
+        if level != LEVEL_NORMAL:
+            DEGRADED.labels(endpoint, LEVEL_NAMES[level]).inc()
+        started = time.monotonic()
+        try:
+            yield Ticket(level, deadline)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+                self._cond.notify()
+
+
+def _counter_values(counter):
+    """把带标签的计数器整理为 {"标签1/标签2": 次数}"""
+    values = {}
+    for metric in counter.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_total'):
+                values['/'.join(sample.labels.values())] = int(sample.value)
+    return values
+
+
+def request_deadline(headers):
+    """
+    按请求头 X-Request-Timeout (秒) 创建截止时间，不超过默认的 REQUEST_DEADLINE。
+    """
+    seconds = REQUEST_DEADLINE
+    value = headers.get('X-Request-Timeout')
+    if value:
+        try:
+            seconds = min(seconds, max(float(value), 0.0))
+        except ValueError:
+            pass
+    return Deadline(seconds)
@@ -1,91 +1,277 @@
 import os
+import re
+import json
 import shutil
-from flask import Flask, request, render_template, redirect, url_for, flash, jsonify, current_app
+import atexit
+import tempfile
+import zipfile
+import time
+import uuid
+from flask import (Flask, request, render_template, redirect, url_for, flash, jsonify, current_app, g, Response,
+                   send_from_directory, stream_with_context)
 from werkzeug.utils import secure_filename
-from pymilvus import connections, Collection, utility, FieldSchema, CollectionSchema, DataType
-from resnet import extract_features
-from search_images import search_similar_vectors, collection_name
-from insert_images import insert_vectors
+import threading
+from milvus_client import get_collection, get_pool
+from embedding_models import load_model, resolve_serving, DEFAULT_MODEL_VERSION
+from search_images import search_similar_vectors, collection_name, DEFAULT_NPROBE
+from insert_images import (insert_vectors, calculate_image_hash, is_image_exists, insert_image_batch,
+                           release_unused)
+from insert_buffer import InsertBuffer, DEFAULT_SPOOL_DIR
+from sharding import SHARDS, get_sharded_collection
+from ingest_queue import IngestQueue, IngestWorker
+from ingest_watcher import DirectoryWatcher, ingest_files, parse_watch_dirs, WATCH_DIRS, KEEP_SOURCE
 from delete_utils import delete_images_from_milvus_and_fs
+from image_metadata import build_metadata, build_filter_expr, filters_from_request
+from image_catalog import get_catalog, remember_alias, SORT_FIELDS
+from embedding_cache import extract_features_cached
+import near_duplicates
+import reconcile
+import cascade
+import clip_search
+import model_export
+import image_store
+from partition_tiering import get_tiering
+from admission import AdmissionController, Overloaded, DeadlineExceeded, request_deadline
 from flask_cors import CORS
+import metrics
+import profiling
+from metrics import (stage_timer, ENDPOINT_ERRORS, DEDUP_SKIPPED, REQUEST_LATENCY, FIRST_RESULT_LATENCY,
+                     STAGE_UPLOAD_RECEIVE, STAGE_RESPONSE_RENDER)
 
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(APP_ROOT, 'static', 'uploads')
+# 异步入库任务的临时文件目录，任务处理完成前文件保存在这里
+JOB_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, 'jobs')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 CORS(app)
+# 按环境变量开启的请求剖析，未开启时不注册任何钩子
+profiling.init_app(app)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 app.config['APP_ROOT'] = APP_ROOT
 app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXTENSIONS
+# 批量上传接口的请求体上限，以及 zip 包解压后的总大小上限
+app.config['MAX_BULK_CONTENT_LENGTH'] = 512 * 1024 * 1024
+app.config['MAX_BULK_UNCOMPRESSED_LENGTH'] = 1024 * 1024 * 1024
+# 视频片段搜索接口的请求体上限 (查询视频或帧图片)
+app.config['MAX_CLIP_CONTENT_LENGTH'] = 128 * 1024 * 1024
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(JOB_UPLOAD_FOLDER, exist_ok=True)
 
-# --- Milvus 集合 Schema 定义 ---
-# 定义集合中每个字段的模式
-fields = [
-    # 主键字段：INT64 类型，自动生成 ID
-    FieldSchema(name="id", dtype=DataType.INT64, is_primary=True,
-                auto_id=True),
-    # 嵌入向量字段：FLOAT_VECTOR 类型，维度为 512 (由 ResNet18 模型决定)
-    FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=512),
-    # 图像文件名字段：VARCHAR 类型，最大长度 255
-    FieldSchema(name="image_filename", dtype=DataType.VARCHAR, max_length=255),
-    # 图像内容哈希值字段：VARCHAR 类型，最大长度 64 (MD5 哈希长度为 32，这里设为 64 足够)
-    FieldSchema(name="image_hash", dtype=DataType.VARCHAR, max_length=64)
-]
-# 创建集合 Schema 对象，包含字段定义和描述信息
-schema = CollectionSchema(fields=fields, description="非遗图像特征向量集合 (基于文件名和哈希去重)")
-
-collection = None
-try:
-    if not connections.has_connection("default"):
-        connections.connect(alias="default",
-                            host='192.168.1.100',
-                            port='19530')
-        print("成功连接到 Milvus。")
-    else:
-        print("已存在 Milvus 连接。")
+# --- 当前服务的集合与模型 ---
+# 检查别名 collection_name 是否被切换到其他模型版本集合的间隔 (秒)，见 model_migration.py
+SERVING_CHECK_INTERVAL = float(os.environ.get('HERITAGE_SERVING_CHECK_INTERVAL', '30'))
+# 流式搜索 (stream=1) 第一阶段使用的 nprobe：先以较低的召回率快速返回初步结果，再返回完整搜索的结果
+STREAM_FAST_NPROBE = int(os.environ.get('HERITAGE_STREAM_FAST_NPROBE', '2'))
+
+
+class ServingSpace:
+    """
+    当前服务使用的一组对象：实际集合、与之匹配的特征提取模型和写缓冲。
+    别名切换后整组替换，请求开始时取一次引用，保证查询向量和集合属于同一个模型版本。
+    """
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.model = load_model(version)
+        # 通过共享连接池获取集合，集合不存在时自动创建并建立索引
+        # Milvus 暂时不可用时集合保持未就绪状态，由连接池的健康检查在恢复后自动重新加载
+        # 配置了 HERITAGE_SHARDS 时使用分片集合，搜索并行查询所有分片
+        self.collection = (get_sharded_collection(create=True, dim=self.model.EMBEDDING_DIM)
+                           or get_collection(name, create=True, dim=self.model.EMBEDDING_DIM))
+        # 开启 HERITAGE_CASCADE 时先用轻量级模型粗筛候选 (见 cascade.py)，不支持时为 None
+        self.coarse = cascade.get_coarse_index(self.collection, name)
+        # 单张上传走写缓冲，由后台线程批量写入 Milvus；
+        # 每个实际集合的落盘文件分目录存放，切换时新旧写缓冲不会恢复对方的记录
+        spool_dir = DEFAULT_SPOOL_DIR if SHARDS or name == collection_name else os.path.join(
+            DEFAULT_SPOOL_DIR, name)
+        # 写入 Milvus 成功后登记到本地图片目录库；目录库尚未同步时在后台从 Milvus 全量同步
+        self.buffer = InsertBuffer(self.collection, spool_dir=spool_dir, on_flushed=self._on_flushed)
+        image_catalog.ensure_synced(name, self.collection)
+
+    def _on_flushed(self, rows, primary_keys):
+        image_catalog.record_buffer_rows(self.name, rows, primary_keys)
+        if self.coarse is not None:
+            self.coarse.notify()
+
+    def search(self, image_path, top_k, filters=None, nprobe=DEFAULT_NPROBE, deadline=None, tier_info=None,
+               use_cascade=True):
+        """
+        提取查询图片的特征并搜索相似图片。开启级联搜索时先粗筛候选，候选不足时退回完整搜索。
+
+        返回:
+            tuple: (results, cascade_path)。cascade_path 为 'coarse' 或 'rerank'，未使用级联搜索时为 None。
+        """
+        if use_cascade and self.coarse is not None and self.coarse.ready:
+            outcome = self.coarse.search(image_path, self.model, top_k=top_k, filters=filters,
+                                         nprobe=nprobe, timeout=deadline.remaining if deadline else None)
+            if outcome is not None:
+                return outcome
+        query_vector = self.model.extract_features(image_path)
+        if deadline is not None:
+            deadline.check('milvus_search')
+        results = search_similar_vectors(query_vector, top_k=top_k, filters=filters,
+                                         target_collection=self.collection, nprobe=nprobe,
+                                         timeout=deadline.remaining if deadline else None,
+                                         deadline=deadline, tier_info=tier_info)
+        return results, None
+
+    def search_stages(self, top_k, image_path=None, query_vector=None, filters=None, nprobe=DEFAULT_NPROBE,
+                      deadline=None, tier_info=None, use_cascade=True):
+        """
+        分阶段搜索，每完成一个阶段产出一次结果，用于流式响应：
+          coarse  级联搜索的结果 (开启级联搜索且候选足够时)；
+          fast    以 STREAM_FAST_NPROBE 搜索的初步结果 (未产出 coarse 且 nprobe 更大时)；
+          final   以 nprobe 完整搜索的结果，总是最后产出。
+
+        参数:
+            image_path (str): 查询图片路径，与 query_vector 二选一。
+            query_vector (numpy.ndarray): 客户端提取的查询向量。
+
+        返回:
+            generator: 产出 (阶段名, 结果列表)。
+        """
+        timeout = (lambda: deadline.remaining) if deadline is not None else (lambda: None)
+        early = False
+        if query_vector is None and use_cascade and self.coarse is not None and self.coarse.ready:
+            info = {}
+            outcome = self.coarse.search(image_path, self.model, top_k=top_k, filters=filters,
+                                         nprobe=nprobe, timeout=timeout(), info=info)
+            if outcome is not None:
+                early = True
+                yield 'coarse', outcome[0]
+                # 级联搜索已对查询图片运行过 ResNet 时复用查询向量
+                query_vector = info.get('query_vector')
+        if query_vector is None:
+            query_vector = self.model.extract_features(image_path)
+        stages = [('final', nprobe)]
+        if not early and nprobe > STREAM_FAST_NPROBE:
+            stages.insert(0, ('fast', STREAM_FAST_NPROBE))
+        for stage, stage_nprobe in stages:
+            if deadline is not None:
+                deadline.check('milvus_search')
+            yield stage, search_similar_vectors(query_vector, top_k=top_k, filters=filters,
+                                                target_collection=self.collection, nprobe=stage_nprobe,
+                                                timeout=timeout(), deadline=deadline, tier_info=tier_info)
 
-    if utility.has_collection(collection_name):
-        collection = Collection(name=collection_name)
-        print(f"集合 {collection_name} 存在。")
 
+def _resolve_serving():
+    """解析别名当前指向的集合和模型版本，Milvus 不可用时使用别名本身和默认模型"""
+    if SHARDS:
+        # 分片集合不参与别名切换，使用默认模型版本
+        return ','.join(SHARDS), DEFAULT_MODEL_VERSION
+    try:
+        return resolve_serving(collection_name)
+    except Exception as e:
+        print(f"解析集合别名 {collection_name} 失败，暂时使用默认模型版本: {e}")
+        return collection_name, DEFAULT_MODEL_VERSION
+
+
+def _watch_serving():
+    """后台线程：别名切换到新的模型版本集合后，整组替换 serving 并关闭旧的写缓冲"""
+    global serving
+    while True:
+        time.sleep(SERVING_CHECK_INTERVAL)
+        try:
+            name, version = resolve_serving(collection_name)
+        except Exception:
+            continue
+        # 刷新目录库的别名缓存，别名切换后目录库立即改用新集合的键
+        remember_alias(collection_name, name)
+        if name == serving.name:
+            continue
+        print(f"集合别名 {collection_name} 已切换到 {name} (模型 {version})，开始切换服务...")
         try:
-            collection.load()
-            print(f"成功加载集合 {collection_name}。")
-        except Exception as load_err:
-            print(f"加载集合 {collection_name} 失败: {load_err}")
-            collection = None
-            flash(f"加载 Milvus 集合失败: {load_err}")
+            new_space = ServingSpace(name, version)
+        except Exception as e:
+            print(f"切换到集合 {name} 失败，继续使用 {serving.name}: {e}")
+            continue
+        old_space, serving = serving, new_space
+        # 旧写缓冲中剩余的行写入旧集合，由迁移工具的追平步骤复制到新集合
+        old_space.buffer.close()
+        if old_space.coarse is not None:
+            old_space.coarse.stop()
+        print(f"已切换到集合 {name}，模型 {version}")
+
+
+image_catalog = get_catalog()
+serving = ServingSpace(*_resolve_serving())
+if serving.collection.ready:
+    print(f"集合 {serving.name} (模型 {serving.version}) 初始化完成，"
+          f"当前实体数量：{serving.collection.num_entities}")
+else:
+    print(f"集合 {serving.name} 暂不可用，请检查 Milvus 服务状态")
+# atexit 按注册的相反顺序执行：入库线程和目录监听线程先停止并等待当前批次写入缓冲，最后才关闭写缓冲
+atexit.register(lambda: serving.buffer.close())
+if not SHARDS:
+    threading.Thread(target=_watch_serving, name='serving-watch', daemon=True).start()
+
+# 异步入库任务由后台线程分批处理，进程重启后未完成的任务会继续处理
+ingest_queue = IngestQueue()
+ingest_worker = IngestWorker(ingest_queue,
+                             lambda paths, names, categories: _process_ingest_batch(paths, names, categories),
+                             is_ready=lambda: serving.collection.ready)
+ingest_worker.start()
+atexit.register(ingest_worker.stop)
+metrics.track_queue_depth('insert_buffer', lambda: serving.buffer.pending_count)
+metrics.track_queue_depth('ingest_jobs', ingest_queue.pending_count)
+# 配置了 HERITAGE_WATCH_DIRS 时监听这些目录，新图片写完后自动分批入库
+watch_dirs = parse_watch_dirs(WATCH_DIRS)
+if watch_dirs:
+    ingest_watcher = DirectoryWatcher(
+        watch_dirs,
+        lambda paths, names, categories: _process_ingest_batch(paths, names, categories, keep_source=KEEP_SOURCE),
+        is_ready=lambda: serving.collection.ready)
+    ingest_watcher.start()
+    atexit.register(ingest_watcher.stop)
 
-    else:
-        print(f"集合 {collection_name} 不存在，开始自动创建...")
-
-        collection = Collection(name=collection_name, schema=schema)
-
-        index_params = {
-            "metric_type": "L2",
-            "index_type": "IVF_FLAT",
-            "params": {
-                "nlist": 1024
-            }
-        }
-        collection.create_index(field_name="embedding",
-                                index_params=index_params)
-        collection.load()  # Load the collection after creating index
-        print(f"成功创建集合 {collection_name} 并建立索引")
-        flash(f"已自动创建新集合 {collection_name}，并完成初始化")
-        print(f"集合初始化完成，当前实体数量：{collection.num_entities}")
-
-except Exception as e:
-    print(f"集合初始化失败: {e}")
-    flash(f"集合初始化失败: {str(e)}。请检查 Milvus 服务状态")
-    collection = None
-    if utility.has_collection(collection_name):
-        utility.drop_collection(collection_name)
-        print(f"已清理无效集合 {collection_name}")
+
+def _refresh_collection_size():
+    """刷新集合实体数量指标 (别名切换后读取新的 serving 集合)"""
+    metrics.refresh_collection_size(lambda: serving.collection.num_entities)
+
+
+# 集合实体数量由 Milvus 健康检查线程定期刷新，抓取指标时不访问 Milvus
+_refresh_collection_size()
+get_pool().add_health_hook(_refresh_collection_size)
+# 推理和搜索的并发名额，过载时降级或拒绝请求
+admission = AdmissionController()
+
+
+@app.before_request
+def start_request_timer():
+    """记录请求开始时间，用于统计接口整体耗时"""
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """统计接口整体耗时和服务端错误次数"""
+    endpoint = request.endpoint or 'unknown'
+    if 'request_start' in g:
+        REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - g.request_start)
+    if response.status_code >= 500:
+        ENDPOINT_ERRORS.labels(endpoint).inc()
+    return response
+
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    """过载时返回 503，并通过 Retry-After 告知客户端多久后重试"""
+    response = jsonify({'success': False, 'message': f'服务繁忙 ({e.reason})，请稍后重试',
+                        'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+
+@app.errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(e):
+    """请求超过截止时间时返回 504，不再继续推理和搜索"""
+    return jsonify({'success': False, 'message': f'请求超时: {e}'}), 504
 
 
 def allowed_file(filename):
@@ -101,12 +287,24 @@ def upload_form():
     return render_template('upload.html')
 
 
+@app.route('/static/images/<path:filename>', methods=['GET'])
+def image_file(filename):
+    """
+    按文件名提供图片：在分层存储和旧的平铺目录中查找 (见 image_store)，
+    图片的 URL 不随存储布局和迁移变化。优先于 Flask 默认的 /static 路由匹配。
+    """
+    if '/' not in filename:
+        filename = image_store.resolve_relative(filename)
+    return send_from_directory(image_store.IMAGE_ROOT, filename, max_age=86400)
+
+
 @app.route('/upload', methods=['POST'])
 def upload_image():
     """处理图片上传、特征提取和相似度搜索"""
     upload_folder = app.config['UPLOAD_FOLDER']
+    space = serving
 
-    if collection is None:
+    if not space.collection.ready:
         flash('Milvus 集合未加载，无法执行搜索。请检查服务器状态和集合是否存在。')
         return redirect(url_for('upload_form'))
 
@@ -122,13 +320,10 @@ def upload_image():
         filename = secure_filename(file.filename)
         filepath = os.path.join(upload_folder, filename)
         try:
-            file.save(filepath)
+            with stage_timer(STAGE_UPLOAD_RECEIVE):
+                file.save(filepath)
             flash(f'文件 {filename} 上传成功，正在处理...')
 
-            print(f"正在提取上传图片 {filepath} 的特征...")
-            query_vector = extract_features(filepath)
-
-            print(f"正在搜索相似图像...")
             try:
                 top_k = int(request.form.get('top_k', 5))
                 if top_k <= 0 or top_k > 50:
@@ -136,31 +331,40 @@ def upload_image():
             except ValueError:
                 top_k = 5
 
-            similar_results = search_similar_vectors(collection,
-                                                     query_vector,
-                                                     top_k=top_k)
-
-            results_for_template = []
-            for res in similar_results:
-                image_url = url_for('static',
-                                    filename=f'images/{res["filename"]}')
-                results_for_template.append({
-                    'id': res['id'],
-                    'distance': res['distance'],
-                    'filename': res['filename'],
-                    'image_url': image_url
-                })
-
-            return render_template('results.html',
-                                   results=results_for_template,
-                                   query_filename=filename,
-                                   query_image_url=url_for(
-                                       'static',
-                                       filename=f'uploads/{filename}'))
+            deadline = request_deadline(request.headers)
+            tier_info = {}
+            with admission.admit('upload_image', deadline) as ticket:
+                print(f"正在提取上传图片 {filepath} 的特征并搜索相似图像...")
+                nprobe, top_k = ticket.search_params(top_k)
+                similar_results, _ = space.search(filepath, top_k, nprobe=nprobe, deadline=deadline,
+                                                  tier_info=tier_info)
+            if tier_info.get('skipped_partitions'):
+                flash(f"有 {len(tier_info['skipped_partitions'])} 个较早的分区尚未加载，本次结果可能不完整")
+
+            with stage_timer(STAGE_RESPONSE_RENDER):
+                results_for_template = []
+                for res in similar_results:
+                    image_url = url_for('image_file', filename=res['filename'])
+                    results_for_template.append({
+                        'id': res['id'],
+                        'distance': res['distance'],
+                        'filename': res['filename'],
+                        'image_url': image_url
+                    })
+
+                return render_template('results.html',
+                                       results=results_for_template,
+                                       query_filename=filename,
+                                       query_image_url=url_for(
+                                           'static',
+                                           filename=f'uploads/{filename}'))
 
         except FileNotFoundError:
             flash(f"错误：处理文件时未找到：{filepath}")
             return redirect(url_for('upload_form'))
+        except (Overloaded, DeadlineExceeded) as e:
+            flash(f'服务繁忙，请稍后重试: {e}')
+            return redirect(url_for('upload_form'))
         except Exception as e:
             flash(f'处理文件或执行搜索时出错: {e}')
             print(f"错误详情: {e}")
@@ -175,13 +379,48 @@ def upload_image():
 
 @app.route('/api/images', methods=['GET'])
 def get_all_images():
-    """获取Milvus中存储的所有图片数据"""
-    if collection is None:
-        return jsonify({'success': False, 'message': 'Milvus 集合未加载。'}), 500
+    """
+    分页获取已入库的图片数据。
+    可选参数：prefix (文件名前缀)、page (从 1 开始)、page_size (默认 1000)、
+    sort (id / filename / ingest_time / size)、order (asc / desc)。
+    图片目录库尚未同步时直接查询 Milvus，只返回前 1000 条且不支持分页和排序。
+    """
+    space = serving
+    collection = space.collection
 
+    prefix = request.args.get('prefix', '')
+    if prefix and not re.fullmatch(r'[\w.\-]+', prefix):
+        return jsonify({'success': False, 'message': f'无效的文件名前缀: {prefix}'}), 400
+    sort = request.args.get('sort', 'id')
+    order = request.args.get('order', 'desc')
+    if sort not in SORT_FIELDS or order not in ('asc', 'desc'):
+        return jsonify({'success': False, 'message': f'无效的排序参数: {sort} {order}'}), 400
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 1000)), 1), 10000)
+    except ValueError:
+        return jsonify({'success': False, 'message': '无效的分页参数'}), 400
+
+    if image_catalog.is_synced(space.name):
+        items, total = image_catalog.list_images(space.name, prefix=prefix, sort=sort, order=order,
+                                                 offset=(page - 1) * page_size, limit=page_size)
+        data = [{
+            'id': str(item['id']),  # 将id转为字符串，避免前端精度丢失
+            'image_filename': item['filename'],
+            'image_hash': item['image_hash'],
+            'size': item['size'],
+            'category': item['category'],
+            'ingest_time': item['ingest_time'],
+            'path': item['path']
+        } for item in items]
+        return jsonify({'success': True, 'data': data, 'total': total,
+                        'page': page, 'page_size': page_size}), 200
+
+    if not collection.ready:
+        return jsonify({'success': False, 'message': 'Milvus 集合未加载。'}), 500
     try:
         results = collection.query(
-            expr="",
+            expr=f'image_filename like "{prefix}%"' if prefix else "",
             output_fields=["id", "image_filename", "image_hash"],
             consistency_level="Strong",  # 确保读取到最新的数据
             limit=1000)
@@ -198,8 +437,9 @@ def get_all_images():
 def delete_images_route():
     """处理从Milvus数据库和文件系统中删除选定图片的请求"""
     app_root = app.config['APP_ROOT']
+    space = serving
 
-    if collection is None:
+    if not space.collection.ready:
         return jsonify({
             'success': False,
             'message': 'Milvus 集合未加载，无法执行删除操作。'
@@ -212,7 +452,8 @@ def delete_images_route():
 
     image_ids = data['ids']
 
-    result = delete_images_from_milvus_and_fs(collection, image_ids, app_root)
+    result = delete_images_from_milvus_and_fs(space.collection, image_ids, app_root,
+                                              catalog=image_catalog, catalog_name=space.name)
 
     if result['success']:
         return jsonify({
@@ -230,13 +471,88 @@ def delete_images_route():
         }), 500
 
 
+@app.route('/api/near_duplicates', methods=['GET'])
+def get_near_duplicates():
+    """查看最近一次近重复聚类报告 (由 near_duplicates.py 生成)，簇按 page、page_size 分页"""
+    report = near_duplicates.load_report()
+    if report is None:
+        return jsonify({'success': False, 'message': '尚未生成近重复报告，请先运行 near_duplicates.py'}), 404
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = min(max(int(request.args.get('page_size', 50)), 1), 1000)
+    except ValueError:
+        return jsonify({'success': False, 'message': '无效的分页参数'}), 400
+    clusters = report.pop('clusters')
+    report['clusters'] = clusters[(page - 1) * page_size:page * page_size]
+    report['stale'] = report['collection'] != serving.name
+    return jsonify({'success': True, 'data': report, 'page': page, 'page_size': page_size}), 200
+
+
+@app.route('/api/near_duplicates/prune', methods=['POST'])
+def prune_near_duplicates():
+    """
+    一键清理近重复图片：删除报告中指定簇 (cluster_ids，缺省为全部簇) 除代表图片以外的图片，
+    并从报告中移除这些簇。
+    """
+    app_root = app.config['APP_ROOT']
+    space = serving
+    if not space.collection.ready:
+        return jsonify({'success': False, 'message': 'Milvus 集合未加载，无法执行删除操作。'}), 500
+    report = near_duplicates.load_report()
+    if report is None:
+        return jsonify({'success': False, 'message': '尚未生成近重复报告，请先运行 near_duplicates.py'}), 404
+    if report['collection'] != space.name:
+        return jsonify({'success': False,
+                        'message': f"报告针对集合 {report['collection']}，当前服务集合为 {space.name}，请重新生成报告"}), 409
+
+    data = request.get_json(silent=True) or {}
+    cluster_ids = data.get('cluster_ids')
+    if cluster_ids is not None and not isinstance(cluster_ids, list):
+        return jsonify({'success': False, 'message': 'cluster_ids 必须是列表'}), 400
+    try:
+        image_ids = near_duplicates.take_prune_ids(report, cluster_ids)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'cluster_ids 必须是整数列表'}), 400
+    if not image_ids:
+        return jsonify({'success': True, 'message': '没有需要清理的图片', 'deleted_count': 0, 'errors': []}), 200
+
+    # 分批删除，避免单个删除表达式过长
+    deleted_count = 0
+    errors = []
+    for i in range(0, len(image_ids), 1000):
+        result = delete_images_from_milvus_and_fs(space.collection, image_ids[i:i + 1000], app_root,
+                                                  catalog=image_catalog, catalog_name=space.name)
+        deleted_count += result.get('deleted_count', 0)
+        errors.extend(result.get('errors', []))
+        if not result['success']:
+            return jsonify({'success': False, 'message': result['message'],
+                            'deleted_count': deleted_count, 'errors': errors}), 500
+    near_duplicates.save_report(report)
+    return jsonify({
+        'success': True,
+        'message': f'已清理 {len(image_ids)} 张近重复图片，删除文件 {deleted_count} 个',
+        'deleted_count': deleted_count,
+        'errors': errors
+    }), 200
+
+
+@app.route('/api/reconcile', methods=['GET'])
+def get_reconcile_report():
+    """查看最近一次 Milvus 与图片目录的一致性核对报告 (由 reconcile.py 生成)"""
+    report = reconcile.load_report()
+    if report is None:
+        return jsonify({'success': False, 'message': '尚未生成核对报告，请先运行 reconcile.py'}), 404
+    report['stale'] = report['collection'] != serving.name
+    return jsonify({'success': True, 'data': report}), 200
+
+
 @app.route('/insert_image', methods=['POST'])
 def insert_image_route():
     """处理图片上传、特征提取和插入到 Milvus"""
     upload_folder = app.config['UPLOAD_FOLDER']
-    app_root = app.config['APP_ROOT']
+    space = serving
 
-    if collection is None:
+    if not space.collection.ready:
         return jsonify({
             'success': False,
             'message': 'Milvus 集合未加载，无法执行插入。请检查服务器状态和集合是否存在。'
@@ -250,25 +566,42 @@ def insert_image_route():
 
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        filepath = os.path.join(upload_folder, filename)
+        # 临时文件名加随机前缀，避免并发上传同名文件时互相覆盖或删除
+        filepath = os.path.join(upload_folder, f'{uuid.uuid4().hex[:8]}_{filename}')
+        # 本次新放入图片存储、尚未写入的文件名，出错或跳过时在 finally 中释放
+        claimed = None
         try:
-            file.save(filepath)
+            with stage_timer(STAGE_UPLOAD_RECEIVE):
+                file.save(filepath)
             print(f'文件 {filename} 上传成功，正在处理并插入...')
 
-            print(f"正在提取上传图片 {filepath} 的特征...")
-            query_vector = extract_features(filepath)
-
-            from insert_images import calculate_image_hash, insert_vectors
             image_hash = calculate_image_hash(filepath)
-            # 调用 insert_vectors 并获取返回值
-            insert_result = insert_vectors([query_vector.tolist()], [filepath])
-
-            target_dir = os.path.join(app_root, 'static', 'images')
-            os.makedirs(target_dir, exist_ok=True)
+            # 先放入图片存储并原子地占用文件名：与已有图片同名但内容不同时改用带哈希后缀的文件名，避免覆盖
+            filename, created = image_store.save(filepath, filename, image_hash)
+            if created:
+                claimed = filename
+            # 先查重再提取特征，已存在的图片不再跑模型
+            if space.buffer.contains(filename, image_hash) or is_image_exists(filename, image_hash,
+                                                                               space.collection):
+                print(f"跳过已存在的图像: {filename}")
+                DEDUP_SKIPPED.inc()
+                insert_result = {"inserted": [], "skipped": [filename], "skipped_count": 1}
+            else:
+                print(f"正在提取上传图片 {filepath} 的特征...")
+                with admission.admit('insert_image', request_deadline(request.headers)):
+                    query_vector = extract_features_cached(space.model, filepath, image_hash)
+                # 写入缓冲并落盘后即返回，由后台线程批量写入 Milvus
+                metadata = build_metadata(filename, request.form.get('category'),
+                                          file_size=os.path.getsize(filepath))
+                if space.buffer.add(query_vector, filename, image_hash, metadata):
+                    insert_result = {"inserted": [filename], "skipped": [], "skipped_count": 0}
+                else:
+                    DEDUP_SKIPPED.inc()
+                    insert_result = {"inserted": [], "skipped": [filename], "skipped_count": 1}
 
-            target_image_path = os.path.join(target_dir, filename)
-            shutil.copy(filepath, target_image_path)
-            print(f'图片已复制到 {target_image_path}')
+            if insert_result["inserted"]:
+                claimed = None
+                print(f'图片已保存到 {image_store.path(filename)}')
 
             # 根据插入结果返回不同的消息
             if insert_result["inserted"]:
@@ -292,6 +625,8 @@ def insert_image_route():
                 'success': False,
                 'message': f'错误：处理文件时未找到：{filepath}'
             }), 500
+        except (Overloaded, DeadlineExceeded):
+            raise
         except Exception as e:
             print(f"错误详情: {e}")
             return jsonify({
@@ -301,17 +636,267 @@ def insert_image_route():
         finally:
             if os.path.exists(filepath):
                 os.remove(filepath)
+            if claimed is not None:
+                try:
+                    release_unused([claimed], buffer=space.buffer, target_collection=space.collection)
+                except Exception as e:
+                    print(f"清理未入库的图片 {claimed} 失败: {e}")
 
     else:
         return jsonify({'success': False, 'message': '不允许的文件类型'}), 400
 
 
+def _save_bulk_uploads(files, staging_dir):
+    """
+    把批量上传的图片和 zip 包保存到临时目录。
+
+    返回:
+        tuple: (待处理的 (文件名, 临时路径) 列表, 无法处理的文件结果列表, 各待处理文件所属上传文件的序号列表)。
+               上传文件的序号是它在 files 中的位置 (zip 包中的每张图片都属于该 zip 包)，
+               无法处理的文件结果中的 upload 字段也是这个序号，客户端据此把结果对应回自己上传的文件。
+    """
+    max_uncompressed = app.config['MAX_BULK_UNCOMPRESSED_LENGTH']
+    entries = []
+    rejected = []
+    uploads = []
+
+    def staging_path(name):
+        # 用序号前缀避免同名文件在临时目录中互相覆盖
+        return os.path.join(staging_dir, f'{len(entries):06d}_{name}')
+
+    for upload, file in enumerate(files):
+        if not file or file.filename == '':
+            continue
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = [m for m in archive.infolist() if not m.is_dir()]
+                    if sum(m.file_size for m in members) > max_uncompressed:
+                        rejected.append({'filename': file.filename, 'status': 'error', 'upload': upload,
+                                         'message': 'zip 包解压后超过大小上限'})
+                        continue
+                    for member in members:
+                        name = secure_filename(os.path.basename(member.filename))
+                        if not name or not allowed_file(name):
+                            rejected.append({'filename': member.filename, 'status': 'error', 'upload': upload,
+                                             'message': '不允许的文件类型'})
+                            continue
+                        path = staging_path(name)
+                        with archive.open(member) as src, open(path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+                        entries.append((name, path))
+                        uploads.append(upload)
+            except zipfile.BadZipFile:
+                rejected.append({'filename': file.filename, 'status': 'error', 'upload': upload,
+                                 'message': '无法解析 zip 文件'})
+        elif allowed_file(file.filename):
+            name = secure_filename(file.filename)
+            path = staging_path(name)
+            with stage_timer(STAGE_UPLOAD_RECEIVE):
+                file.save(path)
+            entries.append((name, path))
+            uploads.append(upload)
+        else:
+            rejected.append({'filename': file.filename, 'status': 'error', 'upload': upload,
+                             'message': '不允许的文件类型'})
+    return entries, rejected, uploads
+
+
+@app.route('/api/insert_images', methods=['POST'])
+def insert_images_route():
+    """
+    批量上传多张图片或 zip 包，批量查重、提取特征并一次性插入 Milvus。
+    每条结果的 upload 字段为对应的上传文件在 files 中的序号，结果中的 filename 可能被改名，不能用于对应。
+    """
+    request.max_content_length = app.config['MAX_BULK_CONTENT_LENGTH']
+    space = serving
+
+    if not space.collection.ready:
+        return jsonify({
+            'success': False,
+            'message': 'Milvus 集合未加载，无法执行插入。请检查服务器状态和集合是否存在。'
+        }), 500
+
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'success': False, 'message': '请求中没有文件部分'}), 400
+
+    staging_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    try:
+        entries, rejected, uploads = _save_bulk_uploads(files, staging_dir)
+        results = []
+        if entries:
+            results = insert_image_batch([path for _, path in entries],
+                                         [name for name, _ in entries],
+                                         buffer=space.buffer,
+                                         model=space.model,
+                                         category=request.form.get('category'))
+
+            # 插入的图片已由 insert_image_batch 放入图片存储，临时目录在 finally 中删除
+            for result, upload in zip(results, uploads):
+                result['upload'] = upload
+        results.extend(rejected)
+
+        inserted = sum(1 for r in results if r['status'] == 'inserted')
+        skipped = sum(1 for r in results if r['status'] == 'skipped')
+        return jsonify({
+            'success': True,
+            'message': f'批量插入完成：插入 {inserted} 张，跳过 {skipped} 张，失败 {len(results) - inserted - skipped} 张。',
+            'inserted_count': inserted,
+            'skipped_count': skipped,
+            'error_count': len(results) - inserted - skipped,
+            'results': results
+        }), 200
+    except Exception as e:
+        print(f"错误详情: {e}")
+        return jsonify({'success': False, 'message': f'批量插入时出错: {e}'}), 500
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _process_ingest_batch(image_paths, image_filenames, categories, keep_source=False):
+    """入库后台线程和目录监听线程调用：按类别分组批量插入一批文件，并把插入成功的文件放入图片存储"""
+    space = serving
+    return ingest_files(image_paths, image_filenames, categories, buffer=space.buffer, model=space.model,
+                        keep_source=keep_source)
+
+
+@app.route('/api/ingest_jobs', methods=['POST'])
+def submit_ingest_job():
+    """提交异步入库任务：保存上传的图片或 zip 包后立即返回任务 ID"""
+    request.max_content_length = app.config['MAX_BULK_CONTENT_LENGTH']
+
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'success': False, 'message': '请求中没有文件部分'}), 400
+
+    staging_dir = tempfile.mkdtemp(dir=JOB_UPLOAD_FOLDER)
+    try:
+        entries, rejected, _ = _save_bulk_uploads(files, staging_dir)
+    except Exception as e:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        print(f"错误详情: {e}")
+        return jsonify({'success': False, 'message': f'保存上传文件时出错: {e}'}), 500
+
+    if not entries:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return jsonify({'success': False, 'message': '没有可入库的图片', 'results': rejected}), 400
+
+    job_id = ingest_queue.submit(entries, staging_dir, category=request.form.get('category') or None)
+    ingest_worker.notify()
+    return jsonify({
+        'success': True,
+        'message': f'已提交入库任务，共 {len(entries)} 张图片。',
+        'job_id': job_id,
+        'rejected': rejected
+    }), 202
+
+
+@app.route('/api/ingest_jobs', methods=['GET'])
+def list_ingest_jobs():
+    """列出最近的入库任务及进度"""
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 200)
+    except ValueError:
+        limit = 20
+    return jsonify({'success': True, 'data': ingest_queue.list_jobs(limit)}), 200
+
+
+@app.route('/api/ingest_jobs/<int:job_id>', methods=['GET'])
+def get_ingest_job(job_id):
+    """查询入库任务进度和每个文件的处理结果"""
+    job = ingest_queue.get_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': f'任务 {job_id} 不存在'}), 404
+    return jsonify({'success': True, 'data': job}), 200
+
+
+def _wants_stream(values):
+    """是否以流式响应返回搜索结果：参数 stream=1，或 Accept 请求头包含 application/x-ndjson"""
+    return str(values.get('stream', '')).lower() in ('1', 'true') or \
+        'application/x-ndjson' in request.headers.get('Accept', '')
+
+
+def _stream_search(space, endpoint, top_k, on_close=None, **kwargs):
+    """
+    以 NDJSON 流式返回分阶段的搜索结果 (见 ServingSpace.search_stages)，每个阶段一行：
+      {"success": true, "stage": "fast", "final": false, "results": [...]}
+    最后一行的 final 为 true；出错时输出 {"success": false, "stage": "error", "final": true, "message": ...}。
+    并发名额在整个流结束 (或客户端断开) 后才归还。
+
+    参数:
+        endpoint (str): 准入控制使用的接口名。
+        on_close (callable): 流结束后调用，例如删除临时文件。
+        kwargs: 传给 search_stages 的查询图片或查询向量和过滤条件。
+
+    异常:
+        Overloaded: 领取并发名额失败，由错误处理返回 503。
+    """
+    deadline = request_deadline(request.headers)
+    admit = admission.admit(endpoint, deadline)
+    try:
+        ticket = admit.__enter__()
+    except Exception:
+        if on_close:
+            on_close()
+        raise
+    nprobe, top_k = ticket.search_params(top_k)
+    tier_info = {}
+    started = g.request_start
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            admit.__exit__(None, None, None)
+            if on_close:
+                on_close()
+
+    def generate():
+        first = True
+        try:
+            for stage, results in space.search_stages(top_k, nprobe=nprobe, deadline=deadline, tier_info=tier_info,
+                                                      **kwargs):
+                for res in results:
+                    res['image_url'] = url_for('image_file', filename=res['filename'], _external=True)
+                chunk = {'success': True, 'stage': stage, 'final': stage == 'final', 'results': results}
+                if ticket.degraded:
+                    chunk['degraded'] = {'level': ticket.level, 'nprobe': nprobe, 'top_k': top_k}
+                if tier_info.get('skipped_partitions'):
+                    chunk['partial'] = {'skipped_partitions': tier_info['skipped_partitions']}
+                if first:
+                    FIRST_RESULT_LATENCY.labels('stream').observe(time.perf_counter() - started)
+                    first = False
+                yield json.dumps(chunk, ensure_ascii=False) + '\n'
+        except Exception as e:
+            yield json.dumps({'success': False, 'stage': 'error', 'final': True, 'message': f'搜索失败: {e}'},
+                             ensure_ascii=False) + '\n'
+        finally:
+            release()
+
+    response = Response(stream_with_context(generate()), content_type='application/x-ndjson; charset=utf-8')
+    # 客户端在第一阶段结果返回前断开时生成器不会运行，由 call_on_close 归还名额
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 经 nginx 反向代理时不缓冲整个响应
+    return response
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
 @app.route('/api/search', methods=['POST'])
 def api_search_similar_images():
     """
-    接收图片文件和top_k，返回相似图片列表
+    接收图片文件和top_k，返回相似图片列表。
+    可选过滤参数：category、source_video、ts_from_ms、ts_to_ms、ingest_after、ingest_before。
+    开启级联搜索时响应中的 cascade 为 coarse (未运行 ResNet) 或 rerank；传 cascade=0 时使用完整搜索。
+    传 stream=1 (或 Accept: application/x-ndjson) 时以 NDJSON 分阶段返回结果，见 _stream_search。
     """
-    if collection is None:
+    space = serving
+    if not space.collection.ready:
         return jsonify({'success': False, 'message': 'Milvus 集合未加载。'}), 500
 
     if 'file' not in request.files:
@@ -320,11 +905,20 @@ def api_search_similar_images():
     if file.filename == '':
         return jsonify({'success': False, 'message': '未选择文件'}), 400
 
+    try:
+        filters = filters_from_request(request.form)
+        build_filter_expr(**filters)  # 提前校验过滤条件，非法参数返回 400
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'过滤参数无效: {e}'}), 400
+
+    streaming = False
     try:
         from werkzeug.utils import secure_filename
         filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(temp_path)
+        # 临时文件名加随机前缀，避免并发搜索同名文件时互相覆盖或删除
+        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{uuid.uuid4().hex[:8]}_{filename}')
+        with stage_timer(STAGE_UPLOAD_RECEIVE):
+            file.save(temp_path)
 
         try:
             top_k = int(request.form.get('top_k', 5))
@@ -333,23 +927,249 @@ def api_search_similar_images():
         except Exception:
             top_k = 5
 
-        # 提取特征并搜索
-        query_vector = extract_features(temp_path)
-        # 注意：search_similar_vectors 只传 query_vector 和 top_k
-        results = search_similar_vectors(query_vector, top_k=top_k)
+        if _wants_stream(request.form):
+            # 临时文件在流结束后删除
+            response = _stream_search(space, 'api_search_similar_images', top_k,
+                                      on_close=lambda: _remove_file(temp_path), image_path=temp_path,
+                                      filters=filters, use_cascade=request.form.get('cascade') != '0')
+            streaming = True
+            return response
+
+        # 领取并发名额后提取特征并搜索，过载时按负载等级降低 nprobe 和 top_k
+        deadline = request_deadline(request.headers)
+        tier_info = {}
+        with admission.admit('api_search_similar_images', deadline) as ticket:
+            nprobe, top_k = ticket.search_params(top_k)
+            # 按类别裁剪分区，并按来源视频、时间范围过滤；cascade=0 时不使用级联搜索
+            results, cascade_path = space.search(temp_path, top_k, filters=filters, nprobe=nprobe,
+                                                 deadline=deadline, tier_info=tier_info,
+                                                 use_cascade=request.form.get('cascade') != '0')
 
         # 构造图片URL
-        for res in results:
-            res['image_url'] = url_for('static',
-                                       filename=f'images/{res["filename"]}',
-                                       _external=True)
+        with stage_timer(STAGE_RESPONSE_RENDER):
+            for res in results:
+                res['image_url'] = url_for('image_file', filename=res['filename'], _external=True)
 
-        return jsonify({'success': True, 'results': results}), 200
+            response = {'success': True, 'results': results}
+            if cascade_path:
+                response['cascade'] = cascade_path
+            if ticket.degraded:
+                response['degraded'] = {'level': ticket.level, 'nprobe': nprobe, 'top_k': top_k}
+            if tier_info.get('skipped_partitions'):
+                # 未加载的冷分区被跳过，结果可能不完整
+                response['partial'] = {'skipped_partitions': tier_info['skipped_partitions']}
+            FIRST_RESULT_LATENCY.labels('full').observe(time.perf_counter() - g.request_start)
+            return jsonify(response), 200
+    except (Overloaded, DeadlineExceeded):
+        raise
     except Exception as e:
         return jsonify({'success': False, 'message': f'搜索失败: {e}'}), 500
     finally:
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            os.remove(temp_path)
+        if 'temp_path' in locals() and not streaming:
+            _remove_file(temp_path)
+
+
+@app.route('/api/model/manifest', methods=['GET'])
+def get_model_manifest():
+    """当前服务模型版本的客户端模型清单，客户端据此下载模型并在本地提取特征"""
+    manifest = model_export.load_manifest(serving.version)
+    if manifest is None:
+        return jsonify({'success': False, 'message': f'模型 {serving.version} 尚未导出客户端模型'}), 404
+    data = dict(manifest)
+    data['artifacts'] = [dict(a, url=url_for('download_model_file', version=manifest['model_version'],
+                                             filename=a['file'], _external=True),
+                              accepted=a['sha256'] in model_export.accepted_hashes(manifest))
+                         for a in manifest['artifacts']]
+    return jsonify({'success': True, 'data': data}), 200
+
+
+@app.route('/api/model/<version>/<path:filename>', methods=['GET'])
+def download_model_file(version, filename):
+    """下载导出的客户端模型文件 (支持断点续传)"""
+    manifest = model_export.load_manifest(secure_filename(version))
+    if manifest is None or filename not in {a['file'] for a in manifest['artifacts']}:
+        return jsonify({'success': False, 'message': f'模型文件 {version}/{filename} 不存在'}), 404
+    return send_from_directory(os.path.join(model_export.EXPORT_DIR, manifest['model_version']), filename,
+                               conditional=True, max_age=86400)
+
+
+@app.route('/api/search_vector', methods=['POST'])
+def api_search_by_vector():
+    """
+    用客户端在本地提取的特征向量搜索相似图片。
+    JSON 请求体：embedding (base64 编码的 float32 小端字节串或数字列表)、model_version、model_hash (所用模型文件的 sha256)，
+    可选 top_k、stream 和与 /api/search 相同的过滤参数。模型与当前集合不兼容时返回 409 和当前的模型版本哈希。
+    """
+    space = serving
+    if not space.collection.ready:
+        return jsonify({'success': False, 'message': 'Milvus 集合未加载。'}), 500
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'embedding' not in data:
+        return jsonify({'success': False, 'message': '请求体应为包含 embedding 的 JSON'}), 400
+
+    manifest = model_export.load_manifest(space.version)
+    reason = model_export.check_compatibility(manifest, data.get('model_version'), data.get('model_hash'))
+    if reason:
+        return jsonify({'success': False, 'message': f'客户端模型不兼容: {reason}',
+                        'model_version': space.version,
+                        'version_hash': manifest['version_hash'] if manifest else None}), 409
+
+    try:
+        query_vector = model_export.decode_embedding(data['embedding'], space.model.EMBEDDING_DIM)
+        filters = filters_from_request(data)
+        build_filter_expr(**filters)
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'参数无效: {e}'}), 400
+
+    try:
+        top_k = int(data.get('top_k', 5))
+        if top_k <= 0 or top_k > 50:
+            top_k = 5
+    except (TypeError, ValueError):
+        top_k = 5
+
+    if _wants_stream(data):
+        return _stream_search(space, 'api_search_vector', top_k, query_vector=query_vector, filters=filters)
+
+    try:
+        # 不需要推理，但搜索同样占用并发名额，过载时一起降级
+        deadline = request_deadline(request.headers)
+        tier_info = {}
+        with admission.admit('api_search_vector', deadline) as ticket:
+            nprobe, top_k = ticket.search_params(top_k)
+            results = search_similar_vectors(query_vector, top_k=top_k, filters=filters,
+                                             target_collection=space.collection,
+                                             nprobe=nprobe, timeout=deadline.remaining,
+                                             deadline=deadline, tier_info=tier_info)
+
+        with stage_timer(STAGE_RESPONSE_RENDER):
+            for res in results:
+                res['image_url'] = url_for('image_file', filename=res['filename'], _external=True)
+            response = {'success': True, 'results': results}
+            if ticket.degraded:
+                response['degraded'] = {'level': ticket.level, 'nprobe': nprobe, 'top_k': top_k}
+            if tier_info.get('skipped_partitions'):
+                response['partial'] = {'skipped_partitions': tier_info['skipped_partitions']}
+            FIRST_RESULT_LATENCY.labels('full').observe(time.perf_counter() - g.request_start)
+            return jsonify(response), 200
+    except (Overloaded, DeadlineExceeded):
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'搜索失败: {e}'}), 500
+
+
+@app.route('/api/search_clip', methods=['POST'])
+def api_search_clip():
+    """
+    用一段视频片段搜索图片库中的视频，返回匹配的视频片段及时间偏移 (见 clip_search.py)。
+    上传 file (视频文件，需要安装 PyAV) 或多个 frames (按时间顺序抽好的帧图片，
+    可用 frame_ts_ms 逐帧指定时间毫秒数，或按 时-分-秒-毫秒_名称.jpg 命名)。
+    可选参数：top_k (视频片段数量)、fps (抽帧频率) 和与 /api/search 相同的过滤参数。
+    """
+    request.max_content_length = app.config['MAX_CLIP_CONTENT_LENGTH']
+    space = serving
+    if not space.collection.ready:
+        return jsonify({'success': False, 'message': 'Milvus 集合未加载。'}), 500
+    if not space.collection.has_metadata:
+        return jsonify({'success': False, 'message': '当前集合没有视频帧元数据，不支持片段搜索'}), 400
+
+    video = request.files.get('file')
+    frame_files = [f for f in request.files.getlist('frames') if f.filename]
+    if (video is None or video.filename == '') and not frame_files:
+        return jsonify({'success': False, 'message': '请上传视频文件 (file) 或帧图片 (frames)'}), 400
+    if video is not None and video.filename and \
+            video.filename.rsplit('.', 1)[-1].lower() not in clip_search.VIDEO_EXTENSIONS:
+        return jsonify({'success': False, 'message': f'不支持的视频格式: {video.filename}'}), 400
+    if not frame_files and not clip_search.has_video_decoder():
+        return jsonify({'success': False, 'message': '服务端未安装 PyAV，无法解码视频，请上传抽好的帧图片 (frames)'}), 501
+
+    try:
+        filters = filters_from_request(request.form)
+        build_filter_expr(**filters)
+        fps = float(request.form.get('fps') or clip_search.SAMPLE_FPS)
+        if not 0 < fps <= 30:
+            raise ValueError('fps 应在 0-30 之间')
+        timestamps = [int(v) for v in request.form.getlist('frame_ts_ms') if v != '']
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'参数无效: {e}'}), 400
+
+    try:
+        top_k = int(request.form.get('top_k', 5))
+        if top_k <= 0 or top_k > 20:
+            top_k = 5
+    except ValueError:
+        top_k = 5
+
+    temp_path = None
+    try:
+        if frame_files:
+            frames = clip_search.load_frame_images([(f.filename, f.stream) for f in frame_files],
+                                                   timestamps=timestamps, fps=fps)
+        else:
+            temp_path = os.path.join(app.config['UPLOAD_FOLDER'],
+                                     f'{uuid.uuid4().hex[:8]}_{secure_filename(video.filename)}')
+            with stage_timer(STAGE_UPLOAD_RECEIVE):
+                video.save(temp_path)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        # 抽帧、特征提取和搜索都占用同一个并发名额；过载时按负载等级降低 nprobe
+        deadline = request_deadline(request.headers)
+        tier_info = {}
+        with admission.admit('api_search_clip', deadline) as ticket:
+            nprobe, _ = ticket.search_params(top_k)
+            if temp_path is not None:
+                try:
+                    frames = clip_search.sample_frames(temp_path, fps=fps)
+                except ValueError as e:
+                    # 没有视频流或无法解码 (损坏、格式不符) 是上传文件的问题
+                    return jsonify({'success': False, 'message': str(e)}), 400
+                deadline.check('model_forward')
+            result = clip_search.search_clip(frames, space.model, space.collection, top_k=top_k, filters=filters,
+                                             nprobe=nprobe, deadline=deadline, tier_info=tier_info)
+
+        with stage_timer(STAGE_RESPONSE_RENDER):
+            for segment in result['segments']:
+                segment['best']['image_url'] = url_for('image_file', filename=segment['best']['filename'],
+                                                       _external=True)
+            response = {'success': True, 'segments': result['segments'],
+                        'query': {'frames': result['frames'], 'searched_frames': result['searched_frames']}}
+            if ticket.degraded:
+                response['degraded'] = {'level': ticket.level, 'nprobe': nprobe}
+            if tier_info.get('skipped_partitions'):
+                response['partial'] = {'skipped_partitions': tier_info['skipped_partitions']}
+            return jsonify(response), 200
+    except (Overloaded, DeadlineExceeded):
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'片段搜索失败: {e}'}), 500
+    finally:
+        if temp_path is not None:
+            _remove_file(temp_path)
+
+
+@app.route('/api/partitions', methods=['GET'])
+def partition_status():
+    """冷热分层状态：各分区的冷热、加载状态和估算大小 (未开启 HERITAGE_PARTITION_TIERING 时返回 404)"""
+    tiering = get_tiering(serving.collection) if serving.collection.ready else None
+    if tiering is None:
+        return jsonify({'success': False, 'message': '当前集合未开启分区冷热分层'}), 404
+    return jsonify({'success': True, 'data': tiering.status()}), 200
+
+
+@app.route('/api/load', methods=['GET'])
+def load_status():
+    """当前负载等级、并发和排队数量，以及各接口被拒绝和降级的次数"""
+    return jsonify({'success': True, 'data': admission.status()}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """以 Prometheus 文本格式输出各阶段耗时、计数和队列深度等指标"""
+    body, content_type = metrics.render_metrics()
+    return Response(body, content_type=content_type)
 
 
 if __name__ == '__main__':
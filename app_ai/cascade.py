@@ -0,0 +1,389 @@
+# 两阶段级联搜索：先用轻量级模型粗筛候选，再用已存储的 ResNet-18 特征重排序
+#
+#   python cascade.py sync [--prune] [--collection 名称]       # 为已有图片补齐粗筛特征
+#   python cascade.py bench [--queries 200] [--augment]       # 对比级联搜索与完整搜索的召回率和延迟
+#
+# 每个查询原本都要先跑一次 ResNet-18 前向计算。开启 HERITAGE_CASCADE=1 后：
+#   1. 用 MobileNetV3-Small (160x160，见 mobilenet.py) 提取查询图片的粗筛特征，
+#      在粗筛集合中检索 CANDIDATES 个候选；
+#   2. 从主集合按 ID 取出候选已存储的 ResNet-18 特征，在内存中按 L2 距离重排序，返回前 top_k 个。
+# 粗筛第 1 名足够近 (距离不超过 MATCH_DISTANCE) 且与第 2 名拉开差距 (不小于 MARGIN) 时，
+# 认为查询图片就是第 1 名 (常见于拍摄或截取库中的图片)，直接以第 1 名的 ResNet 特征作为查询向量重排序，
+# 不再对查询图片运行 ResNet；否则对查询图片运行 ResNet 后重排序。
+# 返回的距离始终是 ResNet 特征之间的 L2 距离，与完整搜索的结果可以直接比较。
+#
+# 粗筛特征保存在与主集合主键一致的粗筛集合 <集合名>_coarse 中，而不是主集合的第二个向量字段：
+# Milvus 不能给已有集合增加向量字段，独立的集合可以在线补齐，不需要重建主集合。
+# 服务进程中的后台线程定期补齐新入库的图片 (写缓冲写入后立即触发)，并在启动时做一次全量补齐；
+# 尚未补齐的新图片只能被完整搜索找到，候选不足或过滤后不足 top_k 个时自动退回完整搜索。
+# 分片集合和按分区加载的集合 (冷热分层) 不支持级联搜索。
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import importlib
+import numpy as np
+from pymilvus import FieldSchema, CollectionSchema, DataType
+from milvus_client import get_pool, get_collection, collection_name, index_params
+from image_metadata import build_filter_expr, METADATA_FIELDS
+from embedding_cache import extract_features_batch_cached
+from partition_tiering import scan, get_tiering
+from metrics import (stage_timer, CASCADE_QUERIES, CASCADE_MARGIN, STAGE_MILVUS_SEARCH, STAGE_MILVUS_QUERY,
+                     STAGE_RERANK)
+import image_store
+
+# --- 级联搜索配置 ---
+CASCADE_ENABLED = os.environ.get('HERITAGE_CASCADE', '0') == '1'
+# 粗筛集合名的后缀
+COARSE_SUFFIX = '_coarse'
+# 粗筛阶段检索的候选数量，越大召回率越高，重排序时从主集合读取的向量也越多
+CANDIDATES = int(os.environ.get('HERITAGE_CASCADE_CANDIDATES', '100'))
+# 粗筛第 1 名与查询的距离不超过 MATCH_DISTANCE、且与第 2 名的距离差不小于 MARGIN 时不运行 ResNet
+# (特征已 L2 归一化，距离为平方 L2 距离，取值 0-4)
+MATCH_DISTANCE = float(os.environ.get('HERITAGE_CASCADE_MATCH_DISTANCE', '0.1'))
+MARGIN = float(os.environ.get('HERITAGE_CASCADE_MARGIN', '0.1'))
+# 后台补齐粗筛特征的间隔 (秒)，以及增量补齐时回看的时间窗口 (秒)
+SYNC_INTERVAL = float(os.environ.get('HERITAGE_CASCADE_SYNC_INTERVAL', '60'))
+SYNC_LOOKBACK = 600
+# 后台全量补齐 (并清理已删除图片的粗筛特征) 的间隔 (秒)
+FULL_SYNC_INTERVAL = 6 * 3600
+# 每批补齐的行数
+SYNC_BATCH = 256
+DEFAULT_NPROBE = 10
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def coarse_name(name):
+    """返回主集合对应的粗筛集合名"""
+    return f"{name}{COARSE_SUFFIX}"
+
+
+def build_schema(dim):
+    """粗筛集合的 Schema：主键沿用主集合的 ID，只保存粗筛特征"""
+    return CollectionSchema(fields=[
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=dim),
+    ], description="非遗图像粗筛特征 (级联搜索第一阶段)")
+
+
+class CoarseIndex:
+    """一个主集合的粗筛集合：补齐粗筛特征并执行级联搜索"""
+
+    def __init__(self, collection, name):
+        """
+        参数:
+            collection (PooledCollection): 主集合，必须保存 ResNet 特征 (embedding 字段)。
+            name (str): 主集合的实际集合名 (不是别名)。
+        """
+        self.collection = collection
+        self.name = name
+        # 只在开启级联搜索时加载粗筛模型
+        self.model = importlib.import_module('mobilenet')
+        pool = get_pool()
+        self.coarse_name = coarse_name(name)
+        pool.ensure_collection(self.coarse_name, schema=build_schema(self.model.EMBEDDING_DIM),
+                               index_params=index_params)
+        self.index = pool.collection(self.coarse_name)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._synced = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        """完成首次全量补齐后才用于搜索 (例如索引重建后的新集合)，之前的查询使用完整搜索"""
+        return self._synced.is_set() and self.collection.ready and self.index.ready
+
+    # --- 补齐粗筛特征 ---
+    def sync(self, ingest_after=None, prune=False):
+        """
+        为主集合中还没有粗筛特征的行提取并写入粗筛特征。
+
+        参数:
+            ingest_after (int): 只检查该时间 (Unix 秒) 之后入库的行，旧版集合没有入库时间时检查全部行。
+            prune (bool): 同时删除主集合中已不存在的行的粗筛特征。
+
+        返回:
+            dict: {'added': 新写入数, 'errors': 提取失败数 (例如图片文件不存在)，'pruned': 清理数}。
+        """
+        stats = {'added': 0, 'errors': 0, 'pruned': 0}
+        expr = None
+        if ingest_after is not None and self.collection.has_metadata:
+            expr = build_filter_expr(ingest_after=ingest_after)
+        else:
+            ingest_after = None
+        for rows in scan(self.collection, ['id', 'image_filename', 'image_hash'], SYNC_BATCH, expr, ingest_after):
+            ids = [row['id'] for row in rows]
+            existing = {row['id'] for row in self.index.query(expr=f'id in {ids}', output_fields=['id'])}
+            missing = [row for row in rows if row['id'] not in existing]
+            if not missing:
+                continue
+            vectors, errors = extract_features_batch_cached(
+                self.model, [image_store.path(row['image_filename']) for row in missing],
+                [row['image_hash'] for row in missing])
+            done = [(row['id'], vector) for row, vector in zip(missing, vectors) if vector is not None]
+            stats['errors'] += len(errors)
+            if done:
+                self.index.insert([[pk for pk, _ in done], np.stack([vector for _, vector in done])])
+                stats['added'] += len(done)
+        if prune:
+            for rows in scan(self.index, ['id'], SYNC_BATCH):
+                ids = [row['id'] for row in rows]
+                present = {row['id'] for row in self.collection.query(expr=f'id in {ids}', output_fields=['id'])}
+                stale = [pk for pk in ids if pk not in present]
+                if stale:
+                    self.index.delete(f'id in {stale}')
+                    stats['pruned'] += len(stale)
+        return stats
+
+    def notify(self):
+        """有新行写入主集合时调用，让后台线程尽快补齐 (写缓冲的 on_flushed 回调)"""
+        self._wake.set()
+
+    def start(self):
+        """启动后台补齐线程：启动时全量补齐，之后定期增量补齐"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sync_loop, name='cascade-sync', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止后台补齐线程 (服务切换到其他集合后调用)"""
+        self._stop.set()
+        self._wake.set()
+
+    def _sync_loop(self):
+        last_full = None
+        last_started = None
+        while not self._stop.is_set():
+            started = time.time()
+            full = last_full is None or started - last_full >= FULL_SYNC_INTERVAL
+            try:
+                if self.ready:
+                    # 回看一段时间，覆盖补齐时图片文件还没有写入 (写缓冲先于文件复制) 的行
+                    stats = self.sync(None if full else int(last_started - SYNC_LOOKBACK), prune=full)
+                    if full:
+                        last_full = started
+                        self._synced.set()
+                    last_started = started
+                    if full or stats['added']:
+                        print(f"集合 {self.name} 已补齐 {stats['added']} 条粗筛特征，"
+                              f"失败 {stats['errors']} 条，清理 {stats['pruned']} 条")
+            except Exception as e:
+                print(f"补齐集合 {self.name} 的粗筛特征失败: {e}")
+            self._wake.wait(SYNC_INTERVAL)
+            if self._wake.is_set() and not self._stop.is_set():
+                # 写缓冲写入后触发：稍等片刻，让同一批次的图片文件写完
+                self._stop.wait(1.0)
+            self._wake.clear()
+
+    # --- 级联搜索 ---
+    def search(self, image_path, model, top_k=10, filters=None, nprobe=DEFAULT_NPROBE, timeout=None,
+               rerank=False, info=None):
+        """
+        级联搜索与查询图片相似的图片。
+
+        参数:
+            image_path (str): 查询图片路径。
+            model (module): 与主集合匹配的特征提取模型 (粗筛置信度不足时用于查询图片)。
+            top_k (int): 返回的结果数量。
+            filters (dict): 结构化过滤条件，参数见 image_metadata.build_filter_expr。
+            nprobe (int): 粗筛集合 IVF 索引搜索的聚类数量。
+            timeout (float): 每次 Milvus 调用的超时 (秒)。
+            rerank (bool): 总是对查询图片运行 ResNet 后重排序 (用于对比评估)。
+            info (dict): 对查询图片运行了 ResNet 时，查询向量写入 info['query_vector']，供后续完整搜索复用。
+
+        返回:
+            tuple: (results, path)。results 的格式与 search_images.search_similar_vectors 相同；
+                   path 为 'coarse' 或 'rerank'。候选不足 top_k 个时返回 None，调用方应改用完整搜索。
+        """
+        extra = {'timeout': timeout} if timeout is not None else {}
+        coarse_vector = self.model.extract_features(image_path)
+        with stage_timer(STAGE_MILVUS_SEARCH):
+            hits = self.index.search(data=[coarse_vector], anns_field="embedding",
+                                     param={"metric_type": "L2", "params": {"nprobe": nprobe}},
+                                     limit=max(CANDIDATES, top_k), output_fields=["id"], **extra)
+        hits = list(hits[0]) if hits else []
+        if len(hits) < top_k:
+            CASCADE_QUERIES.labels('fallback').inc()
+            return None
+        margin = hits[1].distance - hits[0].distance if len(hits) > 1 else float('inf')
+        CASCADE_MARGIN.observe(min(margin, 4.0))
+
+        # 从主集合取出候选的 ResNet 特征，同时应用过滤条件
+        output_fields = ["id", "image_filename"]
+        if self.collection.has_metadata:
+            output_fields += ["image_hash"] + METADATA_FIELDS
+        clauses = [f'id in {[hit.id for hit in hits]}', build_filter_expr(**(filters or {}))]
+        with stage_timer(STAGE_MILVUS_QUERY):
+            rows = self.collection.query(expr=' and '.join(f'({c})' for c in clauses if c),
+                                         output_fields=output_fields + ["embedding"], **extra)
+        if len(rows) < top_k:
+            CASCADE_QUERIES.labels('fallback').inc()
+            return None
+
+        best = next((row for row in rows if row['id'] == hits[0].id), None)
+        confident = (not rerank and best is not None and hits[0].distance <= MATCH_DISTANCE
+                     and margin >= MARGIN)
+        if confident:
+            path, query_vector = 'coarse', np.asarray(best['embedding'], dtype=np.float32)
+        else:
+            path, query_vector = 'rerank', model.extract_features(image_path)
+            if info is not None:
+                info['query_vector'] = query_vector
+        with stage_timer(STAGE_RERANK):
+            matrix = np.asarray([row['embedding'] for row in rows], dtype=np.float32)
+            distances = ((matrix - query_vector) ** 2).sum(axis=1)
+            order = np.argsort(distances, kind='stable')[:top_k]
+        CASCADE_QUERIES.labels(path).inc()
+
+        results = []
+        for i in order:
+            row = rows[i]
+            result = {'id': row['id'], 'distance': float(distances[i]),
+                      'filename': row.get('image_filename', '未知文件名')}
+            for field in output_fields[2:]:
+                result[field] = row.get(field)
+            results.append(result)
+        return results, path
+
+
+def get_coarse_index(collection, name, start=True):
+    """
+    返回主集合的粗筛集合 (同一集合共用一个)。未开启 HERITAGE_CASCADE 或集合不支持级联搜索时返回 None。
+
+    参数:
+        collection (PooledCollection): 主集合。
+        name (str): 主集合的实际集合名。
+        start (bool): 是否启动后台补齐线程。
+    """
+    if not CASCADE_ENABLED:
+        return None
+    if hasattr(type(collection), 'route') or get_tiering(collection) is not None:
+        print(f"集合 {name} 为分片集合或按分区加载，不使用级联搜索")
+        return None
+    with _indexes_lock:
+        index = _indexes.get(name)
+        if index is None:
+            index = _indexes[name] = CoarseIndex(collection, name)
+    if start:
+        index.start()
+    return index
+
+
+# --- 召回率与延迟评估 ---
+def _augment(image_path, directory, rng):
+    """模拟拍摄或截图的查询：随机裁掉边缘、缩小并以较低质量重新压缩为 JPEG"""
+    from PIL import Image
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+        width, height = image.size
+        keep = rng.uniform(0.8, 0.95)
+        left = rng.uniform(0, 1 - keep) * width
+        top = rng.uniform(0, 1 - keep) * height
+        image = image.crop((int(left), int(top), int(left + keep * width), int(top + keep * height)))
+        image.thumbnail((640, 640))
+        path = os.path.join(directory, f'{len(os.listdir(directory))}.jpg')
+        image.save(path, 'JPEG', quality=70)
+    return path
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q) * 1000) if values else 0.0
+
+
+def benchmark(index, model, image_paths, top_k=10, augment=False, seed=0):
+    """
+    用同一组查询图片分别执行完整搜索和级联搜索，以完整搜索的结果为基准计算级联搜索的召回率。
+
+    参数:
+        index (CoarseIndex): 粗筛集合。
+        model (module): 主集合的特征提取模型。
+        image_paths (list[str]): 查询图片。
+        top_k (int): 每次返回的结果数量。
+        augment (bool): 对查询图片随机裁剪和重新压缩，而不是直接使用库中的原图。
+
+    返回:
+        dict: 两种搜索的延迟分位数 (毫秒)、级联搜索的 recall@k 以及各路径的查询比例。
+    """
+    from search_images import search_similar_vectors
+    rng = random.Random(seed)
+    latencies = {'full': [], 'cascade': []}
+    recalls = []
+    paths = {'coarse': 0, 'rerank': 0, 'fallback': 0}
+    with tempfile.TemporaryDirectory() as directory:
+        for image_path in image_paths:
+            query = _augment(image_path, directory, rng) if augment else image_path
+            started = time.perf_counter()
+            expected = search_similar_vectors(model.extract_features(query), top_k=top_k,
+                                              target_collection=index.collection)
+            latencies['full'].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            outcome = index.search(query, model, top_k=top_k)
+            if outcome is None:
+                # 与服务中的处理一致：候选不足时退回完整搜索
+                results = search_similar_vectors(model.extract_features(query), top_k=top_k,
+                                                 target_collection=index.collection)
+                paths['fallback'] += 1
+            else:
+                results, path = outcome
+                paths[path] += 1
+            latencies['cascade'].append(time.perf_counter() - started)
+            if expected:
+                found = {r['id'] for r in results}
+                recalls.append(sum(1 for r in expected if r['id'] in found) / len(expected))
+    total = max(len(image_paths), 1)
+    return {
+        'queries': len(image_paths),
+        'top_k': top_k,
+        'augment': augment,
+        'latency_ms': {kind: {'mean': float(np.mean(values) * 1000) if values else 0.0,
+                              'p50': _percentile(values, 50), 'p95': _percentile(values, 95)}
+                       for kind, values in latencies.items()},
+        'recall_at_k': float(np.mean(recalls)) if recalls else None,
+        'paths': {path: count / total for path, count in paths.items()},
+    }
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from embedding_models import load_model, resolve_serving
+
+    parser = argparse.ArgumentParser(description="两阶段级联搜索：补齐粗筛特征和评估")
+    parser.add_argument('command', choices=['sync', 'bench'])
+    parser.add_argument('--collection', help="主集合的实际集合名，默认为当前服务的集合")
+    parser.add_argument('--prune', action='store_true', help="sync：同时清理已删除图片的粗筛特征")
+    parser.add_argument('--images', default=image_store.IMAGE_ROOT, help="bench：查询图片目录")
+    parser.add_argument('--queries', type=int, default=200, help="bench：查询数量")
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--augment', action='store_true', help="bench：随机裁剪并重新压缩查询图片")
+    args = parser.parse_args()
+
+    CASCADE_ENABLED = True
+    name, version = (args.collection, None) if args.collection else resolve_serving(collection_name)
+    target = get_collection(name)
+    coarse = get_coarse_index(target, name, start=False) if target.ready else None
+    if coarse is None or not coarse.index.ready:
+        print(f"集合 {name} 不可用或不支持级联搜索")
+        sys.exit(1)
+
+    if args.command == 'sync':
+        result = coarse.sync(prune=args.prune)
+        print(f"已补齐 {result['added']} 条粗筛特征，失败 {result['errors']} 条，清理 {result['pruned']} 条")
+        sys.exit(0)
+
+    from milvus_client import model_version_of
+    serving_model = load_model(version or model_version_of(name))
+    queries = image_store.list_images(args.images)
+    random.Random(0).shuffle(queries)
+    report = benchmark(coarse, serving_model, queries[:args.queries], top_k=args.top_k, augment=args.augment)
+    for kind, values in report['latency_ms'].items():
+        print(f"{kind:8s} 平均 {values['mean']:.1f} ms，p50 {values['p50']:.1f} ms，p95 {values['p95']:.1f} ms")
+    print(f"级联搜索 recall@{args.top_k}: {report['recall_at_k']}")
+    print("各路径比例: " + "，".join(f"{path} {ratio:.0%}" for path, ratio in report['paths'].items()))
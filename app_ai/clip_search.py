@@ -0,0 +1,318 @@
+# 视频片段搜索：用一小段视频查找它来自图片库中哪个视频的哪一段
+#
+#   python clip_search.py <视频路径> [--top-k 5] [--fps 2]
+#
+# 图片库中的视频抽帧按 时-分-秒-毫秒_视频名.jpg 命名，入库时解析出 source_video 和 frame_ts_ms (见 image_metadata.py)。
+# 查询流程：
+#   1. 按 SAMPLE_FPS 从查询片段中抽帧 (片段较长时降低抽帧频率，最多 MAX_FRAMES 帧)，
+#      并跳过与上一帧几乎相同的静止画面；
+#   2. 在内存中批量提取所有帧的特征 (不写临时文件)，在一次 Milvus 请求中搜索所有帧，
+#      每帧取 HITS_PER_FRAME 个最近的视频帧 (只搜索 frame_ts_ms >= 0 的抽帧图片)；
+#   3. 时间偏移投票：查询帧 (时间 t) 命中库中视频 v 的帧 (时间 s) 时，为 (v, s - t) 投一票，
+#      权重随距离线性减小。同一段内容的各帧命中同一个偏移，票数集中；偶然相似的画面偏移分散。
+#      偏移按 OFFSET_BIN_MS 分桶，相邻分桶合并计票，容忍库中抽帧间隔带来的误差；
+#      每个查询帧在同一个候选中只计一次。
+#   4. 按得分从高到低选出视频片段，同一视频中偏移相近的候选视为同一段，
+#      至少 MIN_MATCHED_FRAMES 个查询帧匹配时才返回。
+# 投票假设查询片段与库中视频的播放速度相同；对齐的计算量与 查询帧数 x HITS_PER_FRAME 成正比，
+# 几百帧的查询在毫秒级完成，耗时主要在抽帧和特征提取。
+# 解码视频需要 PyAV (pip install av)；未安装时可以由客户端抽帧后上传帧图片 (见 app_flask.py 的 /api/search_clip)。
+import os
+import sys
+import argparse
+import importlib.util
+import numpy as np
+from collections import defaultdict
+from image_metadata import parse_frame_filename
+from search_images import search_similar_vectors_batch, DEFAULT_NPROBE
+from resnet import load_image
+from metrics import stage_timer, CLIP_QUERY_FRAMES, CLIP_SEGMENTS, STAGE_VIDEO_DECODE, STAGE_CLIP_ALIGN
+
+# --- 片段搜索配置 ---
+# 查询片段的抽帧频率 (帧/秒) 和最多使用的帧数，片段较长时按 MAX_FRAMES 降低抽帧频率
+SAMPLE_FPS = float(os.environ.get('HERITAGE_CLIP_SAMPLE_FPS', '2'))
+MAX_FRAMES = int(os.environ.get('HERITAGE_CLIP_MAX_FRAMES', '240'))
+# 解码时把帧缩放到短边为该长度，减少预处理的计算量
+FRAME_SHORT_SIDE = 256
+# 与上一帧的 16x16 灰度缩略图平均像素差小于该值时视为静止画面并跳过，设为 0 时不跳过
+STATIC_DIFF = float(os.environ.get('HERITAGE_CLIP_STATIC_DIFF', '2.0'))
+# 每个查询帧在 ANN 搜索中取的最近邻数量
+HITS_PER_FRAME = int(os.environ.get('HERITAGE_CLIP_HITS_PER_FRAME', '20'))
+# 参与投票的最大距离 (特征已 L2 归一化，距离为平方 L2 距离，取值 0-4)
+MAX_DISTANCE = float(os.environ.get('HERITAGE_CLIP_MAX_DISTANCE', '0.5'))
+# 时间偏移分桶宽度 (毫秒)，应不小于图片库中视频的抽帧间隔的一半
+OFFSET_BIN_MS = int(os.environ.get('HERITAGE_CLIP_OFFSET_BIN_MS', '1000'))
+# 返回一个视频片段至少需要匹配的查询帧数量
+MIN_MATCHED_FRAMES = int(os.environ.get('HERITAGE_CLIP_MIN_FRAMES', '3'))
+# 支持上传的视频格式
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'mkv', 'webm', 'avi', 'flv', 'ts'}
+
+
+def _resize_to(width, height, short_side):
+    scale = short_side / min(width, height)
+    if scale >= 1:
+        return width, height
+    return max(1, int(width * scale + 0.5)), max(1, int(height * scale + 0.5))
+
+
+def has_video_decoder():
+    """是否已安装解码视频所需的 PyAV"""
+    return importlib.util.find_spec('av') is not None
+
+
+def sample_frames(video_path, fps=SAMPLE_FPS, max_frames=MAX_FRAMES):
+    """
+    按固定频率从视频中抽帧。
+
+    参数:
+        video_path (str): 视频文件路径 (或文件对象)。
+        fps (float): 抽帧频率 (帧/秒)，视频时长乘以 fps 超过 max_frames 时自动降低。
+        max_frames (int): 最多抽取的帧数。
+
+    返回:
+        list[tuple]: [(相对片段开头的时间毫秒数, PIL 图像)]，按时间排序。
+
+    异常:
+        RuntimeError: 未安装 PyAV。
+        ValueError: 文件中没有视频流，或文件无法解码 (损坏或不是视频文件)。
+    """
+    try:
+        import av
+        from av.error import FFmpegError
+    except ImportError:
+        raise RuntimeError("未安装 PyAV (pip install av)，无法解码视频，请上传抽好的帧图片")
+    try:
+        return _decode_frames(av, video_path, fps, max_frames)
+    except FFmpegError as e:
+        raise ValueError(f"无法解码视频: {e}") from e
+
+
+def _decode_frames(av, video_path, fps, max_frames):
+    frames = []
+    with stage_timer(STAGE_VIDEO_DECODE), av.open(video_path) as container:
+        if not container.streams.video:
+            raise ValueError("文件中没有视频流")
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'  # 多线程解码
+        duration = (float(stream.duration * stream.time_base) if stream.duration
+                    else container.duration / 1e6 if container.duration else None)
+        if duration and duration * fps > max_frames:
+            fps = max_frames / duration
+        interval_ms = 1000.0 / fps
+        start_ms = None
+        next_ms = 0.0
+        for frame in container.decode(stream):
+            if frame.time is None:
+                continue
+            if start_ms is None:
+                start_ms = frame.time * 1000
+            ts_ms = frame.time * 1000 - start_ms
+            if ts_ms < next_ms:
+                continue
+            # 只转换抽中的帧，并在转换时直接缩放
+            width, height = _resize_to(frame.width, frame.height, FRAME_SHORT_SIDE)
+            frames.append((int(ts_ms), frame.to_image(width=width, height=height)))
+            while next_ms <= ts_ms:
+                next_ms += interval_ms
+            if len(frames) >= max_frames:
+                break
+    return frames
+
+
+def load_frame_images(files, timestamps=None, fps=SAMPLE_FPS, max_frames=MAX_FRAMES):
+    """
+    读取客户端上传的帧图片。帧时间按以下顺序确定：timestamps 中的值、
+    按抽帧格式命名的文件名 (时-分-秒-毫秒_视频名.jpg)、按 fps 依次排列。
+
+    参数:
+        files (list[tuple]): [(文件名, 文件路径或文件对象)]，按时间顺序排列。
+        timestamps (list[int]): 各帧的时间毫秒数。
+        max_frames (int): 帧数超过时均匀抽取 max_frames 帧。
+
+    返回:
+        list[tuple]: [(时间毫秒数, PIL 图像)]，按时间排序。
+
+    异常:
+        ValueError: timestamps 与帧数不一致或图片无法解码。
+    """
+    if timestamps and len(timestamps) != len(files):
+        raise ValueError(f"frame_ts_ms 的数量 ({len(timestamps)}) 与帧数 ({len(files)}) 不一致")
+    keep = (np.linspace(0, len(files) - 1, max_frames).round().astype(int)
+            if len(files) > max_frames else range(len(files)))
+    frames = []
+    with stage_timer(STAGE_VIDEO_DECODE):
+        for i in keep:
+            filename, source = files[i]
+            ts_ms = int(timestamps[i]) if timestamps else parse_frame_filename(filename)[1]
+            if ts_ms < 0:
+                ts_ms = int(i * 1000 / fps)
+            try:
+                frames.append((ts_ms, load_image(source, min_side=FRAME_SHORT_SIDE)))
+            except Exception as e:
+                raise ValueError(f"帧图片 {filename} 无法解码: {e}")
+    frames.sort(key=lambda frame: frame[0])
+    return frames
+
+
+def drop_static_frames(frames, threshold=STATIC_DIFF):
+    """跳过与上一个保留帧几乎相同的帧 (静止画面)，保留的帧仍按时间排序"""
+    if threshold <= 0:
+        return frames
+    kept = []
+    previous = None
+    for ts_ms, image in frames:
+        thumb = np.asarray(image.convert('L').resize((16, 16)), dtype=np.float32)
+        if previous is not None and np.abs(thumb - previous).mean() < threshold:
+            continue
+        kept.append((ts_ms, image))
+        previous = thumb
+    return kept
+
+
+def _candidate(votes, video, center):
+    """合并相邻分桶的选票，每个查询帧只保留权重最高的命中，返回 {查询帧序号: (权重, 命中结果)}"""
+    merged = {}
+    for offset_bin in (center - 1, center, center + 1):
+        for index, vote in votes.get((video, offset_bin), {}).items():
+            if index not in merged or vote[0] > merged[index][0]:
+                merged[index] = vote
+    return merged
+
+
+def align(query_ts, hits_per_frame, top_k=5, bin_ms=OFFSET_BIN_MS, max_distance=MAX_DISTANCE,
+          min_frames=MIN_MATCHED_FRAMES):
+    """
+    按时间偏移投票，把各查询帧的命中结果对齐为视频片段。
+
+    参数:
+        query_ts (list[int]): 各查询帧相对片段开头的时间毫秒数。
+        hits_per_frame (list[list[dict]]): 各查询帧的搜索结果 (含 source_video 和 frame_ts_ms)。
+        top_k (int): 最多返回的视频片段数量。
+        bin_ms (int): 时间偏移分桶宽度 (毫秒)。
+        max_distance (float): 参与投票的最大距离。
+        min_frames (int): 视频片段至少需要匹配的查询帧数量。
+
+    返回:
+        list[dict]: 按得分降序排列的视频片段，包含 source_video、offset_ms (查询片段开头对应的视频时间)、
+                    start_ms / end_ms (匹配的视频帧时间范围)、query_start_ms / query_end_ms、
+                    matched_frames、coverage (匹配的查询帧比例)、score、mean_distance、
+                    best (距离最小的命中结果) 和 matches (逐帧的对应关系)。
+    """
+    votes = defaultdict(dict)  # (视频, 偏移分桶) -> {查询帧序号: (权重, 命中结果)}
+    for index, (ts_ms, hits) in enumerate(zip(query_ts, hits_per_frame)):
+        for hit in hits:
+            if hit['distance'] > max_distance or not hit.get('source_video') or hit.get('frame_ts_ms') is None \
+                    or hit['frame_ts_ms'] < 0:
+                continue
+            key = (hit['source_video'], int(round((hit['frame_ts_ms'] - ts_ms) / bin_ms)))
+            weight = 1.0 - hit['distance'] / max_distance
+            if index not in votes[key] or weight > votes[key][index][0]:
+                votes[key][index] = (weight, hit)
+
+    candidates = []
+    for video, center in votes:
+        merged = _candidate(votes, video, center)
+        if len(merged) >= min_frames:
+            candidates.append((sum(weight for weight, _ in merged.values()), video, center, merged))
+    candidates.sort(key=lambda c: (-c[0], c[1], c[2]))
+
+    # 同一视频中两个候选的偏移相差不超过查询片段的时长时，两段在视频中互相重叠，只保留得分高的一个
+    # (相邻分桶合并计票，偏移相差 2 个分桶以内的候选本身就是同一段的重复计数)
+    overlap_bins = max(2, (max(query_ts) - min(query_ts)) // bin_ms if query_ts else 0)
+    segments = []
+    chosen = defaultdict(list)
+    for score, video, center, merged in candidates:
+        if len(segments) >= top_k:
+            break
+        if any(abs(center - other) <= overlap_bins for other in chosen[video]):
+            continue
+        chosen[video].append(center)
+        matches = sorted(((query_ts[index], hit) for index, (_, hit) in merged.items()), key=lambda m: m[0])
+        distances = [hit['distance'] for _, hit in matches]
+        frame_ts = [hit['frame_ts_ms'] for _, hit in matches]
+        segments.append({
+            'source_video': video,
+            'offset_ms': int(np.median([hit['frame_ts_ms'] - ts_ms for ts_ms, hit in matches])),
+            'start_ms': min(frame_ts),
+            'end_ms': max(frame_ts),
+            'query_start_ms': matches[0][0],
+            'query_end_ms': matches[-1][0],
+            'matched_frames': len(matches),
+            'coverage': round(len(matches) / max(len(query_ts), 1), 4),
+            'score': round(score, 4),
+            'mean_distance': round(float(np.mean(distances)), 4),
+            'best': dict(min((hit for _, hit in matches), key=lambda hit: hit['distance'])),
+            'matches': [{'query_ts_ms': ts_ms, 'frame_ts_ms': hit['frame_ts_ms'], 'id': hit['id'],
+                         'filename': hit['filename'], 'distance': hit['distance']} for ts_ms, hit in matches]
+        })
+    return segments
+
+
+def search_clip(frames, model, collection, top_k=5, filters=None, nprobe=DEFAULT_NPROBE, deadline=None,
+                tier_info=None, static_diff=STATIC_DIFF):
+    """
+    用查询片段的帧搜索图片库中的视频片段。
+
+    参数:
+        frames (list[tuple]): [(时间毫秒数, PIL 图像)]，见 sample_frames / load_frame_images。
+        model (module): 与集合匹配的特征提取模型 (提供 extract_features_images)。
+        collection (PooledCollection): 要搜索的集合，需要包含视频帧元数据。
+        top_k (int): 最多返回的视频片段数量。
+        filters (dict): 结构化过滤条件，参数见 image_metadata.build_filter_expr。
+        deadline (admission.Deadline): 请求截止时间，特征提取后和搜索前检查。
+        tier_info (dict): 同 search_images.search_similar_vectors。
+
+    返回:
+        dict: {'segments': 视频片段列表 (见 align), 'frames': 抽取的帧数, 'searched_frames': 实际搜索的帧数}。
+    """
+    sampled = len(frames)
+    frames = drop_static_frames(frames, static_diff)
+    if not frames:
+        return {'segments': [], 'frames': sampled, 'searched_frames': 0}
+    CLIP_QUERY_FRAMES.observe(len(frames))
+    vectors = model.extract_features_images([image for _, image in frames])
+    if deadline is not None:
+        deadline.check('milvus_search')
+    hits = search_similar_vectors_batch(vectors, top_k=HITS_PER_FRAME, expr='frame_ts_ms >= 0', filters=filters,
+                                        target_collection=collection, nprobe=nprobe,
+                                        timeout=deadline.remaining if deadline else None,
+                                        deadline=deadline, tier_info=tier_info)
+    with stage_timer(STAGE_CLIP_ALIGN):
+        segments = align([ts_ms for ts_ms, _ in frames], hits, top_k=top_k)
+    CLIP_SEGMENTS.observe(len(segments))
+    return {'segments': segments, 'frames': sampled, 'searched_frames': len(frames)}
+
+
+def _format_ms(ms):
+    seconds, millis = divmod(int(ms), 1000)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}:{seconds:02d}.{millis:03d}"
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from milvus_client import get_collection
+    from embedding_models import load_model, resolve_serving
+
+    parser = argparse.ArgumentParser(description="视频片段搜索")
+    parser.add_argument('video', help="查询视频片段的路径")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--fps', type=float, default=SAMPLE_FPS, help="抽帧频率 (帧/秒)")
+    args = parser.parse_args()
+
+    target_name, model_version = resolve_serving()
+    target = get_collection(target_name)
+    if not target.ready or not target.has_metadata:
+        print(f"错误：集合 {target_name} 不可用或没有视频帧元数据")
+        sys.exit(1)
+    try:
+        query_frames = sample_frames(args.video, fps=args.fps)
+        result = search_clip(query_frames, load_model(model_version), target, top_k=args.top_k)
+    except Exception as e:
+        print(f"片段搜索失败: {e}")
+        sys.exit(1)
+    print(f"抽取 {result['frames']} 帧，搜索 {result['searched_frames']} 帧，匹配到 {len(result['segments'])} 个视频片段")
+    for rank, segment in enumerate(result['segments'], 1):
+        print(f"第{rank}个 {segment['source_video']}  {_format_ms(segment['start_ms'])} - {_format_ms(segment['end_ms'])}"
+              f"  片段开头对应 {_format_ms(max(segment['offset_ms'], 0))}  匹配 {segment['matched_frames']} 帧"
+              f" ({segment['coverage']:.0%})  得分 {segment['score']:.2f}  平均距离 {segment['mean_distance']:.3f}")
@@ -0,0 +1,317 @@
+# 集合导出 / 导入工具：不重新运行模型，直接按列搬运特征向量和元数据
+#
+#   python collection_transfer.py export <目录> [--collection 名称] [--shard-rows 100000]
+#   python collection_transfer.py import <目录> [--collection 名称] [--batch-rows 10000]
+#
+# 导出：用 query_iterator 按主键顺序遍历集合，每 shard-rows 行写一个 .npz 分片
+#       (embedding 为 float32 矩阵，其余字段为定长数组，不使用 pickle)，
+#       manifest.json 记录每个分片的行数、最后一个主键和 sha256。中断后从最后一个完整分片继续。
+# 导入：逐个校验分片的 sha256，按大批量列式数据写入目标集合 (按类别分区)，
+#       导入进度记录在 import-<集合名>.json 中，中断后跳过已完成的分片，
+#       未完成的分片按哈希值去重后继续写入。
+#
+# 主键由 Milvus 自动生成 (auto_id)，导入后的 id 与导出时不同；分片中保留原 id 仅供对照。
+# Milvus 的 bulk insert 要求文件位于 Milvus 使用的对象存储中，本工具改为通过 gRPC 写入大批量列数据。
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import numpy as np
+from milvus_client import (get_collection, resolve_alias, insert_rows, model_version_of, collection_name)
+from image_metadata import build_metadata, METADATA_FIELDS
+from image_catalog import get_catalog
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+# 每个分片的默认行数 (512 维时约 200MB)
+DEFAULT_SHARD_ROWS = 100000
+# query_iterator 每次返回的行数
+DEFAULT_ITERATOR_BATCH = 10000
+# 导入时每次 insert 的行数，需保证单次请求小于 Milvus 的 gRPC 消息上限 (默认 64MB)
+DEFAULT_BATCH_ROWS = 10000
+
+
+def sha256_file(path, chunk_size=4 * 1024 * 1024):
+    """计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json(path, data):
+    """先写临时文件再原子替换，避免中断时留下损坏的 JSON"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_shard(out_dir, index, columns):
+    """把一组列写成 .npz 分片，返回分片描述"""
+    name = f'shard-{index:05d}.npz'
+    path = os.path.join(out_dir, name)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return {
+        'file': name,
+        'rows': int(len(columns['id'])),
+        'last_id': int(columns['id'][-1]),
+        'sha256': sha256_file(path)
+    }
+
+
+class _ShardBuffer:
+    """
+    一个分片的列缓冲区：每批 query 结果到达时立即写入预分配的 numpy 数组，
+    不保留行字典 (float 列表形式的 embedding 比 float32 矩阵大约 8 倍)。
+
+    参数:
+        capacity (int): 分片行数。
+        dim (int): 特征向量维度。
+        fields (list): 除 id、embedding 外的输出字段。
+    """
+
+    def __init__(self, capacity, dim, fields):
+        self.capacity = capacity
+        self.size = 0
+        self.columns = {
+            'id': np.empty(capacity, dtype=np.int64),
+            'embedding': np.empty((capacity, dim), dtype=np.float32)
+        }
+        for field in fields:
+            # 字符串列的定长宽度要等整个分片到齐才能确定，先存为 object 数组
+            dtype = np.int64 if field in ('frame_ts_ms', 'ingest_time') else object
+            self.columns[field] = np.empty(capacity, dtype=dtype)
+
+    @property
+    def full(self):
+        return self.size >= self.capacity
+
+    def add(self, rows, start=0):
+        """把 rows[start:] 中能放下的行写入缓冲区，返回写入的行数"""
+        count = min(self.capacity - self.size, len(rows) - start)
+        chunk = rows[start:start + count]
+        end = self.size + count
+        for key, column in self.columns.items():
+            column[self.size:end] = [row[key] for row in chunk]
+        self.size = end
+        return count
+
+    def take(self):
+        """
+        返回已写入部分的列并清空缓冲区。
+
+        数值列是缓冲区的视图，必须在下一次 add 之前写出。
+        """
+        columns = {}
+        for key, column in self.columns.items():
+            part = column[:self.size]
+            columns[key] = part.astype(str) if part.dtype == object else part
+        self.size = 0
+        return columns
+
+
+def export_collection(out_dir, name=None, shard_rows=DEFAULT_SHARD_ROWS,
+                      iterator_batch=DEFAULT_ITERATOR_BATCH):
+    """
+    把集合导出为列式分片。
+
+    参数:
+        out_dir (str): 输出目录。
+        name (str): 集合名或别名，默认为当前服务的集合。
+        shard_rows (int): 每个分片的行数。
+        iterator_batch (int): 每次从 Milvus 读取的行数。
+
+    返回:
+        dict: 导出完成后的 manifest。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    source_name = resolve_alias(name or collection_name)
+    if source_name is None:
+        raise RuntimeError(f"集合 {name or collection_name} 不存在")
+    collection = get_collection(source_name)
+    if not collection.ready:
+        raise RuntimeError(f"集合 {source_name} 不可用")
+
+    fields = ["image_filename", "image_hash"] + (METADATA_FIELDS if collection.has_metadata else [])
+    dim = next(f.params['dim'] for f in collection.schema.fields if f.name == 'embedding')
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    manifest = _read_json(manifest_path)
+    if manifest is not None and manifest['collection'] != source_name:
+        raise RuntimeError(f"目录中已有集合 {manifest['collection']} 的导出，请换一个目录")
+    if manifest is None:
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'collection': source_name,
+            'model_version': model_version_of(source_name),
+            'dim': dim,
+            'fields': fields,
+            'shards': [],
+            'complete': False
+        }
+    elif manifest['complete']:
+        print(f"{out_dir} 中的导出已完成，共 {sum(s['rows'] for s in manifest['shards'])} 行")
+        return manifest
+
+    # 从最后一个完整分片之后继续 (query_iterator 按主键升序返回)
+    last_id = manifest['shards'][-1]['last_id'] if manifest['shards'] else None
+    exported = sum(s['rows'] for s in manifest['shards'])
+    if last_id is not None:
+        print(f"从主键 {last_id} 之后继续导出，已导出 {exported} 行")
+
+    started = time.time()
+    iterator = collection.query_iterator(
+        batch_size=iterator_batch,
+        expr=f"id > {last_id}" if last_id is not None else None,
+        output_fields=["id", "embedding"] + fields)
+    buffer = _ShardBuffer(shard_rows, dim, fields)
+
+    def flush():
+        nonlocal exported
+        shard = _write_shard(out_dir, len(manifest['shards']), buffer.take())
+        manifest['shards'].append(shard)
+        _write_json(manifest_path, manifest)
+        exported += shard['rows']
+        print(f"已写入分片 {shard['file']} ({shard['rows']} 行)，累计 {exported} 行，"
+              f"{exported / max(time.time() - started, 1e-6):.0f} 行/秒")
+
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            start = 0
+            while start < len(rows):
+                start += buffer.add(rows, start)
+                if buffer.full:
+                    flush()
+        if buffer.size:
+            flush()
+    finally:
+        iterator.close()
+
+    manifest['complete'] = True
+    manifest['exported_at'] = int(time.time())
+    _write_json(manifest_path, manifest)
+    print(f"导出完成：{exported} 行，{len(manifest['shards'])} 个分片")
+    return manifest
+
+
+def _existing_hashes(collection, hashes, chunk_size=1000):
+    """查询目标集合中已存在的哈希值 (仅用于续传未完成的分片)"""
+    existing = set()
+    hashes = list(set(hashes))
+    for i in range(0, len(hashes), chunk_size):
+        chunk = hashes[i:i + chunk_size]
+        results = collection.query(
+            expr='image_hash in [' + ', '.join(f'"{h}"' for h in chunk) + ']',
+            output_fields=["image_hash"], consistency_level="Strong")
+        existing.update(item['image_hash'] for item in results)
+    return existing
+
+
+def import_collection(in_dir, name=None, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    把导出的分片写入目标集合 (不存在时按分片的向量维度创建)。
+
+    参数:
+        in_dir (str): 导出目录。
+        name (str): 目标集合名或别名，默认为当前服务的集合。
+        batch_rows (int): 每次 insert 的行数。
+
+    返回:
+        int: 本次写入的行数。
+    """
+    manifest = _read_json(os.path.join(in_dir, MANIFEST_NAME))
+    if manifest is None:
+        raise RuntimeError(f"{in_dir} 中没有 {MANIFEST_NAME}")
+    if not manifest['complete']:
+        raise RuntimeError("导出尚未完成，请先完成导出")
+    target_name = resolve_alias(name or collection_name) or name or collection_name
+    collection = get_collection(target_name, create=True, dim=manifest['dim'])
+    if not collection.ready:
+        raise RuntimeError(f"集合 {target_name} 不可用")
+
+    progress_path = os.path.join(in_dir, f'import-{target_name}.json')
+    progress = _read_json(progress_path) or {'done': [], 'started': None}
+    total = sum(s['rows'] for s in manifest['shards'])
+    imported = sum(s['rows'] for s in manifest['shards'] if s['file'] in progress['done'])
+    written = 0
+    started = time.time()
+    for shard in manifest['shards']:
+        if shard['file'] in progress['done']:
+            continue
+        path = os.path.join(in_dir, shard['file'])
+        if sha256_file(path) != shard['sha256']:
+            raise RuntimeError(f"分片 {shard['file']} 校验失败，文件可能已损坏")
+        with np.load(path) as data:
+            columns = {key: data[key] for key in data.files}
+
+        rows = np.arange(len(columns['id']))
+        if progress['started'] == shard['file']:
+            # 上次导入在这个分片中途中断，跳过已写入的行
+            existing = _existing_hashes(collection, columns['image_hash'].tolist())
+            rows = np.array([i for i in rows if columns['image_hash'][i] not in existing], dtype=np.int64)
+            print(f"续传分片 {shard['file']}：跳过已写入的 {shard['rows'] - len(rows)} 行")
+        progress['started'] = shard['file']
+        _write_json(progress_path, progress)
+
+        for start in range(0, len(rows), batch_rows):
+            batch = rows[start:start + batch_rows]
+            filenames = columns['image_filename'][batch].tolist()
+            if all(field in columns for field in METADATA_FIELDS):
+                metadata = [{field: columns[field][i].item() for field in METADATA_FIELDS} for i in batch]
+            else:
+                metadata = [build_metadata(filename) for filename in filenames]
+            hashes = columns['image_hash'][batch].tolist()
+            primary_keys = insert_rows(collection, columns['embedding'][batch], filenames, hashes, metadata)
+            get_catalog().record(target_name, primary_keys, filenames, hashes, metadata)
+            written += len(batch)
+
+        progress['done'].append(shard['file'])
+        progress['started'] = None
+        _write_json(progress_path, progress)
+        imported += shard['rows']
+        print(f"已导入分片 {shard['file']}，进度 {imported}/{total} 行，"
+              f"{written / max(time.time() - started, 1e-6):.0f} 行/秒")
+
+    collection.flush()
+    print(f"导入完成：本次写入 {written} 行，目标集合 {target_name}")
+    return written
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="导出 / 导入 Milvus 集合的特征向量和元数据")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('directory', help="分片所在目录")
+    parser.add_argument('--collection', help="集合名或别名，默认为当前服务的集合")
+    parser.add_argument('--shard-rows', type=int, default=DEFAULT_SHARD_ROWS)
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_BATCH_ROWS)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'export':
+            export_collection(args.directory, args.collection, shard_rows=args.shard_rows)
+        else:
+            import_collection(args.directory, args.collection, batch_rows=args.batch_rows)
+    except Exception as e:
+        print(f"执行 {args.command} 失败: {e}")
+        sys.exit(1)
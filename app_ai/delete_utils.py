@@ -1,36 +1,39 @@
 import os
-from pymilvus import connections, Collection, utility
+from milvus_client import get_pool, get_collection, collection_name
+from image_catalog import catalog_name as resolve_catalog_name
+from reconcile import get_store
+import image_store
 
 # --- Milvus 连接配置 ---
-def connect_to_milvus(host='192.168.1.100', port='19530', alias='default'):
-    """连接到 Milvus 服务器"""
-    if not connections.has_connection(alias):
-        print(f"正在连接到 Milvus 服务器 {host}:{port}...")
-        connections.connect(alias=alias, host=host, port=port)
-        print("成功连接到 Milvus。")
-    else:
+def connect_to_milvus():
+    """连接到 Milvus 服务器 (使用共享连接池，地址由 MILVUS_ENDPOINTS 环境变量配置)"""
+    pool = get_pool()
+    if pool.is_healthy():
         print("已存在 Milvus 连接。")
+    else:
+        print("Milvus 连接暂不可用，连接池将在后台自动重连。")
 
 # --- Milvus 集合配置 ---
-collection_name = "intangible_cultural_heritage_images"  # 与 app_flask.py 和其他脚本保持一致
+# collection_name 从 milvus_client 导入，与 app_flask.py 和其他脚本保持一致
 
 def load_milvus_collection(collection_name_to_load):
     """加载指定的 Milvus 集合"""
-    if utility.has_collection(collection_name_to_load):
-        collection = Collection(name=collection_name_to_load)
-        try:
-            collection.load()
-            print(f"成功加载集合 {collection_name_to_load}。")
-            return collection
-        except Exception as load_err:
-            print(f"加载集合 {collection_name_to_load} 失败: {load_err}")
-            return None
-    else:
-        print(f"错误：集合 {collection_name_to_load} 不存在。")
-        return None
+    collection = get_collection(collection_name_to_load)
+    if collection.ready:
+        print(f"成功加载集合 {collection_name_to_load}。")
+        return collection
+    print(f"错误：集合 {collection_name_to_load} 不存在或加载失败。")
+    return None
+
+def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path, catalog=None, catalog_name=None):
+    """
+    从Milvus数据库和文件系统中删除选定的图片。
 
-def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path):
-    """从Milvus数据库和文件系统中删除选定的图片"""
+    提供已同步的图片目录库 (image_catalog.ImageCatalog) 时从目录库查找文件名，
+    不再查询 Milvus；删除后同时从目录库中移除这些记录。
+    删除 Milvus 记录前把要删除的文件登记到删除日志，文件删除完成后移除登记，
+    进程在两步之间崩溃时由 reconcile.py 补做文件删除。
+    """
     if collection is None:
         return {'success': False, 'message': 'Milvus 集合未加载，无法执行删除操作。', 'deleted_count': 0, 'errors': ['Milvus collection not loaded.']}
 
@@ -59,10 +62,14 @@ def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path):
         expr = f"id in [{id_list_str}]"
         print(f"查询表达式: {expr}")
 
-        results = collection.query(
-            expr=expr,
-            output_fields=["id", "image_filename"],
-        )
+        if catalog is not None and catalog.is_synced(catalog_name):
+            results = [{'id': item['id'], 'image_filename': item['filename']}
+                       for item in catalog.get(catalog_name, processed_image_ids).values()]
+        else:
+            results = collection.query(
+                expr=expr,
+                output_fields=["id", "image_filename"],
+            )
         print(f"查询到 {len(results)} 条记录准备删除")
 
         if not results:
@@ -71,9 +78,13 @@ def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path):
             errors.append("建议使用list_images_utils.py脚本列出所有图片ID，确认要删除的ID是否存在。")
             return {'success': True, 'message': '没有与提供的ID匹配的图片可删除。', 'deleted_count': 0, 'errors': errors}
 
-        # 删除Milvus中的记录
+        # 登记要删除的文件，再删除Milvus中的记录
+        journal_name = catalog_name or resolve_catalog_name(collection)
+        get_store().begin_delete(journal_name, results)
         delete_result = collection.delete(expr)
         print(f"Milvus 删除结果: {delete_result}")
+        if catalog is not None:
+            catalog.remove(catalog_name, [item['id'] for item in results])
 
         # 删除对应的图片文件
         print(f"开始删除 {len(results)} 个图片文件")
@@ -84,10 +95,9 @@ def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path):
                     errors.append(f"ID {item.get('id')} 的记录缺少 image_filename 字段。")
                     continue
                 
-                image_path = os.path.join(app_root_path, 'static', 'images', image_filename)
+                image_path = image_store.path(image_filename)
                 print(f"尝试删除文件: {image_path}")
-                if os.path.exists(image_path):
-                    os.remove(image_path)
+                if image_store.remove(image_filename):
                     print(f"成功删除文件: {image_filename}")
                     deleted_count += 1
                 else:
@@ -98,7 +108,8 @@ def delete_images_from_milvus_and_fs(collection, image_ids, app_root_path):
                 error_msg = f"删除文件 {item.get('image_filename', '未知文件')} (ID: {item.get('id')}) 失败: {file_err}"
                 print(error_msg)
                 errors.append(error_msg)
-        
+        get_store().end_delete(journal_name, [item['id'] for item in results])
+
         return {'success': True, 'message': f'成功删除 {deleted_count} 个图片', 'deleted_count': deleted_count, 'errors': errors}
 
     except Exception as e:
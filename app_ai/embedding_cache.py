@@ -0,0 +1,360 @@
+# 特征向量磁盘缓存：按图片内容的 MD5 和模型版本保存已提取的特征向量
+#
+# 重建集合、调整索引参数或重新入库移动过的文件时，直接从缓存读取特征向量，不再重新运行模型。
+# 每个模型版本一个只追加的文件 <缓存目录>/<模型版本>.emb：
+#   文件头 16 字节 (魔数、格式版本、向量维度)，之后为定长记录 (MD5 16 字节 + crc32 + float32 向量)。
+# 写入时持有文件排他锁 (fcntl.flock) 并一次性追加整条记录，多个进程 (Flask、迁移工具、入库脚本)
+# 可以同时读写；进程崩溃留下的半条记录会在下次写入时截掉，crc 不匹配的记录按未命中处理。
+# 文件达到大小上限后不再追加；python embedding_cache.py compact 会去掉重复记录，
+# 并可只保留图片目录库中仍存在的图片。
+#
+# 配置：HERITAGE_EMBEDDING_CACHE=0 关闭缓存；HERITAGE_EMBEDDING_CACHE_DIR 缓存目录；
+#       HERITAGE_EMBEDDING_CACHE_MAX_MB 每个模型版本的文件大小上限 (MB)。
+import os
+import sys
+import zlib
+import struct
+import argparse
+import threading
+import numpy as np
+from metrics import CACHE_HITS, CACHE_MISSES
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只保证单进程内的并发安全
+    fcntl = None
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# --- 缓存配置 ---
+CACHE_ENABLED = os.environ.get('HERITAGE_EMBEDDING_CACHE', '1') != '0'
+CACHE_DIR = os.environ.get('HERITAGE_EMBEDDING_CACHE_DIR', os.path.join(APP_ROOT, 'embedding_cache'))
+CACHE_MAX_BYTES = int(float(os.environ.get('HERITAGE_EMBEDDING_CACHE_MAX_MB', '4096')) * 1024 * 1024)
+
+MAGIC = b'HEMB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sII4x')  # 魔数、格式版本、向量维度，共 16 字节
+
+
+def _record_dtype(dim):
+    return np.dtype([('key', 'V16'), ('crc', '<u4'), ('vector', '<f4', (dim,))])
+
+
+def _read(fd, size, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def _write(fd, data, offset):
+    os.lseek(fd, offset, os.SEEK_SET)
+    os.write(fd, data)
+
+
+class EmbeddingCache:
+    """
+    一个模型版本的特征向量缓存。
+
+    内存中只保存 MD5 -> 记录偏移量的索引，向量按需从文件读取；
+    其他进程追加的记录在下一次查询时增量读入索引，压缩后 (文件被替换) 重新建立索引。
+    """
+
+    def __init__(self, path, dim, max_bytes=CACHE_MAX_BYTES):
+        """
+        参数:
+            path (str): 缓存文件路径，不存在时创建。
+            dim (int): 向量维度，与已有文件不一致时抛出 ValueError。
+            max_bytes (int): 文件大小上限，达到后不再追加新记录。
+        """
+        self.path = path
+        self.dim = dim
+        self.max_bytes = max_bytes
+        self.dtype = _record_dtype(dim)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._inode = None
+        self._offset = HEADER.size
+        self._full_warned = False
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = self._open_locked()
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.write(fd, HEADER.pack(MAGIC, FORMAT_VERSION, dim))
+            self._check_header(fd)
+        finally:
+            os.close(fd)
+
+    def _check_header(self, fd):
+        magic, version, dim = HEADER.unpack(_read(fd, HEADER.size, 0))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{self.path} 不是特征向量缓存文件")
+        if dim != self.dim:
+            raise ValueError(f"{self.path} 的向量维度为 {dim}，与模型的 {self.dim} 维不一致")
+
+    # --- 索引 ---
+    def _refresh(self, fd):
+        """读入上次之后追加的完整记录；文件被压缩替换后从头重建索引。调用方持有 self._lock"""
+        stat = os.fstat(fd)
+        if stat.st_ino != self._inode:
+            self._inode = stat.st_ino
+            self._index = {}
+            self._offset = HEADER.size
+        end = HEADER.size + (stat.st_size - HEADER.size) // self.dtype.itemsize * self.dtype.itemsize
+        if end <= self._offset:
+            return
+        keys = np.frombuffer(_read(fd, end - self._offset, self._offset), dtype=self.dtype)['key'].tobytes()
+        for i in range(len(keys) // 16):
+            self._index[keys[i * 16:(i + 1) * 16]] = self._offset + i * self.dtype.itemsize
+        self._offset = end
+
+    def _open(self):
+        return os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+
+    def _open_locked(self):
+        """
+        打开缓存文件并加排他锁，关闭文件时释放锁。
+        加锁前文件恰好被其他进程压缩替换时重新打开。
+        """
+        while True:
+            fd = self._open()
+            if fcntl is None:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def __len__(self):
+        fd = self._open()
+        try:
+            with self._lock:
+                self._refresh(fd)
+                return len(self._index)
+        finally:
+            os.close(fd)
+
+    # --- 读写 ---
+    def get_many(self, image_hashes):
+        """
+        批量读取缓存。
+
+        参数:
+            image_hashes (list[str]): 图片内容的 MD5 (十六进制)。
+
+        返回:
+            dict: {MD5: float32 向量}，只包含命中的条目。
+        """
+        found = {}
+        fd = self._open()
+        try:
+            with self._lock:
+                self._refresh(fd)
+                offsets = [(self._index.get(bytes.fromhex(h)), h) for h in set(image_hashes)]
+            # 按偏移量顺序读取，尽量顺序访问磁盘
+            for offset, image_hash in sorted(o for o in offsets if o[0] is not None):
+                record = np.frombuffer(_read(fd, self.dtype.itemsize, offset), dtype=self.dtype)[0]
+                vector = record['vector']
+                if zlib.crc32(vector.tobytes()) == int(record['crc']):
+                    found[image_hash] = vector.copy()
+        finally:
+            os.close(fd)
+        return found
+
+    def put_many(self, image_hashes, vectors):
+        """
+        追加缓存记录，已存在的 MD5 跳过。文件达到大小上限时不再写入。
+
+        返回:
+            int: 实际追加的记录数量。
+        """
+        fd = self._open_locked()
+        try:
+            with self._lock:
+                self._refresh(fd)
+                size = os.fstat(fd).st_size
+                if size != self._offset:
+                    # 其他进程写到一半崩溃留下的半条记录
+                    os.ftruncate(fd, self._offset)
+                new = {}
+                for image_hash, vector in zip(image_hashes, vectors):
+                    key = bytes.fromhex(image_hash)
+                    if key not in self._index and key not in new:
+                        new[key] = vector
+                if not new:
+                    return 0
+                room = (self.max_bytes - self._offset) // self.dtype.itemsize
+                if room < len(new):
+                    if not self._full_warned:
+                        print(f"特征向量缓存 {self.path} 已达到大小上限，新记录不再写入，"
+                              "可执行 python embedding_cache.py compact 清理")
+                        self._full_warned = True
+                    new = dict(list(new.items())[:max(room, 0)])
+                    if not new:
+                        return 0
+                records = np.zeros(len(new), dtype=self.dtype)
+                for i, (key, vector) in enumerate(new.items()):
+                    vector = np.asarray(vector, dtype=np.float32).reshape(self.dim)
+                    records[i] = (key, zlib.crc32(vector.tobytes()), vector)
+                _write(fd, records.tobytes(), self._offset)
+                for key in new:
+                    self._index[key] = self._offset
+                    self._offset += self.dtype.itemsize
+                return len(new)
+        finally:
+            os.close(fd)
+
+    def compact(self, keep=None):
+        """
+        重写缓存文件：去掉损坏和重复的记录，提供 keep 时只保留其中的 MD5。
+        新文件写完后原子替换，其他进程在下一次访问时重新建立索引。
+
+        参数:
+            keep (set[str]): 需要保留的 MD5 集合，为 None 时保留全部。
+
+        返回:
+            tuple: (压缩前记录数, 压缩后记录数)。
+        """
+        fd = self._open_locked()
+        try:
+            with self._lock:
+                self._refresh(fd)
+                before = (self._offset - HEADER.size) // self.dtype.itemsize
+                keep_keys = None if keep is None else {bytes.fromhex(h) for h in keep}
+                tmp = self.path + '.compact'
+                kept = 0
+                with open(tmp, 'wb') as out:
+                    out.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.dim))
+                    for key, offset in sorted(self._index.items(), key=lambda item: item[1]):
+                        if keep_keys is not None and key not in keep_keys:
+                            continue
+                        data = _read(fd, self.dtype.itemsize, offset)
+                        record = np.frombuffer(data, dtype=self.dtype)[0]
+                        if zlib.crc32(record['vector'].tobytes()) != int(record['crc']):
+                            continue
+                        out.write(data)
+                        kept += 1
+                    out.flush()
+                    os.fsync(out.fileno())
+                os.replace(tmp, self.path)
+                self._inode = None
+                self._full_warned = False
+                return before, kept
+        finally:
+            os.close(fd)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(model):
+    """
+    返回模型对应的缓存，缓存已关闭或无法打开时返回 None。
+
+    参数:
+        model (module): 特征提取模型 (见 embedding_models.load_model)，需提供 MODEL_VERSION 和 EMBEDDING_DIM。
+    """
+    if not CACHE_ENABLED:
+        return None
+    version = model.MODEL_VERSION
+    with _caches_lock:
+        if version not in _caches:
+            try:
+                _caches[version] = EmbeddingCache(os.path.join(CACHE_DIR, f'{version}.emb'),
+                                                  model.EMBEDDING_DIM)
+            except (OSError, ValueError) as e:
+                print(f"无法打开特征向量缓存，不使用缓存: {e}")
+                _caches[version] = None
+        return _caches[version]
+
+
+def _put(cache, image_hashes, vectors):
+    try:
+        cache.put_many(image_hashes, vectors)
+    except OSError as e:
+        # 缓存写入失败 (例如磁盘已满) 不影响入库
+        print(f"写入特征向量缓存失败: {e}")
+
+
+def extract_features_cached(model, image_path, image_hash):
+    """
+    提取单张图片的特征向量，优先读取缓存。未命中时调用 model.extract_features 并写入缓存。
+
+    参数:
+        model (module): 特征提取模型。
+        image_path (str): 图片路径。
+        image_hash (str): 图片内容的 MD5。
+
+    返回:
+        numpy.ndarray: 特征向量。
+    """
+    cache = get_cache(model)
+    if cache is not None:
+        found = cache.get_many([image_hash])
+        if image_hash in found:
+            CACHE_HITS.labels('embedding').inc()
+            return found[image_hash]
+        CACHE_MISSES.labels('embedding').inc()
+    vector = model.extract_features(image_path)
+    if cache is not None:
+        _put(cache, [image_hash], [vector])
+    return vector
+
+
+def extract_features_batch_cached(model, image_paths, image_hashes):
+    """
+    批量提取特征向量，缓存命中的图片不再运行模型，其余图片批量提取后写入缓存。
+
+    参数:
+        model (module): 特征提取模型。
+        image_paths (list[str]): 图片路径列表。
+        image_hashes (list[str]): 与 image_paths 对应的 MD5 列表。
+
+    返回:
+        tuple: (vectors, errors)，含义与 model.extract_features_batch 相同。
+    """
+    cache = get_cache(model)
+    if cache is None:
+        return model.extract_features_batch(image_paths)
+    found = cache.get_many(image_hashes)
+    vectors = [found.get(h) for h in image_hashes]
+    misses = [i for i, vector in enumerate(vectors) if vector is None]
+    CACHE_HITS.labels('embedding').inc(len(image_paths) - len(misses))
+    CACHE_MISSES.labels('embedding').inc(len(misses))
+    errors = {}
+    if misses:
+        extracted, errors = model.extract_features_batch([image_paths[i] for i in misses])
+        done = [(i, vector) for i, vector in zip(misses, extracted) if vector is not None]
+        for i, vector in done:
+            vectors[i] = vector
+        if done:
+            _put(cache, [image_hashes[i] for i, _ in done], [vector for _, vector in done])
+    return vectors, errors
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from embedding_models import load_model, DEFAULT_MODEL_VERSION, MODELS
+
+    parser = argparse.ArgumentParser(description="特征向量缓存管理")
+    parser.add_argument('command', choices=['stats', 'compact'])
+    parser.add_argument('--model', default=DEFAULT_MODEL_VERSION, choices=sorted(MODELS))
+    parser.add_argument('--keep-catalog', action='store_true',
+                        help="压缩时只保留图片目录库中仍存在的图片")
+    args = parser.parse_args()
+
+    cache = get_cache(load_model(args.model))
+    if cache is None:
+        print("特征向量缓存未启用")
+        sys.exit(1)
+    if args.command == 'compact':
+        keep = None
+        if args.keep_catalog:
+            from image_catalog import get_catalog
+            keep = get_catalog().all_hashes()
+        before, after = cache.compact(keep)
+        print(f"压缩完成：{before} 条 -> {after} 条")
+    print(f"{cache.path}: {len(cache)} 条，{os.path.getsize(cache.path) / 1024 / 1024:.1f} MB "
+          f"(上限 {cache.max_bytes / 1024 / 1024:.0f} MB)")
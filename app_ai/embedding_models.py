@@ -0,0 +1,49 @@
+import importlib
+
+# --- 特征提取模型注册表 ---
+# 模型版本 -> 实现该模型的模块名。模块需要提供:
+#   MODEL_VERSION (str)、EMBEDDING_DIM (int)、
+#   extract_features(image_path)、extract_features_batch(image_paths, batch_size)
+#   和 extract_features_images(images, batch_size) (已解码的 PIL 图像，用于视频片段搜索)
+# 接入新模型时新增一个这样的模块并在此登记，再用 model_migration.py 迁移到新版本的集合。
+MODELS = {
+    'resnet18_v1': 'resnet',
+}
+# 尚未进行版本化迁移的旧集合中的特征由该版本的模型生成
+DEFAULT_MODEL_VERSION = 'resnet18_v1'
+
+
+def load_model(version=None):
+    """
+    加载指定版本的特征提取模型 (模块只在首次导入时加载权重)。
+
+    参数:
+        version (str): 模型版本，为空时使用 DEFAULT_MODEL_VERSION。
+
+    返回:
+        module: 提供 extract_features / extract_features_batch 的模块。
+    """
+    version = version or DEFAULT_MODEL_VERSION
+    if version not in MODELS:
+        raise ValueError(f"未知的模型版本: {version}，可选: {', '.join(MODELS)}")
+    module = importlib.import_module(MODELS[version])
+    if module.MODEL_VERSION != version:
+        raise ValueError(f"模块 {MODELS[version]} 的模型版本为 {module.MODEL_VERSION}，与登记的 {version} 不一致")
+    return module
+
+
+def resolve_serving(name=None):
+    """
+    解析当前对外服务的集合及其模型版本。
+
+    参数:
+        name (str): 对外使用的集合名 (别名)，默认为 milvus_client.collection_name。
+
+    返回:
+        tuple: (实际集合名, 模型版本)。集合尚不存在时返回 (name, DEFAULT_MODEL_VERSION)；
+               未版本化的旧集合使用 DEFAULT_MODEL_VERSION。
+    """
+    from milvus_client import resolve_alias, model_version_of, collection_name
+    name = name or collection_name
+    target = resolve_alias(name) or name
+    return target, model_version_of(target, name) or DEFAULT_MODEL_VERSION
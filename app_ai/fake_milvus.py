@@ -0,0 +1,411 @@
+# 内存版 Milvus 替身，用于在没有 Milvus 服务器的环境中做压测和联调
+#
+# install() 会替换 milvus_client 模块中的 connections、utility 和 Collection，
+# 连接池、集合代理、写缓冲等上层代码保持不变，因此压测覆盖的仍是真实的调用路径。
+# 只实现了本项目用到的接口；向量搜索为暴力 L2 计算，过滤表达式按 Python 表达式求值
+# (本项目使用的 ==、in [...]、>=、and、or 等写法与 Python 语法一致)。
+import re
+import time
+import threading
+import numpy as np
+
+# 每次调用前的模拟网络/服务端延迟 (秒)
+DEFAULT_LATENCY = 0.0
+
+
+class _LoadState(str):
+    pass
+
+
+class _MutationResult:
+    def __init__(self, primary_keys):
+        self.primary_keys = primary_keys
+        self.insert_count = len(primary_keys)
+        self.delete_count = len(primary_keys)
+
+
+class _Entity:
+    def __init__(self, row):
+        self._row = row
+
+    def get(self, field, default=None):
+        return self._row.get(field, default)
+
+
+class _Hit:
+    def __init__(self, pk, distance, row):
+        self.id = pk
+        self.distance = distance
+        self.entity = _Entity(row)
+
+
+class _Store:
+    """一个集合的数据：按主键保存的行和按行顺序排列的向量矩阵"""
+
+    def __init__(self, name, schema):
+        self.name = name
+        self.schema = schema
+        self.field_names = [f.name for f in schema.fields]
+        # 主键不是自动生成时由插入的数据提供 (例如 cascade.py 的粗筛集合沿用主集合的 ID)
+        self.auto_id = next((bool(f.auto_id) for f in schema.fields if f.is_primary), True)
+        self.rows = []  # 每行为 dict，包含 id、_partition 以及各字段
+        self.vectors = np.empty((0, _dim(schema)), dtype=np.float32)
+        self.partitions = {'_default'}
+        self.indexed = False
+        self.index_params = None
+        self.loaded = False  # 整个集合已加载 (之后创建的分区也视为已加载)
+        self.loaded_partitions = set()  # 只加载了部分分区时已加载的分区
+        self.lock = threading.Lock()
+
+    def is_loaded(self, partition):
+        return self.loaded or partition in self.loaded_partitions
+
+    def check_loaded(self, partition_names):
+        """与 Milvus 一致：指定了未加载的分区时报错，未指定时只访问已加载的分区"""
+        if partition_names is None:
+            if not self.loaded and not self.loaded_partitions:
+                raise _error(f"collection not loaded[collection={self.name}]")
+            return None if self.loaded else set(self.loaded_partitions)
+        for partition in partition_names:
+            if not self.is_loaded(partition):
+                raise _error(f"partition not loaded[partition={partition}]")
+        return set(partition_names)
+
+
+def _dim(schema):
+    for field in schema.fields:
+        if field.name == 'embedding':
+            return int(field.params['dim'])
+    return 0
+
+
+def _compile(expr):
+    if not expr:
+        return None
+    expr = expr.replace('&&', ' and ').replace('||', ' or ')
+    # 前缀匹配 field like "abc%" 转换为 field.startswith("abc")
+    expr = re.sub(r'(\w+)\s+like\s+"([^"%]*)%"', r'\1.startswith("\2")', expr)
+    return compile(expr, '<milvus-expr>', 'eval')
+
+
+def _matches(code, row):
+    return code is None or bool(eval(code, {'__builtins__': {}}, row))
+
+
+class FakeMilvus:
+    """进程内共享的内存 Milvus 服务端"""
+
+    def __init__(self, latency=DEFAULT_LATENCY):
+        self.latency = latency
+        self.collections = {}
+        self.aliases = {}
+        self._next_id = int(time.time() * 1000) << 12  # 与 Milvus 自动主键类似的递增 ID
+        self._lock = threading.Lock()
+
+    def _delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def resolve(self, name):
+        name = self.aliases.get(name, name)
+        if name not in self.collections:
+            raise _error(f"collection not found[collection={name}]")
+        return self.collections[name]
+
+    def next_ids(self, count):
+        with self._lock:
+            start = self._next_id
+            self._next_id += count
+        return list(range(start, start + count))
+
+
+def _error(message):
+    from pymilvus.exceptions import MilvusException
+    return MilvusException(message=message)
+
+
+class FakeConnections:
+    def __init__(self):
+        self._aliases = set()
+
+    def has_connection(self, alias):
+        return alias in self._aliases
+
+    def connect(self, alias='default', **kwargs):
+        self._aliases.add(alias)
+
+    def disconnect(self, alias):
+        self._aliases.discard(alias)
+
+
+class FakeUtility:
+    def __init__(self, server):
+        self.server = server
+
+    def has_collection(self, name, using='default', timeout=None):
+        self.server._delay()
+        return name in self.server.collections or name in self.server.aliases
+
+    def load_state(self, name, partition_names=None, using='default', timeout=None):
+        store = self.server.resolve(name)
+        if partition_names:
+            loaded = all(store.is_loaded(p) for p in partition_names)
+        else:
+            loaded = store.loaded or bool(store.loaded_partitions)
+        return _LoadState('LoadState.Loaded' if loaded else 'LoadState.NotLoad')
+
+    def get_server_version(self, using='default', timeout=None):
+        return 'fake'
+
+    def list_collections(self, timeout=None, using='default', **kwargs):
+        return list(self.server.collections)
+
+    def list_aliases(self, collection_name, timeout=None, using='default'):
+        return [a for a, target in self.server.aliases.items() if target == collection_name]
+
+    def create_alias(self, collection_name, alias, timeout=None, using='default'):
+        if alias in self.server.aliases or alias in self.server.collections:
+            raise _error(f"alias {alias} already exist")
+        self.server.aliases[alias] = collection_name
+
+    def alter_alias(self, collection_name, alias, timeout=None, using='default'):
+        if alias not in self.server.aliases:
+            raise _error(f"alias {alias} not exist")
+        self.server.aliases[alias] = collection_name
+
+    def drop_alias(self, alias, timeout=None, using='default'):
+        self.server.aliases.pop(alias, None)
+
+    def rename_collection(self, old_collection_name, new_collection_name, new_db_name='',
+                          timeout=None, using='default'):
+        store = self.server.collections.pop(old_collection_name)
+        store.name = new_collection_name
+        self.server.collections[new_collection_name] = store
+
+    def index_building_progress(self, collection_name, index_name='', timeout=None, using='default'):
+        # 内存版没有异步建索引，写入的行立即可搜索
+        rows = len(self.server.resolve(collection_name).rows)
+        return {'total_rows': rows, 'indexed_rows': rows, 'pending_index_rows': 0}
+
+    def drop_collection(self, name, timeout=None, using='default'):
+        self.server.collections.pop(name, None)
+
+
+class FakeCollection:
+    """与 pymilvus.Collection 接口相同的内存集合 (只实现本项目用到的方法)"""
+
+    server = None
+
+    def __init__(self, name, schema=None, using='default', **kwargs):
+        server = FakeCollection.server
+        if name not in server.collections and name not in server.aliases:
+            if schema is None:
+                raise _error(f"collection not found[collection={name}]")
+            server.collections[name] = _Store(name, schema)
+        self.name = name
+
+    @property
+    def _store(self):
+        return FakeCollection.server.resolve(self.name)
+
+    @property
+    def schema(self):
+        return self._store.schema
+
+    @property
+    def num_entities(self):
+        return len(self._store.rows)
+
+    def has_index(self, timeout=None, **kwargs):
+        return self._store.indexed
+
+    def create_index(self, field_name, index_params, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        self._store.indexed = True
+        self._store.index_params = dict(index_params)
+
+    @property
+    def indexes(self):
+        store = self._store
+        return [_Index('embedding', store.index_params)] if store.indexed else []
+
+    def load(self, partition_names=None, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        if partition_names is None:
+            self._store.loaded = True
+        else:
+            self._store.loaded_partitions.update(partition_names)
+
+    def release(self, timeout=None, **kwargs):
+        self._store.loaded = False
+        self._store.loaded_partitions.clear()
+
+    @property
+    def partitions(self):
+        return [_Partition(self._store, name) for name in sorted(self._store.partitions)]
+
+    def partition(self, partition_name, **kwargs):
+        if partition_name not in self._store.partitions:
+            return None
+        return _Partition(self._store, partition_name)
+
+    def flush(self, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+
+    def describe(self, timeout=None):
+        return {'collection_name': self._store.name}
+
+    def has_partition(self, partition_name, timeout=None):
+        return partition_name in self._store.partitions
+
+    def create_partition(self, partition_name, timeout=None, **kwargs):
+        self._store.partitions.add(partition_name)
+
+    def insert(self, data, partition_name=None, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        store = self._store
+        names = [n for n in store.field_names if n != 'id' or not store.auto_id]
+        count = len(data[0])
+        if store.auto_id:
+            ids = FakeCollection.server.next_ids(count)
+        else:
+            ids = [int(pk) for pk in data[names.index('id')]]
+        vectors = np.asarray(data[names.index('embedding')], dtype=np.float32).reshape(count, -1)
+        rows = []
+        for i in range(count):
+            row = {'id': ids[i], '_partition': partition_name or '_default'}
+            for name, column in zip(names, data):
+                if name not in ('id', 'embedding'):
+                    value = column[i]
+                    row[name] = value.item() if hasattr(value, 'item') else value
+            rows.append(row)
+        with store.lock:
+            store.rows.extend(rows)
+            store.vectors = np.vstack([store.vectors, vectors])
+        return _MutationResult(ids)
+
+    def delete(self, expr, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        store = self._store
+        code = _compile(expr)
+        with store.lock:
+            matched = [_matches(code, row) for row in store.rows]
+            deleted = [row['id'] for row, hit in zip(store.rows, matched) if hit]
+            keep = [i for i, hit in enumerate(matched) if not hit]
+            store.rows = [store.rows[i] for i in keep]
+            store.vectors = store.vectors[keep]
+        return _MutationResult(deleted)
+
+    def _select(self, expr, partition_names=None):
+        store = self._store
+        partition_names = store.check_loaded(partition_names)
+        code = _compile(expr)
+        with store.lock:
+            rows = list(store.rows)
+            vectors = store.vectors
+        indices = [i for i, row in enumerate(rows)
+                   if (partition_names is None or row['_partition'] in partition_names)
+                   and _matches(code, row)]
+        return rows, vectors, indices
+
+    @staticmethod
+    def _project(row, output_fields, vectors=None, index=None):
+        result = {'id': row['id']}
+        for field in output_fields or []:
+            if field == 'embedding':
+                result[field] = vectors[index].tolist()
+            elif field in row:
+                result[field] = row[field]
+        return result
+
+    def query(self, expr='', output_fields=None, partition_names=None, limit=None, offset=0,
+              timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        rows, vectors, indices = self._select(expr, partition_names)
+        indices = indices[offset:offset + limit] if limit else indices[offset:]
+        return [self._project(rows[i], output_fields, vectors, i) for i in indices]
+
+    def query_iterator(self, batch_size=1000, limit=-1, expr=None, output_fields=None,
+                       partition_names=None, timeout=None, **kwargs):
+        rows, vectors, indices = self._select(expr, partition_names)
+        indices = sorted(indices, key=lambda i: rows[i]['id'])
+        if limit is not None and limit >= 0:
+            indices = indices[:limit]
+        results = [self._project(rows[i], output_fields, vectors, i) for i in indices]
+        return _Iterator(results, batch_size)
+
+    def search(self, data, anns_field, param, limit, expr=None, partition_names=None,
+               output_fields=None, timeout=None, **kwargs):
+        FakeCollection.server._delay()
+        rows, vectors, indices = self._select(expr, partition_names)
+        all_hits = []
+        for query in np.asarray(data, dtype=np.float32).reshape(len(data), -1):
+            if not indices:
+                all_hits.append([])
+                continue
+            candidates = vectors[indices]
+            distances = ((candidates - query) ** 2).sum(axis=1)
+            order = np.argsort(distances)[:limit]
+            all_hits.append([_Hit(rows[indices[j]]['id'], float(distances[j]),
+                                  self._project(rows[indices[j]], output_fields)) for j in order])
+        return all_hits
+
+
+class _Index:
+    def __init__(self, field_name, params):
+        self.field_name = field_name
+        self.params = params or {}
+
+
+class _Partition:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+
+    @property
+    def num_entities(self):
+        return sum(1 for row in self._store.rows if row['_partition'] == self.name)
+
+    def load(self, timeout=None, **kwargs):
+        self._store.loaded_partitions.add(self.name)
+
+    def release(self, timeout=None, **kwargs):
+        if self._store.loaded:
+            # 整个集合加载后释放单个分区：其余分区保持加载
+            self._store.loaded = False
+            self._store.loaded_partitions = set(self._store.partitions)
+        self._store.loaded_partitions.discard(self.name)
+
+
+class _Iterator:
+    def __init__(self, results, batch_size):
+        self._results = results
+        self._batch_size = batch_size
+        self._offset = 0
+
+    def next(self):
+        batch = self._results[self._offset:self._offset + self._batch_size]
+        self._offset += self._batch_size
+        return batch
+
+    def close(self):
+        pass
+
+
+def install(latency=DEFAULT_LATENCY):
+    """
+    用内存版替身替换 milvus_client 使用的 pymilvus 接口，必须在创建连接池之前调用。
+
+    参数:
+        latency (float): 每次调用模拟的服务端延迟 (秒)。
+
+    返回:
+        FakeMilvus: 内存服务端，可用于预置数据或检查状态。
+    """
+    import milvus_client
+    server = FakeMilvus(latency)
+    FakeCollection.server = server
+    milvus_client.connections = FakeConnections()
+    milvus_client.utility = FakeUtility(server)
+    milvus_client.Collection = FakeCollection
+    return server
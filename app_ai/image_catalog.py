@@ -0,0 +1,365 @@
+# 图片目录库：在本地 SQLite 中保存每张已入库图片的主键、文件名、哈希值、大小、入库时间和路径
+#
+# 查重、列表 (分页、排序、前缀过滤) 和删除前的文件名查找都走目录库，Milvus 只负责向量搜索。
+# 默认与入库任务队列一样使用 app_django 的 SQLite 数据库 (HERITAGE_DB_PATH)，表名以 image_catalog 为前缀。
+#
+# 目录库按实际集合名分开记录。写缓冲写入 Milvus 成功后登记新行；首次使用某个集合时
+# 由后台线程用 query_iterator 从 Milvus 全量同步，同步完成前查重和列表仍直接查询 Milvus。
+# 绕过本服务写入 Milvus 后 (例如 collection_transfer.py import) 可执行 python image_catalog.py sync 重新同步。
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+from ingest_queue import DB_PATH, _Transaction
+from milvus_client import resolve_alias
+from image_metadata import METADATA_FIELDS
+import partition_tiering
+import image_store
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_catalog (
+    collection TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    image_hash TEXT NOT NULL,
+    size INTEGER,
+    category TEXT,
+    ingest_time INTEGER,
+    path TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS image_catalog_filename ON image_catalog (collection, filename);
+CREATE INDEX IF NOT EXISTS image_catalog_hash ON image_catalog (collection, image_hash);
+CREATE INDEX IF NOT EXISTS image_catalog_ingest_time ON image_catalog (collection, ingest_time, id);
+CREATE INDEX IF NOT EXISTS image_catalog_size ON image_catalog (collection, size, id);
+CREATE TABLE IF NOT EXISTS image_catalog_state (
+    collection TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    row_count INTEGER NOT NULL
+);
+"""
+
+# 列表接口允许的排序字段
+SORT_FIELDS = {'id': 'id', 'filename': 'filename', 'ingest_time': 'ingest_time', 'size': 'size'}
+# 单条 SQL 中 IN (...) 的参数个数上限
+_CHUNK = 500
+
+
+def image_path(filename):
+    """返回图片相对于 static 目录的路径 (由 /static/images/<文件名> 路由按存储布局解析)"""
+    return f'images/{filename}'
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(image_store.path(filename))
+    except OSError:
+        return None
+
+
+class ImageCatalog:
+    """
+    基于 SQLite 的图片目录库。
+
+    每个线程使用独立的 autocommit 连接；写操作在 BEGIN IMMEDIATE 事务中执行。
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._syncing = set()
+        self._sync_lock = threading.Lock()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    # --- 写入 ---
+    def record(self, collection, primary_keys, filenames, hashes, metadata=None):
+        """
+        登记已写入 Milvus 的行。
+
+        参数:
+            collection (str): 实际集合名。
+            primary_keys (list[int]): Milvus 返回的实体 ID。
+            filenames (list[str]): 图像文件名。
+            hashes (list[str]): 图像内容的 MD5 哈希值。
+            metadata (list[dict]): 每行的元数据 (见 image_metadata.build_metadata)，
+                                   其中的 file_size 为文件大小，缺省时读取图片目录中的文件。
+        """
+        now = time.time()
+        rows = []
+        for i, (pk, filename, image_hash) in enumerate(zip(primary_keys, filenames, hashes)):
+            meta = metadata[i] if metadata else {}
+            size = meta.get('file_size')
+            rows.append((collection, int(pk), filename, image_hash,
+                         size if size is not None else _file_size(filename),
+                         meta.get('category'), meta.get('ingest_time'), image_path(filename), now))
+        with _Transaction(self._connect()) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO image_catalog (collection, id, filename, image_hash, size, '
+                'category, ingest_time, path, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def record_buffer_rows(self, collection, rows, primary_keys):
+        """InsertBuffer 的 on_flushed 回调：rows 为 (embedding, filename, image_hash, metadata) 列表"""
+        self.record(collection, primary_keys, [row[1] for row in rows], [row[2] for row in rows],
+                    [row[3] for row in rows])
+
+    def remove(self, collection, ids):
+        """删除给定主键的行"""
+        ids = [int(i) for i in ids]
+        with _Transaction(self._connect()) as conn:
+            for i in range(0, len(ids), _CHUNK):
+                chunk = ids[i:i + _CHUNK]
+                conn.execute(f'DELETE FROM image_catalog WHERE collection = ? AND id IN '
+                             f'({",".join("?" * len(chunk))})', [collection] + chunk)
+
+    # --- 查询 ---
+    def is_synced(self, collection):
+        """目录库是否已与该集合完成过全量同步 (之后的写入由写缓冲回调登记)"""
+        row = self._connect().execute(
+            'SELECT 1 FROM image_catalog_state WHERE collection = ?', (collection,)).fetchone()
+        return row is not None
+
+    def find_existing(self, collection, filenames, hashes):
+        """
+        批量查重。
+
+        返回:
+            tuple: (已存在的文件名集合, 已存在的哈希值集合)。
+        """
+        conn = self._connect()
+        existing_filenames = set()
+        existing_hashes = set()
+        for column, values, found in (('filename', list(set(filenames)), existing_filenames),
+                                      ('image_hash', list(set(hashes)), existing_hashes)):
+            for i in range(0, len(values), _CHUNK):
+                chunk = values[i:i + _CHUNK]
+                found.update(row[0] for row in conn.execute(
+                    f'SELECT {column} FROM image_catalog WHERE collection = ? AND {column} IN '
+                    f'({",".join("?" * len(chunk))})', [collection] + chunk))
+        return existing_filenames, existing_hashes
+
+    def exists(self, collection, filename, image_hash):
+        """是否已有相同文件名或相同哈希值的图片"""
+        row = self._connect().execute(
+            'SELECT 1 FROM image_catalog WHERE collection = ? AND filename = ? UNION ALL '
+            'SELECT 1 FROM image_catalog WHERE collection = ? AND image_hash = ? LIMIT 1',
+            (collection, filename, collection, image_hash)).fetchone()
+        return row is not None
+
+    def list_images(self, collection, prefix='', sort='id', order='desc', offset=0, limit=1000):
+        """
+        分页列出图片。
+
+        参数:
+            prefix (str): 文件名前缀，为空时不过滤。
+            sort (str): 排序字段，见 SORT_FIELDS。
+            order (str): asc 或 desc。
+
+        返回:
+            tuple: (当前页的行列表, 满足条件的总行数)。
+        """
+        column = SORT_FIELDS.get(sort)
+        if column is None:
+            raise ValueError(f"不支持的排序字段: {sort}")
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"不支持的排序方向: {order}")
+        where = 'collection = ?'
+        params = [collection]
+        if prefix:
+            # 用范围条件代替 LIKE，可以使用 (collection, filename) 索引
+            where += ' AND filename >= ? AND filename < ?'
+            params += [prefix, prefix + '\U0010ffff']
+        conn = self._connect()
+        total = conn.execute(f'SELECT COUNT(*) FROM image_catalog WHERE {where}', params).fetchone()[0]
+        tiebreak = f', id {order}' if column != 'id' else ''
+        rows = conn.execute(
+            f'SELECT id, filename, image_hash, size, category, ingest_time, path FROM image_catalog '
+            f'WHERE {where} ORDER BY {column} {order}{tiebreak} LIMIT ? OFFSET ?',
+            params + [limit, offset]).fetchall()
+        return [dict(row) for row in rows], total
+
+    def get(self, collection, ids):
+        """按主键查询行，返回 {id: 行} 字典"""
+        ids = [int(i) for i in ids]
+        conn = self._connect()
+        result = {}
+        for i in range(0, len(ids), _CHUNK):
+            chunk = ids[i:i + _CHUNK]
+            for row in conn.execute(
+                    f'SELECT id, filename, image_hash, size, category, ingest_time, path FROM image_catalog '
+                    f'WHERE collection = ? AND id IN ({",".join("?" * len(chunk))})', [collection] + chunk):
+                result[row['id']] = dict(row)
+        return result
+
+    def all_hashes(self):
+        """所有集合中已登记的图片哈希值集合"""
+        return {row[0] for row in self._connect().execute('SELECT DISTINCT image_hash FROM image_catalog')}
+
+    def count(self, collection):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM image_catalog WHERE collection = ?', (collection,)).fetchone()[0]
+
+    def rename(self, old, new):
+        """集合重命名后 (见 milvus_client.adopt_alias) 把目录记录移到新名称下"""
+        with _Transaction(self._connect()) as conn:
+            conn.execute('UPDATE image_catalog SET collection = ? WHERE collection = ?', (new, old))
+            conn.execute('UPDATE image_catalog_state SET collection = ? WHERE collection = ?', (new, old))
+
+    def drop(self, collection):
+        """集合被删除后 (见 index_rebuild.py) 删除它的全部目录记录"""
+        with _Transaction(self._connect()) as conn:
+            conn.execute('DELETE FROM image_catalog WHERE collection = ?', (collection,))
+            conn.execute('DELETE FROM image_catalog_state WHERE collection = ?', (collection,))
+
+    # --- 与 Milvus 同步 ---
+    def invalidate(self, collection):
+        """标记目录库需要重新同步，之后的查重和列表改为直接查询 Milvus"""
+        self._connect().execute('DELETE FROM image_catalog_state WHERE collection = ?', (collection,))
+
+    def sync(self, name, collection, batch_size=5000):
+        """
+        从 Milvus 全量同步一个集合的目录。
+
+        同步期间写缓冲登记的新行会保留；同步开始前登记、但 Milvus 中已不存在的行会被删除。
+
+        参数:
+            name (str): 实际集合名 (目录库中的键)。
+            collection (PooledCollection): 集合代理对象。
+            batch_size (int): query_iterator 每次返回的行数。
+
+        返回:
+            int: 同步的行数。
+        """
+        started = time.time()
+        output_fields = ["id", "image_filename", "image_hash"]
+        if collection.has_metadata:
+            output_fields += METADATA_FIELDS
+        conn = self._connect()
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS image_catalog_seen (id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM image_catalog_seen')
+        synced = 0
+        # 按分区加载 (冷热分层) 的集合逐个加载分区遍历，保证不会漏掉冷分区中的行
+        for rows in partition_tiering.scan(collection, output_fields, batch_size):
+            self.record(name, [row['id'] for row in rows], [row['image_filename'] for row in rows],
+                        [row['image_hash'] for row in rows],
+                        [{field: row.get(field) for field in METADATA_FIELDS} for row in rows])
+            conn.executemany('INSERT OR IGNORE INTO image_catalog_seen (id) VALUES (?)',
+                             [(row['id'],) for row in rows])
+            synced += len(rows)
+        with _Transaction(conn):
+            conn.execute('DELETE FROM image_catalog WHERE collection = ? AND recorded_at < ? '
+                         'AND id NOT IN (SELECT id FROM image_catalog_seen)', (name, started))
+            conn.execute('INSERT OR REPLACE INTO image_catalog_state (collection, synced_at, row_count) '
+                         'VALUES (?, ?, ?)', (name, time.time(), synced))
+        conn.execute('DELETE FROM image_catalog_seen')
+        print(f"图片目录库已与集合 {name} 同步，共 {synced} 条")
+        return synced
+
+    def ensure_synced(self, name, collection, retry_interval=10.0):
+        """
+        集合尚未同步时启动后台线程，等待集合可用后执行全量同步。同一集合只会有一个同步线程。
+        """
+        if self.is_synced(name):
+            return
+        with self._sync_lock:
+            if name in self._syncing:
+                return
+            self._syncing.add(name)
+
+        def run():
+            try:
+                while True:
+                    if collection.ready:
+                        try:
+                            self.sync(name, collection)
+                            return
+                        except Exception as e:
+                            print(f"同步图片目录库失败，稍后重试: {e}")
+                    time.sleep(retry_interval)
+            finally:
+                with self._sync_lock:
+                    self._syncing.discard(name)
+
+        threading.Thread(target=run, name='catalog-sync', daemon=True).start()
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """返回进程内共享的图片目录库"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = ImageCatalog()
+        return _catalog
+
+
+# 别名解析结果的缓存秒数：别名可能被其他进程 (index_rebuild、model_migration) 切换，
+# 缓存过期后重新解析；Flask 服务的别名检查线程每次检查时直接刷新 (见 remember_alias)
+ALIAS_CACHE_TTL = float(os.environ.get('HERITAGE_CATALOG_ALIAS_TTL', '30'))
+_aliases = {}  # 别名 -> (实际集合名, 过期时间 monotonic)
+_aliases_lock = threading.Lock()
+
+
+def remember_alias(alias, name):
+    """记录刚解析出的别名指向 (别名切换检查时调用)，之后 ALIAS_CACHE_TTL 秒内不再查询 Milvus"""
+    with _aliases_lock:
+        _aliases[alias] = (name, time.monotonic() + ALIAS_CACHE_TTL)
+
+
+def catalog_name(collection):
+    """
+    返回集合在目录库中的键：别名解析为实际集合名，分片集合使用分片配置。
+
+    解析结果缓存 ALIAS_CACHE_TTL 秒，查重和列表接口不必每次都查询 Milvus。
+    Milvus 不可用时暂时使用集合代理的名称，不缓存。
+    """
+    name = collection.name
+    if hasattr(type(collection), 'route'):
+        return name
+    with _aliases_lock:
+        cached = _aliases.get(name)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+    try:
+        resolved = resolve_alias(name) or name
+    except Exception:
+        return name
+    remember_alias(name, resolved)
+    return resolved
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from milvus_client import get_collection, collection_name
+    from sharding import get_sharded_collection
+
+    parser = argparse.ArgumentParser(description="图片目录库管理")
+    parser.add_argument('command', choices=['status', 'sync'])
+    parser.add_argument('--collection', help="集合名或别名，默认为当前服务的集合 (或 HERITAGE_SHARDS 分片)")
+    args = parser.parse_args()
+
+    target = (get_sharded_collection() if not args.collection else None) \
+        or get_collection(args.collection or collection_name)
+    if not target.ready:
+        print(f"集合 {target.name} 不可用，请检查 Milvus 服务状态")
+        sys.exit(1)
+    catalog = get_catalog()
+    name = catalog_name(target)
+    if args.command == 'sync':
+        catalog.sync(name, target)
+    print(f"集合 {name}：Milvus {target.num_entities} 条，目录库 {catalog.count(name)} 条，"
+          f"{'已同步' if catalog.is_synced(name) else '未同步'}")
@@ -0,0 +1,165 @@
+import os
+import re
+import time
+import hashlib
+from image_store import original_name
+
+# --- 标量元数据配置 ---
+# 未指定分类时使用的默认分类
+DEFAULT_CATEGORY = "未分类"
+# 元数据字段名，与 milvus_client 中的 Schema 定义保持一致
+METADATA_FIELDS = ["category", "source_video", "frame_ts_ms", "ingest_time"]
+# VARCHAR 字段的 max_length (按 UTF-8 编码的字节数计算)，与 milvus_client 中的 Schema 定义保持一致
+CATEGORY_MAX_BYTES = 64
+SOURCE_VIDEO_MAX_BYTES = 255
+# 冷热分层：每个类别再按入库月份拆分为多个分区，服务只常驻加载最近的分区 (见 partition_tiering.py)
+PARTITION_TIERING = os.environ.get('HERITAGE_PARTITION_TIERING', '0') == '1'
+# 按月份拆分的分区名后缀：_yyyymm
+PARTITION_MONTH_PATTERN = re.compile(r'^(cat_[0-9a-f]{12})_(\d{6})$')
+
+# 视频抽帧文件名格式：时-分-秒-毫秒_视频名.扩展名，例如 00-04-55-000_2025-05-17-_____.jpg
+FRAME_FILENAME_PATTERN = re.compile(r'^(\d{2})-(\d{2})-(\d{2})-(\d{3})_(.+?)(\.[A-Za-z0-9]+)?$')
+
+
+def parse_frame_filename(filename):
+    """
+    从视频抽帧文件名中解析来源视频和帧时间戳。
+
+    参数:
+        filename (str): 图像文件名，例如 00-04-55-000_2025-05-17-_____.jpg；
+                        存储时为避免重名追加的哈希后缀 (见 image_store.original_name) 不计入视频名。
+
+    返回:
+        tuple: (来源视频名, 帧时间戳毫秒数)。文件名不符合抽帧格式时返回 ("", -1)。
+    """
+    match = FRAME_FILENAME_PATTERN.match(original_name(filename))
+    if not match:
+        return "", -1
+    hours, minutes, seconds, millis = (int(match.group(i)) for i in range(1, 5))
+    frame_ts_ms = ((hours * 60 + minutes) * 60 + seconds) * 1000 + millis
+    return match.group(5), frame_ts_ms
+
+
+def truncate_utf8(text, max_bytes):
+    """
+    把字符串截断到 UTF-8 编码后不超过 max_bytes 字节，不会截断在多字节字符中间。
+    Milvus VARCHAR 的 max_length 按字节计算，按字符截断的中文字符串仍可能超长，导致整批写入失败。
+    """
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode('utf-8', errors='ignore')
+
+
+def build_metadata(filename, category=None, ingest_time=None, file_size=None):
+    """
+    构造写入 Milvus 的标量元数据。
+
+    参数:
+        filename (str): 图像文件名。
+        category (str): 非遗类别，默认为 DEFAULT_CATEGORY。
+        ingest_time (int): 入库时间 (Unix 秒)，默认为当前时间。
+        file_size (int): 文件大小 (字节)，只记录在本地图片目录库中，不写入 Milvus。
+
+    返回:
+        dict: 包含 category、source_video、frame_ts_ms、ingest_time (以及 file_size) 的字典。
+    """
+    source_video, frame_ts_ms = parse_frame_filename(filename)
+    metadata = {
+        "category": truncate_utf8(category or DEFAULT_CATEGORY, CATEGORY_MAX_BYTES),
+        "source_video": truncate_utf8(source_video, SOURCE_VIDEO_MAX_BYTES),
+        "frame_ts_ms": frame_ts_ms,
+        "ingest_time": int(ingest_time if ingest_time is not None else time.time())
+    }
+    if file_size is not None:
+        metadata["file_size"] = int(file_size)
+    return metadata
+
+
+def partition_name(category, ingest_time=None):
+    """
+    返回分类对应的 Milvus 分区名。分区名只能包含字母、数字和下划线，因此使用分类名的哈希值。
+    指定入库时间 (Unix 秒) 时追加入库月份后缀，例如 cat_0123456789ab_202605。
+    """
+    digest = hashlib.md5((category or DEFAULT_CATEGORY).encode('utf-8')).hexdigest()[:12]
+    if ingest_time is None:
+        return f"cat_{digest}"
+    return f"cat_{digest}_{time.strftime('%Y%m', time.localtime(ingest_time))}"
+
+
+def parse_partition_name(name):
+    """
+    解析按月份拆分的分区名。
+
+    返回:
+        tuple: (类别分区名, 入库月份 yyyymm)；不带月份后缀的分区返回 (name, None)。
+    """
+    match = PARTITION_MONTH_PATTERN.match(name)
+    if not match:
+        return name, None
+    return match.group(1), int(match.group(2))
+
+
+def _quote(value):
+    """把字符串转为 Milvus 表达式中的字符串字面量，拒绝可能破坏表达式的字符"""
+    value = str(value)
+    if '"' in value or '\\' in value:
+        raise ValueError(f'过滤条件中包含非法字符: {value}')
+    return f'"{value}"'
+
+
+def build_filter_expr(category=None, source_video=None, ts_from_ms=None, ts_to_ms=None,
+                      ingest_after=None, ingest_before=None):
+    """
+    根据过滤条件构造 Milvus 标量过滤表达式。
+
+    参数:
+        category (str): 非遗类别。
+        source_video (str): 来源视频名。
+        ts_from_ms / ts_to_ms (int): 帧时间戳范围 (毫秒，闭区间)。
+        ingest_after / ingest_before (int): 入库时间范围 (Unix 秒，闭区间)。
+
+    返回:
+        str: 过滤表达式；没有任何条件时返回空字符串。
+    """
+    clauses = []
+    if category:
+        clauses.append(f'category == {_quote(category)}')
+    if source_video:
+        clauses.append(f'source_video == {_quote(source_video)}')
+    if ts_from_ms is not None:
+        clauses.append(f'frame_ts_ms >= {int(ts_from_ms)}')
+    if ts_to_ms is not None:
+        clauses.append(f'frame_ts_ms <= {int(ts_to_ms)}')
+    if ingest_after is not None:
+        clauses.append(f'ingest_time >= {int(ingest_after)}')
+    if ingest_before is not None:
+        clauses.append(f'ingest_time <= {int(ingest_before)}')
+    return ' and '.join(clauses)
+
+
+def filters_from_request(values):
+    """
+    从请求参数 (request.form 或 request.args) 中读取过滤条件。
+
+    返回:
+        dict: 可直接传给 build_filter_expr 的关键字参数。
+
+    异常:
+        ValueError: 数值参数格式错误时抛出。
+    """
+    def as_int(name):
+        value = values.get(name)
+        return int(value) if value not in (None, '') else None
+
+    # 与写入时相同的截断，超长的类别名和视频名也能匹配已写入的值
+    category = values.get('category')
+    source_video = values.get('source_video')
+    return {
+        "category": truncate_utf8(category, CATEGORY_MAX_BYTES) if category else None,
+        "source_video": truncate_utf8(source_video, SOURCE_VIDEO_MAX_BYTES) if source_video else None,
+        "ts_from_ms": as_int('ts_from_ms'),
+        "ts_to_ms": as_int('ts_to_ms'),
+        "ingest_after": as_int('ingest_after'),
+        "ingest_before": as_int('ingest_before')
+    }
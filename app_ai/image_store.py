@@ -0,0 +1,238 @@
+# 图片文件存储：按文件名哈希分两级子目录存放，避免单个目录中的文件过多
+#
+#   static/images/3f/a2/00-01-09-000_2025-05-15-5.jpg
+#
+# 子目录由文件名的 MD5 前缀决定，只凭 Milvus 中记录的文件名即可定位文件，不需要额外的索引。
+# 旧版本把所有图片直接放在 static/images 下，查找时先查分层路径再查旧的平铺路径，
+# 迁移期间两种布局可以同时存在；平铺目录中的文件用下面的命令在线迁移：
+#
+#   python image_store.py migrate [--dry-run] [--rate 每秒文件数]
+#
+# 迁移先把文件硬链接 (或复制) 到分层路径，再删除平铺路径，任何时刻文件都至少在一个位置可以找到。
+# 写入新文件时不覆盖已有文件：save 在写入的同时原子地占用文件名，同名但内容不同的图片改用带哈希后缀的文件名
+# (名称~哈希前 8 位.扩展名)，original_name 可去掉后缀，抽帧文件名改名后仍能解析出来源视频和帧时间。
+import os
+import re
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGE_ROOT = os.path.join(APP_ROOT, 'static', 'images')
+
+# 子目录层数，每层为文件名 MD5 的 2 位十六进制前缀 (每层 256 个子目录)
+DEPTH = 2
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+# save 为同名的不同图片追加的后缀：~内容哈希的前 8 位 (secure_filename 处理后的上传文件名不含 ~)
+RENAMED_PATTERN = re.compile(r'~[0-9a-f]{8}(?=\.[^.]*$|$)')
+
+
+def original_name(filename):
+    """去掉 save 追加的哈希后缀，返回上传时的文件名"""
+    return RENAMED_PATTERN.sub('', filename, count=1)
+
+
+def relative_path(filename):
+    """返回文件在分层布局中相对于图片目录的路径"""
+    digest = hashlib.md5(filename.encode('utf-8')).hexdigest()
+    return '/'.join([digest[2 * i:2 * i + 2] for i in range(DEPTH)] + [filename])
+
+
+def _legacy_path(filename):
+    return os.path.join(IMAGE_ROOT, filename)
+
+
+def _sharded_path(filename):
+    return os.path.join(IMAGE_ROOT, *relative_path(filename).split('/'))
+
+
+def path(filename):
+    """
+    返回图片文件的完整路径：优先使用分层路径，只在旧的平铺路径存在时返回平铺路径。
+    文件不存在时返回分层路径 (即新文件应写入的位置)。
+    """
+    sharded = _sharded_path(filename)
+    if os.path.exists(sharded):
+        return sharded
+    legacy = _legacy_path(filename)
+    return legacy if os.path.exists(legacy) else sharded
+
+
+def exists(filename):
+    return os.path.exists(_sharded_path(filename)) or os.path.exists(_legacy_path(filename))
+
+
+def resolve_relative(filename):
+    """返回文件相对于图片目录的实际路径 ('/' 分隔)，用于静态文件服务"""
+    return os.path.relpath(path(filename), IMAGE_ROOT).replace(os.sep, '/')
+
+
+def _md5(file_path):
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _same_content(file_path, image_hash):
+    try:
+        return _md5(file_path) == image_hash
+    except FileNotFoundError:
+        return False
+
+
+def save(source, filename, image_hash=None, move=False):
+    """
+    把图片放入存储，并在写入的同时确定存储文件名。
+
+    文件名未被占用时用硬链接原子地占用 (已存在时失败而不是覆盖)；已有内容相同的文件时沿用，不再写入。
+    给出 image_hash 时，已有同名文件内容不同就在扩展名前加上 ~ 和内容哈希的前 8 位再试 (见 original_name)，
+    并发上传同名的不同图片也会各自得到不同的文件名；不给出时目标已存在即视为相同的图片。
+    调用方应先放入存储、再按返回的文件名写入 Milvus。
+
+    参数:
+        source (str): 源文件路径。
+        filename (str): 上传的文件名。
+        image_hash (str): 图片内容的 MD5 哈希值。
+        move (bool): 是否移动源文件，默认复制。
+
+    返回:
+        tuple: (存储文件名, 是否写入了新文件)。
+
+    异常:
+        FileExistsError: 原文件名和带哈希后缀的文件名都已被内容不同的图片占用。
+    """
+    candidates = [filename]
+    if image_hash is not None:
+        stem, ext = os.path.splitext(filename)
+        candidates.append(f'{stem}~{image_hash[:8]}{ext}')
+    tmp = None
+    try:
+        for name in candidates:
+            legacy = _legacy_path(name)
+            if os.path.exists(legacy):
+                if image_hash is None or _same_content(legacy, image_hash):
+                    if move and tmp is None:
+                        os.remove(source)
+                    return name, False
+                continue
+            target = _sharded_path(name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if tmp is None:
+                # 先写入图片目录下的临时文件，再硬链接到候选路径
+                fd, tmp = tempfile.mkstemp(dir=IMAGE_ROOT, prefix='.tmp_')
+                os.close(fd)
+                if move:
+                    shutil.move(source, tmp)
+                else:
+                    shutil.copyfile(source, tmp)
+            try:
+                os.link(tmp, target)
+                return name, True
+            except FileExistsError:
+                if image_hash is None or _same_content(target, image_hash):
+                    return name, False
+        if move and tmp is not None:
+            # 没有写入存储时把源文件移回原处
+            shutil.move(tmp, source)
+            tmp = None
+        raise FileExistsError(f"{filename} 的候选文件名都已被内容不同的图片占用")
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+
+
+def remove(filename):
+    """删除图片 (分层路径和旧的平铺路径)，返回是否删除了文件"""
+    removed = False
+    for candidate in (_sharded_path(filename), _legacy_path(filename)):
+        try:
+            os.remove(candidate)
+            removed = True
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def list_images(directory=IMAGE_ROOT):
+    """递归列出目录中的图片文件路径 (按路径排序)"""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return paths
+
+
+def migrate(dry_run=False, rate=None):
+    """
+    把平铺在图片目录下的文件迁移到分层布局。
+
+    参数:
+        dry_run (bool): 只统计不迁移。
+        rate (float): 每秒最多迁移的文件数，默认不限速。
+
+    返回:
+        dict: {'migrated': 迁移数, 'duplicates': 分层路径已有相同文件而删除的平铺文件数,
+               'conflicts': 分层路径已有不同文件而保留的平铺文件数, 'errors': 失败数}。
+    """
+    stats = {'migrated': 0, 'duplicates': 0, 'conflicts': 0, 'errors': 0}
+    started = time.time()
+    with os.scandir(IMAGE_ROOT) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False) or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            target = _sharded_path(entry.name)
+            try:
+                if os.path.exists(target):
+                    # 之前的迁移在删除平铺文件前中断，或两处是不同的图片
+                    if _md5(target) == _md5(entry.path):
+                        stats['duplicates'] += 1
+                        if not dry_run:
+                            os.remove(entry.path)
+                    else:
+                        stats['conflicts'] += 1
+                        print(f"冲突：{entry.name} 在分层路径中已有内容不同的文件，保留平铺文件")
+                    continue
+                if not dry_run:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    try:
+                        os.link(entry.path, target)
+                    except OSError:
+                        # 文件系统不支持硬链接时复制
+                        shutil.copy2(entry.path, target)
+                    os.remove(entry.path)
+                # 迁移完成后才计数，中途文件被删除时不计入
+                stats['migrated'] += 1
+            except FileNotFoundError:
+                pass  # 迁移期间被删除
+            except OSError as e:
+                stats['errors'] += 1
+                print(f"迁移 {entry.name} 失败: {e}")
+            done = stats['migrated'] + stats['duplicates']
+            if done and done % 1000 == 0:
+                print(f"已迁移 {done} 个文件 ({done / max(time.time() - started, 1e-6):.0f} 个/秒)")
+            if rate:
+                time.sleep(1.0 / rate)
+    return stats
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图片文件存储")
+    parser.add_argument('command', choices=['migrate', 'locate'])
+    parser.add_argument('filenames', nargs='*', help="locate：要定位的文件名")
+    parser.add_argument('--dry-run', action='store_true', help="migrate：只统计不迁移")
+    parser.add_argument('--rate', type=float, help="migrate：每秒最多迁移的文件数")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        result = migrate(args.dry_run, args.rate)
+        print(f"{'预计' if args.dry_run else '已'}迁移 {result['migrated']} 个文件，"
+              f"重复 {result['duplicates']} 个，冲突 {result['conflicts']} 个，失败 {result['errors']} 个")
+        sys.exit(1 if result['errors'] else 0)
+    for name in args.filenames:
+        print(f"{name}: {path(name)}{'' if exists(name) else ' (不存在)'}")
@@ -0,0 +1,352 @@
+# 索引蓝绿重建：在不影响线上搜索的前提下，用新的索引参数重建当前服务的集合
+#
+#   python index_rebuild.py rebuild [--index-type IVF_FLAT|IVF_SQ8] [--nlist 2048] [--rate 行/秒] [--keep-old]
+#   python index_rebuild.py status
+#   python index_rebuild.py rollback <集合名>    # 重建时使用了 --keep-old，把别名切回旧集合
+#   python index_rebuild.py drop <集合名>        # 删除保留的旧集合
+#
+# 在线上集合上直接 create_index (或按 insert_images.py 的 FORCE_RECREATE_COLLECTION 删除重建)
+# 会在重建期间降低搜索质量甚至中断服务。蓝绿重建的流程：
+#   1. 创建同一模型版本的下一代集合 (<集合名>__<模型版本>__g<N>，见 milvus_client.generation_name)，
+#      按新参数建立索引并加载；
+#   2. 把当前集合的向量和元数据分批复制过去 (不重新提取特征)，按行/秒限速，
+#      并根据服务进程 /metrics 中的搜索 p95 自动降速 (与 model_migration.py 的回填相同)；
+#   3. 追平复制期间新写入的行 (按入库时间) 和被删除的行，等待索引构建完成；
+#   4. 用一组查询向量对比新旧集合的搜索结果，通过校验后原子地切换别名，
+#      服务进程 (app_flask.py) 在 HERITAGE_SERVING_CHECK_INTERVAL 内切换到新集合；
+#   5. 宽限期后再追平一次切换期间写入旧集合的行，经别名再校验一次，通过后删除旧集合。
+# 任何一步失败都不会切换别名，旧集合继续服务；中断后重新执行会继续使用已创建的下一代集合，
+# 已复制的行按哈希值跳过。宽限期内在旧集合上的删除不会同步到新集合，由 reconcile.py 清理悬空向量。
+# 分片集合 (HERITAGE_SHARDS) 不使用别名，不支持蓝绿重建。
+import sys
+import time
+import random
+import argparse
+import numpy as np
+from pymilvus import utility
+from milvus_client import (get_pool, get_collection, build_schema, resolve_alias, switch_alias, insert_rows,
+                           model_version_of, generation_name, generation_of, collection_name, index_params)
+from model_migration import (RateLimiter, LatencyGuard, adopt_legacy, delete_stale, _existing_hashes,
+                             DEFAULT_MAX_SEARCH_P95, DEFAULT_PAUSE, DEFAULT_GRACE, MIN_RATE)
+from image_metadata import build_filter_expr, METADATA_FIELDS
+from image_catalog import get_catalog
+from partition_tiering import scan
+from search_images import search_similar_vectors
+from sharding import SHARDS
+from cascade import coarse_name
+
+# --- 重建配置 ---
+INDEX_TYPES = ('IVF_FLAT', 'IVF_SQ8')
+# 复制时每批的行数和默认的复制速度上限 (行/秒)，复制不需要运行模型，比 model_migration 的回填快得多
+BATCH_SIZE = 500
+DEFAULT_COPY_RATE = 1000.0
+# 按入库时间追平时向前多回看的时间 (秒)，覆盖写缓冲中尚未写入的行
+CATCH_UP_SLACK = 60
+# 校验使用的查询数量和每次查询返回的结果数
+VERIFY_QUERIES = 200
+VERIFY_TOP_K = 10
+# 校验通过的条件：查询向量本身在新集合中排第 1 的比例，以及新旧集合前 top_k 个结果 (按哈希值) 的平均重合率
+MIN_SELF_HIT = 0.99
+MIN_OVERLAP = 0.9
+# 等待索引构建完成的最长时间 (秒)
+INDEX_WAIT_TIMEOUT = 3600
+
+
+def _dim(collection):
+    return int(next(f.params['dim'] for f in collection.schema.fields if f.name == 'embedding'))
+
+
+def _list_collections():
+    pool = get_pool()
+    return pool.call(lambda alias: utility.list_collections(timeout=pool.timeout, using=alias))
+
+
+def _index_params_of(name):
+    """返回集合当前的索引参数，未建索引时返回 None"""
+    pool = get_pool()
+    indexes = pool.call(lambda alias: pool.collection(name)._get(alias).indexes)
+    return indexes[0].params if indexes else None
+
+
+def _next_generation(source):
+    """
+    返回下一代集合名。上次重建中断时留下的更新一代集合 (别名未指向它) 会被继续使用。
+
+    返回:
+        tuple: (集合名, 是否为已存在的集合)。
+    """
+    version = model_version_of(source)
+    current = generation_of(source)
+    generations = [generation_of(name) for name in _list_collections()
+                   if model_version_of(name) == version and not name.endswith(coarse_name(''))]
+    newer = [g for g in generations if g > current]
+    if newer:
+        return generation_name(version, max(newer)), True
+    return generation_name(version, max(generations + [current]) + 1), False
+
+
+def copy_rows(source, target, since=None, rate=DEFAULT_COPY_RATE, batch_size=BATCH_SIZE, guard=None):
+    """
+    把 source 中的行 (向量、文件名、哈希值和元数据) 复制到 target，target 中已有相同哈希值的行跳过。
+
+    参数:
+        since (int): 只复制该时间 (Unix 秒) 之后入库的行；旧版集合没有入库时间时复制全部行。
+        rate (float): 复制速度上限 (行/秒)，<= 0 表示不限速。
+        guard (LatencyGuard): 线上搜索延迟保护，搜索变慢时降速并暂停。
+
+    返回:
+        dict: {'copied': 复制数, 'skipped': 跳过数}。
+    """
+    limiter = RateLimiter(rate)
+    max_rate = rate
+    stats = {'copied': 0, 'skipped': 0}
+    output_fields = ["embedding", "image_filename", "image_hash"] + (METADATA_FIELDS if source.has_metadata else [])
+    expr = build_filter_expr(ingest_after=since) if since is not None and source.has_metadata else None
+    started = time.time()
+    for rows in scan(source, output_fields, batch_size, expr, since if expr else None):
+        existing = _existing_hashes(target, [row['image_hash'] for row in rows])
+        todo = [row for row in rows if row['image_hash'] not in existing]
+        stats['skipped'] += len(rows) - len(todo)
+        if not todo:
+            continue
+        if guard is not None and limiter.rate > 0:
+            p95 = guard.p95()
+            if p95 is not None and p95 > guard.max_p95:
+                limiter.rate = max(MIN_RATE, limiter.rate / 2)
+                print(f"搜索 p95 {p95 * 1000:.0f}ms 超过阈值，复制降速至 {limiter.rate:.0f} 行/秒")
+                time.sleep(DEFAULT_PAUSE)
+            elif p95 is not None:
+                limiter.rate = min(max_rate, limiter.rate * 1.25)
+        limiter.wait(len(todo))
+
+        filenames = [row['image_filename'] for row in todo]
+        hashes = [row['image_hash'] for row in todo]
+        metadata = [{field: row[field] for field in METADATA_FIELDS} for row in todo] if source.has_metadata else None
+        primary_keys = insert_rows(target, np.asarray([row['embedding'] for row in todo], dtype=np.float32),
+                                   filenames, hashes, metadata)
+        get_catalog().record(target.name, primary_keys, filenames, hashes, metadata)
+        stats['copied'] += len(todo)
+        if stats['copied'] % (batch_size * 20) < len(todo):
+            print(f"已复制 {stats['copied']} 行，跳过 {stats['skipped']} 行 ({time.time() - started:.0f}s)")
+    target.flush()
+    return stats
+
+
+def count_rows(collection, batch_size=1000):
+    """遍历集合统计行数 (不包含已删除的行，按分区加载的集合逐个分区统计)"""
+    return sum(len(rows) for rows in scan(collection, ["id"], batch_size))
+
+
+def wait_indexed(name, timeout=INDEX_WAIT_TIMEOUT):
+    """等待集合中已写入的行全部建好索引，超时返回 False"""
+    pool = get_pool()
+    deadline = time.monotonic() + timeout
+    while True:
+        progress = pool.call(lambda alias: utility.index_building_progress(name, timeout=pool.timeout, using=alias))
+        if progress.get('indexed_rows', 0) >= progress.get('total_rows', 0):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        print(f"等待索引构建：{progress.get('indexed_rows', 0)}/{progress.get('total_rows', 0)}")
+        time.sleep(5)
+
+
+def sample_queries(collection, count=VERIFY_QUERIES, seed=0, batch_size=1000):
+    """从集合中均匀抽样 count 个已存储的向量作为校验查询 (蓄水池抽样)，返回 [(向量, 哈希值)]"""
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    for rows in scan(collection, ["embedding", "image_hash"], batch_size):
+        for row in rows:
+            seen += 1
+            if len(sample) < count:
+                sample.append((row['embedding'], row['image_hash']))
+            else:
+                j = rng.randrange(seen)
+                if j < count:
+                    sample[j] = (row['embedding'], row['image_hash'])
+    return [(np.asarray(vector, dtype=np.float32), image_hash) for vector, image_hash in sample]
+
+
+def verify(reference, candidate, queries, top_k=VERIFY_TOP_K, min_self_hit=MIN_SELF_HIT, min_overlap=MIN_OVERLAP):
+    """
+    用同一组查询向量分别搜索 reference (旧集合) 和 candidate (新集合)，按哈希值比较结果 (两边的 ID 不同)。
+
+    参数:
+        queries (list[tuple]): [(查询向量, 该向量所属图片的哈希值)]，见 sample_queries。
+
+    返回:
+        dict: {'passed': 是否通过, 'self_hit': 查询图片本身排第 1 的比例, 'overlap': 平均重合率, 'queries': 数量}。
+              按分区加载的集合跳过了未加载的冷分区时结果不完整，这样的查询不计入重合率。
+    """
+    self_hits = 0
+    overlaps = []
+    for vector, image_hash in queries:
+        expected_info, actual_info = {}, {}
+        expected = [r['image_hash'] for r in search_similar_vectors(vector, top_k=top_k, target_collection=reference,
+                                                                   tier_info=expected_info)]
+        actual = [r['image_hash'] for r in search_similar_vectors(vector, top_k=top_k, target_collection=candidate,
+                                                                 tier_info=actual_info)]
+        if actual and actual[0] == image_hash:
+            self_hits += 1
+        if expected and not expected_info.get('skipped_partitions') and not actual_info.get('skipped_partitions'):
+            overlaps.append(len(set(expected) & set(actual)) / len(expected))
+    total = max(len(queries), 1)
+    result = {'queries': len(queries), 'self_hit': self_hits / total,
+              'overlap': float(np.mean(overlaps)) if overlaps else 1.0}
+    result['passed'] = bool(queries) and result['self_hit'] >= min_self_hit and result['overlap'] >= min_overlap
+    print(f"校验 {result['queries']} 个查询：自身命中率 {result['self_hit']:.1%} (要求 {min_self_hit:.0%})，"
+          f"结果重合率 {result['overlap']:.1%} (要求 {min_overlap:.0%})，{'通过' if result['passed'] else '未通过'}")
+    return result
+
+
+def drop(name):
+    """删除集合及其目录记录和级联搜索的粗筛集合"""
+    if name == resolve_alias(collection_name):
+        raise RuntimeError(f"别名 {collection_name} 仍指向 {name}，不能删除")
+    pool = get_pool()
+
+    def drop_collections(alias):
+        for target in (name, coarse_name(name)):
+            if utility.has_collection(target, using=alias, timeout=pool.timeout):
+                utility.drop_collection(target, using=alias, timeout=pool.timeout)
+
+    pool.call(drop_collections, retry=False)
+    get_catalog().drop(name)
+    print(f"已删除集合 {name}")
+
+
+def rebuild(new_index_params, rate=DEFAULT_COPY_RATE, batch_size=BATCH_SIZE, guard=None, queries=VERIFY_QUERIES,
+            max_missing=0, grace=DEFAULT_GRACE, keep_old=False):
+    """
+    按新的索引参数蓝绿重建当前服务的集合，校验通过后切换别名。
+
+    参数:
+        new_index_params (dict): 新集合的索引参数 (格式同 milvus_client.index_params)。
+        rate (float): 复制速度上限 (行/秒)。
+        queries (int): 校验使用的查询数量。
+        max_missing (int): 切换前允许新集合比旧集合少的行数。
+        grace (float): 切换别名后等待服务进程切换的时间 (秒)。
+        keep_old (bool): 切换后保留旧集合 (可用 rollback 回退)，否则校验通过后删除。
+
+    返回:
+        str: 新集合名；未切换时返回 None。
+    """
+    if SHARDS:
+        raise RuntimeError("分片集合不使用别名，不支持蓝绿重建")
+    source_name = adopt_legacy()
+    if source_name is None:
+        raise RuntimeError(f"集合 {collection_name} 不存在")
+    source = get_collection(source_name)
+    if not source.ready:
+        raise RuntimeError(f"集合 {source_name} 不可用")
+    target_name, resumed = _next_generation(source_name)
+    print(f"{'继续上次中断的重建' if resumed else '开始重建'}：{source_name} -> {target_name}，"
+          f"索引 {new_index_params['index_type']} {new_index_params['params']}")
+
+    if resumed and _index_params_of(target_name) not in (None, new_index_params):
+        raise RuntimeError(f"已存在的集合 {target_name} 使用了不同的索引参数 {_index_params_of(target_name)}，"
+                           f"请先执行 drop {target_name}")
+    pool = get_pool()
+    if not pool.ensure_collection(target_name, schema=build_schema(_dim(source)), index_params=new_index_params,
+                                  partial=False):
+        raise RuntimeError(f"新集合 {target_name} 创建失败")
+    target = pool.collection(target_name)
+
+    copy_started = int(time.time())
+    stats = copy_rows(source, target, rate=rate, batch_size=batch_size, guard=guard)
+    print(f"全量复制完成：复制 {stats['copied']} 行，跳过 {stats['skipped']} 行")
+    # 先统计源集合的行数再追平：统计到的行在追平时都已存在，都应被复制
+    source_rows = count_rows(source)
+    # 追平复制期间写入的行，再删除复制期间被删除的行
+    stats = copy_rows(source, target, since=copy_started - CATCH_UP_SLACK, rate=0, batch_size=batch_size)
+    print(f"追平复制期间的写入：{stats['copied']} 行")
+    _, missing = delete_stale(source, target)
+    if missing > max_missing:
+        print(f"新集合缺少 {missing} 张图片 (允许 {max_missing} 张)，取消切换")
+        return None
+    # num_entities 包含尚未压缩的已删除行，只会偏大；仍少于源集合的行数说明复制不完整
+    target_entities = target.num_entities
+    if target_entities + max_missing < source_rows:
+        print(f"新集合只有 {target_entities} 行，少于源集合的 {source_rows} 行 (允许缺少 {max_missing} 行)，取消切换")
+        return None
+    if not wait_indexed(target_name):
+        print(f"新集合 {target_name} 的索引在 {INDEX_WAIT_TIMEOUT} 秒内未构建完成，取消切换")
+        return None
+
+    query_set = sample_queries(source, queries)
+    if not verify(source, target, query_set)['passed']:
+        print(f"校验未通过，别名保持指向 {source_name}，新集合 {target_name} 保留以便排查")
+        return None
+
+    switch_started = int(time.time())
+    switch_alias(collection_name, target_name)
+    print(f"等待 {grace:.0f} 秒，让服务进程切换到新集合并写完旧写缓冲...")
+    time.sleep(grace)
+    stats = copy_rows(source, target, since=switch_started - CATCH_UP_SLACK, rate=0, batch_size=batch_size)
+    print(f"追平切换期间写入旧集合的行：{stats['copied']} 行")
+
+    # 经别名再校验一次，确认线上实际访问的是新集合且结果正确
+    if keep_old or not verify(source, get_collection(collection_name), query_set)['passed']:
+        print(f"旧集合 {source_name} 保留，可用 rollback {source_name} 回退")
+    else:
+        drop(source_name)
+    return target_name
+
+
+def rollback(name):
+    """把别名切回指定的集合 (重建时保留的旧集合)"""
+    if not get_collection(name).ready:
+        raise RuntimeError(f"集合 {name} 不可用，无法回退")
+    switch_alias(collection_name, name)
+
+
+def status():
+    """打印别名指向以及同一模型版本各代集合的实体数量和索引参数"""
+    current = resolve_alias(collection_name)
+    print(f"别名 {collection_name} -> {current}")
+    version = model_version_of(current or '')
+    for name in sorted(_list_collections(), key=generation_of):
+        if version is None or model_version_of(name) != version or name.endswith(coarse_name('')):
+            continue
+        params = _index_params_of(name) or {}
+        marker = '*' if name == current else ' '
+        print(f" {marker} {name}  第 {generation_of(name)} 代  实体 {get_collection(name).num_entities}  索引 {params}")
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="索引蓝绿重建")
+    parser.add_argument('command', choices=['rebuild', 'status', 'rollback', 'drop'])
+    parser.add_argument('name', nargs='?', help="rollback / drop 的集合名")
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default=index_params['index_type'])
+    parser.add_argument('--nlist', type=int, default=index_params['params']['nlist'])
+    parser.add_argument('--rate', type=float, default=DEFAULT_COPY_RATE, help="复制速度上限 (行/秒)，0 表示不限速")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--metrics-url', default='http://127.0.0.1:5000/metrics',
+                        help="服务进程的指标地址，用于根据线上搜索延迟自动降速；设为空字符串关闭")
+    parser.add_argument('--max-search-p95', type=float, default=DEFAULT_MAX_SEARCH_P95)
+    parser.add_argument('--queries', type=int, default=VERIFY_QUERIES, help="校验使用的查询数量")
+    parser.add_argument('--max-missing', type=int, default=0, help="切换时允许新集合缺少的图片数量")
+    parser.add_argument('--grace', type=float, default=DEFAULT_GRACE)
+    parser.add_argument('--keep-old', action='store_true', help="切换后保留旧集合")
+    args = parser.parse_args()
+
+    if args.command in ('rollback', 'drop') and not args.name:
+        parser.error(f"{args.command} 需要指定集合名")
+    try:
+        if args.command == 'rebuild':
+            params = {"metric_type": "L2", "index_type": args.index_type, "params": {"nlist": args.nlist}}
+            guard = LatencyGuard(args.metrics_url, args.max_search_p95) if args.metrics_url else None
+            if not rebuild(params, rate=args.rate, batch_size=args.batch_size, guard=guard, queries=args.queries,
+                           max_missing=args.max_missing, grace=args.grace, keep_old=args.keep_old):
+                sys.exit(1)
+        elif args.command == 'rollback':
+            rollback(args.name)
+        elif args.command == 'drop':
+            drop(args.name)
+        else:
+            status()
+    except Exception as e:
+        print(f"执行 {args.command} 失败: {e}")
+        sys.exit(1)
@@ -0,0 +1,304 @@
+import os
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import threading
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# --- 任务队列数据库配置 ---
+# 默认与 app_django 项目共用同一个 SQLite 数据库文件，表名以 ingest_ 为前缀
+DB_PATH = os.environ.get('HERITAGE_DB_PATH',
+                         os.path.join(os.path.dirname(APP_ROOT), 'app_django', 'db.sqlite3'))
+# 进程退出时等待后台入库线程处理完当前批次的最长秒数 (之后才关闭写缓冲)
+STOP_TIMEOUT = float(os.environ.get('HERITAGE_INGEST_STOP_TIMEOUT', '30'))
+# 领取的文件的租约秒数：处理期间每隔三分之一租约续期一次，进程退出或崩溃后租约过期的文件由其他进程重新领取
+LEASE_SECONDS = float(os.environ.get('HERITAGE_INGEST_LEASE', '120'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    staging_dir TEXT NOT NULL,
+    category TEXT
+);
+CREATE TABLE IF NOT EXISTS ingest_job_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES ingest_jobs(id),
+    filename TEXT NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    message TEXT NOT NULL DEFAULT '',
+    updated_at REAL NOT NULL,
+    owner TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS ingest_job_files_status ON ingest_job_files (status, id);
+CREATE INDEX IF NOT EXISTS ingest_job_files_job ON ingest_job_files (job_id);
+"""
+
+
+class IngestQueue:
+    """
+    基于 SQLite 的持久化入库任务队列。
+
+    每个任务包含若干待处理文件，文件状态依次为 pending -> running -> inserted / skipped / error。
+    领取的文件记录领取者 (主机名:进程号:随机串) 和租约到期时间，处理期间由 IngestWorker 续期；
+    多个进程 (gunicorn worker、调试模式的重载进程、滚动发布中的新旧进程) 共用同一个数据库时，
+    只有租约已过期的 running 文件 (领取者已退出或崩溃) 才会被重新领取，不会重复处理仍在处理中的文件。
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # 旧版本创建的 ingest_jobs 表没有 category 列，ingest_job_files 表没有租约列
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(ingest_jobs)')}
+        if 'category' not in columns:
+            conn.execute('ALTER TABLE ingest_jobs ADD COLUMN category TEXT')
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(ingest_job_files)')}
+        if 'owner' not in columns:
+            conn.execute('ALTER TABLE ingest_job_files ADD COLUMN owner TEXT')
+            conn.execute('ALTER TABLE ingest_job_files ADD COLUMN lease_until REAL')
+
+    def _connect(self):
+        """每个线程使用独立的 autocommit SQLite 连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        """返回写事务上下文，进入时执行 BEGIN IMMEDIATE"""
+        return _Transaction(self._connect())
+
+    def submit(self, entries, staging_dir, category=None):
+        """
+        提交一个入库任务。
+
+        参数:
+            entries (list[tuple]): (文件名, 临时文件路径) 列表。
+            staging_dir (str): 存放该任务临时文件的目录。
+            category (str): 该任务所有图片的非遗类别，为空时使用默认类别。
+
+        返回:
+            int: 新任务的 ID。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO ingest_jobs (created_at, updated_at, staging_dir, category) '
+                'VALUES (?, ?, ?, ?)', (now, now, staging_dir, category))
+            job_id = cursor.lastrowid
+            conn.executemany(
+                'INSERT INTO ingest_job_files (job_id, filename, path, updated_at) VALUES (?, ?, ?, ?)',
+                [(job_id, name, path, now) for name, path in entries])
+        return job_id
+
+    def claim_batch(self, batch_size):
+        """
+        领取一批待处理文件 (可跨多个任务)，并将其标记为 running。
+        租约已过期的 running 文件 (领取者已退出，或旧版本留下的没有租约的文件) 同样可以领取。
+
+        返回:
+            list[sqlite3.Row]: 包含 id、job_id、filename、path、category 的行列表。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT f.id, f.job_id, f.filename, f.path, j.category FROM ingest_job_files f "
+                "JOIN ingest_jobs j ON j.id = f.job_id "
+                "WHERE f.status = 'pending' OR (f.status = 'running' AND "
+                "(f.lease_until IS NULL OR f.lease_until < ?)) ORDER BY f.id LIMIT ?",
+                (now, batch_size)).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE ingest_job_files SET status = 'running', owner = ?, lease_until = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    [(self.owner, now + LEASE_SECONDS, now, row['id']) for row in rows])
+        return rows
+
+    def renew(self, rows):
+        """为本队列领取且仍在处理中的文件续期租约"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE ingest_job_files SET lease_until = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                [(now + LEASE_SECONDS, row['id'], self.owner) for row in rows])
+
+    def complete(self, rows, results):
+        """记录一批文件的处理结果 (租约过期后已被其他进程重新领取的文件不覆盖)"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                'UPDATE ingest_job_files SET status = ?, message = ?, updated_at = ?, lease_until = NULL '
+                'WHERE id = ? AND owner = ?',
+                [(result['status'], result.get('message', ''), now, row['id'], self.owner)
+                 for row, result in zip(rows, results)])
+            conn.executemany('UPDATE ingest_jobs SET updated_at = ? WHERE id = ?',
+                             [(now, job_id) for job_id in {row['job_id'] for row in rows}])
+
+    def pending_count(self):
+        """尚未处理完成的文件数量 (pending + running)"""
+        conn = self._connect()
+        return conn.execute(
+            "SELECT COUNT(*) FROM ingest_job_files WHERE status IN ('pending', 'running')"
+        ).fetchone()[0]
+
+    def get_job(self, job_id, include_files=True):
+        """
+        查询任务进度。
+
+        返回:
+            dict: 任务信息、各状态的文件数量和 (可选) 每个文件的结果；任务不存在时返回 None。
+        """
+        conn = self._connect()
+        job = conn.execute('SELECT * FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = dict(conn.execute(
+            'SELECT status, COUNT(*) FROM ingest_job_files WHERE job_id = ? GROUP BY status',
+            (job_id,)).fetchall())
+        files = []
+        if include_files:
+            files = [dict(row) for row in conn.execute(
+                'SELECT filename, status, message FROM ingest_job_files WHERE job_id = ? ORDER BY id',
+                (job_id,)).fetchall()]
+
+        total = sum(counts.values())
+        unfinished = counts.get('pending', 0) + counts.get('running', 0)
+        if unfinished == 0:
+            status = 'done'
+        elif unfinished == total:
+            status = 'pending' if counts.get('running', 0) == 0 else 'running'
+        else:
+            status = 'running'
+        result = {
+            'job_id': job['id'],
+            'status': status,
+            'created_at': job['created_at'],
+            'updated_at': job['updated_at'],
+            'total': total,
+            'processed': total - unfinished,
+            'counts': counts
+        }
+        if include_files:
+            result['files'] = files
+        return result
+
+    def list_jobs(self, limit=20):
+        """列出最近的任务及其进度 (不含每个文件的结果)"""
+        conn = self._connect()
+        ids = [row[0] for row in conn.execute(
+            'SELECT id FROM ingest_jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()]
+        return [self.get_job(job_id, include_files=False) for job_id in ids]
+
+    def cleanup_finished(self, job_ids):
+        """删除给定任务中已全部处理完成的任务的临时目录"""
+        conn = self._connect()
+        for job_id in job_ids:
+            row = conn.execute(
+                "SELECT staging_dir FROM ingest_jobs j WHERE id = ? AND NOT EXISTS ("
+                "SELECT 1 FROM ingest_job_files f WHERE f.job_id = j.id "
+                "AND f.status IN ('pending', 'running'))", (job_id,)).fetchone()
+            if row is not None:
+                shutil.rmtree(row[0], ignore_errors=True)
+
+
+class _Transaction:
+    """让 with 语句在 autocommit 连接上开启 BEGIN IMMEDIATE 事务"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+class IngestWorker(threading.Thread):
+    """
+    入库后台线程：循环领取一批文件，交给 process_batch 处理并记录结果。
+
+    process_batch 接收 (路径列表, 文件名列表, 类别列表)，返回与之一一对应的结果字典列表，
+    每个字典至少包含 status 和 message。is_ready 返回 False 时 (例如 Milvus 不可用) 暂停领取任务。
+    """
+
+    def __init__(self, queue, process_batch, batch_size=64, poll_interval=1.0, is_ready=None):
+        super().__init__(name='ingest-worker', daemon=True)
+        self.queue = queue
+        self.process_batch = process_batch
+        self.is_ready = is_ready
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def notify(self):
+        """有新任务提交时唤醒线程，不必等到下一次轮询"""
+        self._wakeup.set()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        停止线程，并等待正在处理的批次写入写缓冲后返回，调用方随后才能关闭写缓冲。
+
+        参数:
+            timeout (float): 最长等待秒数，超时后返回，未完成的文件在进程重启后重新处理。
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(timeout)
+            if self.is_alive():
+                print(f"入库线程 {timeout:g} 秒内没有处理完当前批次，未完成的文件在租约过期后重新处理")
+
+    def _renew(self, rows, done):
+        """处理一批文件期间定期续期租约，避免处理较慢时被其他进程重新领取"""
+        while not done.wait(LEASE_SECONDS / 3):
+            try:
+                self.queue.renew(rows)
+            except Exception as e:
+                print(f"续期入库任务租约失败: {e}")
+
+    def run(self):
+        while not self._stopped:
+            if self.is_ready is not None and not self.is_ready():
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                rows = self.queue.claim_batch(self.batch_size)
+            except Exception as e:
+                print(f"领取入库任务失败: {e}")
+                rows = []
+            if not rows:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            print(f"开始处理 {len(rows)} 个待入库文件...")
+            done = threading.Event()
+            threading.Thread(target=self._renew, args=(rows, done), name='ingest-lease', daemon=True).start()
+            try:
+                results = self.process_batch([row['path'] for row in rows],
+                                             [row['filename'] for row in rows],
+                                             [row['category'] for row in rows])
+            except Exception as e:
+                print(f"处理入库任务时出错: {e}")
+                results = [{'status': 'error', 'message': f'处理失败: {e}'} for _ in rows]
+            finally:
+                done.set()
+            self.queue.complete(rows, results)
+            self.queue.cleanup_finished({row['job_id'] for row in rows})
@@ -0,0 +1,448 @@
+# 目录监听自动入库：监听视频抽帧等程序的输出目录，新图片写完后分批查重、提取特征并写入 Milvus
+#
+#   python ingest_watcher.py --dir /data/frames/剪纸=剪纸 --dir /data/frames/other [--keep-source]
+#
+# 也可以在 Flask 服务中运行：设置 HERITAGE_WATCH_DIRS 后随服务启动 (多进程部署时只应在一个进程中设置)。
+#
+# Linux 上通过 inotify 接收文件事件 (不依赖第三方库)，其他平台或 inotify 不可用时定期扫描目录。
+# 写入中的文件不会被读取：inotify 模式下收到关闭写入 (IN_CLOSE_WRITE) 或移入 (IN_MOVED_TO) 事件后
+# 才认为文件已写完 (超过 OPEN_TIMEOUT 秒仍未关闭时按未变化处理)；扫描目录发现的文件
+# 在大小和修改时间 DEBOUNCE 秒内不再变化后才认为已写完。
+# 写完的文件凑满 BATCH_SIZE 张或最早一张等待超过 MAX_WAIT 秒时作为一批处理
+# (批量哈希、查重、特征提取，经写缓冲写入 Milvus)，新图片通常在几秒内即可被搜索到。
+# 从文件写完到写入 Milvus 的延迟记录在 heritage_ingest_lag_seconds 指标中。
+#
+# 插入成功的图片移入图片存储 (--keep-source 时复制)；重复的图片删除 (--keep-source 时保留)；
+# 处理失败的图片保留在原处，文件再次变化后重试。
+# 已处理文件的记录在文件被删除或移走后清除 (inotify 删除/移出事件，或定期扫描时不再出现)。
+#
+# 配置：HERITAGE_WATCH_DIRS 监听的目录，以 os.pathsep 分隔，每项为 "目录" 或 "目录=类别"；
+#       HERITAGE_WATCH_DEBOUNCE、HERITAGE_WATCH_BATCH、HERITAGE_WATCH_MAX_WAIT、
+#       HERITAGE_WATCH_POLL_INTERVAL (秒)；HERITAGE_WATCH_KEEP_SOURCE=1 保留源文件。
+import os
+import sys
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+import threading
+import image_store
+from insert_images import insert_image_batch
+from ingest_queue import STOP_TIMEOUT
+from metrics import INGEST_LAG, track_queue_depth
+
+# --- 监听配置 ---
+WATCH_DIRS = os.environ.get('HERITAGE_WATCH_DIRS', '')
+# 文件大小和修改时间保持不变多久 (秒) 后认为已写完
+DEBOUNCE = float(os.environ.get('HERITAGE_WATCH_DEBOUNCE', '2.0'))
+BATCH_SIZE = int(os.environ.get('HERITAGE_WATCH_BATCH', '64'))
+# 写完的文件最多等待多久 (秒) 凑批
+MAX_WAIT = float(os.environ.get('HERITAGE_WATCH_MAX_WAIT', '1.0'))
+# inotify 模式下写入方打开文件后最长等待关闭事件的时间 (秒)
+OPEN_TIMEOUT = 60.0
+# 不使用 inotify 时扫描目录的间隔 (秒)
+POLL_INTERVAL = float(os.environ.get('HERITAGE_WATCH_POLL_INTERVAL', '5.0'))
+KEEP_SOURCE = os.environ.get('HERITAGE_WATCH_KEEP_SOURCE', '0') == '1'
+
+# --- inotify 常量 (见 <sys/inotify.h>) ---
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+
+
+def parse_watch_dirs(value):
+    """
+    解析监听目录配置。
+
+    参数:
+        value (str | list[str]): 以 os.pathsep 分隔的字符串或列表，每项为 "目录" 或 "目录=类别"。
+
+    返回:
+        dict: {目录的绝对路径: 类别 (None 表示默认类别)}。
+    """
+    items = value.split(os.pathsep) if isinstance(value, str) else value
+    directories = {}
+    for item in items:
+        item = item.strip()
+        if not item:
+            continue
+        path, _, category = item.partition('=')
+        directories[os.path.abspath(path)] = category or None
+    return directories
+
+
+def _is_candidate(name):
+    # 以 . 开头的通常是写入中的临时文件，写完后会重命名 (产生 IN_MOVED_TO)
+    return not name.startswith('.') and name.lower().endswith(image_store.IMAGE_EXTENSIONS)
+
+
+class _Inotify:
+    """通过 ctypes 调用 libc 的 inotify 接口"""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError(errno.ENOSYS, '当前平台不支持 inotify')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}  # 监听描述符 -> 目录
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'{os.strerror(err)}: {path}')
+        self.paths[wd] = path
+
+    def read(self, timeout):
+        """等待最多 timeout 秒，返回 (目录, 文件名, 事件掩码) 列表"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            events.append((self.paths.get(wd), os.fsdecode(name), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher(threading.Thread):
+    """
+    目录监听线程：发现写完的新图片后分批交给 process_batch 处理。
+
+    process_batch 接收 (路径列表, 文件名列表, 类别列表)，返回与之一一对应的结果字典列表
+    (至少包含 status)；is_ready 返回 False 时 (例如 Milvus 不可用) 暂不处理，文件留待下次。
+    """
+
+    def __init__(self, directories, process_batch, batch_size=BATCH_SIZE, max_wait=MAX_WAIT,
+                 debounce=DEBOUNCE, poll_interval=POLL_INTERVAL, use_inotify=True, skip_existing=False,
+                 is_ready=None):
+        """
+        参数:
+            directories (dict): {目录: 类别}，见 parse_watch_dirs。
+            use_inotify (bool): 是否尝试使用 inotify，否则定期扫描目录。
+            skip_existing (bool): 是否忽略启动时目录中已有的文件，默认启动时补入库这些文件。
+        """
+        super().__init__(name='ingest-watcher', daemon=True)
+        self.directories = directories
+        self.process_batch = process_batch
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.skip_existing = skip_existing
+        self.is_ready = is_ready
+        self.mode = None
+        self._inotify = None
+        self._stopped = threading.Event()
+        self._start_time = time.time()
+        # 尚未写完的文件：路径 -> [大小, 修改时间, 最后一次变化的时间 (monotonic), 需要保持不变的秒数]
+        self._pending = {}
+        # 已写完、等待处理的文件：路径 -> 写完的时间 (Unix 秒)
+        self._ready = {}
+        # 已处理过的文件：路径 -> (大小, 修改时间)，文件再次变化时重新处理
+        self._seen = {}
+        track_queue_depth('watch', lambda: len(self._pending) + len(self._ready))
+
+    @property
+    def backlog(self):
+        return len(self._pending) + len(self._ready)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """停止监听，并等待正在处理的批次写入写缓冲后返回 (最长 timeout 秒)"""
+        self._stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(timeout)
+            if self.is_alive():
+                print(f"目录监听线程 {timeout:g} 秒内没有处理完当前批次")
+
+    # --- 发现文件 ---
+    def _category(self, path):
+        for directory, category in self.directories.items():
+            if path == directory or path.startswith(directory + os.sep):
+                return category
+        return None
+
+    def _observe(self, path, closed=False, opened=False):
+        """
+        记录一次文件变化：closed 为 True 时 (写入方已关闭文件) 直接视为写完；
+        opened 为 True 时 (收到创建或修改事件) 等待关闭事件，否则按 debounce 判断。
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._pending.pop(path, None)
+            return
+        signature = (stat.st_size, stat.st_mtime)
+        if self._seen.get(path) == signature or path in self._ready:
+            return
+        if closed:
+            self._pending.pop(path, None)
+            self._ready[path] = time.time()
+            return
+        entry = self._pending.get(path)
+        wait = OPEN_TIMEOUT if opened or (entry is not None and entry[3] == OPEN_TIMEOUT) else self.debounce
+        if entry is None or (entry[0], entry[1]) != signature or entry[3] != wait:
+            self._pending[path] = [stat.st_size, stat.st_mtime, time.monotonic(), wait]
+
+    def _scan(self, directory, record_only=False):
+        """
+        遍历目录 (含子目录)，新文件或有变化的文件进入待定列表；inotify 模式下同时为子目录添加监听。
+
+        返回:
+            set: 扫描到的候选文件路径。
+        """
+        found = set()
+        for root, dirs, files in os.walk(directory):
+            if self._inotify is not None:
+                try:
+                    self._inotify.add_watch(root)
+                except OSError as e:
+                    print(f"监听目录 {root} 失败: {e}")
+            for name in files:
+                if not _is_candidate(name):
+                    continue
+                path = os.path.join(root, name)
+                found.add(path)
+                if record_only:
+                    try:
+                        stat = os.stat(path)
+                        self._seen[path] = (stat.st_size, stat.st_mtime)
+                    except OSError:
+                        pass
+                else:
+                    self._observe(path)
+        return found
+
+    def _rescan(self):
+        """重新扫描所有监听目录，并清除已不存在的文件的处理记录 (保留源文件时 _seen 不会无限增长)"""
+        found = set()
+        for directory in self.directories:
+            found |= self._scan(directory)
+        for path in [path for path in self._seen if path not in found]:
+            del self._seen[path]
+
+    def _settle(self):
+        """大小和修改时间在规定时间内未变化的待定文件视为写完"""
+        now = time.monotonic()
+        for path, (size, mtime, changed, wait) in list(self._pending.items()):
+            if now - changed < wait:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime) == (size, mtime):
+                del self._pending[path]
+                self._ready[path] = time.time() - (now - changed)
+            else:
+                self._pending[path] = [stat.st_size, stat.st_mtime, now, wait]
+
+    # --- 处理 ---
+    def _flush(self, force=False):
+        """写完的文件凑满一批或最早一张等待超过 max_wait 秒时处理"""
+        while self._ready:
+            oldest = min(self._ready.values())
+            if not force and len(self._ready) < self.batch_size and time.time() - oldest < self.max_wait:
+                return
+            if self.is_ready is not None and not self.is_ready():
+                return
+            batch = sorted(self._ready, key=self._ready.get)[:self.batch_size]
+            signatures = {}
+            for path in batch:
+                try:
+                    stat = os.stat(path)
+                    signatures[path] = (stat.st_size, stat.st_mtime)
+                except OSError:
+                    pass
+            try:
+                results = self.process_batch(batch, [os.path.basename(path) for path in batch],
+                                             [self._category(path) for path in batch])
+            except Exception as e:
+                print(f"自动入库失败，稍后重试: {e}")
+                return
+            now = time.time()
+            for path, result in zip(batch, results):
+                ready_at = self._ready.pop(path)
+                if result['status'] in ('inserted', 'skipped'):
+                    # 启动前已存在的文件按启动时间计算延迟
+                    INGEST_LAG.observe(now - max(ready_at, self._start_time))
+                else:
+                    print(f"自动入库 {path} 失败: {result.get('message')}")
+                if path in signatures and os.path.exists(path):
+                    self._seen[path] = signatures[path]
+                else:
+                    self._seen.pop(path, None)
+            inserted = sum(1 for result in results if result['status'] == 'inserted')
+            print(f"自动入库 {len(batch)} 个文件：插入 {inserted} 个，剩余 {self.backlog} 个待处理")
+
+    # --- 主循环 ---
+    def _setup(self):
+        if self.use_inotify:
+            try:
+                self._inotify = _Inotify()
+                self.mode = 'inotify'
+            except OSError as e:
+                print(f"inotify 不可用，改为每 {self.poll_interval} 秒扫描一次目录: {e}")
+        if self._inotify is None:
+            self.mode = 'poll'
+        for directory in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            try:
+                self._scan(directory, record_only=self.skip_existing)
+            except OSError as e:
+                print(f"扫描目录 {directory} 失败: {e}")
+        print(f"开始监听 {len(self.directories)} 个目录 ({self.mode})，"
+              f"{len(self._pending) + len(self._ready)} 个已有文件待入库")
+
+    def _handle_events(self, timeout):
+        for directory, name, mask in self._inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，部分事件丢失，重新扫描
+                print("inotify 事件队列溢出，重新扫描目录")
+                self._rescan()
+                continue
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # 新建或移入的子目录：添加监听，并补上监听生效前写入的文件
+                    self._scan(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    prefix = path + os.sep
+                    for seen in [seen for seen in self._seen if seen.startswith(prefix)]:
+                        del self._seen[seen]
+            elif not _is_candidate(name):
+                continue
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                # 文件被删除或移走 (包括入库后删除的源文件)，不再需要处理记录
+                self._seen.pop(path, None)
+                self._pending.pop(path, None)
+            else:
+                closed = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+                self._observe(path, closed=closed, opened=not closed)
+
+    def run(self):
+        self._setup()
+        last_scan = time.monotonic()
+        try:
+            while not self._stopped.is_set():
+                timeout = min(self.max_wait, self.debounce / 2) if self._pending or self._ready \
+                    else self.poll_interval
+                if self._inotify is not None:
+                    try:
+                        self._handle_events(timeout)
+                    except OSError as e:
+                        print(f"读取 inotify 事件失败: {e}")
+                        self._stopped.wait(timeout)
+                else:
+                    self._stopped.wait(timeout)
+                    if time.monotonic() - last_scan >= self.poll_interval:
+                        last_scan = time.monotonic()
+                        self._rescan()
+                self._settle()
+                self._flush()
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+
+
+def ingest_files(image_paths, image_filenames, categories, buffer=None, model=None, keep_source=False):
+    """
+    按类别分组批量插入一批文件，插入成功的文件放入图片存储。
+
+    参数:
+        image_paths (list[str]): 文件路径。
+        image_filenames (list[str]): 写入 Milvus 的文件名。
+        categories (list[str]): 每个文件的非遗类别。
+        buffer (InsertBuffer): 写缓冲，默认直接写入 Milvus (见 insert_images.insert_image_batch)。
+        model (module): 特征提取模型。
+        keep_source (bool): 是否保留源文件：插入成功的复制到图片存储，重复的不删除。
+
+    返回:
+        list[dict]: 与 image_paths 一一对应的结果。
+    """
+    results = [None] * len(image_paths)
+    for category in set(categories):
+        indices = [i for i, c in enumerate(categories) if c == category]
+        group = insert_image_batch([image_paths[i] for i in indices],
+                                   [image_filenames[i] for i in indices],
+                                   buffer=buffer, category=category, model=model)
+        for i, result in zip(indices, group):
+            results[i] = result
+    # 插入的图片已由 insert_image_batch 复制到图片存储
+    for path, result in zip(image_paths, results):
+        if result['status'] in ('inserted', 'skipped') and not keep_source and os.path.exists(path):
+            os.remove(path)
+    return results
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from prometheus_client import start_http_server
+    from embedding_models import load_model, resolve_serving
+
+    parser = argparse.ArgumentParser(description="监听目录并自动入库新图片")
+    parser.add_argument('--dir', action='append', default=[],
+                        help="监听的目录，可写为 目录=类别，可重复；默认使用 HERITAGE_WATCH_DIRS")
+    parser.add_argument('--keep-source', action='store_true', default=KEEP_SOURCE,
+                        help="保留源文件 (插入成功的复制到图片存储)")
+    parser.add_argument('--skip-existing', action='store_true', help="忽略启动时目录中已有的文件")
+    parser.add_argument('--poll', action='store_true', help="不使用 inotify，定期扫描目录")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE)
+    parser.add_argument('--metrics-port', type=int, help="在该端口暴露 Prometheus 指标")
+    args = parser.parse_args()
+
+    directories = parse_watch_dirs(args.dir or WATCH_DIRS)
+    if not directories:
+        print("未配置监听目录，请使用 --dir 或 HERITAGE_WATCH_DIRS")
+        sys.exit(1)
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    serving_model = load_model(resolve_serving()[1])
+    watcher = DirectoryWatcher(
+        directories,
+        lambda paths, names, categories: ingest_files(paths, names, categories, model=serving_model,
+                                                      keep_source=args.keep_source),
+        batch_size=args.batch_size, debounce=args.debounce, use_inotify=not args.poll,
+        skip_existing=args.skip_existing)
+    watcher.start()
+    try:
+        while watcher.is_alive():
+            watcher.join(1.0)
+    except KeyboardInterrupt:
+        watcher.stop()
+        watcher.join()
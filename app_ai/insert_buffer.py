@@ -0,0 +1,399 @@
+import os
+import json
+import uuid
+import base64
+import threading
+import time
+import numpy as np
+from milvus_client import insert_rows, PartialInsertError
+from image_metadata import build_metadata
+from metrics import stage_timer, INSERTED, ERRORS, STAGE_MILVUS_INSERT, STAGE_MILVUS_FLUSH
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只能单进程使用同一个落盘目录
+    fcntl = None
+
+# --- 写缓冲配置 ---
+# 缓冲区中累计多少行后立即写入 Milvus
+DEFAULT_MAX_ROWS = 256
+# 缓冲区中最早一行等待多久 (秒) 后强制写入 Milvus
+DEFAULT_MAX_DELAY = 2.0
+# 本地落盘目录，用于在进程崩溃后恢复尚未写入 Milvus 的行。
+# 每个写缓冲在其中使用自己的子目录 proc-<pid>-<随机串>，并在生命周期内持有子目录中锁文件的排他锁；
+# 启动时只接管能加上锁的子目录 (所属进程已退出)，多个进程 (gunicorn worker、调试模式的重载进程)
+# 共用同一个落盘目录时不会接管彼此仍在写入的文件。
+DEFAULT_SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+_OWNER_PREFIX = 'proc-'
+_LOCK_NAME = '.lock'
+
+
+def _lock_dir(path):
+    """
+    打开子目录中的锁文件并尝试加排他锁 (不等待)。
+
+    返回:
+        int: 加锁成功时返回文件描述符 (关闭即释放锁)；锁被其他进程持有或目录已被接管删除时返回 None。
+    """
+    try:
+        fd = os.open(os.path.join(path, _LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+    return fd
+
+
+def _remove_dir(path):
+    """删除 (已加锁的) 空子目录，目录中还有其他文件时保留"""
+    try:
+        os.remove(os.path.join(path, _LOCK_NAME))
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+class InsertBuffer:
+    """
+    Milvus 写缓冲 (write-behind)。
+
+    插入请求只把行追加到内存缓冲和本地落盘文件中，由后台线程按行数或时间
+    批量写入 Milvus。向量以 float32 的 numpy 矩阵按列写入，不再逐个 tolist()，
+    也不再每次插入后调用 collection.flush()，避免产生大量小 segment。
+    需要读到自己写入的数据的查询应使用 consistency_level="Session"。
+    """
+
+    def __init__(self, collection, max_rows=DEFAULT_MAX_ROWS, max_delay=DEFAULT_MAX_DELAY,
+                 spool_dir=DEFAULT_SPOOL_DIR, fsync=True, on_flushed=None):
+        """
+        参数:
+            collection (pymilvus.Collection): 目标 Milvus 集合。
+            max_rows (int): 缓冲行数达到该值时立即写入。
+            max_delay (float): 缓冲中最早一行的最长等待时间 (秒)。
+            spool_dir (str): 本地落盘目录，为 None 时不落盘。
+            fsync (bool): 每次追加落盘记录后是否调用 os.fsync。
+            on_flushed (callable): 写入成功后的回调，参数为 (rows, primary_keys)。
+        """
+        self.collection = collection
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.spool_dir = spool_dir
+        self.fsync = fsync
+        self.on_flushed = on_flushed
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._rows = []  # 每行为 (embedding, filename, image_hash, metadata)
+        self._pending_hashes = set()
+        self._pending_filenames = set()
+        self._oldest = None  # 缓冲中最早一行的加入时间
+        self._closed = False
+
+        # 已封存但尚未确认写入 Milvus 的落盘文件
+        self._sealed_spools = []
+        self._spool_seq = 0
+        self._spool_file = None
+        # 本写缓冲独占的落盘子目录及其锁文件
+        self._owner_dir = None
+        self._owner_lock = None
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._owner_dir = os.path.join(self.spool_dir, f'{_OWNER_PREFIX}{os.getpid()}-{uuid.uuid4().hex[:8]}')
+            os.makedirs(self._owner_dir)
+            self._owner_lock = _lock_dir(self._owner_dir)
+            self._recover_spool()
+            self._open_spool()
+
+        self._thread = threading.Thread(target=self._run, name='milvus-insert-buffer', daemon=True)
+        self._thread.start()
+
+    # --- 落盘文件 ---
+    def _spool_path(self, seq):
+        return os.path.join(self._owner_dir, f'insert-{seq:08d}.spool')
+
+    def _open_spool(self):
+        self._spool_seq += 1
+        self._spool_file = open(self._spool_path(self._spool_seq), 'a', encoding='utf-8')
+
+    def _write_spool(self, embedding, filename, image_hash, metadata):
+        record = {
+            'f': filename,
+            'h': image_hash,
+            'm': metadata,
+            'e': base64.b64encode(embedding.tobytes()).decode('ascii')
+        }
+        self._spool_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._spool_file.flush()
+        if self.fsync:
+            os.fsync(self._spool_file.fileno())
+
+    def _seal_spool(self):
+        """封存当前落盘文件并打开新文件，返回被封存的文件路径"""
+        if self._spool_file is None:
+            return None
+        path = self._spool_file.name
+        self._spool_file.close()
+        self._open_spool()
+        return path
+
+    def _adopt(self, directory):
+        """把目录中的落盘文件按顺序移入本写缓冲的子目录，返回移入后的路径 (其他进程已移走的文件跳过)"""
+        try:
+            names = sorted(n for n in os.listdir(directory) if n.endswith('.spool'))
+        except FileNotFoundError:
+            return []
+        adopted = []
+        for name in names:
+            self._spool_seq += 1
+            target = self._spool_path(self._spool_seq)
+            try:
+                os.replace(os.path.join(directory, name), target)
+            except FileNotFoundError:
+                continue
+            adopted.append(target)
+        return adopted
+
+    def _recover_spool(self):
+        """
+        启动时接管已退出进程留下的落盘文件，恢复尚未写入 Milvus 的行。
+
+        其他写缓冲的子目录只有在能加上锁 (所属进程已退出) 时才接管，文件移入本写缓冲的子目录，
+        接管过程中崩溃时文件仍在某个无主的子目录中，下次启动时再次接管。
+        直接放在落盘目录下的文件是旧版本留下的，同样移入后恢复。
+        """
+        paths = self._adopt(self.spool_dir)
+        for name in sorted(os.listdir(self.spool_dir)):
+            directory = os.path.join(self.spool_dir, name)
+            if not name.startswith(_OWNER_PREFIX) or directory == self._owner_dir:
+                continue
+            lock = _lock_dir(directory)
+            if lock is None:
+                continue
+            try:
+                paths.extend(self._adopt(directory))
+                _remove_dir(directory)
+            finally:
+                os.close(lock)
+        if not paths:
+            return
+        recovered = []
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃时最后一行可能只写了一半，直接丢弃
+                        print(f"丢弃损坏的落盘记录: {path}")
+                        continue
+                    embedding = np.frombuffer(base64.b64decode(record['e']), dtype=np.float32)
+                    metadata = record.get('m') or build_metadata(record['f'])
+                    recovered.append((embedding, record['f'], record['h'], metadata))
+            self._sealed_spools.append(path)
+
+        # 崩溃可能发生在写入 Milvus 之后、删除落盘文件之前，按哈希剔除已写入的行
+        existing = set()
+        hashes = list({row[2] for row in recovered})
+        try:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                expr = 'image_hash in [' + ', '.join(f'"{h}"' for h in chunk) + ']'
+                results = self.collection.query(expr=expr, output_fields=["image_hash"],
+                                                consistency_level="Strong")
+                existing.update(item['image_hash'] for item in results)
+        except Exception as e:
+            # Milvus 暂不可用时保留全部恢复的行，宁可重复写入也不丢数据
+            print(f"恢复落盘记录时查重失败，将保留全部记录: {e}")
+
+        for embedding, filename, image_hash, metadata in recovered:
+            if image_hash in existing or image_hash in self._pending_hashes:
+                continue
+            self._append_row(embedding, filename, image_hash, metadata)
+        print(f"从落盘文件恢复 {len(self._rows)} 条未写入的记录 (共读取 {len(recovered)} 条)")
+
+    # --- 缓冲操作 ---
+    def _append_row(self, embedding, filename, image_hash, metadata):
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._rows.append((embedding, filename, image_hash, metadata))
+        self._pending_hashes.add(image_hash)
+        self._pending_filenames.add(filename)
+
+    def contains(self, filename, image_hash):
+        """检查缓冲中是否已有相同文件名或哈希值的待写入行"""
+        with self._lock:
+            return filename in self._pending_filenames or image_hash in self._pending_hashes
+
+    @property
+    def pending_count(self):
+        """缓冲中尚未写入 Milvus 的行数"""
+        with self._lock:
+            return len(self._rows)
+
+    def add(self, embedding, filename, image_hash, metadata=None):
+        """
+        向缓冲追加一行。
+
+        参数:
+            embedding (numpy.ndarray): 512 维特征向量。
+            filename (str): 图像文件名。
+            image_hash (str): 图像内容的 MD5 哈希值。
+            metadata (dict): 标量元数据，缺省时按文件名解析 (见 image_metadata.build_metadata)。
+
+        返回:
+            bool: 成功加入缓冲返回 True；缓冲中已存在相同文件名或哈希时返回 False。
+        """
+        return self.add_many([embedding], [filename], [image_hash],
+                             None if metadata is None else [metadata])[0]
+
+    def add_many(self, embeddings, filenames, image_hashes, metadata=None):
+        """
+        向缓冲批量追加多行，落盘后即视为已接收。
+
+        返回:
+            list[bool]: 每一行是否成功加入缓冲。
+        """
+        if metadata is None:
+            metadata = [build_metadata(name) for name in filenames]
+        accepted = []
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('写缓冲已关闭')
+            was_empty = not self._rows
+            for embedding, filename, image_hash, meta in zip(embeddings, filenames, image_hashes, metadata):
+                if filename in self._pending_filenames or image_hash in self._pending_hashes:
+                    accepted.append(False)
+                    continue
+                embedding = np.ascontiguousarray(embedding, dtype=np.float32).reshape(-1)
+                if self._spool_file is not None:
+                    self._write_spool(embedding, filename, image_hash, meta)
+                self._append_row(embedding, filename, image_hash, meta)
+                accepted.append(True)
+            # 缓冲由空变为非空时唤醒后台线程开始计时，行数达到阈值时立即写入
+            if (was_empty and self._rows) or len(self._rows) >= self.max_rows:
+                self._cond.notify()
+        return accepted
+
+    def flush(self):
+        """
+        把缓冲中的所有行一次性写入 Milvus。
+
+        返回:
+            list: 本次写入的实体 ID 列表。
+        """
+        with self._flush_lock:
+            with self._lock:
+                rows = self._rows
+                if not rows:
+                    return []
+                sealed = self._sealed_spools + [p for p in [self._seal_spool()] if p]
+                self._rows = []
+                self._sealed_spools = []
+                self._oldest = None
+
+            try:
+                with stage_timer(STAGE_MILVUS_INSERT):
+                    primary_keys = insert_rows(
+                        self.collection,
+                        np.vstack([row[0] for row in rows]),  # 特征向量，float32 矩阵
+                        [row[1] for row in rows],  # 图像文件名
+                        [row[2] for row in rows],  # 图像哈希值
+                        [row[3] for row in rows])  # 标量元数据，按类别写入对应分区
+            except Exception as e:
+                ERRORS.labels(STAGE_MILVUS_INSERT).inc()
+                # 部分分区 (或分片) 已写入时只重试未写入的行，已写入的行不能再写一次
+                keys = e.primary_keys if isinstance(e, PartialInsertError) else [None] * len(rows)
+                failed = [row for row, pk in zip(rows, keys) if pk is None]
+                # 写入失败的行放回缓冲头部，落盘文件保留到下一次成功写入
+                # (其中已写入的行在崩溃恢复时按哈希剔除)
+                print(f"写缓冲写入 Milvus 失败，{len(failed)} 条记录将稍后重试: {e}")
+                with self._lock:
+                    self._rows = failed + self._rows
+                    self._sealed_spools = sealed + self._sealed_spools
+                    if self._oldest is None:
+                        self._oldest = time.monotonic()
+                written = [(row, pk) for row, pk in zip(rows, keys) if pk is not None]
+                if written:
+                    self._written([row for row, _ in written], [pk for _, pk in written])
+                raise
+
+            for path in sealed:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._written(rows, primary_keys)
+            return primary_keys
+
+    def _written(self, rows, primary_keys):
+        """已写入 Milvus 的行移出待写入集合，并通知 on_flushed"""
+        with self._lock:
+            for _, filename, image_hash, _ in rows:
+                self._pending_hashes.discard(image_hash)
+                self._pending_filenames.discard(filename)
+        INSERTED.inc(len(rows))
+        print(f"写缓冲已向 Milvus 写入 {len(rows)} 条记录")
+        if self.on_flushed:
+            self.on_flushed(rows, primary_keys)
+
+    def _run(self):
+        """后台线程：行数或等待时间达到阈值时写入 Milvus"""
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.max_rows:
+                        break
+                    if self._oldest is not None:
+                        remaining = self._oldest + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # 出错后稍等再重试，避免 Milvus 不可用时空转
+                time.sleep(self.max_delay)
+
+    def close(self, seal_segments=True):
+        """
+        停止后台线程并写入剩余的行。
+
+        参数:
+            seal_segments (bool): 是否在最后调用一次 collection.flush() 封存 segment。
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        try:
+            self.flush()
+            if seal_segments:
+                with stage_timer(STAGE_MILVUS_FLUSH):
+                    self.collection.flush()
+        except Exception as e:
+            # 未写入的行仍保留在落盘文件中，下次启动时恢复
+            print(f"关闭写缓冲时写入 Milvus 失败，未写入的记录将在下次启动时恢复: {e}")
+        if self._spool_file is not None:
+            path = self._spool_file.name
+            self._spool_file.close()
+            self._spool_file = None
+            if os.path.exists(path) and os.path.getsize(path) == 0:
+                os.remove(path)
+        if self._owner_lock is not None:
+            # 全部写入后删除子目录；还有未写入的落盘文件时保留，释放锁后由下一个启动的进程接管
+            if not any(n.endswith('.spool') for n in os.listdir(self._owner_dir)):
+                _remove_dir(self._owner_dir)
+            os.close(self._owner_lock)
+            self._owner_lock = None
@@ -1,87 +1,25 @@
 # 导入所需的库
-from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility  # Milvus 客户端库
+from milvus_client import get_collection, recreate_collection, insert_rows, collection_name  # 共享的 Milvus 连接池和集合配置
+from sharding import get_sharded_collection  # 分片集合 (HERITAGE_SHARDS)
+from image_metadata import build_metadata  # 从文件名解析来源视频、帧时间戳等标量元数据
+from image_catalog import get_catalog, catalog_name  # 本地图片目录库，用于查重
+import image_store  # 图片文件的分层存储
 import numpy as np  # 用于数值计算
-from resnet import extract_features  # 从自定义的 resnet 模块导入特征提取函数
+import resnet  # 默认的特征提取模型
+from embedding_cache import extract_features_cached, extract_features_batch_cached  # 按图片哈希缓存特征向量
 import os  # 用于操作系统相关操作，如路径处理
 import hashlib  # 用于计算文件哈希值
-
-# --- Milvus 连接配置 ---
-# 使用别名 "default" 连接到本地运行的 Milvus 实例
-connections.connect(
-    alias="default",  # 连接别名
-    host='192.168.1.100',  # Milvus 服务器地址
-    port='19530'  # Milvus 服务器端口
-)
-
-# --- Milvus 集合 Schema 定义 ---
-# 定义集合中每个字段的模式
-fields = [
-    # 主键字段：INT64 类型，自动生成 ID
-    FieldSchema(name="id", dtype=DataType.INT64, is_primary=True,
-                auto_id=True),
-    # 嵌入向量字段：FLOAT_VECTOR 类型，维度为 512 (由 ResNet18 模型决定)
-    FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=512),
-    # 图像文件名字段：VARCHAR 类型，最大长度 255
-    FieldSchema(name="image_filename", dtype=DataType.VARCHAR, max_length=255),
-    # 图像内容哈希值字段：VARCHAR 类型，最大长度 64 (MD5 哈希长度为 32，这里设为 64 足够)
-    FieldSchema(name="image_hash", dtype=DataType.VARCHAR, max_length=64)
-]
-# 创建集合 Schema 对象，包含字段定义和描述信息
-schema = CollectionSchema(fields=fields, description="非遗图像特征向量集合 (基于文件名和哈希去重)")
-# 定义集合名称
-collection_name = "intangible_cultural_heritage_images"
+from metrics import (stage_timer, DEDUP_SKIPPED, INSERTED, STAGE_MILVUS_QUERY, STAGE_MILVUS_INSERT,
+                     STAGE_MILVUS_FLUSH)  # 各阶段耗时和计数指标
 
 # --- 初始化或获取 Milvus 集合对象 ---
-collection = None  # 先将集合对象初始化为 None
-# 检查指定名称的集合是否存在
-if not utility.has_collection(collection_name):
-    # 如果集合不存在，打印提示信息并创建新集合
-    print(f"集合 {collection_name} 不存在，正在创建...")
-    collection = Collection(name=collection_name,
-                            schema=schema)  # 使用定义的 Schema 创建集合
-    # --- 为新创建的集合创建索引 ---
-    print(f"为新集合 {collection_name} 创建索引...")
-    # 定义索引参数：使用 L2 距离度量，索引类型为 IVF_FLAT，聚类数量为 1024
-    index_params = {
-        "metric_type": "L2",  # 距离度量类型
-        "index_type": "IVF_FLAT",  # 索引类型
-        "params": {
-            "nlist": 1024
-        }  # 索引参数，nlist 是聚类中心的数量
-    }
-    # 在 "embedding" 字段上创建索引
-    collection.create_index(
-        field_name="embedding",  # 需要创建索引的字段名
-        index_params=index_params  # 索引参数
-    )
-    print(f"已为新集合创建索引 {index_params['index_type']}")  # 打印索引创建成功的提示
-    # --- 创建索引结束 ---
-else:
-    # 如果集合已存在，获取现有集合对象
-    collection = Collection(name=collection_name)
-    print(f"集合 {collection_name} 已存在，直接使用")
-    # --- 检查现有集合是否有索引 ---
-    # 如果现有集合没有索引
-    if not collection.has_index():
-        # 打印警告信息并创建索引
-        print(f"警告：集合 {collection_name} 存在但没有索引，正在创建...")
-        # 定义索引参数 (同上)
-        index_params = {
-            "metric_type": "L2",
-            "index_type": "IVF_FLAT",
-            "params": {
-                "nlist": 1024
-            }
-        }
-        # 在 "embedding" 字段上创建索引
-        collection.create_index(field_name="embedding",
-                                index_params=index_params)
-        print(f"已为现有集合创建索引 {index_params['index_type']}")  # 打印索引创建成功的提示
-    # --- 索引检查结束 ---
+# 通过共享连接池获取集合；集合不存在时按 milvus_client 中定义的 Schema 创建并建立索引
+# 配置了 HERITAGE_SHARDS 时使用分片集合，写入按哈希值路由到分片
+collection = get_sharded_collection(create=True) or get_collection(collection_name, create=True)
 
 # --- 检查集合是否为空 ---
-# 确保 collection 对象已成功初始化后再检查实体数量
-if collection and collection.num_entities > 0:
+# 确保集合已就绪后再检查实体数量
+if collection.ready and collection.num_entities > 0:
     # 如果集合中已有数据，打印警告信息
     print(f"警告：集合中已有 {collection.num_entities} 条数据，继续操作将会追加新数据")
 
@@ -108,35 +46,48 @@ def calculate_image_hash(image_path):
 
 
 # 检查图像是否已存在于 Milvus 集合中 (基于文件名和哈希值)
-def is_image_exists(image_filename, image_hash):
+def is_image_exists(image_filename, image_hash, target_collection=None):
     """
-    查询 Milvus 集合，检查具有相同文件名或相同哈希值的图像是否已存在。
+    检查具有相同文件名或相同哈希值的图像是否已存在。
+    图片目录库已与集合同步时查询本地目录库，否则查询 Milvus 集合。
 
     参数:
         image_filename (str): 图像的文件名。
         image_hash (str): 图像内容的 MD5 哈希值。
+        target_collection (PooledCollection): 要检查的集合，默认为本模块的集合。
 
     返回:
         bool: 如果图像已存在则返回 True，否则返回 False。
     """
+    target = target_collection if target_collection is not None else collection
+    catalog, name = get_catalog(), catalog_name(target)
+    if catalog.is_synced(name):
+        return catalog.exists(name, image_filename, image_hash)
     # 构建查询表达式：查找 image_filename 匹配或 image_hash 匹配的记录
     # 注意：Milvus 查询表达式中的字符串值需要用双引号括起来
     expr = f'image_filename == "{image_filename}" or image_hash == "{image_hash}"'
     # 执行查询，指定查询表达式和需要输出的字段
-    results = collection.query(
-        expr=expr,  # 查询条件表达式
-        output_fields=["id", "image_filename"]  # 指定返回结果中包含的字段
-    )
+    with stage_timer(STAGE_MILVUS_QUERY):
+        results = target.query(
+            expr=expr,  # 查询条件表达式
+            output_fields=["id", "image_filename"],  # 指定返回结果中包含的字段
+            consistency_level="Session"  # 保证能读到本会话刚写入的数据
+        )
     # 如果查询结果列表不为空 (即找到匹配记录)，则表示图像已存在
     return len(results) > 0
 
 
 # 向 Milvus 集合插入图像特征向量、文件名和哈希值
-def insert_vectors(vectors, image_paths):
+def insert_vectors(vectors, image_paths, flush=False, category=None):
     """
-    将图像特征向量、文件名和哈希值批量插入到 Milvus 集合中，
+    将图像特征向量、文件名、哈希值和标量元数据批量插入到 Milvus 集合中，
     并在插入前检查重复项。
     返回插入和跳过的详细信息。
+
+    category 为这批图像的非遗类别，决定写入的分区；来源视频和帧时间戳从文件名中解析。
+
+    flush 为 True 时插入后调用 collection.flush() 封存 segment，
+    只应在一批数据全部写完后使用，逐条调用会产生大量小 segment。
     """
     # 检查输入的向量列表和路径列表长度是否一致
     if len(vectors) != len(image_paths):
@@ -144,9 +95,8 @@ def insert_vectors(vectors, image_paths):
         return  # 如果不匹配则直接返回
 
     # --- 准备插入数据 ---
-    # 将 numpy 数组转换为列表 (如果需要)，因为 Milvus Python SDK 通常接受列表格式
-    embeddings = [v.tolist() for v in vectors] if isinstance(
-        vectors[0], np.ndarray) else vectors
+    # 统一转换为 float32 的 numpy 矩阵，按列写入，避免逐个 tolist()
+    embeddings = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
     # 从完整路径中提取文件名
     image_filenames = [os.path.basename(path) for path in image_paths]
     # 计算每个图像文件的哈希值
@@ -166,6 +116,7 @@ def insert_vectors(vectors, image_paths):
         if is_image_exists(filename, hash_value):
             # 如果已存在，打印跳过信息并增加计数器
             print(f"跳过已存在的图像: {filename}")
+            DEDUP_SKIPPED.inc()
             skipped_count += 1
             skipped_files.append(filename)  # 新增
         else:
@@ -177,20 +128,21 @@ def insert_vectors(vectors, image_paths):
     # --- 执行插入操作 ---
     # 如果存在需要插入的新图像数据
     if new_embeddings:
-        # 准备插入的数据列表，顺序与 Schema 定义一致
-        data_to_insert = [
-            new_embeddings,  # 特征向量字段数据
-            new_filenames,  # 图像文件名字段数据
-            new_hashes  # 图像哈希字段数据
-        ]
-        # 调用 collection.insert() 方法执行插入
-        mutation_result = collection.insert(data_to_insert)
-        # 调用 collection.flush() 确保数据写入 Milvus (对于非 auto-flush 的集合是必要的)
-        collection.flush()
-        # 打印成功插入的信息和当前集合的总实体数
+        # 准备标量元数据，按 Schema 字段顺序组织列数据后按类别写入对应分区
+        metadata = [build_metadata(name, category) for name in new_filenames]
+        with stage_timer(STAGE_MILVUS_INSERT):
+            primary_keys = insert_rows(collection, np.vstack(new_embeddings), new_filenames,
+                                       new_hashes, metadata)
+        INSERTED.inc(len(new_embeddings))
+        # 登记到本地图片目录库
+        get_catalog().record(catalog_name(collection), primary_keys, new_filenames, new_hashes, metadata)
+        # 仅在调用方要求时封存 segment，Milvus 会自动封存写满的 segment
+        if flush:
+            with stage_timer(STAGE_MILVUS_FLUSH):
+                collection.flush()
+        # 打印成功插入的信息
         print(f"成功插入 {len(new_embeddings)} 个新特征向量（跳过 {skipped_count} 个已存在图像）")
-        print(f"插入的实体ID: {mutation_result.primary_keys}")
-        print(f"集合当前总数：{collection.num_entities}")
+        print(f"插入的实体ID: {primary_keys}")
         return {
             "inserted": new_filenames,
             "skipped": skipped_files,
@@ -206,56 +158,218 @@ def insert_vectors(vectors, image_paths):
         }
 
 
+# 批量检查图像是否已存在于 Milvus 集合中
+def find_existing_images(image_filenames, image_hashes, chunk_size=500, target_collection=None):
+    """
+    一次性找出已存在的文件名和哈希值。
+    图片目录库已与集合同步时查询本地目录库，否则使用 in 表达式分块查询 Milvus。
+
+    参数:
+        image_filenames (list[str]): 图像文件名列表。
+        image_hashes (list[str]): 图像内容的 MD5 哈希值列表。
+        chunk_size (int): 每次查询包含的值的数量上限。
+        target_collection (PooledCollection): 要检查的集合，默认为本模块的集合。
+
+    返回:
+        tuple: (已存在的文件名集合, 已存在的哈希值集合)。
+    """
+    target = target_collection if target_collection is not None else collection
+    catalog, name = get_catalog(), catalog_name(target)
+    if catalog.is_synced(name):
+        return catalog.find_existing(name, image_filenames, image_hashes)
+    existing_filenames = set()
+    existing_hashes = set()
+    filenames = list(set(image_filenames))
+    hashes = list(set(image_hashes))
+    if hasattr(type(target), 'query_by_hash'):
+        # 分片集合：同一哈希值的图片总在同一分片，哈希查重只查询所属分片，文件名查重仍需广播
+        with stage_timer(STAGE_MILVUS_QUERY):
+            for item in target.query_by_hash(hashes, output_fields=["image_filename", "image_hash"],
+                                                 consistency_level="Session"):
+                existing_hashes.add(item['image_hash'])
+        hashes = []
+    for i in range(0, max(len(filenames), len(hashes)), chunk_size):
+        name_chunk = filenames[i:i + chunk_size]
+        hash_chunk = hashes[i:i + chunk_size]
+        clauses = []
+        if name_chunk:
+            clauses.append('image_filename in [' + ', '.join(f'"{n}"' for n in name_chunk) + ']')
+        if hash_chunk:
+            clauses.append('image_hash in [' + ', '.join(f'"{h}"' for h in hash_chunk) + ']')
+        with stage_timer(STAGE_MILVUS_QUERY):
+            results = target.query(
+                expr=' or '.join(clauses),
+                output_fields=["image_filename", "image_hash"],
+                consistency_level="Session"
+            )
+        for item in results:
+            existing_filenames.add(item['image_filename'])
+            existing_hashes.add(item['image_hash'])
+    return existing_filenames, existing_hashes
+
+
+def release_unused(filenames, buffer=None, target_collection=None):
+    """
+    从图片存储中删除放入后没有写入集合的图片 (image_store.save 新写入的文件)。
+
+    同名且内容相同的并发上传共用同一个文件，集合或写缓冲中已有引用该文件名的行时保留。
+
+    参数:
+        filenames (list[str]): 本次新写入存储但没有写入集合的文件名。
+        buffer (InsertBuffer): 写缓冲。
+        target_collection (PooledCollection): 要检查的集合，默认为本模块的集合。
+    """
+    filenames = [name for name in filenames if buffer is None or not buffer.contains(name, None)]
+    if not filenames:
+        return
+    referenced, _ = find_existing_images(filenames, [], target_collection=target_collection)
+    for name in filenames:
+        if name not in referenced:
+            image_store.remove(name)
+
+
+# 批量处理一组图像文件：哈希、查重、特征提取、插入
+def insert_image_batch(image_paths, image_filenames=None, buffer=None, category=None, model=None):
+    """
+    对一组图像文件执行批量哈希、批量查重、批量特征提取，并一次性插入 Milvus。
+
+    参数:
+        image_paths (list[str]): 图像文件的完整路径列表。
+        image_filenames (list[str]): 写入 Milvus 的文件名，默认取路径中的文件名。
+                                     图片在查重前先复制到图片存储并占用文件名，与已有的不同图片同名时
+                                     改为带哈希后缀的文件名 (见 image_store.save)，结果中的 filename
+                                     为最终的文件名；没有写入的图片从存储中删除 (见 release_unused)。
+        buffer (InsertBuffer): 写缓冲，提供时通过缓冲写入以便与其他待写入行合并。
+        category (str): 这批图像的非遗类别，决定写入的分区。
+        model (module): 特征提取模型 (见 embedding_models.load_model)，须与写入的集合匹配；
+                        默认使用 resnet 模块。
+
+    返回:
+        list[dict]: 与 image_paths 一一对应的结果，包含 filename、status
+                    (inserted / skipped / error) 和 message。
+    """
+    if image_filenames is None:
+        image_filenames = [os.path.basename(path) for path in image_paths]
+    results = [{'filename': name, 'status': None, 'message': ''} for name in image_filenames]
+
+    # --- 批量计算哈希值 ---
+    image_hashes = [None] * len(image_paths)
+    for i, path in enumerate(image_paths):
+        try:
+            image_hashes[i] = calculate_image_hash(path)
+        except Exception as e:
+            results[i].update(status='error', message=f'读取文件失败: {e}')
+
+    # --- 放入图片存储并占用文件名，同名但内容不同的图片改名，避免覆盖已有图片 ---
+    image_filenames = list(image_filenames)
+    created = [False] * len(image_paths)
+    for i, image_hash in enumerate(image_hashes):
+        if image_hash is None:
+            continue
+        try:
+            image_filenames[i], created[i] = image_store.save(image_paths[i], image_filenames[i], image_hash)
+            results[i]['filename'] = image_filenames[i]
+        except OSError as e:
+            image_hashes[i] = None
+            results[i].update(status='error', message=f'保存文件失败: {e}')
+
+    # --- 批量查重：先查 Milvus 和写缓冲，再剔除同一批次内的重复 ---
+    valid = [i for i in range(len(image_paths)) if image_hashes[i] is not None]
+    target = buffer.collection if buffer is not None else collection
+    existing_filenames, existing_hashes = find_existing_images(
+        [image_filenames[i] for i in valid], [image_hashes[i] for i in valid], target_collection=target)
+    seen_filenames = set()
+    seen_hashes = set()
+    to_extract = []
+    for i in valid:
+        filename, image_hash = image_filenames[i], image_hashes[i]
+        if (filename in existing_filenames or image_hash in existing_hashes
+                or (buffer is not None and buffer.contains(filename, image_hash))):
+            results[i].update(status='skipped', message='图片已存在')
+        elif filename in seen_filenames or image_hash in seen_hashes:
+            results[i].update(status='skipped', message='与同批次中的图片重复')
+        else:
+            seen_filenames.add(filename)
+            seen_hashes.add(image_hash)
+            to_extract.append(i)
+
+    # --- 批量特征提取 (缓存中已有的图片不再运行模型) ---
+    vectors, errors = extract_features_batch_cached(model if model is not None else resnet,
+                                                    [image_paths[i] for i in to_extract],
+                                                    [image_hashes[i] for i in to_extract])
+    to_insert = []
+    for i, vector in zip(to_extract, vectors):
+        if vector is None:
+            results[i].update(status='error', message=f'提取特征失败: {errors.get(image_paths[i])}')
+        else:
+            to_insert.append((i, vector))
+
+    # --- 一次性插入 ---
+    if to_insert:
+        embeddings = np.vstack([vector for _, vector in to_insert])
+        filenames = [image_filenames[i] for i, _ in to_insert]
+        hashes = [image_hashes[i] for i, _ in to_insert]
+        metadata = [build_metadata(image_filenames[i], category, file_size=os.path.getsize(image_paths[i]))
+                    for i, _ in to_insert]
+        message = '已插入'
+        if buffer is not None:
+            accepted = buffer.add_many(embeddings, filenames, hashes, metadata)
+            try:
+                buffer.flush()
+            except Exception as e:
+                # 行已落盘并留在写缓冲中，由后台线程稍后写入；不能报告为失败，否则重新提交会重复入库
+                print(f"写缓冲暂时无法写入 Milvus，{sum(accepted)} 条记录将稍后写入: {e}")
+                message = '已接收，稍后写入 Milvus'
+        else:
+            with stage_timer(STAGE_MILVUS_INSERT):
+                primary_keys = insert_rows(collection, embeddings, filenames, hashes, metadata)
+            INSERTED.inc(len(to_insert))
+            get_catalog().record(catalog_name(collection), primary_keys, filenames, hashes, metadata)
+            accepted = [True] * len(to_insert)
+        for (i, _), ok in zip(to_insert, accepted):
+            if ok:
+                results[i].update(status='inserted', message=message)
+            else:
+                results[i].update(status='skipped', message='图片已存在')
+
+    inserted_filenames = {r['filename'] for r in results if r['status'] == 'inserted'}
+    release_unused([image_filenames[i] for i in valid
+                    if created[i] and results[i]['status'] != 'inserted'
+                    and image_filenames[i] not in inserted_filenames], buffer=buffer, target_collection=target)
+
+    inserted_count = sum(1 for r in results if r['status'] == 'inserted')
+    skipped_count = sum(1 for r in results if r['status'] == 'skipped')
+    DEDUP_SKIPPED.inc(skipped_count)
+    print(f"批量插入完成：插入 {inserted_count} 个，跳过 {skipped_count} 个，"
+          f"失败 {len(results) - inserted_count - skipped_count} 个")
+    return results
+
+
 # --- 主程序入口 ---
 if __name__ == "__main__":
     # --- 配置区 ---
     # 设置图片所在的目录路径 (请根据实际情况修改为你本地的路径)
     IMAGE_DIRECTORY = "D:\\Code\\heritage\\app_ai\\static\\images"
+    # 设置这批图片的非遗类别 (决定写入的分区，None 表示使用默认分类)
+    IMAGE_CATEGORY = None
     # 设置是否强制重新创建集合 (True: 删除旧集合并创建新的, False: 使用现有集合或创建新集合)
+    # 只调整索引参数或在大量删除后重建索引时，使用 index_rebuild.py 蓝绿重建，不中断线上搜索
     FORCE_RECREATE_COLLECTION = False  # 正常运行时设为 False，需要清空并重建时改为 True
     # --- 配置区结束 ---
 
     # --- 处理强制重建集合的逻辑 ---
     if FORCE_RECREATE_COLLECTION:
-        # 检查集合是否存在
-        if utility.has_collection(collection_name):
-            # 如果存在，打印提示并删除集合
-            print(f"强制删除集合 {collection_name}...")
-            utility.drop_collection(collection_name)
-        # 打印提示并创建新集合
+        # 删除旧集合，按默认 Schema 创建新集合、建立索引并加载
         print("创建新集合...")
-        collection = Collection(name=collection_name, schema=schema)
-        # --- 为新创建的集合创建索引并加载 ---
-        print(f"为新集合 {collection_name} 创建索引...")
-        # 定义索引参数 (同上)
-        index_params = {
-            "metric_type": "L2",
-            "index_type": "IVF_FLAT",
-            "params": {
-                "nlist": 1024
-            }
-        }
-        # 创建索引
-        collection.create_index(field_name="embedding",
-                                index_params=index_params)
-        print(f"已为新集合创建索引 {index_params['index_type']}")
-        # 加载新创建并已建立索引的集合到内存，准备进行查询和插入
-        print(f"加载新集合 {collection_name}...")
-        collection.load()
-        print("新集合加载完成")
-        # --- 添加结束 ---
-    else:
-        # --- 如果不是强制重建模式 ---
-        # 检查在脚本开头获取的 collection 对象是否有效
-        if collection:
-            # 加载现有集合到内存
-            print(f"加载现有集合 {collection_name}...")
-            collection.load()
-            print(f"现有集合 {collection_name} 加载完成")
-        else:
-            # 如果 collection 对象无效 (可能在脚本开头获取失败)，打印错误并退出
-            print(f"错误：无法获取集合对象 {collection_name}")
-            exit()  # 退出脚本
+        collection = recreate_collection(collection_name)
+        # 集合已清空，目录库需要重新同步
+        get_catalog().invalidate(catalog_name(collection))
+
+    # 检查集合是否已就绪 (已创建索引并加载到内存)
+    if not collection.ready:
+        # 如果集合不可用，打印错误并退出
+        print(f"错误：无法获取集合对象 {collection_name}")
+        exit()  # 退出脚本
 
     # --- 处理指定目录下的所有图片 ---
     image_dir = IMAGE_DIRECTORY  # 使用配置中指定的图片目录
@@ -280,8 +394,8 @@ if __name__ == "__main__":
             # 构建图片的完整路径
             image_path = os.path.join(image_dir, image_file)
             try:
-                # 调用 resnet 模块的 extract_features 函数提取特征向量
-                query_vector = extract_features(image_path)
+                # 提取特征向量，缓存中已有的图片 (按内容哈希) 直接读取，不再运行模型
+                query_vector = extract_features_cached(resnet, image_path, calculate_image_hash(image_path))
                 # 将提取到的向量和对应的路径添加到列表中
                 all_vectors.append(query_vector)
                 all_image_paths.append(image_path)
@@ -296,8 +410,9 @@ if __name__ == "__main__":
         if all_vectors:
             # 如果提取到了向量，打印提示并调用 insert_vectors 函数进行插入
             print(f"正在向Milvus插入 {len(all_vectors)} 个特征向量...")
-            insert_vectors(all_vectors, all_image_paths)
-            print("插入完成")  # 打印插入操作完成的提示
+            insert_vectors(all_vectors, all_image_paths, flush=True, category=IMAGE_CATEGORY)
+            print("插入完成")
+            print(f"集合当前总数：{collection.num_entities}")  # 打印插入操作完成的提示
         else:
             # 如果未能成功提取任何特征，打印提示
             print("未能成功提取任何特征")
@@ -1,33 +1,26 @@
 import os
-from pymilvus import connections, Collection, utility
+from milvus_client import get_pool, get_collection, collection_name
 
 # --- Milvus 连接配置 ---
-def connect_to_milvus(host='192.168.1.100', port='19530', alias='default'):
-    """连接到 Milvus 服务器"""
-    if not connections.has_connection(alias):
-        print(f"正在连接到 Milvus 服务器 {host}:{port}...")
-        connections.connect(alias=alias, host=host, port=port)
-        print("成功连接到 Milvus。")
-    else:
+def connect_to_milvus():
+    """连接到 Milvus 服务器 (使用共享连接池，地址由 MILVUS_ENDPOINTS 环境变量配置)"""
+    pool = get_pool()
+    if pool.is_healthy():
         print("已存在 Milvus 连接。")
+    else:
+        print("Milvus 连接暂不可用，连接池将在后台自动重连。")
 
 # --- Milvus 集合配置 ---
-collection_name = "intangible_cultural_heritage_images"  # 与 app_flask.py 和其他脚本保持一致
+# collection_name 从 milvus_client 导入，与 app_flask.py 和其他脚本保持一致
 
 def load_milvus_collection(collection_name_to_load):
     """加载指定的 Milvus 集合"""
-    if utility.has_collection(collection_name_to_load):
-        collection = Collection(name=collection_name_to_load)
-        try:
-            collection.load()
-            print(f"成功加载集合 {collection_name_to_load}。")
-            return collection
-        except Exception as load_err:
-            print(f"加载集合 {collection_name_to_load} 失败: {load_err}")
-            return None
-    else:
-        print(f"错误：集合 {collection_name_to_load} 不存在。")
-        return None
+    collection = get_collection(collection_name_to_load)
+    if collection.ready:
+        print(f"成功加载集合 {collection_name_to_load}。")
+        return collection
+    print(f"错误：集合 {collection_name_to_load} 不存在或加载失败。")
+    return None
 
 def list_all_images_from_milvus(collection):
     """从 Milvus 数据库中列出所有图片及其 ID 和文件名"""
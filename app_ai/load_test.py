@@ -0,0 +1,349 @@
+# HTTP 压测工具：按比例混合调用 /api/search、/insert_image、/api/images 和 /api/delete_images
+#
+#   python load_test.py                       # 进程内启动 app_flask，使用内存版 Milvus 替身
+#   python load_test.py --url http://host:5000 # 压测已部署的服务
+#
+# 报告每个接口的 p50/p95/p99 延迟、吞吐量和错误率，以及压测期间服务端 /metrics 中
+# 各处理阶段 (解码、预处理、模型前向、Milvus 搜索等) 的耗时分布。
+# 插入的图片使用 load_ 前缀的文件名并追加随机字节 (哈希各不相同)，压测结束后通过删除接口清理。
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.error
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+from image_store import list_images
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(APP_ROOT, 'static', 'images')
+LOAD_PREFIX = 'load_'
+
+# 默认请求比例：以搜索为主，少量插入、列表和删除
+DEFAULT_MIX = 'search=70,insert=10,list=15,delete=5'
+OPERATIONS = ('search', 'insert', 'list', 'delete')
+
+
+def _multipart(fields, files):
+    """构造 multipart/form-data 请求体，files 为 [(字段名, 文件名, 字节内容)]"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                     .encode('utf-8'))
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                     f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+                     .encode('utf-8') + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class LoadTest:
+    """多线程按比例发送请求，并记录每个请求的延迟和结果"""
+
+    def __init__(self, base_url, images, mix, concurrency=8, duration=30.0, total_requests=0,
+                 top_k=5, timeout=60.0, search_fields=None):
+        self.base_url = base_url.rstrip('/')
+        self.images = images
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+        self.concurrency = concurrency
+        self.duration = duration
+        self.total_requests = total_requests
+        self.top_k = top_k
+        self.timeout = timeout
+        self.search_fields = search_fields or {}  # 搜索请求附带的表单字段，例如 {'cascade': '0'}
+
+        self.samples = {op: [] for op in OPERATIONS}  # 操作 -> [(延迟秒数, 是否成功)]
+        self.inserted_names = set()  # 本次压测插入的文件名，删除和清理时使用
+        self._lock = threading.Lock()
+        self._issued = 0
+
+    def _request(self, method, path, body=None, content_type=None):
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def _random_image(self):
+        path = random.choice(self.images)
+        with open(path, 'rb') as f:
+            return os.path.basename(path), f.read()
+
+    # --- 各类请求 ---
+    def do_search(self):
+        name, content = self._random_image()
+        body, content_type = _multipart({'top_k': self.top_k, **self.search_fields}, [('file', name, content)])
+        status, _ = self._request('POST', '/api/search', body, content_type)
+        return status == 200
+
+    def do_insert(self):
+        name, content = self._random_image()
+        ext = os.path.splitext(name)[1]
+        filename = f'{LOAD_PREFIX}{uuid.uuid4().hex[:12]}{ext}'
+        # 在图片末尾追加随机字节，解码结果不变但哈希不同，避免被查重跳过
+        body, content_type = _multipart({}, [('file', filename, content + os.urandom(16))])
+        status, data = self._request('POST', '/insert_image', body, content_type)
+        ok = status == 200 and json.loads(data).get('success')
+        if ok:
+            with self._lock:
+                self.inserted_names.add(filename)
+        return bool(ok)
+
+    def _list(self, prefix=''):
+        status, data = self._request('GET', '/api/images' + (f'?prefix={prefix}' if prefix else ''))
+        return status, (json.loads(data).get('data', []) if status == 200 else [])
+
+    def do_list(self):
+        status, _ = self._list()
+        return status == 200
+
+    def do_delete(self):
+        # 只删除本次压测插入且已写入 Milvus 的图片
+        status, items = self._list(LOAD_PREFIX)
+        if status != 200:
+            return False
+        with self._lock:
+            candidates = [item['id'] for item in items if item['image_filename'] in self.inserted_names]
+        if not candidates:
+            return True
+        target = random.choice(candidates)
+        status, _ = self._request('POST', '/api/delete_images', json.dumps({'ids': [target]}).encode(),
+                                  'application/json')
+        return status == 200
+
+    # --- 执行 ---
+    def _next_operation(self, deadline):
+        with self._lock:
+            if self.total_requests and self._issued >= self.total_requests:
+                return None
+            if not self.total_requests and time.perf_counter() >= deadline:
+                return None
+            self._issued += 1
+        return random.choices(self.operations, self.weights)[0]
+
+    def _worker(self, deadline):
+        while True:
+            operation = self._next_operation(deadline)
+            if operation is None:
+                return
+            start = time.perf_counter()
+            try:
+                ok = getattr(self, f'do_{operation}')()
+            except Exception as e:
+                print(f"{operation} 请求失败: {e}")
+                ok = False
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.samples[operation].append((elapsed, ok))
+
+    def run(self):
+        """执行压测，返回实际耗时 (秒)"""
+        started = time.perf_counter()
+        deadline = started + self.duration
+        threads = [threading.Thread(target=self._worker, args=(deadline,), name=f'load-{i}')
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def cleanup(self, wait=3.0):
+        """删除本次压测插入的所有图片 (先等待写缓冲写入 Milvus)"""
+        time.sleep(wait)
+        deleted = 0
+        while True:
+            status, items = self._list(LOAD_PREFIX)
+            ids = [item['id'] for item in items if item['image_filename'].startswith(LOAD_PREFIX)]
+            if status != 200 or not ids:
+                break
+            status, _ = self._request('POST', '/api/delete_images', json.dumps({'ids': ids}).encode(),
+                                      'application/json')
+            if status != 200:
+                break
+            deleted += len(ids)
+        print(f"已清理 {deleted} 张压测插入的图片")
+
+
+# --- 统计 ---
+def summarize_requests(samples, elapsed):
+    """每个接口的请求数、吞吐量、错误率和延迟分位数 (毫秒)"""
+    report = {}
+    for operation, items in samples.items():
+        if not items:
+            continue
+        latencies = np.array([latency for latency, _ in items]) * 1000
+        errors = sum(1 for _, ok in items if not ok)
+        report[operation] = {
+            'requests': len(items),
+            'throughput_rps': len(items) / elapsed,
+            'error_rate': errors / len(items),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max())
+        }
+    return report
+
+
+def scrape_stage_histograms(base_url):
+    """读取服务端各阶段耗时直方图：阶段 -> {'buckets': {上界: 累计数}, 'sum': 总耗时}"""
+    with urllib.request.urlopen(base_url.rstrip('/') + '/metrics', timeout=10) as response:
+        text = response.read().decode('utf-8')
+    stages = {}
+    for family in text_string_to_metric_families(text):
+        if family.name != 'heritage_stage_seconds':
+            continue
+        for sample in family.samples:
+            stage = stages.setdefault(sample.labels['stage'], {'buckets': {}, 'sum': 0.0})
+            if sample.name.endswith('_bucket'):
+                stage['buckets'][float(sample.labels['le'])] = sample.value
+            elif sample.name.endswith('_sum'):
+                stage['sum'] = sample.value
+    return stages
+
+
+def _bucket_quantile(buckets, q):
+    """按直方图分桶线性插值估算分位数"""
+    total = buckets[-1][1]
+    target = q * total
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= target:
+            if bound == float('inf'):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (target - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+def summarize_stages(before, after):
+    """根据压测前后两次抓取的直方图差值，计算每个阶段的次数、平均值和分位数 (毫秒)"""
+    report = {}
+    for stage, data in after.items():
+        old = before.get(stage, {'buckets': {}, 'sum': 0.0})
+        buckets = sorted((le, count - old['buckets'].get(le, 0.0)) for le, count in data['buckets'].items())
+        count = buckets[-1][1] if buckets else 0
+        if count <= 0:
+            continue
+        report[stage] = {
+            'count': int(count),
+            'mean_ms': (data['sum'] - old['sum']) / count * 1000,
+            'p50_ms': _bucket_quantile(buckets, 0.50) * 1000,
+            'p95_ms': _bucket_quantile(buckets, 0.95) * 1000,
+            'p99_ms': _bucket_quantile(buckets, 0.99) * 1000
+        }
+    return report
+
+
+def print_report(requests_report, stage_report, elapsed):
+    total = sum(r['requests'] for r in requests_report.values())
+    print(f"\n压测耗时 {elapsed:.1f}s，共 {total} 个请求，总吞吐量 {total / elapsed:.1f} 请求/秒")
+    print(f"{'接口':<8}{'请求数':>8}{'吞吐(r/s)':>11}{'错误率':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for operation, r in requests_report.items():
+        print(f"{operation:<10}{r['requests']:>8}{r['throughput_rps']:>11.1f}{r['error_rate']:>9.1%}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+    if stage_report:
+        print(f"\n{'阶段':<16}{'次数':>8}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+        for stage, r in sorted(stage_report.items()):
+            print(f"{stage:<18}{r['count']:>8}{r['mean_ms']:>10.1f}{r['p50_ms']:>10.1f}"
+                  f"{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+
+
+def parse_mix(text):
+    """解析 "search=70,insert=10" 形式的请求比例"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"未知的请求类型: {name}，可选: {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def start_local_app(latency, seed_rows):
+    """
+    在当前进程中使用内存版 Milvus 启动 app_flask，返回服务地址。
+
+    参数:
+        latency (float): 模拟的 Milvus 调用延迟 (秒)。
+        seed_rows (int): 预置的随机向量数量，让搜索在接近真实规模的数据上执行。
+    """
+    import fake_milvus
+    fake_milvus.install(latency)
+    import app_flask
+    from werkzeug.serving import make_server
+    from milvus_client import insert_rows
+
+    if seed_rows:
+        collection = app_flask.serving.collection
+        dim = app_flask.serving.model.EMBEDDING_DIM
+        rng = np.random.default_rng(0)
+        for start in range(0, seed_rows, 10000):
+            count = min(10000, seed_rows - start)
+            vectors = rng.standard_normal((count, dim)).astype(np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            insert_rows(collection, vectors, [f'seed_{start + i}.jpg' for i in range(count)],
+                        [uuid.uuid4().hex for _ in range(count)])
+        print(f"已向内存 Milvus 预置 {seed_rows} 条随机向量")
+
+    server = make_server('127.0.0.1', 0, app_flask.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='load-test-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="app_flask 接口压测")
+    parser.add_argument('--url', help="被压测服务的地址，不指定时在进程内启动服务并使用内存版 Milvus")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0, help="压测时长 (秒)")
+    parser.add_argument('--requests', type=int, default=0, help="请求总数，指定后忽略 --duration")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"请求比例，默认 {DEFAULT_MIX}")
+    parser.add_argument('--images', default=IMAGE_DIR, help="查询和插入使用的图片目录")
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--fake-latency-ms', type=float, default=1.0, help="内存版 Milvus 每次调用的模拟延迟")
+    parser.add_argument('--seed-rows', type=int, default=10000, help="内存版 Milvus 预置的随机向量数量")
+    parser.add_argument('--no-cleanup', action='store_true', help="不删除压测插入的图片")
+    parser.add_argument('--no-cascade', action='store_true',
+                        help="搜索请求不使用级联搜索 (与默认设置对比 coarse_forward、model_forward 等阶段耗时)")
+    parser.add_argument('--json', help="把报告写入 JSON 文件")
+    args = parser.parse_args()
+
+    images = [path for path in list_images(args.images) if not os.path.basename(path).startswith(LOAD_PREFIX)]
+    if not images:
+        print(f"目录 {args.images} 中没有图片")
+        sys.exit(1)
+
+    base_url = args.url or start_local_app(args.fake_latency_ms / 1000, args.seed_rows)
+    test = LoadTest(base_url, images, parse_mix(args.mix), concurrency=args.concurrency,
+                    duration=args.duration, total_requests=args.requests, top_k=args.top_k,
+                    search_fields={'cascade': '0'} if args.no_cascade else None)
+
+    stages_before = scrape_stage_histograms(base_url)
+    print(f"开始压测 {base_url}：并发 {args.concurrency}，比例 {args.mix}")
+    elapsed = test.run()
+    stage_report = summarize_stages(stages_before, scrape_stage_histograms(base_url))
+    requests_report = summarize_requests(test.samples, elapsed)
+    print_report(requests_report, stage_report, elapsed)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'elapsed_s': elapsed, 'concurrency': args.concurrency, 'mix': args.mix,
+                       'endpoints': requests_report, 'stages': stage_report}, f, ensure_ascii=False, indent=2)
+    if not args.no_cleanup:
+        test.cleanup()
@@ -0,0 +1,114 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+import profiling
+
+# --- 指标定义 ---
+# 所有模块共用的 Prometheus 指标，统一在这里定义，通过 /metrics 接口以文本格式暴露
+
+# 延迟分桶 (秒)：覆盖从毫秒级的 Milvus 查询到数秒的批量入库
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 各处理阶段的耗时，stage 取值见下方 STAGE_* 常量
+STAGE_LATENCY = Histogram('heritage_stage_seconds', '各处理阶段耗时 (秒)', ['stage'],
+                          buckets=LATENCY_BUCKETS)
+# 每个 HTTP 接口的整体耗时
+REQUEST_LATENCY = Histogram('heritage_request_seconds', 'HTTP 请求整体耗时 (秒)', ['endpoint'],
+                            buckets=LATENCY_BUCKETS)
+# 搜索请求从收到到产出第一批结果的耗时，mode 为 stream (流式响应的第一阶段) 或 full (一次性响应)
+FIRST_RESULT_LATENCY = Histogram('heritage_search_first_result_seconds', '搜索请求产出第一批结果的耗时 (秒)',
+                                 ['mode'], buckets=LATENCY_BUCKETS)
+# 每次模型前向计算处理的图片数量
+BATCH_SIZE = Histogram('heritage_model_batch_size', '每次模型前向计算的图片数量',
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+# 目录监听自动入库 (见 ingest_watcher.py)：从文件写完到写入 Milvus 的延迟
+INGEST_LAG = Histogram('heritage_ingest_lag_seconds', '监听目录中的新图片从写完到写入 Milvus 的延迟 (秒)',
+                       buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0))
+
+CACHE_HITS = Counter('heritage_cache_hits_total', '缓存命中次数', ['cache'])
+CACHE_MISSES = Counter('heritage_cache_misses_total', '缓存未命中次数', ['cache'])
+DEDUP_SKIPPED = Counter('heritage_dedup_skipped_total', '因重复而跳过插入的图片数量')
+INSERTED = Counter('heritage_inserted_total', '写入 Milvus 的图片数量')
+ERRORS = Counter('heritage_errors_total', '各阶段发生的错误次数', ['stage'])
+# 每个 HTTP 接口返回 5xx 的次数 (与按处理阶段统计的 ERRORS 分开，避免同一标签混用两类取值)
+ENDPOINT_ERRORS = Counter('heritage_endpoint_errors_total', '各 HTTP 接口返回服务端错误的次数', ['endpoint'])
+
+# 准入控制 (见 admission.py)
+SHED = Counter('heritage_shed_total', '因过载或超时被拒绝的请求数量', ['endpoint', 'reason'])
+DEGRADED = Counter('heritage_degraded_total', '以降级参数执行的请求数量', ['endpoint', 'level'])
+
+# 分区冷热分层 (见 partition_tiering.py)
+TIER_LOADS = Counter('heritage_tier_partition_events_total', '分区加载和释放次数 (hot、cold、timeout、over_budget、released)',
+                     ['event'])
+SEARCH_PARTIAL = Counter('heritage_search_partial_total', '因冷分区未加载而跳过部分分区的搜索次数')
+
+# 两阶段级联搜索 (见 cascade.py)：path 为 coarse (粗筛置信度足够，未运行 ResNet)、
+# rerank (运行 ResNet 后重排序) 或 fallback (候选不足，改为完整搜索)
+CASCADE_QUERIES = Counter('heritage_cascade_queries_total', '级联搜索各路径的查询次数', ['path'])
+CASCADE_MARGIN = Histogram('heritage_cascade_margin', '粗筛结果第 1、2 名的距离差',
+                           buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0))
+# 视频片段搜索 (见 clip_search.py)：每次查询实际用于搜索的帧数和匹配到的视频片段数
+CLIP_QUERY_FRAMES = Histogram('heritage_clip_query_frames', '视频片段搜索每次查询的帧数',
+                              buckets=(1, 8, 16, 32, 64, 128, 256, 512))
+CLIP_SEGMENTS = Histogram('heritage_clip_segments', '视频片段搜索每次查询匹配到的视频片段数',
+                          buckets=(0, 1, 2, 3, 5, 10, 20))
+
+QUEUE_DEPTH = Gauge('heritage_queue_depth', '队列中等待处理的条目数量', ['queue'])
+COLLECTION_SIZE = Gauge('heritage_collection_entities', 'Milvus 集合中的实体数量')
+LOAD_LEVEL = Gauge('heritage_load_level', '当前负载等级 (0 正常，1 繁忙，2 过载)')
+INFLIGHT = Gauge('heritage_inflight_requests', '正在执行的推理请求数量')
+TIER_LOADED = Gauge('heritage_tier_loaded_partitions', '已加载的分区数量', ['tier'])
+
+# --- 阶段名称 ---
+STAGE_UPLOAD_RECEIVE = 'upload_receive'
+STAGE_IMAGE_DECODE = 'image_decode'
+STAGE_PREPROCESS = 'preprocess'
+STAGE_MODEL_FORWARD = 'model_forward'
+STAGE_COARSE_FORWARD = 'coarse_forward'
+STAGE_RERANK = 'rerank'
+STAGE_VIDEO_DECODE = 'video_decode'
+STAGE_CLIP_ALIGN = 'clip_align'
+STAGE_MILVUS_SEARCH = 'milvus_search'
+STAGE_MILVUS_QUERY = 'milvus_query'
+STAGE_MILVUS_INSERT = 'milvus_insert'
+STAGE_MILVUS_FLUSH = 'milvus_flush'
+STAGE_RESPONSE_RENDER = 'response_render'
+
+
+def stage_timer(stage):
+    """
+    返回记录指定阶段耗时的上下文管理器，例如 with stage_timer(STAGE_MODEL_FORWARD): ...
+    当前请求正在被剖析时，同时记录一个同名的剖析区间。
+    """
+    return profiling.span(stage, STAGE_LATENCY.labels(stage).time())
+
+
+def _safe(func):
+    """抓取指标时读取失败 (例如 Milvus 不可用) 返回 NaN，不影响其他指标输出"""
+    def wrapper():
+        try:
+            return func()
+        except Exception:
+            return float('nan')
+    return wrapper
+
+
+def track_queue_depth(queue, func):
+    """登记一个在抓取指标时调用的函数，用于读取队列深度"""
+    QUEUE_DEPTH.labels(queue).set_function(_safe(func))
+
+
+def refresh_collection_size(func):
+    """
+    读取集合实体数量并缓存到指标中，由 Milvus 健康检查线程定期调用，抓取指标时不再访问 Milvus。
+    读取失败 (例如 Milvus 不可用) 时记为 NaN。
+    """
+    COLLECTION_SIZE.set(_safe(func)())
+
+
+def render_metrics():
+    """
+    生成 Prometheus 文本格式的指标数据。
+
+    返回:
+        tuple: (指标文本, Content-Type)。
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
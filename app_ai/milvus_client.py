@@ -0,0 +1,700 @@
+import os
+import time
+import random
+import threading
+import numpy as np
+from pymilvus import connections, Collection, utility, FieldSchema, CollectionSchema, DataType
+from pymilvus.exceptions import MilvusException, MilvusUnavailableException
+from image_metadata import build_metadata, partition_name, METADATA_FIELDS, PARTITION_TIERING
+
+# --- Milvus 连接配置 ---
+# 以逗号分隔的 Milvus 地址列表，例如 "10.0.0.1:19530,10.0.0.2:19530"
+MILVUS_ENDPOINTS = [e.strip() for e in os.environ.get('MILVUS_ENDPOINTS', '192.168.1.100:19530').split(',')
+                    if e.strip()]
+# 连接池中的连接 (gRPC 通道) 数量，多个连接按轮询方式分摊并发请求
+MILVUS_POOL_SIZE = int(os.environ.get('MILVUS_POOL_SIZE', '4'))
+# 单次调用的超时时间 (秒)
+MILVUS_TIMEOUT = float(os.environ.get('MILVUS_TIMEOUT', '10'))
+# 可重试错误的最大重试次数，以及指数退避的初始和最大等待时间 (秒)
+MILVUS_MAX_RETRIES = int(os.environ.get('MILVUS_MAX_RETRIES', '3'))
+MILVUS_BACKOFF_BASE = float(os.environ.get('MILVUS_BACKOFF_BASE', '0.2'))
+MILVUS_BACKOFF_MAX = float(os.environ.get('MILVUS_BACKOFF_MAX', '5'))
+# 健康检查间隔 (秒)
+MILVUS_HEALTH_INTERVAL = float(os.environ.get('MILVUS_HEALTH_INTERVAL', '10'))
+
+# --- Milvus 集合配置 ---
+# 对外使用的集合名。完成模型迁移准备后它是一个别名，指向当前模型版本的集合
+# (集合名为 <collection_name>__<模型版本>，见 versioned_name)
+collection_name = "intangible_cultural_heritage_images"
+# 版本化集合名中分隔基础名和模型版本的分隔符
+VERSION_SEPARATOR = "__"
+
+
+# --- Milvus 集合 Schema 定义 ---
+def build_schema(dim=512):
+    """
+    构造集合 Schema。
+
+    参数:
+        dim (int): 特征向量维度，由生成特征的模型决定 (ResNet18 为 512)。
+
+    返回:
+        CollectionSchema: 集合 Schema 对象。
+    """
+    return CollectionSchema(fields=build_fields(dim),
+                            description="非遗图像特征向量集合 (基于文件名和哈希去重)")
+
+
+def build_fields(dim=512):
+    """返回集合的字段定义列表，向量维度由 dim 指定"""
+    return [
+        # 主键字段：INT64 类型，自动生成 ID
+        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True,
+                    auto_id=True),
+        # 嵌入向量字段：FLOAT_VECTOR 类型，维度由模型决定 (ResNet18 为 512)
+        FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=dim),
+        # 图像文件名字段：VARCHAR 类型，最大长度 255
+        FieldSchema(name="image_filename", dtype=DataType.VARCHAR, max_length=255),
+        # 图像内容哈希值字段：VARCHAR 类型，最大长度 64 (MD5 哈希长度为 32，这里设为 64 足够)
+        FieldSchema(name="image_hash", dtype=DataType.VARCHAR, max_length=64),
+        # 非遗类别：主要的过滤维度，每个类别写入独立的分区，按类别过滤时只搜索对应分区
+        # VARCHAR 的 max_length 按 UTF-8 字节数计算，写入前由 image_metadata.truncate_utf8 截断
+        FieldSchema(name="category", dtype=DataType.VARCHAR, max_length=64),
+        # 来源视频名和帧时间戳 (毫秒)：从抽帧文件名中解析，非抽帧图片分别为空字符串和 -1
+        FieldSchema(name="source_video", dtype=DataType.VARCHAR, max_length=255),
+        FieldSchema(name="frame_ts_ms", dtype=DataType.INT64),
+        # 入库时间 (Unix 秒)
+        FieldSchema(name="ingest_time", dtype=DataType.INT64)
+    ]
+
+
+# 默认 (ResNet18, 512 维) 的字段定义和 Schema
+fields = build_fields(512)
+schema = build_schema(512)
+
+# 索引参数：使用 L2 距离度量，索引类型为 IVF_FLAT，聚类数量为 1024
+index_params = {
+    "metric_type": "L2",
+    "index_type": "IVF_FLAT",
+    "params": {
+        "nlist": 1024
+    }
+}
+
+# 只读或幂等的集合方法，遇到可重试错误时自动重试；insert 不重试，避免重复写入
+_RETRYABLE_METHODS = {'search', 'query', 'delete', 'flush', 'load', 'release', 'has_index',
+                      'create_index', 'describe', 'num_entities'}
+
+
+def is_transient_error(error):
+    """判断错误是否为可重试的临时错误 (连接中断、服务不可用、超时等)"""
+    if isinstance(error, (MilvusUnavailableException, ConnectionError, TimeoutError)):
+        return True
+    try:
+        import grpc
+        if isinstance(error, grpc.RpcError) and error.code() in (
+                grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                grpc.StatusCode.RESOURCE_EXHAUSTED):
+            return True
+    except ImportError:
+        pass
+    if isinstance(error, MilvusException):
+        message = str(error).lower()
+        return any(word in message for word in (
+            'unavailable', 'deadline', 'timeout', 'connect', 'not ready', 'too many requests'))
+    return False
+
+
+class MilvusPool:
+    """
+    共享的 Milvus 连接池。
+
+    为每个地址建立若干个连接别名，按轮询方式分配给调用方；调用失败时按指数退避重试并重建连接。
+    后台健康检查线程定期探测每个连接，必要时重连并重新加载集合。
+    """
+
+    def __init__(self, endpoints=None, pool_size=MILVUS_POOL_SIZE, timeout=MILVUS_TIMEOUT,
+                 health_interval=MILVUS_HEALTH_INTERVAL, alias_prefix='heritage'):
+        self.endpoints = endpoints or MILVUS_ENDPOINTS
+        self.timeout = timeout
+        self.health_interval = health_interval
+        # 每个连接别名对应的 (host, port)，连接数不少于地址数
+        self.aliases = {}
+        for i in range(max(pool_size, len(self.endpoints))):
+            host, _, port = self.endpoints[i % len(self.endpoints)].partition(':')
+            self.aliases[f'{alias_prefix}-{i}'] = (host, port or '19530')
+        self._alias_list = list(self.aliases)
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._healthy = {alias: False for alias in self.aliases}
+        # 需要保持加载状态的集合：名称 -> (schema, index_params)
+        self._managed = {}
+        self._ready = set()
+        # 按分区加载的集合 (冷热分层)：名称 -> 检查并补齐分区加载状态的回调 (见 partition_tiering.py)
+        self._partial = {}
+        # 每次健康检查结束后调用的函数 (例如刷新缓存的指标)
+        self._hooks = []
+        self._thread = None
+
+        for alias in self._alias_list:
+            self._connect(alias)
+
+    # --- 连接管理 ---
+    def _connect(self, alias):
+        host, port = self.aliases[alias]
+        try:
+            if connections.has_connection(alias):
+                connections.disconnect(alias)
+            connections.connect(alias=alias, host=host, port=port, timeout=self.timeout)
+            self._healthy[alias] = True
+            print(f"成功连接到 Milvus {host}:{port} (连接 {alias})。")
+        except Exception as e:
+            self._healthy[alias] = False
+            print(f"连接 Milvus {host}:{port} (连接 {alias}) 失败: {e}")
+
+    def acquire(self):
+        """按轮询方式返回一个连接别名，优先选择健康的连接"""
+        with self._lock:
+            for _ in range(len(self._alias_list)):
+                alias = self._alias_list[self._cursor % len(self._alias_list)]
+                self._cursor += 1
+                if self._healthy[alias]:
+                    return alias
+            # 所有连接都不健康时仍然轮询返回，由调用失败触发重连
+            alias = self._alias_list[self._cursor % len(self._alias_list)]
+            self._cursor += 1
+            return alias
+
+    def mark_unhealthy(self, alias):
+        self._healthy[alias] = False
+
+    def is_healthy(self):
+        return any(self._healthy.values())
+
+    def call(self, func, retry=True):
+        """
+        在连接池中的某个连接上执行 func(alias)，遇到临时错误时按指数退避重试。
+
+        参数:
+            func (callable): 接收连接别名的函数。
+            retry (bool): 是否对临时错误进行重试。
+        """
+        attempts = MILVUS_MAX_RETRIES + 1 if retry else 1
+        for attempt in range(attempts):
+            alias = self.acquire()
+            try:
+                if not connections.has_connection(alias):
+                    self._connect(alias)
+                return func(alias)
+            except Exception as e:
+                if not is_transient_error(e):
+                    raise
+                self.mark_unhealthy(alias)
+                if attempt == attempts - 1:
+                    raise
+                delay = min(MILVUS_BACKOFF_MAX, MILVUS_BACKOFF_BASE * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.0)
+                print(f"Milvus 调用失败 (连接 {alias})，{delay:.2f} 秒后重试: {e}")
+                time.sleep(delay)
+                self._connect(alias)
+
+    # --- 集合管理 ---
+    def ensure_collection(self, name, schema=None, index_params=None, partial=False):
+        """
+        确保集合存在、已建立索引并已加载。集合不存在且提供了 schema 时自动创建。
+
+        参数:
+            partial (bool): 只准备集合而不整体加载，由 partition_tiering 按需加载分区
+                            (仅对包含元数据字段的集合生效)。
+
+        返回:
+            bool: 集合是否可用。
+        """
+        # 只带名称的调用不覆盖已登记的 schema 和索引参数
+        if schema is not None or name not in self._managed:
+            self._managed[name] = (schema, index_params)
+        if partial:
+            self._partial.setdefault(name, None)
+        try:
+            self.call(lambda alias: self._prepare(name, schema, index_params, alias))
+            self._ready.add(name)
+            return True
+        except Exception as e:
+            self._ready.discard(name)
+            print(f"集合 {name} 初始化失败: {e}")
+            return False
+
+    def _prepare(self, name, schema, index_params, alias):
+        if not utility.has_collection(name, using=alias, timeout=self.timeout):
+            if schema is None:
+                raise MilvusException(message=f"集合 {name} 不存在")
+            print(f"集合 {name} 不存在，开始自动创建...")
+            collection = Collection(name=name, schema=schema, using=alias)
+        else:
+            collection = Collection(name=name, using=alias)
+        if index_params and not collection.has_index(timeout=self.timeout):
+            print(f"为集合 {name} 创建索引 {index_params['index_type']}...")
+            collection.create_index(field_name="embedding", index_params=index_params,
+                                    timeout=self.timeout)
+        if name in self._partial:
+            if all(f in [field.name for field in collection.schema.fields] for f in METADATA_FIELDS):
+                # 冷热分层：不加载整个集合，由 partition_tiering 按需加载分区
+                print(f"集合 {name} 已就绪 (按分区加载)。")
+                return
+            # 旧版集合没有按类别和月份拆分的分区，仍然整体加载
+            self._partial.pop(name)
+        state = utility.load_state(name, using=alias, timeout=self.timeout)
+        if str(state).endswith('NotLoad'):
+            print(f"加载集合 {name}...")
+            collection.load(timeout=self.timeout)
+        print(f"集合 {name} 已就绪。")
+
+    def is_ready(self, name):
+        return name in self._ready and self.is_healthy()
+
+    def collection(self, name):
+        """返回通过连接池访问指定集合的代理对象"""
+        return PooledCollection(self, name)
+
+    # --- 健康检查 ---
+    def start_health_check(self):
+        """启动后台健康检查线程 (重复调用无副作用)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._health_loop, name='milvus-health', daemon=True)
+            self._thread.start()
+
+    def add_health_hook(self, func):
+        """登记一个在每次健康检查结束后调用的无参函数，异常只打印不影响健康检查"""
+        self._hooks.append(func)
+
+    def probe(self):
+        """探测每个连接，失败的连接重连；连接恢复后重新准备所有受管理的集合"""
+        try:
+            self._probe()
+        finally:
+            for hook in list(self._hooks):
+                try:
+                    hook()
+                except Exception as e:
+                    print(f"健康检查回调执行失败: {e}")
+
+    def _probe(self):
+        for alias in self._alias_list:
+            try:
+                utility.get_server_version(using=alias, timeout=self.timeout)
+                self._healthy[alias] = True
+            except Exception as e:
+                print(f"Milvus 健康检查失败 (连接 {alias}): {e}")
+                self._connect(alias)
+        if not self.is_healthy():
+            self._ready.clear()
+            return
+        for name, (schema, params) in list(self._managed.items()):
+            try:
+                self.call(lambda alias: self._check_loaded(name, schema, params, alias), retry=False)
+                self._ready.add(name)
+            except Exception as e:
+                self._ready.discard(name)
+                print(f"集合 {name} 健康检查失败: {e}")
+
+    def set_partition_loader(self, name, loader):
+        """
+        登记按分区加载的集合的回调 loader(force=False)：健康检查时调用以补齐分区加载状态，
+        创建新分区后以 force=True 调用。
+        """
+        self._partial[name] = loader
+
+    def partitions_changed(self, name):
+        loader = self._partial.get(name)
+        if loader is not None:
+            loader(force=True)
+
+    def is_partial(self, name):
+        """集合是否按分区加载 (冷热分层)"""
+        return name in self._partial
+
+    def _check_loaded(self, name, schema, params, alias):
+        if name in self._partial:
+            if self._partial[name] is not None:
+                self._partial[name]()
+            return
+        state = utility.load_state(name, using=alias, timeout=self.timeout)
+        if not str(state).endswith('Loaded'):
+            self._prepare(name, schema, params, alias)
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.probe()
+
+
+class PooledCollection:
+    """
+    与 pymilvus.Collection 接口相同的代理对象。
+
+    每次调用从连接池中取一个连接，并自动附加超时参数和重试逻辑。
+    """
+
+    def __init__(self, pool, name):
+        self._pool = pool
+        self.name = name
+        self._collections = {}
+        self._field_names = None
+        self._partitions = set()
+
+    def _get(self, alias):
+        collection = self._collections.get(alias)
+        if collection is None:
+            collection = Collection(name=self.name, using=alias)
+            self._collections[alias] = collection
+        return collection
+
+    @property
+    def ready(self):
+        """集合是否已就绪 (连接健康且已加载)"""
+        return self._pool.is_ready(self.name)
+
+    @property
+    def num_entities(self):
+        return self._pool.call(lambda alias: self._get(alias).num_entities)
+
+    @property
+    def schema(self):
+        return self._pool.call(lambda alias: self._get(alias).schema)
+
+    @property
+    def field_names(self):
+        """集合 Schema 中的字段名列表 (按定义顺序，首次读取后缓存)"""
+        if self._field_names is None:
+            self._field_names = [f.name for f in self.schema.fields]
+        return self._field_names
+
+    @property
+    def has_metadata(self):
+        """集合是否包含标量元数据字段 (旧版集合只有 embedding、image_filename、image_hash)"""
+        return all(name in self.field_names for name in METADATA_FIELDS)
+
+    def partition_exists(self, name):
+        """检查分区是否存在 (已确认存在的分区会被缓存)"""
+        if name in self._partitions:
+            return True
+        if self._pool.call(lambda alias: self._get(alias).has_partition(name)):
+            self._partitions.add(name)
+            return True
+        return False
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def partial(self):
+        """集合是否按分区加载 (冷热分层)，此时搜索只能访问已加载的分区"""
+        return self._pool.is_partial(self.name)
+
+    def list_partitions(self):
+        """集合的全部分区名"""
+        names = self._pool.call(lambda alias: [p.name for p in self._get(alias).partitions])
+        self._partitions.update(names)
+        return names
+
+    def partition_entities(self, name):
+        """分区中的实体数量 (已落盘的部分)"""
+        return self._pool.call(lambda alias: self._get(alias).partition(name).num_entities)
+
+    def partition_loaded(self, name):
+        state = self._pool.call(lambda alias: utility.load_state(self.name, partition_names=[name], using=alias,
+                                                                 timeout=self._pool.timeout))
+        return str(state).endswith('.Loaded')
+
+    def load_partitions(self, names, timeout=None):
+        """加载分区并等待完成，超时后分区在服务端继续加载"""
+        self._pool.call(lambda alias: self._get(alias).load(partition_names=list(names),
+                                                            timeout=timeout or self._pool.timeout))
+
+    def release_partition(self, name):
+        self._pool.call(lambda alias: self._get(alias).partition(name).release(timeout=self._pool.timeout))
+
+    def ensure_partition(self, name):
+        """确保分区存在，不存在时创建"""
+        if name in self._partitions:
+            return
+        if not self._pool.call(lambda alias: self._get(alias).has_partition(name)):
+            try:
+                self._pool.call(lambda alias: self._get(alias).create_partition(name))
+                print(f"已创建分区 {name}")
+            except MilvusException as e:
+                # 并发创建时分区可能已被其他进程创建
+                if 'exist' not in str(e).lower():
+                    raise
+            self._partitions.add(name)
+            if self.partial:
+                # 按分区加载时新分区需要由冷热分层管理器加载后才能被搜索到
+                self._pool.partitions_changed(self.name)
+            return
+        self._partitions.add(name)
+
+    def __getattr__(self, attr):
+        def method(*args, **kwargs):
+            if attr not in ('query_iterator', 'search_iterator'):
+                kwargs.setdefault('timeout', self._pool.timeout)
+            return self._pool.call(lambda alias: getattr(self._get(alias), attr)(*args, **kwargs),
+                                   retry=attr in _RETRYABLE_METHODS)
+        return method
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def get_pool(endpoints=None):
+    """
+    返回进程内共享的 Milvus 连接池 (首次调用时创建并启动健康检查)。
+
+    参数:
+        endpoints (list[str]): Milvus 地址列表，默认为 MILVUS_ENDPOINTS。
+                               不同的地址列表 (例如分布在不同 Milvus 上的分片) 使用各自的连接池。
+    """
+    key = tuple(endpoints or MILVUS_ENDPOINTS)
+    with _pool_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            # 第一个连接池沿用 heritage-N 连接别名，其余连接池加序号区分
+            prefix = 'heritage' if not _pools else f'heritage{len(_pools)}'
+            pool = MilvusPool(endpoints=list(key), alias_prefix=prefix)
+            pool.start_health_check()
+            _pools[key] = pool
+        return pool
+
+
+def get_collection(name=collection_name, create=False, dim=512, endpoints=None, partial=PARTITION_TIERING):
+    """
+    返回通过共享连接池访问集合的代理对象，并尽量确保集合已加载。
+
+    参数:
+        name (str): 集合名称或别名。
+        create (bool): 集合不存在时是否按默认 schema 自动创建。
+        dim (int): 自动创建集合时使用的向量维度。
+        endpoints (list[str]): 集合所在的 Milvus 地址，默认为 MILVUS_ENDPOINTS。
+        partial (bool): 是否按分区加载 (冷热分层)，默认由 HERITAGE_PARTITION_TIERING 决定。
+
+    返回:
+        PooledCollection: 集合代理对象，可通过 ready 属性判断是否可用。
+    """
+    pool = get_pool(endpoints)
+    if create:
+        pool.ensure_collection(name, schema=build_schema(dim), index_params=index_params, partial=partial)
+    else:
+        pool.ensure_collection(name, partial=partial)
+    return pool.collection(name)
+
+
+class PartialInsertError(Exception):
+    """
+    insert_rows 按分区 (或分片) 分组写入，部分分组已写入、其余分组失败。
+
+    primary_keys 与输入顺序一致，未写入的行为 None；调用方只应重试这些行，已写入的行不能再次写入。
+    """
+
+    def __init__(self, primary_keys, cause):
+        super().__init__(f"{sum(pk is None for pk in primary_keys)}/{len(primary_keys)} 行写入失败: {cause}")
+        self.primary_keys = primary_keys
+        self.cause = cause
+
+
+def _insert_groups(groups, insert_group, total):
+    """
+    逐组写入 (Milvus 不支持跨分区或跨分片回滚)，一组失败后继续写入其余分组。
+
+    参数:
+        groups (iterable): (分组, 行下标列表)。
+        insert_group (callable): 写入一组，返回与行下标对应的实体 ID。
+        total (int): 总行数。
+
+    返回:
+        list: 与输入顺序一致的实体 ID 列表。
+
+    异常:
+        PartialInsertError: 部分分组写入成功。全部失败时抛出第一个分组的原始异常。
+    """
+    primary_keys = [None] * total
+    error = None
+    for group, indices in groups:
+        try:
+            keys = insert_group(group, indices)
+        except PartialInsertError as e:
+            keys, error = e.primary_keys, error or e.cause
+        except Exception as e:
+            error = error or e
+            continue
+        for i, pk in zip(indices, keys):
+            primary_keys[i] = pk
+    if error is not None:
+        if all(pk is None for pk in primary_keys):
+            raise error
+        raise PartialInsertError(primary_keys, error) from error
+    return primary_keys
+
+
+def insert_rows(collection, embeddings, filenames, hashes, metadata=None):
+    """
+    按集合 Schema 的字段顺序组织列数据并写入 Milvus。
+
+    集合包含元数据字段时，按类别分组写入对应分区；旧版集合只写入基础字段。
+    分片集合或多个分区逐组写入，部分分组失败时抛出 PartialInsertError，其中记录了已写入的行。
+
+    参数:
+        collection (PooledCollection): 目标集合。
+        embeddings (numpy.ndarray): (N, 512) 的 float32 特征矩阵。
+        filenames (list[str]): 图像文件名。
+        hashes (list[str]): 图像内容的 MD5 哈希值。
+        metadata (list[dict]): 每行的元数据，缺省时按文件名解析。
+
+    返回:
+        list: 与输入顺序一致的实体 ID 列表。
+
+    异常:
+        PartialInsertError: 部分分区或分片写入成功。
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(filenames), -1)
+    if hasattr(type(collection), 'route'):
+        # 分片集合 (sharding.ShardedCollection)：按哈希值路由到各分片后分别写入
+        if metadata is None:
+            metadata = [build_metadata(name) for name in filenames]
+        return _insert_groups(
+            collection.route(hashes).items(),
+            lambda shard, indices: insert_rows(shard, embeddings[indices], [filenames[i] for i in indices],
+                                               [hashes[i] for i in indices], [metadata[i] for i in indices]),
+            len(filenames))
+    if not collection.has_metadata:
+        return list(collection.insert([embeddings, list(filenames), list(hashes)]).primary_keys)
+
+    if metadata is None:
+        metadata = [build_metadata(name) for name in filenames]
+    groups = {}
+    for i, meta in enumerate(metadata):
+        # 冷热分层时每个类别按入库月份写入不同的分区
+        partition = partition_name(meta["category"], meta["ingest_time"] if PARTITION_TIERING else None)
+        groups.setdefault(partition, []).append(i)
+
+    def insert_partition(partition, indices):
+        collection.ensure_partition(partition)
+        columns = {
+            "embedding": embeddings[indices],
+            "image_filename": [filenames[i] for i in indices],
+            "image_hash": [hashes[i] for i in indices]
+        }
+        for field in METADATA_FIELDS:
+            columns[field] = [metadata[i][field] for i in indices]
+        data = [columns[name] for name in collection.field_names if name != "id"]
+        return collection.insert(data, partition_name=partition).primary_keys
+
+    return _insert_groups(groups.items(), insert_partition, len(filenames))
+
+
+def recreate_collection(name=collection_name):
+    """删除并按默认 schema 重新创建集合 (会清空全部数据)"""
+    pool = get_pool()
+
+    def drop(alias):
+        if utility.has_collection(name, using=alias, timeout=pool.timeout):
+            print(f"强制删除集合 {name}...")
+            utility.drop_collection(name, using=alias, timeout=pool.timeout)
+
+    pool.call(drop)
+    pool.ensure_collection(name, schema=schema, index_params=index_params)
+    return pool.collection(name)
+
+
+# --- 模型版本与别名 ---
+def versioned_name(model_version, base=collection_name):
+    """返回某个模型版本对应的集合名，例如 intangible_cultural_heritage_images__resnet18_v1"""
+    return f"{base}{VERSION_SEPARATOR}{model_version}"
+
+
+def model_version_of(name, base=collection_name):
+    """从版本化集合名中解析模型版本 (忽略索引重建的代数后缀)，不是版本化集合名时返回 None"""
+    prefix = f"{base}{VERSION_SEPARATOR}"
+    return name[len(prefix):].split(VERSION_SEPARATOR)[0] if name.startswith(prefix) else None
+
+
+def generation_name(model_version, generation, base=collection_name):
+    """
+    返回同一模型版本第 generation 次重建索引后的集合名 (见 index_rebuild.py)，
+    例如 intangible_cultural_heritage_images__resnet18_v1__g2；generation 为 0 时即 versioned_name。
+    """
+    name = versioned_name(model_version, base)
+    return f"{name}{VERSION_SEPARATOR}g{generation}" if generation else name
+
+
+def generation_of(name, base=collection_name):
+    """从集合名中解析索引重建的代数，没有代数后缀时返回 0"""
+    parts = name[len(base):].split(VERSION_SEPARATOR) if name.startswith(base) else []
+    suffix = parts[2] if len(parts) > 2 else ''
+    return int(suffix[1:]) if suffix.startswith('g') and suffix[1:].isdigit() else 0
+
+
+def resolve_alias(name=collection_name):
+    """
+    解析集合名或别名对应的实际集合。
+
+    返回:
+        str: name 本身是集合时返回 name；name 是别名时返回它指向的集合；都不存在时返回 None。
+    """
+    pool = get_pool()
+
+    def resolve(alias):
+        collections = utility.list_collections(timeout=pool.timeout, using=alias)
+        if name in collections:
+            return name
+        # 别名不会出现在集合列表中，逐个检查同名前缀的版本化集合的别名
+        for candidate in collections:
+            if model_version_of(candidate, name) is None:
+                continue
+            if name in utility.list_aliases(candidate, timeout=pool.timeout, using=alias):
+                return candidate
+        return None
+
+    return pool.call(resolve)
+
+
+def switch_alias(alias_name, target):
+    """
+    把别名原子地切换到 target 集合，别名不存在时创建。
+
+    参数:
+        alias_name (str): 别名。
+        target (str): 别名要指向的集合名。
+    """
+    pool = get_pool()
+    current = resolve_alias(alias_name)
+    if current == alias_name:
+        raise MilvusException(message=f"{alias_name} 是一个集合而不是别名，请先执行迁移准备")
+
+    def switch(alias):
+        if current is None:
+            utility.create_alias(target, alias_name, timeout=pool.timeout, using=alias)
+        else:
+            utility.alter_alias(target, alias_name, timeout=pool.timeout, using=alias)
+
+    pool.call(switch, retry=False)
+    print(f"别名 {alias_name} 已指向集合 {target}")
+
+
+def adopt_alias(name, target):
+    """
+    把名为 name 的集合重命名为 target，并创建同名别名 name -> target。
+    旧代码和其他进程继续使用 name 访问同一份数据。
+
+    参数:
+        name (str): 现有集合名，完成后成为别名。
+        target (str): 集合的新名称 (通常为 versioned_name 的结果)。
+    """
+    pool = get_pool()
+
+    def adopt(alias):
+        utility.rename_collection(name, target, timeout=pool.timeout, using=alias)
+        utility.create_alias(target, name, timeout=pool.timeout, using=alias)
+
+    pool.call(adopt, retry=False)
+    print(f"集合 {name} 已重命名为 {target}，并创建别名 {name} -> {target}")
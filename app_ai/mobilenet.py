@@ -0,0 +1,108 @@
+# 轻量级粗筛模型：MobileNetV3-Small，输入分辨率 160x160
+#
+# 用于两阶段级联搜索 (见 cascade.py) 的第一阶段：查询图片和图片库都用它提取 576 维特征，
+# 在粗筛集合中检索候选，再用集合中已存储的 ResNet-18 特征对候选重排序。
+# 计算量约为 ResNet-18 (224x224) 的 1/50，JPEG 图片也可以按更小的尺寸降采样解码。
+# 与 resnet.py 提供相同的接口 (MODEL_VERSION、EMBEDDING_DIM、extract_features、extract_features_batch、
+# extract_features_images)，
+# 因此可以直接使用 embedding_cache 的特征向量缓存。
+import torch
+import torchvision.models as models
+import torchvision.transforms.functional as TF
+import numpy as np
+from metrics import stage_timer, BATCH_SIZE, STAGE_IMAGE_DECODE, STAGE_PREPROCESS, STAGE_COARSE_FORWARD
+from resnet import load_image  # 共用尺寸检查和 JPEG 降采样解码
+
+# --- 模型加载与配置 ---
+# 修改输入分辨率或模型结构时必须修改版本号，粗筛集合和缓存中的旧特征随之失效
+MODEL_VERSION = 'mobilenet_v3_small_160_v1'
+EMBEDDING_DIM = 576
+
+RESIZE_SIZE = 182
+CROP_SIZE = 160
+_MEAN_255 = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1) * 255
+_STD_255 = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1) * 255
+
+# 只保留卷积特征和全局平均池化，去掉分类头：输出 (N, 576, 1, 1)
+_base = models.mobilenet_v3_small(pretrained=True)
+model = torch.nn.Sequential(_base.features, _base.avgpool)
+model.eval()
+del _base
+
+
+def _prepare_batch(images):
+    """把一组 PIL 图像缩放、中心裁剪并标准化为 (N, 3, 160, 160) 的 Tensor"""
+    batch = torch.empty((len(images), 3, CROP_SIZE, CROP_SIZE), dtype=torch.float32)
+    for i, image in enumerate(images):
+        tensor = torch.from_numpy(np.array(image)).permute(2, 0, 1)
+        tensor = TF.resize(tensor, RESIZE_SIZE, antialias=True)
+        batch[i].copy_(TF.center_crop(tensor, CROP_SIZE))
+    return batch.sub_(_MEAN_255).div_(_STD_255)
+
+
+def _forward(batch):
+    """执行模型前向计算并对每行特征做 L2 归一化，返回 (N, 576) 的 numpy 数组"""
+    with torch.no_grad(), stage_timer(STAGE_COARSE_FORWARD):
+        features = model(batch)
+    BATCH_SIZE.observe(batch.shape[0])
+    return torch.nn.functional.normalize(features.flatten(1), p=2, dim=1).numpy()
+
+
+def extract_features(image_path):
+    """
+    提取单张图像的粗筛特征向量。
+
+    参数:
+        image_path (str): 图像文件的路径。
+
+    返回:
+        numpy.ndarray: 经过 L2 归一化的 576 维特征向量。
+    """
+    with stage_timer(STAGE_IMAGE_DECODE):
+        image = load_image(image_path, min_side=RESIZE_SIZE)
+    with stage_timer(STAGE_PREPROCESS):
+        batch = _prepare_batch([image])
+    return _forward(batch)[0].copy()
+
+
+def extract_features_batch(image_paths, batch_size=64):
+    """
+    批量提取粗筛特征向量。
+
+    参数:
+        image_paths (list[str]): 图像文件路径列表。
+        batch_size (int): 每次送入模型的图像数量。
+
+    返回:
+        tuple: (vectors, errors)，含义与 resnet.extract_features_batch 相同。
+    """
+    vectors = [None] * len(image_paths)
+    errors = {}
+    for start in range(0, len(image_paths), batch_size):
+        images = []
+        indices = []
+        for i in range(start, min(start + batch_size, len(image_paths))):
+            try:
+                with stage_timer(STAGE_IMAGE_DECODE):
+                    images.append(load_image(image_paths[i], min_side=RESIZE_SIZE))
+                indices.append(i)
+            except Exception as e:
+                errors[image_paths[i]] = str(e)
+        if not images:
+            continue
+        with stage_timer(STAGE_PREPROCESS):
+            batch = _prepare_batch(images)
+        features = _forward(batch)
+        for row, i in enumerate(indices):
+            vectors[i] = features[row].copy()
+    return vectors, errors
+
+
+def extract_features_images(images, batch_size=64):
+    """批量提取已解码图像的粗筛特征向量，返回 (N, 576) 的特征矩阵，含义与 resnet.extract_features_images 相同"""
+    features = [np.empty((0, EMBEDDING_DIM), dtype=np.float32)]
+    for start in range(0, len(images), batch_size):
+        with stage_timer(STAGE_PREPROCESS):
+            batch = _prepare_batch(images[start:start + batch_size])
+        features.append(_forward(batch))
+    return np.concatenate(features)
@@ -0,0 +1,319 @@
+# 客户端模型导出：把服务端的特征提取模型导出为可在移动端运行的压缩模型，并生成带版本哈希的清单
+#
+#   python model_export.py [--model resnet18_v1] [--calibration-dir static/images]
+#
+# 有计算能力的客户端 (uniapp) 下载导出的模型在本地提取特征，只把约 2 KB 的特征向量
+# 提交给 POST /api/search_vector，不再上传整张照片，也不占用服务端的推理 CPU。
+# 导出内容 (<导出目录>/<模型版本>/)：
+#   model_int8.pt    用校准图片做静态 int8 量化后的 TorchScript 模型 (PyTorch Mobile)，约为原模型的 1/4；
+#   model.onnx       float32 ONNX 模型 (需要安装 onnx，onnxruntime-web 等运行时使用)；
+#   model_int8.onnx  权重 int8 量化的 ONNX 模型 (需要安装 onnxruntime)；
+#   manifest.json    模型版本、版本哈希、预处理参数、各文件的 sha256 和大小，可通过 GET /api/model/manifest 获取。
+# 量化会让特征向量产生偏差：导出时在校验图片上比较客户端模型与服务端 extract_features_batch 的结果，
+# 把最大 L2 距离写入清单，只有偏差不超过 DRIFT_TOLERANCE 的文件会被服务端接受。
+# 客户端提交特征时带上模型版本和所用文件的哈希，版本不匹配 (集合已切换到新模型) 或哈希未知
+# (导出文件已更新) 时接口返回 409，客户端应重新下载清单和模型。
+#
+# 配置：HERITAGE_MODEL_EXPORT_DIR 导出目录。
+import os
+import sys
+import copy
+import base64
+import json
+import time
+import hashlib
+import argparse
+import threading
+import numpy as np
+import torch
+from PIL import Image
+import image_store
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# --- 导出配置 ---
+EXPORT_DIR = os.environ.get('HERITAGE_MODEL_EXPORT_DIR', os.path.join(APP_ROOT, 'exported_models'))
+MANIFEST_NAME = 'manifest.json'
+# 客户端特征与服务端特征之间允许的最大 L2 距离 (向量已 L2 归一化)，
+# 远小于近重复阈值对应的距离 (见 near_duplicates.DEFAULT_THRESHOLD)
+DRIFT_TOLERANCE = 0.1
+# 量化后端：qnnpack 针对 ARM 移动端，fbgemm 针对 x86
+QUANT_BACKEND = 'qnnpack'
+# 用于校准量化参数和校验偏差的图片数量
+CALIBRATION_IMAGES = 64
+DEFAULT_CALIBRATION_DIR = image_store.IMAGE_ROOT
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _preprocess_spec(model):
+    """从模型模块的 preprocess 流程中取出客户端需要复现的预处理参数"""
+    spec = {'resize': model.RESIZE_SIZE, 'crop': model.CROP_SIZE, 'layout': 'NCHW', 'color': 'RGB',
+            'scale': 1 / 255}
+    for transform in model.preprocess.transforms:
+        if hasattr(transform, 'mean') and hasattr(transform, 'std'):
+            spec['mean'] = [float(v) for v in transform.mean]
+            spec['std'] = [float(v) for v in transform.std]
+    return spec
+
+
+def _client_features(runner, batch):
+    """运行客户端模型并像服务端一样做 L2 归一化"""
+    with torch.no_grad():
+        features = runner(batch)
+    if not isinstance(features, torch.Tensor):
+        features = torch.from_numpy(np.asarray(features))
+    return torch.nn.functional.normalize(features.flatten(1), p=2, dim=1).numpy()
+
+
+def _max_drift(runner, batch, reference):
+    """客户端模型与服务端特征之间的最大 L2 距离"""
+    features = _client_features(runner, batch)
+    return float(np.linalg.norm(features - reference, axis=1).max())
+
+
+def _export_torchscript_int8(model, calibration, example, path, backend):
+    """用校准图片做 FX 静态量化，保存为冻结的 TorchScript 模型 (调用方需先切换到对应的量化后端)"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    prepared = prepare_fx(copy.deepcopy(model.model).eval(), get_default_qconfig_mapping(backend), (example,))
+    with torch.no_grad():
+        prepared(calibration)
+    scripted = torch.jit.freeze(torch.jit.trace(convert_fx(prepared), (example,)).eval())
+    torch.jit.save(scripted, path)
+    return torch.jit.load(path)
+
+
+def _export_onnx(model, example, path, quantized_path):
+    """导出 float32 ONNX 模型，安装了 onnxruntime 时再生成权重 int8 量化的版本；返回生成的文件列表"""
+    try:
+        torch.onnx.export(model.model, (example,), path, dynamo=False,
+                          input_names=['input'], output_names=['features'],
+                          dynamic_axes={'input': {0: 'batch'}, 'features': {0: 'batch'}})
+    except Exception as e:  # 未安装 onnx 时 torch.onnx 抛出 OnnxExporterError
+        print(f"跳过 ONNX 导出: {e}")
+        return []
+    exported = [(path, 'onnx', 'fp32')]
+    try:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+    except ImportError:
+        print("未安装 onnxruntime，跳过 ONNX 量化")
+        return exported
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QUInt8)
+    exported.append((quantized_path, 'onnx', 'int8'))
+    return exported
+
+
+def _onnx_runner(path):
+    """用 onnxruntime 运行 ONNX 模型，未安装时返回 None"""
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return lambda batch: session.run(None, {'input': batch.numpy()})[0]
+
+
+def export_model(model, output_dir=EXPORT_DIR, calibration_dir=DEFAULT_CALIBRATION_DIR,
+                 calibration_images=CALIBRATION_IMAGES, backend=QUANT_BACKEND):
+    """
+    导出客户端模型并写入清单。
+
+    参数:
+        model (module): embedding_models.load_model 返回的模型模块，需要提供 model、preprocess、
+                        RESIZE_SIZE 和 CROP_SIZE。
+        output_dir (str): 导出目录，文件写入 <output_dir>/<模型版本>/。
+        calibration_dir (str): 校准图片目录，前一半图片用于校准量化参数，后一半用于校验偏差。
+        calibration_images (int): 最多使用的图片数量。
+        backend (str): 量化后端。
+
+    返回:
+        dict: 清单。
+
+    异常:
+        ValueError: 校准目录中没有可用的图片。
+    """
+    paths = image_store.list_images(calibration_dir)[:calibration_images]
+    if len(paths) < 2:
+        raise ValueError(f"校准目录 {calibration_dir} 中至少需要 2 张图片")
+    # 客户端按清单中的参数做标准预处理，与服务端快速路径之间的差异也计入偏差
+    batch = torch.stack([model.preprocess(Image.open(p).convert('RGB')) for p in paths])
+    reference, errors = model.extract_features_batch(paths)
+    if errors:
+        raise ValueError(f"校准图片无法处理: {errors}")
+    reference = np.stack(reference)
+    half = len(paths) // 2
+    calibration, validation, expected = batch[:half], batch[half:], reference[half:]
+
+    version_dir = os.path.join(output_dir, model.MODEL_VERSION)
+    os.makedirs(version_dir, exist_ok=True)
+    artifacts = []
+
+    def add(path, fmt, precision, runner):
+        drift = _max_drift(runner, validation, expected) if runner is not None else None
+        artifacts.append({
+            'file': os.path.basename(path),
+            'format': fmt,
+            'precision': precision,
+            'size': os.path.getsize(path),
+            'sha256': _sha256(path),
+            'max_drift': drift
+        })
+        print(f"已导出 {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)"
+              + (f"，最大偏差 {drift:.4f}" if drift is not None else ""))
+
+    ts_path = os.path.join(version_dir, 'model_int8.pt')
+    previous_engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        add(ts_path, 'torchscript', 'int8',
+            _export_torchscript_int8(model, calibration, batch[:1], ts_path, backend))
+    finally:
+        torch.backends.quantized.engine = previous_engine
+    for path, fmt, precision in _export_onnx(model, batch[:1], os.path.join(version_dir, 'model.onnx'),
+                                             os.path.join(version_dir, 'model_int8.onnx')):
+        add(path, fmt, precision, _onnx_runner(path))
+
+    manifest = {
+        'model_version': model.MODEL_VERSION,
+        'embedding_dim': model.EMBEDDING_DIM,
+        # 版本哈希由全部导出文件的 sha256 计算，任何文件更新后都会变化
+        'version_hash': hashlib.sha256(''.join(a['sha256'] for a in artifacts).encode()).hexdigest()[:16],
+        'created_at': int(time.time()),
+        'quant_backend': backend,
+        'drift_tolerance': DRIFT_TOLERANCE,
+        'preprocess': _preprocess_spec(model),
+        'output': {'normalize': 'l2', 'encoding': 'float32 little-endian, base64'},
+        'artifacts': artifacts
+    }
+    tmp = os.path.join(version_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, os.path.join(version_dir, MANIFEST_NAME))
+    return manifest
+
+
+# --- 清单读取与客户端特征校验 ---
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def load_manifest(version, export_dir=EXPORT_DIR):
+    """
+    读取模型版本的清单，文件更新后自动重新读取。
+
+    返回:
+        dict: 清单，尚未导出时返回 None。
+    """
+    path = os.path.join(export_dir, version, MANIFEST_NAME)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _manifests_lock:
+        cached = _manifests.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    with _manifests_lock:
+        _manifests[path] = (mtime, manifest)
+    return manifest
+
+
+def accepted_hashes(manifest):
+    """清单中可以提交特征的文件哈希：float32 文件和偏差在容差内的量化文件"""
+    tolerance = manifest.get('drift_tolerance', DRIFT_TOLERANCE)
+    return {a['sha256'] for a in manifest['artifacts']
+            if a['precision'] == 'fp32' or (a['max_drift'] is not None and a['max_drift'] <= tolerance)}
+
+
+def check_compatibility(manifest, version, model_hash):
+    """
+    检查客户端使用的模型能否在当前集合上搜索。
+
+    参数:
+        manifest (dict): 当前服务模型版本的清单，未导出时为 None。
+        version (str): 客户端提交的模型版本。
+        model_hash (str): 客户端所用文件的 sha256。
+
+    返回:
+        str: 不兼容的原因，兼容时返回 None。
+    """
+    if manifest is None:
+        return '服务端尚未导出客户端模型'
+    if version != manifest['model_version']:
+        return f"模型版本 {version} 与服务端的 {manifest['model_version']} 不一致"
+    if model_hash not in accepted_hashes(manifest):
+        return f"模型文件 {model_hash} 已过期或未通过偏差校验"
+    return None
+
+
+def decode_embedding(value, dim):
+    """
+    解析客户端提交的特征向量并重新做 L2 归一化。
+
+    参数:
+        value (str | list): base64 编码的 float32 小端字节串，或数字列表。
+        dim (int): 期望的维度。
+
+    返回:
+        numpy.ndarray: 归一化后的 float32 向量。
+
+    异常:
+        ValueError: 维度不符、包含非有限值或为零向量。
+    """
+    if isinstance(value, str):
+        try:
+            raw = base64.b64decode(value, validate=True)
+        except Exception as e:
+            raise ValueError(f'base64 解码失败: {e}')
+        if len(raw) != dim * 4:
+            raise ValueError(f'特征向量应为 {dim * 4} 字节，实际 {len(raw)} 字节')
+        vector = np.frombuffer(raw, dtype='<f4').astype(np.float32)
+    elif isinstance(value, list):
+        if len(value) != dim:
+            raise ValueError(f'特征向量应为 {dim} 维，实际 {len(value)} 维')
+        try:
+            vector = np.asarray(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            raise ValueError('特征向量只能包含数字')
+    else:
+        raise ValueError('embedding 应为 base64 字符串或数字列表')
+    if not np.all(np.isfinite(vector)):
+        raise ValueError('特征向量包含 NaN 或无穷大')
+    norm = float(np.linalg.norm(vector))
+    if norm == 0:
+        raise ValueError('特征向量不能为零向量')
+    return vector / norm
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from embedding_models import load_model, DEFAULT_MODEL_VERSION, MODELS
+
+    parser = argparse.ArgumentParser(description="导出客户端特征提取模型")
+    parser.add_argument('--model', default=DEFAULT_MODEL_VERSION, choices=sorted(MODELS))
+    parser.add_argument('--output-dir', default=EXPORT_DIR)
+    parser.add_argument('--calibration-dir', default=DEFAULT_CALIBRATION_DIR)
+    parser.add_argument('--calibration-images', type=int, default=CALIBRATION_IMAGES)
+    parser.add_argument('--backend', choices=['qnnpack', 'fbgemm'], default=QUANT_BACKEND)
+    args = parser.parse_args()
+
+    try:
+        result = export_model(load_model(args.model), args.output_dir, args.calibration_dir,
+                              args.calibration_images, args.backend)
+    except ValueError as e:
+        print(f"导出失败: {e}")
+        sys.exit(1)
+    rejected = [a['file'] for a in result['artifacts'] if a['sha256'] not in accepted_hashes(result)]
+    print(f"模型 {result['model_version']} 导出完成，版本哈希 {result['version_hash']}")
+    if rejected:
+        print(f"以下文件偏差超过 {DRIFT_TOLERANCE}，服务端不会接受其特征: {', '.join(rejected)}")
@@ -0,0 +1,366 @@
+# 模型迁移工具：在不停止搜索服务的前提下，把特征向量迁移到新模型版本的集合
+#
+# 流程：
+#   1. prepare  <版本>  把旧集合重命名为版本化集合名并创建同名别名，然后创建新版本的影子集合
+#   2. backfill <版本>  用新模型重新提取已有图片的特征并写入影子集合 (限速，可中断后重复执行)
+#   3. cutover  <版本>  追平增量和删除、校验数量后原子切换别名，宽限期后再追平一次
+#   4. rollback <版本>  把别名切回指定版本的集合
+#   status             查看别名指向和各版本集合的实体数量
+#
+# 服务进程 (app_flask.py) 定期检查别名指向，切换后整组替换集合、模型和写缓冲。
+# 迁移期间新上传的图片仍写入旧集合，由 backfill / cutover 的追平步骤复制到影子集合。
+import os
+import sys
+import time
+import argparse
+import urllib.request
+import numpy as np
+import torch
+from pymilvus import utility
+from prometheus_client.parser import text_string_to_metric_families
+from milvus_client import (get_pool, get_collection, resolve_alias, switch_alias, adopt_alias,
+                           versioned_name, model_version_of, insert_rows, collection_name)
+from embedding_models import load_model, DEFAULT_MODEL_VERSION, MODELS
+from image_metadata import build_metadata, METADATA_FIELDS
+from image_catalog import get_catalog
+from embedding_cache import extract_features_batch_cached
+from cascade import COARSE_SUFFIX
+from partition_tiering import scan
+import image_store
+
+# --- 回填限速配置 ---
+# 默认回填速度 (张/秒) 以及自适应调整的上下限
+DEFAULT_RATE = 20.0
+MIN_RATE = 1.0
+# 线上搜索接口的 p95 耗时超过该值 (秒) 时回填速度减半并暂停一段时间
+DEFAULT_MAX_SEARCH_P95 = 0.5
+DEFAULT_PAUSE = 5.0
+# 用于判断线上搜索延迟的接口 (Flask endpoint 名称)
+SEARCH_ENDPOINTS = ('api_search_similar_images', 'upload_image')
+# 计算 p95 所需的最少请求数，请求过少时不调整速度
+MIN_LATENCY_SAMPLES = 5
+# 切换别名后等待服务进程完成切换的时间 (秒)，应大于 HERITAGE_SERVING_CHECK_INTERVAL 加写缓冲的最长等待时间
+DEFAULT_GRACE = 75.0
+
+
+class RateLimiter:
+    """按张/秒限制回填速度，rate <= 0 表示不限速"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    def wait(self, count):
+        if self.rate <= 0 or count <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + count / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class LatencyGuard:
+    """
+    定期抓取服务进程的 /metrics，根据两次抓取之间搜索接口耗时直方图的增量估算 p95。
+    """
+
+    def __init__(self, metrics_url, max_p95=DEFAULT_MAX_SEARCH_P95):
+        self.metrics_url = metrics_url
+        self.max_p95 = max_p95
+        self._last = None
+
+    def _scrape(self):
+        with urllib.request.urlopen(self.metrics_url, timeout=5) as response:
+            text = response.read().decode('utf-8')
+        buckets = {}
+        for family in text_string_to_metric_families(text):
+            if family.name != 'heritage_request_seconds':
+                continue
+            for sample in family.samples:
+                if sample.name.endswith('_bucket') and sample.labels.get('endpoint') in SEARCH_ENDPOINTS:
+                    le = float(sample.labels['le'])
+                    buckets[le] = buckets.get(le, 0.0) + sample.value
+        return buckets
+
+    def p95(self):
+        """返回上次调用以来搜索接口的 p95 耗时 (秒)，无法抓取或请求过少时返回 None"""
+        try:
+            current = self._scrape()
+        except Exception as e:
+            print(f"抓取指标失败 ({self.metrics_url}): {e}")
+            return None
+        last, self._last = self._last, current
+        if last is None or not current:
+            return None
+        delta = sorted((le, current[le] - last.get(le, 0.0)) for le in current)
+        total = delta[-1][1]  # le=+Inf 的累计数即请求总数
+        if total < MIN_LATENCY_SAMPLES:
+            return None
+        for le, count in delta:
+            if count >= 0.95 * total:
+                return le
+        return None
+
+
+def _existing_hashes(collection, hashes, chunk_size=500):
+    """查询集合中已存在的哈希值"""
+    existing = set()
+    hashes = list(set(hashes))
+    for i in range(0, len(hashes), chunk_size):
+        chunk = hashes[i:i + chunk_size]
+        results = collection.query(
+            expr='image_hash in [' + ', '.join(f'"{h}"' for h in chunk) + ']',
+            output_fields=["image_hash"],
+            consistency_level="Strong")
+        existing.update(item['image_hash'] for item in results)
+    return existing
+
+
+def _shadow(version):
+    """返回新版本影子集合的代理对象 (不存在时创建) 和模型"""
+    model = load_model(version)
+    shadow = get_collection(versioned_name(version), create=True, dim=model.EMBEDDING_DIM)
+    if not shadow.ready:
+        raise RuntimeError(f"影子集合 {versioned_name(version)} 不可用")
+    return shadow, model
+
+
+def adopt_legacy():
+    """
+    集合尚未版本化时重命名为默认模型版本的集合名并创建同名别名。
+
+    返回:
+        str: 别名当前指向的集合名，集合不存在时返回 None。
+    """
+    current = resolve_alias(collection_name)
+    if current == collection_name:
+        # 旧集合的特征由默认模型生成，重命名后别名保持原名，读写不受影响
+        print(f"集合 {collection_name} 尚未版本化，重命名为 {versioned_name(DEFAULT_MODEL_VERSION)} 并创建别名 "
+              "(重命名和创建别名之间的瞬间请求可能失败并被重试)")
+        adopt_alias(collection_name, versioned_name(DEFAULT_MODEL_VERSION))
+        get_catalog().rename(collection_name, versioned_name(DEFAULT_MODEL_VERSION))
+        current = versioned_name(DEFAULT_MODEL_VERSION)
+    return current
+
+
+def prepare(version):
+    """把旧集合改为版本化集合 + 别名，并创建新版本的影子集合"""
+    current = adopt_legacy()
+    if current is None:
+        print(f"集合 {collection_name} 不存在，无需迁移")
+        return False
+    if current == versioned_name(version):
+        print(f"别名 {collection_name} 已指向 {current}，无需迁移")
+        return False
+    _shadow(version)
+    print(f"影子集合 {versioned_name(version)} 已就绪，当前服务集合为 {current}")
+    return True
+
+
+def backfill(version, source_name=None, rate=DEFAULT_RATE, batch_size=64, guard=None):
+    """
+    用新模型重新提取源集合中所有图片的特征并写入影子集合。
+    影子集合中已存在相同哈希值的图片会被跳过，因此可以中断后重复执行，也用于追平增量。
+
+    参数:
+        version (str): 新模型版本。
+        source_name (str): 源集合，默认为别名当前指向的集合。
+        rate (float): 初始回填速度 (张/秒)，<= 0 表示不限速。
+        batch_size (int): 每批处理的图片数量。
+        guard (LatencyGuard): 线上搜索延迟保护，为 None 时只按固定速度限速。
+
+    返回:
+        dict: 复制、跳过、缺少文件和失败的数量。
+    """
+    source_name = source_name or resolve_alias(collection_name)
+    if source_name == versioned_name(version):
+        raise RuntimeError(f"别名已指向 {source_name}，请用 --source 指定旧版本集合")
+    source = get_collection(source_name)
+    if not source.ready:
+        raise RuntimeError(f"源集合 {source_name} 不可用")
+    shadow, model = _shadow(version)
+
+    max_rate = rate
+    limiter = RateLimiter(rate)
+    stats = {'copied': 0, 'skipped': 0, 'missing': 0, 'errors': 0}
+    output_fields = ["image_filename", "image_hash"] + (METADATA_FIELDS if source.has_metadata else [])
+    started = time.time()
+    for rows in scan(source, output_fields, batch_size):
+        existing = _existing_hashes(shadow, [row['image_hash'] for row in rows])
+        todo = []
+        for row in rows:
+            if row['image_hash'] in existing:
+                stats['skipped'] += 1
+            elif not image_store.exists(row['image_filename']):
+                stats['missing'] += 1
+            else:
+                todo.append(row)
+        if not todo:
+            continue
+
+        # 线上搜索变慢时减速并暂停，恢复后逐步提速
+        if guard is not None and limiter.rate > 0:
+            p95 = guard.p95()
+            if p95 is not None and p95 > guard.max_p95:
+                limiter.rate = max(MIN_RATE, limiter.rate / 2)
+                print(f"搜索 p95 {p95 * 1000:.0f}ms 超过阈值，回填降速至 {limiter.rate:.1f} 张/秒")
+                time.sleep(DEFAULT_PAUSE)
+            elif p95 is not None:
+                limiter.rate = min(max_rate, limiter.rate * 1.25)
+        limiter.wait(len(todo))
+
+        vectors, errors = extract_features_batch_cached(
+            model, [image_store.path(row['image_filename']) for row in todo],
+            [row['image_hash'] for row in todo])
+        done = [(row, vector) for row, vector in zip(todo, vectors) if vector is not None]
+        stats['errors'] += len(todo) - len(done)
+        for path, message in errors.items():
+            print(f"提取特征失败 {path}: {message}")
+        if done:
+            metadata = [{field: row[field] for field in METADATA_FIELDS} if source.has_metadata
+                        else build_metadata(row['image_filename']) for row, _ in done]
+            filenames = [row['image_filename'] for row, _ in done]
+            hashes = [row['image_hash'] for row, _ in done]
+            primary_keys = insert_rows(shadow, np.vstack([vector for _, vector in done]),
+                                       filenames, hashes, metadata)
+            get_catalog().record(shadow.name, primary_keys, filenames, hashes, metadata)
+            stats['copied'] += len(done)
+        elapsed = time.time() - started
+        print(f"已复制 {stats['copied']} 张，跳过 {stats['skipped']} 张，"
+              f"缺少文件 {stats['missing']} 张，失败 {stats['errors']} 张 ({elapsed:.0f}s)")
+    shadow.flush()
+    return stats
+
+
+def sync_deletes(version, source_name=None, batch_size=1000):
+    """
+    删除影子集合中源集合已不存在的图片 (迁移期间被删除的图片)。
+
+    返回:
+        tuple: (删除数量, 源集合中尚未复制到影子集合的哈希值数量)。
+    """
+    source = get_collection(source_name or resolve_alias(collection_name))
+    shadow, _ = _shadow(version)
+    return delete_stale(source, shadow, batch_size)
+
+
+def delete_stale(source, shadow, batch_size=1000):
+    """
+    删除 shadow 中哈希值在 source 里已不存在的行 (也用于 index_rebuild.py)。
+    两个集合都用 partition_tiering.scan 遍历：按分区加载的集合逐个加载冷分区，
+    否则未加载分区中的行会被误认为已删除。
+
+    返回:
+        tuple: (删除数量, source 中尚未复制到 shadow 的哈希值数量)。
+    """
+    source_hashes = set()
+    for rows in scan(source, ["image_hash"], batch_size):
+        source_hashes.update(row['image_hash'] for row in rows)
+    stale_ids = []
+    shadow_hashes = set()
+    for rows in scan(shadow, ["id", "image_hash"], batch_size):
+        for row in rows:
+            shadow_hashes.add(row['image_hash'])
+            if row['image_hash'] not in source_hashes:
+                stale_ids.append(row['id'])
+    for i in range(0, len(stale_ids), batch_size):
+        shadow.delete(expr=f"id in {stale_ids[i:i + batch_size]}")
+    get_catalog().remove(shadow.name, stale_ids)
+    if stale_ids:
+        print(f"已从影子集合删除 {len(stale_ids)} 张源集合中已不存在的图片")
+    return len(stale_ids), len(source_hashes - shadow_hashes)
+
+
+def cutover(version, rate=0, batch_size=64, max_missing=0, grace=DEFAULT_GRACE):
+    """
+    追平增量和删除、校验后把别名切换到新版本集合，宽限期后从旧集合再追平一次。
+    """
+    source_name = resolve_alias(collection_name)
+    target = versioned_name(version)
+    if source_name == target:
+        print(f"别名 {collection_name} 已指向 {target}")
+        return False
+    if source_name == collection_name:
+        raise RuntimeError("请先执行 prepare")
+
+    print("追平迁移期间新增的图片...")
+    backfill(version, source_name, rate=rate, batch_size=batch_size)
+    _, missing = sync_deletes(version, source_name)
+    if missing > max_missing:
+        print(f"影子集合缺少 {missing} 张图片 (允许 {max_missing} 张)，取消切换。"
+              "缺少的图片可能是图片文件丢失或特征提取失败，可用 --max-missing 放宽限制")
+        return False
+
+    switch_alias(collection_name, target)
+    print(f"等待 {grace:.0f} 秒，让服务进程切换到新集合并写完旧写缓冲...")
+    time.sleep(grace)
+    print("从旧集合追平切换期间写入的图片...")
+    backfill(version, source_name, rate=rate, batch_size=batch_size)
+    print(f"切换完成，旧集合 {source_name} 保留，可用 rollback {model_version_of(source_name)} 回退")
+    return True
+
+
+def rollback(version):
+    """把别名切回指定版本的集合"""
+    target = versioned_name(version)
+    if not get_collection(target).ready:
+        raise RuntimeError(f"集合 {target} 不可用，无法回退")
+    switch_alias(collection_name, target)
+    return True
+
+
+def status():
+    """打印别名指向和各版本集合的实体数量"""
+    pool = get_pool()
+    current = resolve_alias(collection_name)
+    print(f"别名 {collection_name} -> {current}")
+    names = pool.call(lambda alias: utility.list_collections(timeout=pool.timeout, using=alias))
+    for name in sorted(names):
+        version = model_version_of(name)
+        if (version is None and name != collection_name) or name.endswith(COARSE_SUFFIX):
+            continue
+        marker = '*' if name == current else ' '
+        count = get_collection(name).num_entities
+        print(f" {marker} {name}  模型 {version or DEFAULT_MODEL_VERSION}  实体 {count}")
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把特征向量迁移到新模型版本的集合")
+    parser.add_argument('command', choices=['prepare', 'backfill', 'cutover', 'rollback', 'status'])
+    parser.add_argument('version', nargs='?', help=f"模型版本，可选: {', '.join(MODELS)}")
+    parser.add_argument('--source', help="backfill 的源集合，默认为别名当前指向的集合")
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="回填速度上限 (张/秒)，0 表示不限速")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=1, help="模型推理使用的 CPU 线程数，避免挤占线上服务")
+    parser.add_argument('--metrics-url', default='http://127.0.0.1:5000/metrics',
+                        help="服务进程的指标地址，用于根据线上搜索延迟自动降速；设为空字符串关闭")
+    parser.add_argument('--max-search-p95', type=float, default=DEFAULT_MAX_SEARCH_P95)
+    parser.add_argument('--max-missing', type=int, default=0, help="切换时允许影子集合缺少的图片数量")
+    parser.add_argument('--grace', type=float, default=DEFAULT_GRACE)
+    args = parser.parse_args()
+
+    if args.command != 'status' and not args.version:
+        parser.error(f"{args.command} 需要指定模型版本")
+    torch.set_num_threads(args.threads)
+
+    try:
+        if args.command == 'prepare':
+            prepare(args.version)
+        elif args.command == 'backfill':
+            guard = LatencyGuard(args.metrics_url, args.max_search_p95) if args.metrics_url else None
+            result = backfill(args.version, args.source, rate=args.rate, batch_size=args.batch_size,
+                              guard=guard)
+            print(f"回填完成: {result}")
+        elif args.command == 'cutover':
+            if not cutover(args.version, batch_size=args.batch_size, max_missing=args.max_missing,
+                           grace=args.grace):
+                sys.exit(1)
+        elif args.command == 'rollback':
+            rollback(args.version)
+        else:
+            status()
+    except Exception as e:
+        print(f"执行 {args.command} 失败: {e}")
+        sys.exit(1)
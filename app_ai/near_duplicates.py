@@ -0,0 +1,324 @@
+# 近重复图片聚类：在整个集合上做向量自相似连接，把距离在阈值内的图片聚成簇，
+# 每簇给出建议保留的代表图片，其余图片的 ID 可直接交给删除接口一键清理。
+#
+#   python near_duplicates.py [--threshold 0.05] [--method ann|matmul] [--collection 名称]
+#
+# 两种连接方式，都不会构造全量的两两距离矩阵：
+#   ann    (默认) 用 query_iterator 分批读出向量，每批作为多向量查询调用一次 Milvus 搜索，
+#          取每个向量的 top_k 个近邻，距离不超过阈值的连成边。适合百万级集合。
+#   matmul 把向量写入临时的内存映射文件，按内存预算分块做矩阵乘法，精确找出所有阈值内的向量对。
+# 边用并查集合并成连通分量；连续的视频帧会两两相近、连成很长的链，链两端可能已完全不同，
+# 因此每个连通分量再按到代表图片的距离拆分 (leader 聚类)：近邻最多的图片 (相同时取入库最早的)
+# 先作为代表，与已有代表的距离都超过阈值的图片成为新的代表。报告中的每个簇是一个代表和
+# 与它的距离在阈值内的图片，建议清理的图片到代表的距离都不超过阈值。
+# 距离与搜索接口返回的 distance 相同，为 L2 距离的平方 (向量已 L2 归一化，0 表示完全相同)。
+#
+# 结果写入 reports/near_duplicates.json，可通过 GET /api/near_duplicates 查看，
+# POST /api/near_duplicates/prune 删除建议清理的图片。
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import numpy as np
+from milvus_client import get_collection, collection_name
+from sharding import get_sharded_collection
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+REPORT_PATH = os.path.join(APP_ROOT, 'reports', 'near_duplicates.json')
+
+# 默认距离阈值 (L2 距离的平方，约等于余弦相似度 0.975)
+DEFAULT_THRESHOLD = 0.05
+# ann 方式每个向量取的近邻数量
+DEFAULT_TOP_K = 16
+# ann 方式每次搜索的查询向量数量 (Milvus 要求 nq * top_k 不超过 16384)
+DEFAULT_SEARCH_BATCH = 256
+DEFAULT_NPROBE = 32
+# matmul 方式分块距离矩阵的内存预算 (MB)
+DEFAULT_MEMORY_MB = 256
+
+
+class UnionFind:
+    """按主键合并的并查集 (路径压缩 + 按大小合并)"""
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        if parent == x:
+            self.size.setdefault(x, 1)
+            return x
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size.pop(rb)
+
+    def groups(self):
+        result = {}
+        for x in self.parent:
+            result.setdefault(self.find(x), []).append(x)
+        return [members for members in result.values() if len(members) > 1]
+
+
+def _iterate(collection, output_fields, batch_size):
+    iterator = collection.query_iterator(batch_size=batch_size, output_fields=output_fields)
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            yield rows
+    finally:
+        iterator.close()
+
+
+def _info(row):
+    return {'image_filename': row['image_filename'], 'ingest_time': row.get('ingest_time', 0)}
+
+
+def join_ann(collection, threshold, top_k=DEFAULT_TOP_K, batch_size=DEFAULT_SEARCH_BATCH,
+             nprobe=DEFAULT_NPROBE):
+    """
+    用批量多向量 ANN 搜索找出阈值内的近邻对。
+
+    返回:
+        tuple: (UnionFind, {主键: 近邻数量}, {主键: 图片信息}, 向量总数)。
+    """
+    output_fields = ["id", "embedding", "image_filename"] + (["ingest_time"] if collection.has_metadata else [])
+    param = {"metric_type": "L2", "params": {"nprobe": nprobe}}
+    uf, degree, info = UnionFind(), {}, {}
+    total = 0
+    started = time.time()
+    for rows in _iterate(collection, output_fields, batch_size):
+        for row in rows:
+            info[row['id']] = _info(row)
+        vectors = np.asarray([row['embedding'] for row in rows], dtype=np.float32)
+        results = collection.search(data=vectors, anns_field="embedding", param=param, limit=top_k + 1)
+        for row, hits in zip(rows, results):
+            for hit in hits:
+                if hit.id != row['id'] and hit.distance <= threshold:
+                    uf.union(row['id'], hit.id)
+                    degree[row['id']] = degree.get(row['id'], 0) + 1
+        total += len(rows)
+        print(f"已比较 {total} 个向量 ({total / max(time.time() - started, 1e-6):.0f} 个/秒)")
+    return uf, degree, info, total
+
+
+def join_matmul(collection, threshold, memory_mb=DEFAULT_MEMORY_MB, batch_size=10000):
+    """
+    把向量写入临时内存映射文件后分块计算距离，精确找出阈值内的所有向量对。
+
+    返回:
+        tuple: (UnionFind, {主键: 近邻数量}, {主键: 图片信息}, 向量总数)。
+    """
+    output_fields = ["id", "embedding", "image_filename"] + (["ingest_time"] if collection.has_metadata else [])
+    ids, info = [], {}
+    dim = None
+    with tempfile.NamedTemporaryFile(suffix='.f32', delete=False) as tmp:
+        for rows in _iterate(collection, output_fields, batch_size):
+            vectors = np.asarray([row['embedding'] for row in rows], dtype=np.float32)
+            dim = vectors.shape[1]
+            tmp.write(vectors.tobytes())
+            for row in rows:
+                ids.append(row['id'])
+                info[row['id']] = _info(row)
+    uf, degree = UnionFind(), {}
+    try:
+        if not ids:
+            return uf, degree, info, 0
+        matrix = np.memmap(tmp.name, dtype=np.float32, mode='r', shape=(len(ids), dim))
+        # 每块距离矩阵及其临时数组约占 3 * block^2 * 4 字节
+        block = max(256, int((memory_mb * 1024 * 1024 / 12) ** 0.5))
+        norms = np.einsum('ij,ij->i', matrix, matrix)
+        started = time.time()
+        for i in range(0, len(ids), block):
+            a = np.asarray(matrix[i:i + block])
+            for j in range(i, len(ids), block):
+                b = a if j == i else np.asarray(matrix[j:j + block])
+                distances = norms[i:i + len(a), None] + norms[None, j:j + len(b)] - 2 * (a @ b.T)
+                rows, cols = np.nonzero(distances <= threshold)
+                for r, c in zip(rows.tolist(), cols.tolist()):
+                    if j == i and c <= r:
+                        continue
+                    x, y = ids[i + r], ids[j + c]
+                    uf.union(x, y)
+                    degree[x] = degree.get(x, 0) + 1
+                    degree[y] = degree.get(y, 0) + 1
+            done = min(i + block, len(ids))
+            print(f"已比较 {done}/{len(ids)} 个向量 ({time.time() - started:.0f}s)")
+        del matrix
+    finally:
+        os.remove(tmp.name)
+    return uf, degree, info, len(ids)
+
+
+def fetch_vectors(collection, ids, chunk_size=1000):
+    """按主键读取特征向量，返回与 ids 顺序一致的 float32 矩阵"""
+    vectors = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        for row in collection.query(expr=f"id in [{', '.join(str(pk) for pk in chunk)}]",
+                                    output_fields=["id", "embedding"]):
+            vectors[row['id']] = row['embedding']
+    return np.asarray([vectors[pk] for pk in ids], dtype=np.float32)
+
+
+def split_by_leader(members, vectors, threshold):
+    """
+    把一个连通分量拆分成以代表图片为中心的簇。
+
+    参数:
+        members (list): 按代表优先级排好序的主键。
+        vectors (numpy.ndarray): 与 members 对应的特征向量。
+        threshold (float): 距离阈值 (L2 距离的平方)。
+
+    返回:
+        list[list[tuple]]: 每个簇为 [(主键, 到代表的距离)]，第一项是代表本身；只有代表的簇不返回。
+    """
+    norms = np.einsum('ij,ij->i', vectors, vectors)
+    leaders = []  # members 中的下标
+    groups = {}
+    for i in range(len(members)):
+        if leaders:
+            distances = norms[leaders] + norms[i] - 2 * (vectors[leaders] @ vectors[i])
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= threshold:
+                groups[leaders[nearest]].append((members[i], max(float(distances[nearest]), 0.0)))
+                continue
+        leaders.append(i)
+        groups[i] = [(members[i], 0.0)]
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def build_report(name, method, threshold, uf, degree, info, total, collection):
+    """把并查集的结果按代表图片拆分后整理成报告，簇按大小降序排列"""
+    clusters = []
+    for component in uf.groups():
+        component.sort(key=lambda pk: (-degree.get(pk, 0), info[pk]['ingest_time'], pk))
+        for members in split_by_leader(component, fetch_vectors(collection, component), threshold):
+            canonical = members[0][0]
+            clusters.append({
+                'size': len(members),
+                'canonical': {'id': str(canonical), 'image_filename': info[canonical]['image_filename']},
+                'members': [{'id': str(pk), 'image_filename': info[pk]['image_filename'],
+                             'neighbors': degree.get(pk, 0), 'distance': round(distance, 6)}
+                            for pk, distance in members],
+                # 主键转为字符串，避免前端精度丢失；可直接提交给 /api/delete_images
+                'prune_ids': [str(pk) for pk, _ in members[1:]]
+            })
+    clusters.sort(key=lambda c: -c['size'])
+    for i, cluster in enumerate(clusters):
+        cluster['cluster_id'] = i
+    return {
+        'collection': name,
+        'created_at': int(time.time()),
+        'method': method,
+        'threshold': threshold,
+        'total_vectors': total,
+        'cluster_count': len(clusters),
+        'duplicate_count': sum(c['size'] - 1 for c in clusters),
+        'clusters': clusters
+    }
+
+
+def save_report(report, path=REPORT_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_report(path=REPORT_PATH):
+    """读取最近一次的报告，不存在时返回 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def take_prune_ids(report, cluster_ids=None):
+    """
+    取出要清理的图片 ID，并把这些簇从报告中移除。
+
+    参数:
+        report (dict): 报告。
+        cluster_ids (list[int]): 要清理的簇，为 None 时清理全部簇。
+
+    返回:
+        list[str]: 要删除的图片 ID。
+    """
+    selected = None if cluster_ids is None else {int(c) for c in cluster_ids}
+    prune_ids = []
+    remaining = []
+    for cluster in report['clusters']:
+        if selected is None or cluster['cluster_id'] in selected:
+            prune_ids.extend(cluster['prune_ids'])
+        else:
+            remaining.append(cluster)
+    report['clusters'] = remaining
+    report['cluster_count'] = len(remaining)
+    report['duplicate_count'] = sum(c['size'] - 1 for c in remaining)
+    return prune_ids
+
+
+def find_near_duplicates(collection, name, threshold=DEFAULT_THRESHOLD, method='ann', **kwargs):
+    """
+    对集合执行近重复聚类并返回报告。
+
+    参数:
+        collection (PooledCollection): 集合代理对象 (或分片集合)。
+        name (str): 报告中记录的集合名，应与服务的实际集合名一致。
+        threshold (float): 距离阈值 (L2 距离的平方)。
+        method (str): ann 或 matmul。
+        kwargs: 传给 join_ann / join_matmul 的参数。
+
+    返回:
+        dict: 报告。
+    """
+    join = join_ann if method == 'ann' else join_matmul
+    uf, degree, info, total = join(collection, threshold, **kwargs)
+    report = build_report(name, method, threshold, uf, degree, info, total, collection)
+    print(f"共 {total} 个向量，找到 {report['cluster_count']} 个近重复簇，"
+          f"建议清理 {report['duplicate_count']} 张图片")
+    return report
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from image_catalog import catalog_name
+
+    parser = argparse.ArgumentParser(description="近重复图片聚类")
+    parser.add_argument('--collection', help="集合名或别名，默认为当前服务的集合 (或 HERITAGE_SHARDS 分片)")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--method', choices=['ann', 'matmul'], default='ann')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K, help="ann：每个向量取的近邻数量")
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE, help="ann：IVF 搜索的聚类数量")
+    parser.add_argument('--memory-mb', type=int, default=DEFAULT_MEMORY_MB, help="matmul：分块距离矩阵的内存预算")
+    parser.add_argument('--output', default=REPORT_PATH)
+    args = parser.parse_args()
+
+    target = (get_sharded_collection() if not args.collection else None) \
+        or get_collection(args.collection or collection_name)
+    if not target.ready:
+        print(f"集合 {target.name} 不可用，请检查 Milvus 服务状态")
+        sys.exit(1)
+    options = {'top_k': args.top_k, 'nprobe': args.nprobe} if args.method == 'ann' \
+        else {'memory_mb': args.memory_mb}
+    result = find_near_duplicates(target, catalog_name(target), args.threshold, args.method, **options)
+    save_report(result, args.output)
+    print(f"报告已写入 {args.output}")
@@ -0,0 +1,448 @@
+# 分区冷热分层：只常驻加载最近入库的分区，较早的分区按需加载并在内存预算内按 LRU 释放
+#
+# 开启 HERITAGE_PARTITION_TIERING=1 后：
+#   - 每个类别按入库月份写入不同的分区 cat_<类别哈希>_<yyyymm> (见 image_metadata.partition_name)；
+#   - 连接池不再整体加载集合 (milvus_client 的 partial 模式)，查询节点的内存不再随全部数据增长；
+#   - 热分区：最近 HERITAGE_TIER_HOT_MONTHS 个月的分区，始终保持加载；
+#   - 冷分区：更早的分区和开启分层前写入的无月份分区，搜索用到时才加载，
+#     已加载的冷分区总大小 (按实体数估算) 不超过 HERITAGE_TIER_COLD_MB，超出时释放最久未使用的冷分区。
+# 搜索遇到未加载的冷分区时按 HERITAGE_TIER_COLD_MODE 处理：
+#   load  在 HERITAGE_TIER_LOAD_BUDGET 秒 (且不超过请求剩余时间) 内等待加载，超时的分区本次跳过；
+#   skip  直接跳过并在后台加载，后续搜索即可命中。
+# 被跳过的分区会在搜索结果中标出 (partial 字段)，调用方可以提示结果不完整。
+# 按类别或入库时间过滤时只考虑对应的分区，较少触发冷分区加载。
+#
+# 注意：Milvus 的查询 (query / query_iterator) 同样只能访问已加载的分区。图片目录库的全量同步、
+# 模型迁移和索引重建使用 scan() 逐个加载分区；近重复聚类、集合导入导出等其他需要遍历全部数据的工具应以
+# HERITAGE_PARTITION_TIERING=0 运行 (整体加载集合)，服务进程随后会按 LRU 释放多出的冷分区。
+#
+#   python partition_tiering.py status    查看各分区的冷热和加载状态
+import os
+import sys
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from image_metadata import parse_partition_name, partition_name
+from metrics import TIER_LOADED, TIER_LOADS, SEARCH_PARTIAL
+
+# --- 分层配置 ---
+HOT_MONTHS = int(os.environ.get('HERITAGE_TIER_HOT_MONTHS', '3'))
+COLD_BUDGET_BYTES = int(float(os.environ.get('HERITAGE_TIER_COLD_MB', '2048')) * 1024 * 1024)
+COLD_MODE = os.environ.get('HERITAGE_TIER_COLD_MODE', 'load')
+LOAD_BUDGET = float(os.environ.get('HERITAGE_TIER_LOAD_BUDGET', '2.0'))
+# 重新读取分区列表、核对加载状态的间隔 (秒)
+REFRESH_INTERVAL = float(os.environ.get('HERITAGE_TIER_REFRESH_INTERVAL', '60'))
+# 搜索的类别不在分区列表中时强制刷新的最小间隔 (秒)
+MIN_FORCED_REFRESH = 5.0
+# 后台加载 (skip 模式) 冷分区的超时时间 (秒)
+BACKGROUND_LOAD_TIMEOUT = 60.0
+# 估算分区内存占用时每个实体的标量字段和索引开销 (字节)，向量部分按 dim * 4 计算
+ENTITY_OVERHEAD_BYTES = 256
+# scan() 等待冷分区腾出内存预算的最长时间 (秒)，超时后抛出异常而不是无限重试
+SCAN_WAIT_TIMEOUT = float(os.environ.get('HERITAGE_TIER_SCAN_WAIT', '300'))
+
+
+def _month_index(yyyymm):
+    return (yyyymm // 100) * 12 + yyyymm % 100 - 1
+
+
+def _current_month(now=None):
+    return int(time.strftime('%Y%m', time.localtime(now)))
+
+
+class TieringManager:
+    """
+    一个按分区加载的集合的冷热分层状态。
+
+    热分区在创建时和每次刷新时加载且不会被释放；冷分区按 LRU 顺序记录，
+    正在被搜索使用的冷分区 (引用计数大于 0) 不会被释放。
+    """
+
+    def __init__(self, collection, dim=512, hot_months=HOT_MONTHS, cold_budget_bytes=COLD_BUDGET_BYTES,
+                 cold_mode=COLD_MODE, load_budget=LOAD_BUDGET, refresh_interval=REFRESH_INTERVAL):
+        self.collection = collection
+        self.entity_bytes = dim * 4 + ENTITY_OVERHEAD_BYTES
+        self.hot_months = hot_months
+        self.cold_budget_bytes = cold_budget_bytes
+        self.cold_mode = cold_mode
+        self.load_budget = load_budget
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._partitions = {}  # 分区名 -> (类别分区名, 月份)
+        self._sizes = {}  # 分区名 -> 估算的内存占用 (字节)
+        self._hot = set()  # 已加载的热分区
+        self._cold = OrderedDict()  # 已加载的冷分区 -> 估算大小，按最近使用排序
+        self._in_use = {}  # 冷分区 -> 正在使用它的搜索数量
+        self._loading = {}  # 正在加载的分区 -> threading.Event
+        self._refreshed = 0.0
+        TIER_LOADED.labels('hot').set_function(lambda: len(self._hot))
+        TIER_LOADED.labels('cold').set_function(lambda: len(self._cold))
+        self.refresh(force=True)
+
+    # --- 分区状态 ---
+    def is_hot(self, name, now=None):
+        month = self._partitions.get(name, (name, None))[1]
+        if month is None:
+            return False
+        return _month_index(_current_month(now)) - _month_index(month) < self.hot_months
+
+    @property
+    def cold_bytes(self):
+        return sum(self._cold.values())
+
+    def _size(self, name):
+        if name not in self._sizes:
+            try:
+                self._sizes[name] = self.collection.partition_entities(name) * self.entity_bytes
+            except Exception:
+                self._sizes[name] = 0
+        return self._sizes[name]
+
+    def refresh(self, force=False):
+        """
+        重新读取分区列表并核对加载状态：补齐热分区 (包括新月份的分区)，
+        登记由其他进程加载的冷分区，超出内存预算时释放最久未使用的冷分区。
+        """
+        if not force and time.time() - self._refreshed < self.refresh_interval:
+            return
+        # 同一时间只有一个线程刷新，非强制刷新时其他线程直接使用现有状态
+        if not self._refresh_lock.acquire(blocking=force):
+            return
+        try:
+            self._refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        self._refreshed = time.time()
+        names = self.collection.list_partitions()
+        self._sizes.clear()
+        loaded = {name for name in names if self.collection.partition_loaded(name)}
+        sizes = {name: self._size(name) for name in loaded}
+        missing_hot = []
+        with self._lock:
+            self._partitions = {name: parse_partition_name(name) for name in names}
+            for name in names:
+                if self.is_hot(name):
+                    self._cold.pop(name, None)
+                    if name in loaded:
+                        self._hot.add(name)
+                    else:
+                        missing_hot.append(name)
+                elif name in loaded:
+                    self._hot.discard(name)
+                    # 其他进程加载的冷分区也纳入 LRU，按最久未使用释放
+                    self._cold.setdefault(name, sizes[name])
+                else:
+                    self._hot.discard(name)
+                    if name not in self._loading:
+                        self._cold.pop(name, None)
+        if missing_hot:
+            print(f"加载热分区 {', '.join(missing_hot)}...")
+            self.collection.load_partitions(missing_hot)
+            with self._lock:
+                self._hot.update(missing_hot)
+            TIER_LOADS.labels('hot').inc(len(missing_hot))
+        with self._lock:
+            evict = self._evict_locked(0)
+        self._release(evict or [])
+
+    def _evict_locked(self, needed):
+        """
+        挑出为腾出 needed 字节需要释放的冷分区 (从最久未使用的开始，跳过正在使用的)。
+        正在使用的分区占满预算、无法腾出足够空间时不释放任何分区，返回 None。
+        """
+        in_use = sum(size for name, size in self._cold.items() if self._in_use.get(name))
+        if in_use + needed > self.cold_budget_bytes and needed > 0:
+            return None
+        evict = []
+        total = self.cold_bytes
+        for name, size in list(self._cold.items()):
+            if total + needed <= self.cold_budget_bytes:
+                break
+            if self._in_use.get(name):
+                continue
+            evict.append(name)
+            total -= size
+            del self._cold[name]
+        return evict
+
+    def _release(self, names):
+        for name in names:
+            try:
+                self.collection.release_partition(name)
+                TIER_LOADS.labels('released').inc()
+                print(f"已释放冷分区 {name}")
+            except Exception as e:
+                print(f"释放冷分区 {name} 失败: {e}")
+
+    # --- 搜索 ---
+    def candidates(self, category=None, ingest_after=None, ingest_before=None):
+        """
+        返回搜索需要访问的分区：按类别和入库时间范围裁剪。
+
+        返回:
+            list[str]: 分区名列表。
+        """
+        self.refresh()
+        prefix = partition_name(category) if category else None
+        month_from = _current_month(ingest_after) if ingest_after is not None else None
+        month_to = _current_month(ingest_before) if ingest_before is not None else None
+        with self._lock:
+            partitions = dict(self._partitions)
+        if prefix and prefix not in {base for base, _ in partitions.values()} \
+                and time.time() - self._refreshed > MIN_FORCED_REFRESH:
+            # 分区列表可能尚未包含其他进程刚创建的分区
+            self.refresh(force=True)
+            with self._lock:
+                partitions = dict(self._partitions)
+        result = []
+        for name, (base, month) in partitions.items():
+            # 包含元数据字段的集合只写入类别分区，默认分区始终为空，不需要加载
+            if name == '_default':
+                continue
+            if prefix and base != prefix:
+                continue
+            if month is not None and ((month_from and month < month_from) or (month_to and month > month_to)):
+                continue
+            result.append(name)
+        return result
+
+    def _hold_locked(self, name):
+        self._in_use[name] = self._in_use.get(name, 0) + 1
+
+    def _load_cold(self, name, timeout, hold=False, oversize=False):
+        """
+        加载一个冷分区，timeout 秒内未完成返回 False (分区在服务端继续加载)。
+
+        参数:
+            hold (bool): 加载成功时在同一个加锁区间内占用该分区，其他线程不会在占用前将其释放。
+            oversize (bool): 允许临时加载大于整个冷分区预算的分区 (先释放所有未使用的冷分区)，
+                             占用结束后即被释放；否则这样的分区无法加载。
+        """
+        size = self._size(name)
+        with self._lock:
+            event = self._loading.get(name)
+            owner = event is None
+            if owner and name in self._cold:
+                # 等待锁期间已被其他线程加载
+                self._cold.move_to_end(name)
+                if hold:
+                    self._hold_locked(name)
+                return True
+            if owner:
+                if size > self.cold_budget_bytes and oversize:
+                    evict = [other for other in self._cold if not self._in_use.get(other)]
+                    for other in evict:
+                        del self._cold[other]
+                else:
+                    evict = self._evict_locked(size)
+                if evict is None:
+                    # 分区超过预算，或其余冷分区都在使用中，暂时无法腾出空间
+                    TIER_LOADS.labels('over_budget').inc()
+                    return False
+                event = self._loading[name] = threading.Event()
+        if not owner:
+            if not event.wait(timeout):
+                return False
+            with self._lock:
+                if name not in self._cold:
+                    return False
+                if hold:
+                    self._hold_locked(name)
+                return True
+        self._release(evict)
+        started = time.time()
+        loaded = False
+        try:
+            self.collection.load_partitions([name], timeout=max(timeout, 0.1))
+            loaded = True
+        except Exception as e:
+            # 超时后分区在服务端继续加载，下次刷新或搜索时会被登记
+            print(f"冷分区 {name} 未能在 {timeout:.1f} 秒内加载: {e}")
+        finally:
+            with self._lock:
+                if loaded:
+                    self._cold[name] = size
+                    if hold:
+                        self._hold_locked(name)
+                del self._loading[name]
+            event.set()
+        TIER_LOADS.labels('cold' if loaded else 'timeout').inc()
+        if loaded:
+            print(f"已加载冷分区 {name} ({time.time() - started:.2f}s)")
+        return loaded
+
+    def _load_in_background(self, names):
+        def run():
+            for name in names:
+                if name not in self._loading:
+                    self._load_cold(name, BACKGROUND_LOAD_TIMEOUT)
+        threading.Thread(target=run, name='tier-load', daemon=True).start()
+
+    @contextmanager
+    def use(self, partitions, deadline=None, blocking=None, oversize=False):
+        """
+        在搜索期间占用分区，返回 (可搜索的分区, 跳过的分区)。
+
+        参数:
+            partitions (list[str]): 候选分区。
+            deadline (admission.Deadline): 请求截止时间，等待加载冷分区不超过剩余时间。
+            blocking (bool): 是否等待冷分区加载，默认由 cold_mode 决定。
+            oversize (bool): 允许临时加载大于整个冷分区预算的分区，见 _load_cold。
+        """
+        if blocking is None:
+            blocking = self.cold_mode == 'load'
+        searchable, pending = [], []
+        with self._lock:
+            for name in partitions:
+                if name in self._hot:
+                    searchable.append(name)
+                elif name in self._cold:
+                    self._cold.move_to_end(name)
+                    self._hold_locked(name)
+                    searchable.append(name)
+                else:
+                    pending.append(name)
+        held = [name for name in searchable if name not in self._hot]
+        # 预算不足以加载全部冷分区时优先加载较新的分区，无月份的旧分区最后加载
+        pending.sort(key=lambda name: self._partitions.get(name, (name, None))[1] or 0, reverse=True)
+        skipped = []
+        if pending and blocking:
+            expires = time.monotonic() + self.load_budget
+            for name in pending:
+                remaining = expires - time.monotonic()
+                if deadline is not None:
+                    remaining = min(remaining, deadline.remaining)
+                if remaining > 0 and self._load_cold(name, remaining, hold=True, oversize=oversize):
+                    held.append(name)
+                    searchable.append(name)
+                else:
+                    skipped.append(name)
+        elif pending:
+            skipped = pending
+            self._load_in_background(pending)
+        if skipped:
+            SEARCH_PARTIAL.inc()
+        try:
+            yield searchable, skipped
+        finally:
+            with self._lock:
+                for name in held:
+                    self._in_use[name] -= 1
+                    if not self._in_use[name]:
+                        del self._in_use[name]
+                # 临时加载的超大分区在占用结束后超出预算，此时释放
+                evict = self._evict_locked(0) if self.cold_bytes > self.cold_budget_bytes else []
+            self._release(evict or [])
+
+    def status(self):
+        with self._lock:
+            partitions = [{
+                'name': name,
+                'month': month,
+                'tier': 'hot' if self.is_hot(name) else 'cold',
+                'loaded': name in self._hot or name in self._cold,
+                'estimated_mb': round(self._sizes.get(name, 0) / 1024 / 1024, 2)
+            } for name, (_, month) in sorted(self._partitions.items())]
+            return {
+                'hot_months': self.hot_months,
+                'cold_mode': self.cold_mode,
+                'cold_loaded_mb': round(self.cold_bytes / 1024 / 1024, 2),
+                'cold_budget_mb': round(self.cold_budget_bytes / 1024 / 1024, 2),
+                'partitions': partitions
+            }
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_tiering(collection):
+    """
+    返回集合的冷热分层管理器；集合不是按分区加载的 (未开启分层、旧版集合或分片集合) 时返回 None。
+    首次调用时加载热分区，并在连接池的健康检查中定期核对加载状态。
+    """
+    if not getattr(type(collection), 'partial', None) or not collection.partial:
+        return None
+    # 同一集合的多个代理对象 (例如 search_images 和 app_flask 各自获取的) 共用一个管理器
+    key = (id(collection.pool), collection.name)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            dim = next((f.params['dim'] for f in collection.schema.fields if f.name == 'embedding'), 512)
+            manager = TieringManager(collection, dim=int(dim))
+            collection.pool.set_partition_loader(collection.name, manager.refresh)
+            _managers[key] = manager
+        return manager
+
+
+def scan(collection, output_fields, batch_size=1000, expr=None, ingest_after=None):
+    """
+    按批遍历集合的全部行。按分区加载的集合逐个分区遍历，遍历期间等待加载并占用该分区；
+    大于整个冷分区预算的分区在遍历期间临时加载，遍历完即释放。
+
+    参数:
+        expr (str): 过滤表达式，默认遍历全部行。
+        ingest_after (int): 只遍历可能包含该时间 (Unix 秒) 之后入库的行的分区，应与 expr 中的条件一致。
+
+    返回:
+        generator: 每次产出一批行 (list[dict])。
+
+    异常:
+        RuntimeError: 某个分区在 SCAN_WAIT_TIMEOUT 秒内无法加载 (预算一直被正在使用的分区占满)。
+    """
+    manager = get_tiering(collection)
+    groups = [None] if manager is None else [[name] for name in manager.candidates(ingest_after=ingest_after)]
+    for partitions in groups:
+        if partitions is None:
+            yield from _iterate(collection, output_fields, batch_size, None, expr)
+            continue
+        give_up = time.monotonic() + SCAN_WAIT_TIMEOUT
+        while True:
+            with manager.use(partitions, blocking=True, oversize=True) as (searchable, _):
+                if searchable:
+                    yield from _iterate(collection, output_fields, batch_size, searchable, expr)
+                    break
+            if time.monotonic() >= give_up:
+                raise RuntimeError(f"分区 {partitions[0]} 在 {SCAN_WAIT_TIMEOUT:.0f} 秒内无法加载，遍历中止")
+            # 冷分区内存预算暂时被正在使用的分区占满，稍后重试
+            time.sleep(1.0)
+
+
+def _iterate(collection, output_fields, batch_size, partitions, expr=None):
+    kwargs = {'partition_names': partitions} if partitions else {}
+    if expr:
+        kwargs['expr'] = expr
+    iterator = collection.query_iterator(batch_size=batch_size, output_fields=output_fields, **kwargs)
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            yield rows
+    finally:
+        iterator.close()
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    from milvus_client import get_collection, collection_name
+
+    parser = argparse.ArgumentParser(description="分区冷热分层")
+    parser.add_argument('command', choices=['status'])
+    parser.add_argument('--collection', default=collection_name)
+    args = parser.parse_args()
+
+    target = get_collection(args.collection, partial=True)
+    manager = get_tiering(target) if target.ready else None
+    if manager is None:
+        print(f"集合 {args.collection} 不可用或不支持按分区加载")
+        sys.exit(1)
+    status = manager.status()
+    for p in status['partitions']:
+        print(f"{p['name']:<28} {p['tier']:<5} {'已加载' if p['loaded'] else '未加载'}  {p['estimated_mb']} MB")
+    print(f"冷分区已加载 {status['cold_loaded_mb']} / {status['cold_budget_mb']} MB")
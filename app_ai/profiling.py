@@ -0,0 +1,212 @@
+import os
+import io
+import json
+import time
+import random
+import shutil
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# --- 性能剖析配置 (默认全部关闭) ---
+# 按百分比随机抽样剖析请求，例如 1 表示剖析 1% 的请求
+SAMPLE_PERCENT = float(os.environ.get('HERITAGE_PROFILE_SAMPLE_PERCENT', '0'))
+# 设置后，携带 X-Heritage-Profile 请求头且值等于该令牌的请求会被剖析
+HEADER_TOKEN = os.environ.get('HERITAGE_PROFILE_TOKEN', '')
+PROFILE_HEADER = 'X-Heritage-Profile'
+# 剖析结果输出目录及最多保留的结果数量，超出后删除最旧的结果
+PROFILE_DIR = os.environ.get('HERITAGE_PROFILE_DIR', os.path.join(APP_ROOT, 'profiles'))
+PROFILE_KEEP = int(os.environ.get('HERITAGE_PROFILE_KEEP', '50'))
+# 是否在剖析的请求中同时记录 torch.profiler 的模型前向计算轨迹
+TORCH_TRACE = os.environ.get('HERITAGE_PROFILE_TORCH', '1') == '1'
+
+ENABLED = SAMPLE_PERCENT > 0 or bool(HEADER_TOKEN)
+
+_local = threading.local()
+_rotate_lock = threading.Lock()
+
+
+class _NullSpan:
+    """未开启剖析时使用的空上下文管理器"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class ProfileSession:
+    """一次被剖析的请求：cProfile、耗时区间和 torch.profiler 轨迹"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.spans = []
+        self.torch_traces = []
+        self.profiler = cProfile.Profile()
+
+    def save(self):
+        """把剖析结果写入新的子目录，并清理超出保留数量的旧结果"""
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        out_dir = os.path.join(PROFILE_DIR, f'{stamp}_{self.name}')
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.profiler.dump_stats(os.path.join(out_dir, 'cprofile.prof'))
+        text = io.StringIO()
+        pstats.Stats(self.profiler, stream=text).sort_stats('cumulative').print_stats(50)
+        with open(os.path.join(out_dir, 'cprofile.txt'), 'w', encoding='utf-8') as f:
+            f.write(text.getvalue())
+
+        with open(os.path.join(out_dir, 'spans.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'name': self.name,
+                'total_ms': (time.perf_counter() - self.started_at) * 1000,
+                'spans': self.spans
+            }, f, ensure_ascii=False, indent=2)
+
+        for i, prof in enumerate(self.torch_traces):
+            prof.export_chrome_trace(os.path.join(out_dir, f'torch_trace_{i}.json'))
+
+        _rotate()
+        return out_dir
+
+
+class _Span:
+    """记录一段代码的起止时间 (相对请求开始的毫秒数)，可嵌套另一个上下文管理器"""
+
+    def __init__(self, session, name, inner):
+        self.session = session
+        self.name = name
+        self.inner = inner
+
+    def __enter__(self):
+        if self.inner is not None:
+            self.inner.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.session.spans.append({
+            'name': self.name,
+            'start_ms': (self.start - self.session.started_at) * 1000,
+            'duration_ms': (end - self.start) * 1000,
+            'thread': threading.current_thread().name
+        })
+        if self.inner is not None:
+            return self.inner.__exit__(exc_type, exc, tb)
+        return False
+
+
+class _TorchTrace:
+    """在剖析的请求中用 torch.profiler 记录一次模型前向计算"""
+
+    def __init__(self, session):
+        import torch.profiler
+        self.session = session
+        self.prof = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                           record_shapes=True)
+
+    def __enter__(self):
+        self.prof.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.prof.__exit__(exc_type, exc, tb)
+        self.session.torch_traces.append(self.prof)
+        return False
+
+
+def _rotate():
+    """只保留最新的 PROFILE_KEEP 个剖析结果目录"""
+    with _rotate_lock:
+        entries = sorted(os.listdir(PROFILE_DIR))
+        for name in entries[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else entries:
+            shutil.rmtree(os.path.join(PROFILE_DIR, name), ignore_errors=True)
+
+
+def current_session():
+    """当前线程正在剖析的会话，未剖析时返回 None"""
+    return getattr(_local, 'session', None)
+
+
+def span(name, inner=None):
+    """
+    记录一段代码的耗时区间。未处于剖析中的请求直接返回 inner (或空上下文)，几乎没有额外开销。
+
+    参数:
+        name (str): 区间名称，例如 image_decode、milvus_search。
+        inner: 需要同时进入的上下文管理器，例如指标计时器。
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        return inner if inner is not None else _NULL_SPAN
+    return _Span(session, name, inner)
+
+
+def torch_trace():
+    """在剖析的请求中返回 torch.profiler 上下文，否则返回空上下文"""
+    session = getattr(_local, 'session', None)
+    if session is None or not TORCH_TRACE:
+        return _NULL_SPAN
+    return _TorchTrace(session)
+
+
+def start(name):
+    """在当前线程开始剖析"""
+    session = ProfileSession(name)
+    _local.session = session
+    session.profiler.enable()
+    return session
+
+
+def stop():
+    """结束当前线程的剖析并写出结果，返回结果目录"""
+    session = getattr(_local, 'session', None)
+    if session is None:
+        return None
+    session.profiler.disable()
+    _local.session = None
+    try:
+        return session.save()
+    except Exception as e:
+        print(f"写入剖析结果失败: {e}")
+        return None
+
+
+def should_profile(headers):
+    """根据请求头和抽样比例决定是否剖析当前请求"""
+    if HEADER_TOKEN and headers.get(PROFILE_HEADER) == HEADER_TOKEN:
+        return True
+    return SAMPLE_PERCENT > 0 and random.random() * 100 < SAMPLE_PERCENT
+
+
+def init_app(app):
+    """
+    为 Flask 应用注册剖析钩子。未通过环境变量开启时不注册任何钩子。
+    """
+    if not ENABLED:
+        return
+    from flask import request
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    print(f"已开启请求剖析：抽样 {SAMPLE_PERCENT}%，请求头触发 {'开启' if HEADER_TOKEN else '关闭'}，"
+          f"输出目录 {PROFILE_DIR}")
+
+    @app.before_request
+    def _start_profile():
+        if should_profile(request.headers):
+            start(request.endpoint or 'unknown')
+
+    @app.teardown_request
+    def _stop_profile(exc):
+        out_dir = stop()
+        if out_dir:
+            print(f"请求剖析结果已写入 {out_dir}")
@@ -0,0 +1,577 @@
+# Milvus 与图片目录 (static/images，见 image_store) 的一致性核对：找出并修复悬空向量和未入库的图片文件
+#
+#   python reconcile.py [--incremental] [--repair] [--orphan-files report|quarantine|index]
+#                       [--interval 秒] [--full-every 小时] [--collection 名称]
+#
+# 插入接口先把文件放入图片目录 (image_store.save) 再写 Milvus，写入失败时删除刚放入的文件 (见
+# insert_images.release_unused)；删除接口先删 Milvus 再删文件。两步之间崩溃或清理失败会留下：
+#   未入库文件 图片目录中有文件但 Milvus 中没有记录，永远搜索不到；插入中途崩溃时出现，
+#              是最常见的不一致，也可能是写缓冲中尚未写入 Milvus 的行；
+#   悬空向量   Milvus 中有记录但图片文件不存在，搜索结果会返回打不开的图片；插入路径不会产生，
+#              只来自手工删除文件或从备份恢复 Milvus 等外部操作。
+#
+# 全量核对：后台线程用 query_iterator 按批读出 Milvus 的 (id, 文件名, 入库时间)，
+# 同时多个线程并行遍历图片目录，两边都经有界队列写入临时 SQLite 库，再用 SQL 连接比较，
+# 内存占用与集合大小无关，可用于百万级集合。
+# 增量核对：只检查上次核对以来入库的向量和修改过的文件，逐个检查对方是否存在；
+# 更早的不一致 (例如手工删除的旧文件) 由定期的全量核对发现 (--full-every)。
+#
+# 刚放入的文件对应的向量可能仍在写缓冲中，GRACE_SECONDS 内的不一致只报告不修复。
+# 删除接口在删除 Milvus 记录前把要删除的文件登记到删除日志 (pending_file_deletes)，
+# 核对时补做崩溃后未完成的文件删除。
+#
+# 结果写入 reports/reconcile.json，可通过 GET /api/reconcile 查看。
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import shutil
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from milvus_client import get_collection, collection_name
+from sharding import get_sharded_collection
+from image_catalog import get_catalog, catalog_name
+from ingest_queue import DB_PATH, _Transaction
+from partition_tiering import scan
+import image_store
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = image_store.IMAGE_ROOT
+REPORT_PATH = os.path.join(APP_ROOT, 'reports', 'reconcile.json')
+# 未入库文件的隔离目录 (不在 static 下，不会被直接访问)
+QUARANTINE_DIR = os.path.join(APP_ROOT, 'quarantine')
+
+# 宽限期 (秒)：入库时间或修改时间在宽限期内的不一致视为正在进行的写入，只报告不修复
+GRACE_SECONDS = int(os.environ.get('HERITAGE_RECONCILE_GRACE', '600'))
+# 与 app_flask.ALLOWED_EXTENSIONS 一致
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+# 报告中每类问题最多列出的样例数量
+SAMPLE_LIMIT = 100
+# 遍历 Milvus 和图片目录时每批的行数，也是每次修复的行数上限
+BATCH_SIZE = 1000
+# 单条 Milvus 查询中 in [...] 的值的数量上限
+_CHUNK = 500
+# 遍历图片目录的线程数
+SCAN_WORKERS = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_file_deletes (
+    collection TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (collection, id)
+);
+CREATE TABLE IF NOT EXISTS reconcile_state (
+    collection TEXT PRIMARY KEY,
+    last_run_at REAL NOT NULL,
+    last_full_at REAL
+);
+"""
+
+ORPHAN_POLICIES = ('report', 'quarantine', 'index')
+
+
+class ReconcileStore:
+    """
+    删除日志和核对状态，保存在与入库队列相同的 SQLite 数据库中。
+
+    每个线程使用独立的 autocommit 连接；写操作在 BEGIN IMMEDIATE 事务中执行。
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    # --- 删除日志 ---
+    def begin_delete(self, collection, items):
+        """删除 Milvus 记录前登记要删除的文件，items 为包含 id 和 image_filename 的字典列表"""
+        now = time.time()
+        rows = [(collection, int(item['id']), item['image_filename'], now)
+                for item in items if item.get('image_filename')]
+        with _Transaction(self._connect()) as conn:
+            conn.executemany('INSERT OR REPLACE INTO pending_file_deletes (collection, id, filename, created_at) '
+                             'VALUES (?, ?, ?, ?)', rows)
+
+    def end_delete(self, collection, ids):
+        """文件删除完成 (或确认无需删除) 后移除登记"""
+        ids = [int(i) for i in ids]
+        with _Transaction(self._connect()) as conn:
+            for i in range(0, len(ids), _CHUNK):
+                chunk = ids[i:i + _CHUNK]
+                conn.execute(f'DELETE FROM pending_file_deletes WHERE collection = ? AND id IN '
+                             f'({",".join("?" * len(chunk))})', [collection] + chunk)
+
+    def pending_deletes(self, collection, older_than):
+        """返回登记时间早于 older_than 的 (id, 文件名) 列表"""
+        return self._connect().execute(
+            'SELECT id, filename FROM pending_file_deletes WHERE collection = ? AND created_at < ? ORDER BY id',
+            (collection, older_than)).fetchall()
+
+    # --- 核对状态 ---
+    def state(self, collection):
+        """返回 (上次核对时间, 上次全量核对时间)，从未核对过时返回 (None, None)"""
+        row = self._connect().execute(
+            'SELECT last_run_at, last_full_at FROM reconcile_state WHERE collection = ?', (collection,)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def save_state(self, collection, run_at, full):
+        with _Transaction(self._connect()) as conn:
+            if full:
+                conn.execute('INSERT OR REPLACE INTO reconcile_state (collection, last_run_at, last_full_at) '
+                             'VALUES (?, ?, ?)', (collection, run_at, run_at))
+            else:
+                conn.execute('INSERT INTO reconcile_state (collection, last_run_at, last_full_at) VALUES (?, ?, NULL) '
+                             'ON CONFLICT(collection) DO UPDATE SET last_run_at = excluded.last_run_at',
+                             (collection, run_at))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """返回进程内共享的 ReconcileStore"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ReconcileStore()
+        return _store
+
+
+# --- 遍历 ---
+def _is_image(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _walk(directory, root, out, modified_after=None):
+    """递归遍历目录，把 (文件名, 相对路径, 修改时间, 大小) 按批放入队列"""
+    batch = []
+    stack = [directory]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError as e:
+            print(f"无法读取目录: {e}")
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif _is_image(entry.name):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # 遍历期间被删除
+                if modified_after is not None and stat.st_mtime < modified_after:
+                    continue
+                batch.append((entry.name, os.path.relpath(entry.path, root), stat.st_mtime, stat.st_size))
+                if len(batch) >= BATCH_SIZE:
+                    out.put(('files', batch))
+                    batch = []
+    if batch:
+        out.put(('files', batch))
+
+
+def scan_files(out, directory=IMAGE_DIR, workers=SCAN_WORKERS, modified_after=None):
+    """
+    并行遍历图片目录：顶层文件由当前线程处理，每个子目录交给线程池，结果按批放入有界队列。
+
+    参数:
+        out (queue.Queue): 接收 ('files', 行列表) 的队列。
+        modified_after (float): 只返回修改时间不早于该时间的文件，默认返回全部文件。
+    """
+    if not os.path.isdir(directory):
+        return
+    batch = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile-scan') as pool:
+        futures = []
+        for entry in os.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                futures.append(pool.submit(_walk, entry.path, directory, out, modified_after))
+            elif _is_image(entry.name):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if modified_after is not None and stat.st_mtime < modified_after:
+                    continue
+                batch.append((entry.name, entry.name, stat.st_mtime, stat.st_size))
+                if len(batch) >= BATCH_SIZE:
+                    out.put(('files', batch))
+                    batch = []
+        if batch:
+            out.put(('files', batch))
+        for future in futures:
+            future.result()
+
+
+def scan_vectors(collection, out, expr=None, ingest_after=None):
+    """按批读出 Milvus 的 (id, 文件名, 入库时间) 放入有界队列"""
+    fields = ["id", "image_filename"] + (["ingest_time"] if collection.has_metadata else [])
+    for rows in scan(collection, fields, BATCH_SIZE, expr=expr, ingest_after=ingest_after):
+        out.put(('vectors', [(row['id'], row['image_filename'], row.get('ingest_time') or 0) for row in rows]))
+
+
+def _producer(target, out, kind, *args, **kwargs):
+    """在后台线程中运行遍历函数，结束时放入 ('done', kind)，出错时放入 ('error', 异常)"""
+    def run():
+        try:
+            target(*args, out=out, **kwargs)
+            out.put(('done', kind))
+        except Exception as e:
+            out.put(('error', e))
+    thread = threading.Thread(target=run, name=f'reconcile-{kind}', daemon=True)
+    thread.start()
+    return thread
+
+
+def _indexed_filenames(collection, filenames):
+    """返回给定文件名中在 Milvus 中有记录的部分"""
+    found = set()
+    filenames = list(set(filenames))
+    for i in range(0, len(filenames), _CHUNK):
+        chunk = filenames[i:i + _CHUNK]
+        expr = f'image_filename in {json.dumps(chunk, ensure_ascii=False)}'
+        found.update(row['image_filename'] for row in collection.query(expr=expr, output_fields=["image_filename"]))
+    return found
+
+
+# --- 核对结果 ---
+class Findings:
+    """核对结果的计数和样例"""
+
+    def __init__(self, name, mode):
+        self.report = {
+            'collection': name,
+            'mode': mode,
+            'started_at': int(time.time()),
+            'vectors_scanned': 0,
+            'files_scanned': 0,
+            'dangling_vectors': {'count': 0, 'recent': 0, 'repaired': 0, 'samples': []},
+            'unindexed_files': {'count': 0, 'recent': 0, 'handled': 0, 'action': 'report', 'samples': []},
+            'duplicate_filenames': {'count': 0, 'samples': []},
+            'pending_deletes': {'completed': 0, 'dropped': 0},
+            'errors': []
+        }
+
+    def add(self, kind, sample, recent=False):
+        section = self.report[kind]
+        section['count'] += 1
+        if recent:
+            section['recent'] += 1
+        if len(section['samples']) < SAMPLE_LIMIT:
+            section['samples'].append(dict(sample, recent=recent))
+
+    def error(self, message):
+        print(message)
+        if len(self.report['errors']) < SAMPLE_LIMIT:
+            self.report['errors'].append(message)
+
+
+class Reconciler:
+    """
+    比较一个集合与图片目录，按需修复不一致。
+
+    参数:
+        collection (PooledCollection): 集合代理对象 (或分片集合)。
+        name (str): 目录库和删除日志中的集合名，见 image_catalog.catalog_name。
+        repair (bool): 是否删除悬空向量并处理未入库文件，否则只报告。
+        orphan_policy (str): 未入库文件的处理方式：report 只报告、quarantine 移到隔离目录、index 重新入库。
+        grace (int): 宽限期 (秒)。
+    """
+
+    def __init__(self, collection, name, repair=False, orphan_policy='report', grace=GRACE_SECONDS,
+                 store=None, catalog=None):
+        if orphan_policy not in ORPHAN_POLICIES:
+            raise ValueError(f"未知的未入库文件处理方式: {orphan_policy}，可选: {', '.join(ORPHAN_POLICIES)}")
+        self.collection = collection
+        self.name = name
+        self.repair = repair
+        self.orphan_policy = orphan_policy
+        self.grace = grace
+        self.store = store or get_store()
+        self.catalog = catalog or get_catalog()
+
+    def run(self, incremental=False, full_every=None):
+        """
+        执行一次核对。
+
+        参数:
+            incremental (bool): 是否只核对上次以来的变化；从未全量核对过、
+                                集合没有入库时间字段或距上次全量核对超过 full_every 时仍执行全量核对。
+            full_every (float): 全量核对的最长间隔 (秒)。
+
+        返回:
+            dict: 核对报告。
+        """
+        started = time.time()
+        last_run, last_full = self.store.state(self.name)
+        if incremental and (last_run is None or last_full is None or not self.collection.has_metadata
+                            or (full_every and started - last_full > full_every)):
+            incremental = False
+        findings = Findings(self.name, 'incremental' if incremental else 'full')
+        findings.report['unindexed_files']['action'] = self.orphan_policy if self.repair else 'report'
+        self._finish_pending_deletes(findings, started)
+        if incremental:
+            self._run_incremental(findings, since=last_run - self.grace, now=started)
+        else:
+            self._run_full(findings, now=started)
+        self.store.save_state(self.name, started, full=not incremental)
+        report = findings.report
+        report['duration_seconds'] = round(time.time() - started, 2)
+        print(f"核对完成 ({report['mode']})：遍历 {report['vectors_scanned']} 个向量、"
+              f"{report['files_scanned']} 个文件；悬空向量 {report['dangling_vectors']['count']} 个 "
+              f"(已修复 {report['dangling_vectors']['repaired']})，未入库文件 "
+              f"{report['unindexed_files']['count']} 个 (已处理 {report['unindexed_files']['handled']})，"
+              f"用时 {report['duration_seconds']}s")
+        return report
+
+    # --- 删除日志 ---
+    def _finish_pending_deletes(self, findings, now):
+        """
+        补做崩溃前未完成的文件删除：Milvus 记录已删除则删除文件，仍存在则说明删除未执行，移除登记。
+        按分区加载的集合中，未加载的冷分区里的行查询不到，因此通过 partition_tiering.scan 逐个加载分区查询；
+        有分区无法加载时保留登记，下次核对再处理，避免误删仍有向量的图片文件。
+        """
+        pending = self.store.pending_deletes(self.name, now - self.grace)
+        for i in range(0, len(pending), _CHUNK):
+            chunk = pending[i:i + _CHUNK]
+            ids = [pk for pk, _ in chunk]
+            try:
+                remaining = {row['id'] for rows in scan(self.collection, ["id"], _CHUNK,
+                                                        expr=f"id in {json.dumps(ids)}")
+                             for row in rows}
+            except Exception as e:
+                findings.error(f"查询待删除记录失败，保留 {len(ids)} 条删除登记: {e}")
+                continue
+            for pk, filename in chunk:
+                if pk in remaining:
+                    findings.report['pending_deletes']['dropped'] += 1
+                    continue
+                try:
+                    image_store.remove(filename)
+                    findings.report['pending_deletes']['completed'] += 1
+                except OSError as e:
+                    findings.error(f"删除文件 {filename} 失败: {e}")
+            self.store.end_delete(self.name, ids)
+
+    # --- 全量核对 ---
+    def _run_full(self, findings, now):
+        fd, tmp_path = tempfile.mkstemp(suffix='.sqlite3', prefix='reconcile_')
+        os.close(fd)
+        conn = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=OFF')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE vectors (id INTEGER, name TEXT, ingest_time INTEGER)')
+            conn.execute('CREATE TABLE files (name TEXT, path TEXT, mtime REAL, size INTEGER)')
+            self._load(conn, findings)
+            conn.execute('CREATE INDEX vectors_name ON vectors (name)')
+            conn.execute('CREATE INDEX files_name ON files (name)')
+
+            dangling = conn.execute(
+                'SELECT v.id, v.name, v.ingest_time FROM vectors v '
+                'WHERE NOT EXISTS (SELECT 1 FROM files f WHERE f.name = v.name) ORDER BY v.id')
+            self._handle_dangling(findings, _batches(dangling), now)
+            unindexed = conn.execute(
+                'SELECT f.name, f.path, f.mtime, f.size FROM files f '
+                'WHERE NOT EXISTS (SELECT 1 FROM vectors v WHERE v.name = f.name) ORDER BY f.path')
+            self._handle_unindexed(findings, _batches(unindexed), now)
+            for name, count in conn.execute('SELECT name, COUNT(*) FROM vectors GROUP BY name HAVING COUNT(*) > 1'):
+                findings.add('duplicate_filenames', {'image_filename': name, 'vectors': count})
+        finally:
+            conn.close()
+            os.remove(tmp_path)
+
+    def _load(self, conn, findings):
+        """并行遍历 Milvus 和图片目录，把结果写入临时库"""
+        out = queue.Queue(maxsize=32)
+        _producer(scan_vectors, out, 'vectors', self.collection)
+        _producer(scan_files, out, 'files')
+        running = 2
+        while running:
+            kind, payload = out.get()
+            if kind == 'done':
+                running -= 1
+            elif kind == 'error':
+                raise payload
+            elif kind == 'vectors':
+                conn.executemany('INSERT INTO vectors VALUES (?, ?, ?)', payload)
+                findings.report['vectors_scanned'] += len(payload)
+            else:
+                conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', payload)
+                findings.report['files_scanned'] += len(payload)
+
+    # --- 增量核对 ---
+    def _run_incremental(self, findings, since, now):
+        """since 之后入库的向量逐个检查文件是否存在，since 之后修改的文件批量检查 Milvus 中是否有记录"""
+        out = queue.Queue(maxsize=32)
+        _producer(scan_vectors, out, 'vectors', self.collection,
+                  expr=f'ingest_time >= {int(since)}', ingest_after=int(since))
+        _producer(scan_files, out, 'files', modified_after=since)
+        running = 2
+        files = []
+        while running:
+            kind, payload = out.get()
+            if kind == 'done':
+                running -= 1
+            elif kind == 'error':
+                raise payload
+            elif kind == 'vectors':
+                findings.report['vectors_scanned'] += len(payload)
+                missing = [row for row in payload if not image_store.exists(row[1])]
+                self._handle_dangling(findings, [missing], now)
+            else:
+                findings.report['files_scanned'] += len(payload)
+                files.extend(payload)
+        # 文件名在 Milvus 中的查询在遍历结束后执行，避免与遍历争用队列
+        for i in range(0, len(files), BATCH_SIZE):
+            chunk = files[i:i + BATCH_SIZE]
+            indexed = self._indexed([row[0] for row in chunk])
+            self._handle_unindexed(findings, [[row for row in chunk if row[0] not in indexed]], now)
+
+    def _indexed(self, filenames):
+        """文件名中已入库的部分：目录库已同步时查询目录库，否则查询 Milvus"""
+        if self.catalog.is_synced(self.name):
+            return self.catalog.find_existing(self.name, filenames, [])[0]
+        return _indexed_filenames(self.collection, filenames)
+
+    # --- 处理 ---
+    def _handle_dangling(self, findings, batches, now):
+        """batches 为 (id, 文件名, 入库时间) 的批次，宽限期外的悬空向量在 repair 时删除"""
+        for batch in batches:
+            to_delete = []
+            for pk, filename, ingest_time in batch:
+                recent = bool(ingest_time) and ingest_time >= now - self.grace
+                findings.add('dangling_vectors', {'id': str(pk), 'image_filename': filename,
+                                                  'ingest_time': ingest_time}, recent=recent)
+                # 删除前再次确认文件不存在 (遍历期间文件可能已被补回，例如从备份恢复)
+                if self.repair and not recent and not image_store.exists(filename):
+                    to_delete.append(pk)
+            if to_delete:
+                try:
+                    self.collection.delete(f"id in {json.dumps(to_delete)}")
+                    self.catalog.remove(self.name, to_delete)
+                    findings.report['dangling_vectors']['repaired'] += len(to_delete)
+                except Exception as e:
+                    findings.error(f"删除悬空向量失败: {e}")
+
+    def _handle_unindexed(self, findings, batches, now):
+        """batches 为 (文件名, 相对路径, 修改时间, 大小) 的批次，宽限期外的文件按 orphan_policy 处理"""
+        for batch in batches:
+            candidates = []
+            for filename, path, mtime, size in batch:
+                recent = mtime >= now - self.grace
+                findings.add('unindexed_files', {'image_filename': filename, 'path': path, 'size': size,
+                                                 'mtime': int(mtime)}, recent=recent)
+                if not recent:
+                    candidates.append((filename, path))
+            if not self.repair or self.orphan_policy == 'report' or not candidates:
+                continue
+            try:
+                # 处理前再次确认 Milvus 中没有记录 (遍历期间写缓冲可能已写入)
+                indexed = _indexed_filenames(self.collection, [filename for filename, _ in candidates])
+                candidates = [(filename, path) for filename, path in candidates if filename not in indexed]
+                if self.orphan_policy == 'quarantine':
+                    handled = self._quarantine(findings, candidates)
+                else:
+                    handled = self._index(findings, candidates)
+                findings.report['unindexed_files']['handled'] += handled
+            except Exception as e:
+                findings.error(f"处理未入库文件失败: {e}")
+
+    def _quarantine(self, findings, candidates):
+        handled = 0
+        for filename, path in candidates:
+            target = os.path.join(QUARANTINE_DIR, path)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(os.path.join(IMAGE_DIR, path), target)
+                handled += 1
+            except OSError as e:
+                findings.error(f"隔离文件 {path} 失败: {e}")
+        return handled
+
+    def _index(self, findings, candidates):
+        # 延迟导入：insert_images 导入时会连接默认集合，只有 index 方式需要
+        from insert_images import insert_image_batch
+        from embedding_models import load_model, resolve_serving
+        model = load_model(resolve_serving(self.name)[1])
+        results = insert_image_batch([os.path.join(IMAGE_DIR, path) for _, path in candidates],
+                                     [filename for filename, _ in candidates], model=model)
+        for result in results:
+            if result['status'] == 'error':
+                findings.error(f"重新入库 {result['filename']} 失败: {result['message']}")
+        return sum(1 for result in results if result['status'] == 'inserted')
+
+
+def _batches(cursor):
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+def save_report(report, path=REPORT_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def load_report(path=REPORT_PATH):
+    """读取最近一次的报告，不存在时返回 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Milvus 与图片目录的一致性核对")
+    parser.add_argument('--collection', help="集合名或别名，默认为当前服务的集合 (或 HERITAGE_SHARDS 分片)")
+    parser.add_argument('--incremental', action='store_true', help="只核对上次以来的变化")
+    parser.add_argument('--repair', action='store_true', help="删除悬空向量并按 --orphan-files 处理未入库文件")
+    parser.add_argument('--orphan-files', choices=ORPHAN_POLICIES, default='report',
+                        help="未入库文件的处理方式 (index 只适用于默认集合)")
+    parser.add_argument('--grace', type=int, default=GRACE_SECONDS, help="宽限期 (秒)")
+    parser.add_argument('--interval', type=float, help="按该间隔 (秒) 循环运行，默认只运行一次")
+    parser.add_argument('--full-every', type=float, default=24, help="增量模式下全量核对的最长间隔 (小时)")
+    parser.add_argument('--output', default=REPORT_PATH)
+    args = parser.parse_args()
+
+    target = (get_sharded_collection() if not args.collection else None) \
+        or get_collection(args.collection or collection_name)
+    if not target.ready:
+        print(f"集合 {target.name} 不可用，请检查 Milvus 服务状态")
+        sys.exit(1)
+    reconciler = Reconciler(target, catalog_name(target), repair=args.repair,
+                            orphan_policy=args.orphan_files, grace=args.grace)
+    while True:
+        try:
+            result = reconciler.run(incremental=args.incremental, full_every=args.full_every * 3600)
+            save_report(result, args.output)
+            print(f"报告已写入 {args.output}")
+        except Exception as e:
+            print(f"核对失败: {e}")
+            if args.interval is None:
+                sys.exit(1)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
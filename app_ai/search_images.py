@@ -1,86 +1,149 @@
 # 导入所需的库
-from pymilvus import connections, Collection  # Milvus 客户端库，用于连接和操作集合
+from milvus_client import get_collection, collection_name  # 共享的 Milvus 连接池和集合配置
 import numpy as np  # 用于数值计算 (虽然在此脚本中未直接使用，但通常与向量操作相关)
 from resnet import extract_features  # 从自定义的 resnet 模块导入特征提取函数
-
-# --- Milvus 连接配置 ---
-# 使用别名 "default" 连接到本地运行的 Milvus 实例
-connections.connect(
-    alias="default",  # 连接别名
-    host='192.168.1.100',  # Milvus 服务器地址
-    port='19530'  # Milvus 服务器端口
-)
-
-# --- Milvus 集合配置 ---
-# 定义要操作的集合名称 (应与 insert_images.py 中使用的名称一致)
-collection_name = "intangible_cultural_heritage_images"
+from metrics import stage_timer, STAGE_MILVUS_SEARCH  # Milvus 搜索耗时指标
+from sharding import get_sharded_collection  # 分片集合 (HERITAGE_SHARDS)
+from image_metadata import build_filter_expr, partition_name, METADATA_FIELDS  # 标量过滤和分区裁剪
+from embedding_models import load_model, resolve_serving  # 按集合的模型版本选择特征提取模型
+from partition_tiering import get_tiering  # 分区冷热分层 (HERITAGE_PARTITION_TIERING)
 
 # --- 加载 Milvus 集合 ---
-# 尝试获取并加载指定名称的集合
-try:
-    # 获取集合对象
-    collection = Collection(name=collection_name)
-    # 将集合加载到内存中以进行搜索操作
-    collection.load()
-    # 打印加载成功的提示信息
+# 通过共享连接池获取集合 (集合名称应与 insert_images.py 中使用的名称一致)
+# 集合暂时不可用时不退出，由连接池的健康检查在 Milvus 恢复后自动重新加载
+# 配置了 HERITAGE_SHARDS 时使用分片集合，搜索并行查询所有分片后合并结果
+collection = get_sharded_collection() or get_collection(collection_name)
+if collection.ready:
     print(f"集合 {collection_name} 加载成功")
-# 捕获加载过程中可能发生的任何异常
-except Exception as e:
-    # 如果加载失败，打印错误信息和用户提示
-    print(f"加载集合 {collection_name} 时出错: {e}")
+else:
+    print(f"集合 {collection_name} 暂不可用，将在 Milvus 恢复后自动重新加载")
     print("请确保集合存在、已创建索引且 Milvus 服务器正在运行。")
     print("您可能需要先运行 insert_images.py 脚本来创建集合并插入数据。")
-    # 退出脚本，因为无法继续执行搜索
-    exit()
+
+
+# IVF 索引默认搜索的聚类数量
+DEFAULT_NPROBE = 10
 
 
 # --- 相似度搜索函数 ---
-def search_similar_vectors(query_vector, top_k=10):
+def search_similar_vectors(query_vector, top_k=10, expr=None, filters=None, target_collection=None,
+                           nprobe=DEFAULT_NPROBE, timeout=None, deadline=None, tier_info=None):
     """
     在 Milvus 集合中搜索与给定查询向量最相似的 top_k 个向量。
 
     参数:
         query_vector (numpy.ndarray): 用于查询的特征向量 (应与集合中存储的向量维度相同)。
         top_k (int): 希望返回的最相似结果的数量，默认为 10。
+        expr (str): 额外的 Milvus 标量过滤表达式，例如 'frame_ts_ms >= 60000'。
+        filters (dict): 结构化过滤条件，参数见 image_metadata.build_filter_expr。
+                        指定 category 时只搜索该类别对应的分区。
+        target_collection (PooledCollection): 要搜索的集合，默认为本模块的集合。
+                        查询向量必须由与该集合匹配的模型版本生成。
+        nprobe (int): IVF 索引搜索的聚类数量，过载时可调低以换取速度 (见 admission.py)。
+        timeout (float): Milvus 搜索超时 (秒)，默认使用连接池的超时设置。
+        deadline (admission.Deadline): 请求截止时间，开启冷热分层时等待冷分区加载不超过剩余时间。
+        tier_info (dict): 开启冷热分层时，未加载而被跳过的分区写入 tier_info['skipped_partitions']。
 
     返回:
         list: 一个包含相似结果字典的列表。每个字典包含 'id' (Milvus 中的实体 ID)
               和 'distance' (与查询向量的 L2 距离)。列表按距离升序排列。
     """
+    return search_similar_vectors_batch([query_vector], top_k=top_k, expr=expr, filters=filters,
+                                        target_collection=target_collection, nprobe=nprobe, timeout=timeout,
+                                        deadline=deadline, tier_info=tier_info)[0]
+
+
+def search_similar_vectors_batch(query_vectors, top_k=10, expr=None, filters=None, target_collection=None,
+                                 nprobe=DEFAULT_NPROBE, timeout=None, deadline=None, tier_info=None):
+    """
+    在一次 Milvus 搜索请求中同时搜索多个查询向量 (例如视频片段的各帧)，参数同 search_similar_vectors。
+
+    返回:
+        list: 与 query_vectors 一一对应的结果列表，每项的格式同 search_similar_vectors 的返回值。
+    """
     # 定义搜索参数
     search_params = {
         "metric_type": "L2",  # 使用 L2 距离作为相似度度量 (应与创建索引时一致)
         "params": {
-            "nprobe": 10
+            "nprobe": nprobe
         }  # 搜索参数，nprobe 控制搜索时查找的聚类数量，影响召回率和性能
         # nprobe 的值通常需要根据数据集大小和性能要求进行调整
     }
-    # 执行搜索操作
-    results = collection.search(
-        data=[query_vector],  # 查询向量列表 (这里只有一个查询向量)
-        anns_field="embedding",  # 指定在哪一个向量字段上进行搜索
-        param=search_params,  # 搜索参数
-        limit=top_k,  # 返回结果的数量上限
-        # 指定需要从搜索结果中额外获取的字段 (除了 id 和 distance)
-        # 我们需要获取存储在 Milvus 中的 image_filename
-        output_fields=["id", "image_filename"]  # 请求返回 id 和 image_filename
-    )
-
-    # --- 格式化搜索结果 ---
+    target = target_collection if target_collection is not None else collection
+    # --- 构造过滤表达式并裁剪分区 ---
+    output_fields = ["id", "image_filename"]
+    partition_names = None
+    clauses = [c for c in (expr, build_filter_expr(**(filters or {}))) if c]
+    tiering = None
+    if target.has_metadata:
+        output_fields += ["image_hash"] + METADATA_FIELDS
+        category = (filters or {}).get("category")
+        tiering = get_tiering(target)
+        if tiering is not None:
+            # 冷热分层：按类别和入库时间裁剪出候选分区，搜索时再确定其中已加载的分区
+            partition_names = tiering.candidates(category, (filters or {}).get("ingest_after"),
+                                                 (filters or {}).get("ingest_before"))
+            if not partition_names:
+                return [[] for _ in query_vectors]
+        elif category:
+            # 每个类别写入独立的分区，只在对应分区中执行 ANN 搜索
+            partition = partition_name(category)
+            if not target.partition_exists(partition):
+                return [[] for _ in query_vectors]
+            partition_names = [partition]
+
+    if tiering is None:
+        results = _search(target, query_vectors, search_params, top_k, clauses, partition_names,
+                          output_fields, timeout)
+    else:
+        with tiering.use(partition_names, deadline) as (searchable, skipped):
+            if tier_info is not None:
+                tier_info['skipped_partitions'] = skipped
+            if deadline is not None:
+                # 等待冷分区加载后，搜索超时不超过剩余时间
+                timeout = max(deadline.remaining, 0.1)
+            results = _search(target, query_vectors, search_params, top_k, clauses, searchable,
+                              output_fields, timeout) if searchable else []
+    return [_format_results(results[i] if i < len(results) else None, output_fields)
+            for i in range(len(query_vectors))]
+
+
+def _search(target, query_vectors, search_params, top_k, clauses, partition_names, output_fields, timeout):
+    """执行搜索操作"""
+    with stage_timer(STAGE_MILVUS_SEARCH):
+        return target.search(
+            data=list(query_vectors),  # 查询向量列表 (单张图片搜索时只有一个查询向量)
+            anns_field="embedding",  # 指定在哪一个向量字段上进行搜索
+            param=search_params,  # 搜索参数
+            limit=top_k,  # 返回结果的数量上限
+            expr=' and '.join(f'({c})' for c in clauses) or None,  # 标量过滤条件
+            partition_names=partition_names,  # 只搜索过滤条件对应的分区
+            # 指定需要从搜索结果中额外获取的字段 (除了 id 和 distance)
+            # 我们需要获取存储在 Milvus 中的 image_filename 以及标量元数据
+            output_fields=output_fields,
+            **({'timeout': timeout} if timeout is not None else {})
+        )
+
+
+def _format_results(hits, output_fields):
+    """把 Milvus 返回的一个查询向量的命中结果整理为字典列表"""
     formatted_results = []  # 初始化用于存储格式化结果的列表
-    # Milvus 的 search 方法返回一个列表，每个元素对应一个查询向量的结果
-    # 因为我们只有一个查询向量，所以只关心 results[0]
-    if results and results[0]:  # 检查 results 是否非空且第一个查询有命中结果 (hits)
-        # 遍历第一个查询的所有命中结果 (hits)
-        for hit in results[0]:
+    # Milvus 的 search 方法返回一个列表，每个元素对应一个查询向量的命中结果 (hits)
+    if hits:  # 检查该查询是否有命中结果
+        # 遍历该查询的所有命中结果
+        for hit in hits:
             # 将每个命中结果的 id, distance 和 filename 提取出来，存入字典
             # hit.entity.get('field_name') 用于获取 output_fields 中指定的字段值
             filename = hit.entity.get('image_filename', '未知文件名')  # 提供默认值以防万一
-            formatted_results.append({
+            result = {
                 'id': hit.id,  # 命中向量在 Milvus 中的 ID
                 'distance': hit.distance,  # 命中向量与查询向量的距离
                 'filename': filename  # 获取到的图像文件名
-            })
+            }
+            # 附带标量元数据 (类别、来源视频、帧时间戳、入库时间)
+            for field in output_fields[2:]:
+                result[field] = hit.entity.get(field)
+            formatted_results.append(result)
     # 返回格式化后的结果列表
     return formatted_results
 
@@ -93,17 +156,23 @@ if __name__ == "__main__":
     # 设置希望返回的最相似图片的数量
     top_k = 5
 
+    if not collection.ready:
+        print(f"错误：集合 {collection_name} 不可用，无法执行搜索")
+        exit()
+
     # --- 执行查询与结果展示 ---
     try:
         # 打印开始提取特征的提示
         print(f"正在提取查询图片 {image_path} 的特征...")
-        # 调用 resnet 模块的 extract_features 函数提取查询图片的特征向量
-        query_vector = extract_features(image_path)
+        # 使用与当前集合版本匹配的模型提取查询图片的特征向量
+        target_name, model_version = resolve_serving()
+        query_vector = load_model(model_version).extract_features(image_path)
 
         # 打印开始搜索的提示
-        print(f"正在搜索前 {top_k} 个相似图像...")
+        print(f"正在搜索前 {top_k} 个相似图像 (集合 {target_name}，模型 {model_version})...")
         # 调用 search_similar_vectors 函数执行相似度搜索
-        similar_results = search_similar_vectors(query_vector, top_k=top_k)
+        similar_results = search_similar_vectors(query_vector, top_k=top_k,
+                                                 target_collection=get_collection(target_name))
 
         # 检查是否找到了相似结果
         if similar_results:
@@ -0,0 +1,267 @@
+# 分片集合：把图片按哈希值分布到多个集合 (可位于不同的 Milvus)，搜索时并行查询所有分片后合并
+#
+# 通过环境变量 HERITAGE_SHARDS 配置分片，逗号分隔，每项为 "集合名" 或 "host:port/集合名"，例如
+#   HERITAGE_SHARDS="heritage_s0,heritage_s1"
+#   HERITAGE_SHARDS="10.0.0.1:19530/heritage_s0,10.0.0.2:19530/heritage_s1"
+# 未配置时使用单个集合。
+#
+# 写入按图片哈希值用最高随机权重 (rendezvous) 哈希选择分片，同一张图片总是落在同一分片，
+# 哈希查重只需查询一个分片；分片数量变化时只有约 1/N 的数据需要迁移 (python sharding.py rebalance)。
+import os
+import sys
+import heapq
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from milvus_client import get_collection, insert_rows, MILVUS_ENDPOINTS
+from image_metadata import METADATA_FIELDS
+from image_catalog import get_catalog
+
+# 分片配置
+SHARDS = [s.strip() for s in os.environ.get('HERITAGE_SHARDS', '').split(',') if s.strip()]
+
+
+def parse_shard(spec):
+    """解析分片配置项，返回 (Milvus 地址列表, 集合名)"""
+    endpoint, _, name = spec.rpartition('/')
+    return ([endpoint] if endpoint else list(MILVUS_ENDPOINTS)), name
+
+
+def _shard_score(shard_name, image_hash):
+    return hashlib.md5(f'{shard_name}:{image_hash}'.encode('utf-8')).digest()
+
+
+def shard_for(image_hash, shard_names):
+    """用 rendezvous 哈希为图片选择分片，返回分片序号"""
+    return max(range(len(shard_names)), key=lambda i: _shard_score(shard_names[i], image_hash))
+
+
+class _ChainedIterator:
+    """依次遍历各分片的 query_iterator"""
+
+    def __init__(self, shards, kwargs):
+        self._pending = list(shards)
+        self._kwargs = kwargs
+        self._current = None
+
+    def next(self):
+        while True:
+            if self._current is None:
+                if not self._pending:
+                    return []
+                self._current = self._pending.pop(0).query_iterator(**self._kwargs)
+            rows = self._current.next()
+            if rows:
+                return rows
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._pending = []
+
+
+class ShardedCollection:
+    """
+    与 PooledCollection 接口相同的分片集合。
+
+    search 并行查询所有分片，用堆合并各分片按距离排好序的结果；
+    query / delete / flush 广播到所有分片；insert_rows 按哈希值路由 (见 milvus_client.insert_rows)。
+    """
+
+    def __init__(self, specs, create=False, dim=512):
+        """
+        参数:
+            specs (list[str]): 分片配置项，格式见模块说明。
+            create (bool): 分片集合不存在时是否自动创建。
+            dim (int): 自动创建时使用的向量维度。
+        """
+        self.specs = list(specs)
+        self.shards = []
+        self.shard_names = []
+        for spec in self.specs:
+            endpoints, name = parse_shard(spec)
+            # 分片集合不做冷热分层，各分片整体加载
+            self.shards.append(get_collection(name, create=create, dim=dim, endpoints=endpoints, partial=False))
+            self.shard_names.append(spec)
+        self.name = ','.join(self.shard_names)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard')
+
+    # --- 路由 ---
+    def shard_index(self, image_hash):
+        return shard_for(image_hash, self.shard_names)
+
+    def route(self, hashes):
+        """按哈希值把行分组到分片，返回 {分片: [行序号]}"""
+        groups = {}
+        for i, image_hash in enumerate(hashes):
+            groups.setdefault(self.shards[self.shard_index(image_hash)], []).append(i)
+        return groups
+
+    def _map(self, func, shards=None):
+        """在所有 (或指定的) 分片上并行执行 func(shard)，按分片顺序返回结果"""
+        shards = self.shards if shards is None else shards
+        return list(self._executor.map(func, shards))
+
+    # --- 与 PooledCollection 相同的接口 ---
+    @property
+    def ready(self):
+        return all(shard.ready for shard in self.shards)
+
+    @property
+    def num_entities(self):
+        return sum(self._map(lambda shard: shard.num_entities))
+
+    @property
+    def schema(self):
+        return self.shards[0].schema
+
+    @property
+    def field_names(self):
+        return self.shards[0].field_names
+
+    @property
+    def has_metadata(self):
+        return all(shard.has_metadata for shard in self.shards)
+
+    def partition_exists(self, name):
+        return any(self._map(lambda shard: shard.partition_exists(name)))
+
+    def ensure_partition(self, name):
+        self._map(lambda shard: shard.ensure_partition(name))
+
+    def search(self, data, anns_field, param, limit, partition_names=None, **kwargs):
+        """
+        并行搜索所有分片，每个分片返回 limit 个结果，再按距离合并出全局的前 limit 个。
+        指定 partition_names 时跳过不包含这些分区的分片。
+        """
+        def search_shard(shard):
+            partitions = partition_names
+            if partitions is not None:
+                partitions = [p for p in partitions if shard.partition_exists(p)]
+                if not partitions:
+                    return [[] for _ in data]
+            return shard.search(data=data, anns_field=anns_field, param=param, limit=limit,
+                                partition_names=partitions, **kwargs)
+
+        per_shard = self._map(search_shard)
+        merged = []
+        for q in range(len(data)):
+            # 各分片的结果已按距离升序排列，heapq.merge 只需 O(limit * log N) 即可取出前 limit 个
+            streams = [list(results[q]) for results in per_shard if len(results) > q]
+            merged.append(list(heapq.merge(*streams, key=lambda hit: hit.distance))[:limit])
+        return merged
+
+    def query(self, expr='', output_fields=None, limit=None, **kwargs):
+        """广播查询到所有分片并拼接结果；指定 limit 时截断到 limit 行"""
+        if limit is not None:
+            kwargs['limit'] = limit
+        results = self._map(lambda shard: shard.query(expr=expr, output_fields=output_fields, **kwargs))
+        rows = [row for shard_rows in results for row in shard_rows]
+        return rows[:limit] if limit is not None else rows
+
+    def query_by_hash(self, image_hashes, output_fields=None, **kwargs):
+        """只在哈希值所属的分片上查询，用于查重"""
+        groups = {}
+        for image_hash in set(image_hashes):
+            groups.setdefault(self.shard_index(image_hash), []).append(image_hash)
+
+        def query_shard(item):
+            index, hashes = item
+            expr = 'image_hash in [' + ', '.join(f'"{h}"' for h in hashes) + ']'
+            return self.shards[index].query(expr=expr, output_fields=output_fields, **kwargs)
+
+        return [row for rows in self._executor.map(query_shard, groups.items()) for row in rows]
+
+    def query_iterator(self, **kwargs):
+        return _ChainedIterator(self.shards, kwargs)
+
+    def delete(self, expr, **kwargs):
+        return self._map(lambda shard: shard.delete(expr, **kwargs))
+
+    def flush(self, **kwargs):
+        self._map(lambda shard: shard.flush(**kwargs))
+
+    def load(self, **kwargs):
+        self._map(lambda shard: shard.load(**kwargs))
+
+
+def get_sharded_collection(specs=None, create=False, dim=512):
+    """按配置返回分片集合；未配置分片时返回 None"""
+    specs = SHARDS if specs is None else specs
+    return ShardedCollection(specs, create=create, dim=dim) if specs else None
+
+
+def rebalance(sharded, batch_size=1000):
+    """
+    把不在所属分片上的图片迁移到正确的分片 (分片数量变化后执行)。
+    先写入目标分片再从原分片删除，目标分片中已存在相同哈希值时只删除，可中断后重复执行。
+
+    返回:
+        int: 迁移的图片数量。
+    """
+    moved = 0
+    output_fields = ["id", "embedding", "image_filename", "image_hash"]
+    if sharded.has_metadata:
+        output_fields += METADATA_FIELDS
+    for index, shard in enumerate(sharded.shards):
+        iterator = shard.query_iterator(batch_size=batch_size, output_fields=output_fields)
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                misplaced = {}
+                for row in rows:
+                    target = sharded.shard_index(row['image_hash'])
+                    if target != index:
+                        misplaced.setdefault(target, []).append(row)
+                for target, items in misplaced.items():
+                    target_shard = sharded.shards[target]
+                    hashes = [row['image_hash'] for row in items]
+                    existing = {row['image_hash'] for row in target_shard.query(
+                        expr='image_hash in [' + ', '.join(f'"{h}"' for h in hashes) + ']',
+                        output_fields=["image_hash"], consistency_level="Strong")}
+                    todo = [row for row in items if row['image_hash'] not in existing]
+                    if todo:
+                        metadata = [{field: row[field] for field in METADATA_FIELDS} for row in todo] \
+                            if sharded.has_metadata else None
+                        filenames = [row['image_filename'] for row in todo]
+                        hashes = [row['image_hash'] for row in todo]
+                        primary_keys = insert_rows(target_shard, [row['embedding'] for row in todo],
+                                                   filenames, hashes, metadata)
+                        target_shard.flush()
+                        get_catalog().record(sharded.name, primary_keys, filenames, hashes, metadata)
+                    shard.delete(f"id in {[row['id'] for row in items]}")
+                    # 迁移后的图片在目标分片中有新的主键
+                    get_catalog().remove(sharded.name, [row['id'] for row in items])
+                    moved += len(items)
+                    print(f"分片 {sharded.shard_names[index]} -> {sharded.shard_names[target]}：迁移 {len(items)} 张")
+        finally:
+            iterator.close()
+    print(f"重新分片完成，共迁移 {moved} 张图片")
+    return moved
+
+
+# --- 主程序入口 ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="分片集合管理")
+    parser.add_argument('command', choices=['status', 'rebalance'])
+    parser.add_argument('--shards', help="逗号分隔的分片配置，默认读取 HERITAGE_SHARDS")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    specs = [s.strip() for s in args.shards.split(',') if s.strip()] if args.shards else SHARDS
+    if not specs:
+        print("未配置分片 (HERITAGE_SHARDS 或 --shards)")
+        sys.exit(1)
+    sharded = ShardedCollection(specs, create=True)
+    if not sharded.ready:
+        print("部分分片不可用，请检查 Milvus 服务状态")
+        sys.exit(1)
+    if args.command == 'rebalance':
+        rebalance(sharded, args.batch_size)
+    for name, shard in zip(sharded.shard_names, sharded.shards):
+        print(f"分片 {name}: {shard.num_entities} 条")
@@ -0,0 +1,225 @@
+// 端侧特征搜索：下载服务端导出的量化模型，在本地提取特征后只提交约 2 KB 的特征向量。
+// 模型的推理由各端的运行时实现 (App 端 PyTorch Mobile 插件、H5 端 onnxruntime-web)，
+// 这里只负责清单、模型缓存和 /api/search_vector 的调用；版本不兼容 (409) 时清除缓存，下次重新下载。
+// searchByVectorStream 使用服务端的流式响应 (NDJSON)，先回调快速搜索的初步结果，再回调最终结果。
+
+const API_BASE: string = import.meta.env.VITE_API_BASE || "";
+const STORAGE_KEY = "heritage_model_manifest";
+
+export interface ModelArtifact {
+  file: string;
+  format: "torchscript" | "onnx";
+  precision: "int8" | "fp32";
+  size: number;
+  sha256: string;
+  max_drift: number | null;
+  accepted: boolean;
+  url: string;
+}
+
+export interface ModelManifest {
+  model_version: string;
+  embedding_dim: number;
+  version_hash: string;
+  preprocess: {
+    resize: number;
+    crop: number;
+    layout: string;
+    color: string;
+    scale: number;
+    mean: number[];
+    std: number[];
+  };
+  artifacts: ModelArtifact[];
+}
+
+export interface LocalModel {
+  manifest: ModelManifest;
+  artifact: ModelArtifact;
+  path: string;
+}
+
+export interface SearchResult {
+  id: string;
+  filename: string;
+  distance: number;
+  image_url: string;
+  [key: string]: unknown;
+}
+
+export interface SearchStage {
+  stage: "coarse" | "fast" | "final";
+  final: boolean;
+  results: SearchResult[];
+}
+
+export class IncompatibleModelError extends Error {}
+
+function request<T>(options: UniApp.RequestOptions): Promise<{ statusCode: number; data: T }> {
+  return new Promise((resolve, reject) => {
+    uni.request({
+      ...options,
+      success: (res) => resolve({ statusCode: res.statusCode, data: res.data as T }),
+      fail: reject,
+    });
+  });
+}
+
+/** 获取服务端当前模型的清单 */
+export async function fetchManifest(): Promise<ModelManifest | null> {
+  const res = await request<{ success: boolean; data: ModelManifest }>({
+    url: `${API_BASE}/api/model/manifest`,
+    method: "GET",
+  });
+  return res.statusCode === 200 && res.data.success ? res.data.data : null;
+}
+
+/**
+ * 确保本地有与服务端版本一致的模型文件，返回模型信息；服务端未导出模型时返回 null，应回退到上传图片搜索。
+ * format 为当前端运行时支持的模型格式。
+ */
+export async function ensureModel(format: ModelArtifact["format"]): Promise<LocalModel | null> {
+  const cached = uni.getStorageSync(STORAGE_KEY) as LocalModel | "";
+  const manifest = await fetchManifest();
+  if (!manifest) {
+    return null;
+  }
+  if (cached && cached.manifest.version_hash === manifest.version_hash) {
+    return cached;
+  }
+  // 优先选择服务端接受的量化模型，体积约为 float32 模型的 1/4
+  const candidates = manifest.artifacts.filter((a) => a.accepted && a.format === format);
+  const artifact = candidates.find((a) => a.precision === "int8") || candidates[0];
+  if (!artifact) {
+    return null;
+  }
+  const path = await new Promise<string>((resolve, reject) => {
+    uni.downloadFile({
+      url: artifact.url,
+      success: (res) => {
+        if (res.statusCode !== 200) {
+          reject(new Error(`模型下载失败: ${res.statusCode}`));
+          return;
+        }
+        uni.saveFile({
+          tempFilePath: res.tempFilePath,
+          success: (saved) => resolve(saved.savedFilePath),
+          fail: reject,
+        });
+      },
+      fail: reject,
+    });
+  });
+  const model: LocalModel = { manifest, artifact, path };
+  uni.setStorageSync(STORAGE_KEY, model);
+  return model;
+}
+
+/** 把特征向量编码为 base64 的 float32 小端字节串 */
+export function encodeEmbedding(embedding: Float32Array): string {
+  const bytes = new Uint8Array(embedding.length * 4);
+  const view = new DataView(bytes.buffer);
+  embedding.forEach((value, i) => view.setFloat32(i * 4, value, true));
+  return uni.arrayBufferToBase64(bytes.buffer);
+}
+
+/**
+ * 用本地提取的特征向量搜索相似图片。
+ * 模型与服务端不兼容时清除缓存的模型并抛出 IncompatibleModelError，调用方应重新 ensureModel。
+ */
+export async function searchByVector(
+  model: LocalModel,
+  embedding: Float32Array,
+  topK = 5,
+  filters: Record<string, string | number> = {}
+): Promise<SearchResult[]> {
+  const res = await request<{ success: boolean; message?: string; results?: SearchResult[] }>({
+    url: `${API_BASE}/api/search_vector`,
+    method: "POST",
+    header: { "Content-Type": "application/json" },
+    data: {
+      embedding: encodeEmbedding(embedding),
+      model_version: model.manifest.model_version,
+      model_hash: model.artifact.sha256,
+      top_k: topK,
+      ...filters,
+    },
+  });
+  if (res.statusCode === 409) {
+    uni.removeStorageSync(STORAGE_KEY);
+    throw new IncompatibleModelError(res.data.message || "客户端模型不兼容");
+  }
+  if (res.statusCode !== 200 || !res.data.success) {
+    throw new Error(res.data.message || `搜索失败: ${res.statusCode}`);
+  }
+  return res.data.results || [];
+}
+
+/**
+ * 流式搜索：每完成一个搜索阶段调用一次 onStage (最后一次的 final 为 true)，返回最终结果。
+ * H5 端通过 fetch 逐行读取 NDJSON 响应；其他端的 uni.request 不支持读取分块响应，退回一次性搜索。
+ */
+export async function searchByVectorStream(
+  model: LocalModel,
+  embedding: Float32Array,
+  onStage: (stage: SearchStage) => void,
+  topK = 5,
+  filters: Record<string, string | number> = {}
+): Promise<SearchResult[]> {
+  // #ifdef H5
+  const res = await fetch(`${API_BASE}/api/search_vector`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json", Accept: "application/x-ndjson" },
+    body: JSON.stringify({
+      embedding: encodeEmbedding(embedding),
+      model_version: model.manifest.model_version,
+      model_hash: model.artifact.sha256,
+      top_k: topK,
+      stream: 1,
+      ...filters,
+    }),
+  });
+  if (res.status === 409) {
+    uni.removeStorageSync(STORAGE_KEY);
+    const data = await res.json().catch(() => ({}));
+    throw new IncompatibleModelError(data.message || "客户端模型不兼容");
+  }
+  if (!res.ok || !res.body) {
+    const data = await res.json().catch(() => ({}));
+    throw new Error(data.message || `搜索失败: ${res.status}`);
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let latest: SearchResult[] = [];
+  for (;;) {
+    const { value, done } = await reader.read();
+    buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = lines.pop() || "";
+    for (const line of lines) {
+      if (!line.trim()) {
+        continue;
+      }
+      const chunk = JSON.parse(line);
+      if (!chunk.success) {
+        throw new Error(chunk.message || "搜索失败");
+      }
+      latest = chunk.results || [];
+      onStage({ stage: chunk.stage, final: chunk.final, results: latest });
+      if (chunk.final) {
+        reader.cancel();
+        return latest;
+      }
+    }
+    if (done) {
+      return latest;
+    }
+  }
+  // #endif
+  // #ifndef H5
+  const results = await searchByVector(model, embedding, topK, filters);
+  onStage({ stage: "final", final: true, results });
+  return results;
+  // #endif
+}